@@ -1,5 +1,6 @@
 from abc import abstractmethod
 import io
+import math
 import time
 
 import gevent
@@ -21,6 +22,11 @@ class CamFeeder(object):
     STATS_PUSH_WAIT = 1
     SLEEP_WHEN_INACTIVE = 0.01
 
+    # Seconds between reads of the demand that the servers publish.
+    DEMAND_CHECK_INTERVAL = 2
+    # Demand entries older than this (in seconds) belong to servers that went away, and are ignored.
+    DEMAND_MAX_AGE = 30
+
     ########################################################
     # PUBLIC API
     ########################################################
@@ -39,6 +45,11 @@ class CamFeeder(object):
         self._active = None  # Whether the camera is active or not (being used, according to redis)
         self._active_since = None  # Timestamp when we last became active
 
+        # Highest FPS and width requested by the viewers, according to the servers. 0 means no limit.
+        self._demand_fps = 0
+        self._demand_width = 0
+        self._demand_checked_at = 0
+
     def get_current_fps(self) -> float:
         """
         Retrieves the current FPS for this active cycle, measured as the number
@@ -52,6 +63,16 @@ class CamFeeder(object):
             return 0
         return self._frames_this_cycle / elapsed
 
+    def get_target_fps(self) -> float:
+        """
+        Retrieves the FPS that the feeder should produce: the highest FPS that the viewers requested, but no more than
+        the max_fps of the camera.
+        :return:
+        """
+        if self._demand_fps <= 0:
+            return self._max_fps
+        return min(self._max_fps, self._demand_fps)
+
     def start(self):
         """
         Starts running the greenlet.
@@ -131,6 +152,36 @@ class CamFeeder(object):
         active = self._rdb.get("{}:cams:{}:active".format(self._redis_prefix, self._cam_name))
         self._active = active is not None
 
+        if self._active and time.time() - self._demand_checked_at >= CamFeeder.DEMAND_CHECK_INTERVAL:
+            self._check_demand()
+
+    def _check_demand(self) -> None:
+        """
+        Reads the demand (highest FPS and width requested by the viewers) that every server publishes.
+        :return:
+        """
+        self._demand_checked_at = time.time()
+        entries = self._rdb.hgetall("{}:cams:{}:demand".format(self._redis_prefix, self._cam_name))
+
+        demand_fps = None
+        demand_width = None
+        for value in entries.values():
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            try:
+                # Servers publish integers, but fractional rates are tolerated (and rounded up).
+                fps, width, ts = [int(math.ceil(float(v))) for v in value.split(',')]
+            except ValueError:
+                continue
+            if self._demand_checked_at - ts > CamFeeder.DEMAND_MAX_AGE:
+                continue
+            demand_fps = self._merge_limit(demand_fps, fps)
+            demand_width = self._merge_limit(demand_width, width)
+
+        # Without any (valid) demand, the camera is served at full rate.
+        self._demand_fps = demand_fps or 0
+        self._demand_width = demand_width or 0
+
     def _notify_frame_put(self) -> None:
         """
         Should be called just after a new frame is put into redis so that internal FPS calculations, etc,
@@ -139,6 +190,24 @@ class CamFeeder(object):
         """
         self._frames_this_cycle += 1
 
+    @staticmethod
+    def _merge_limit(a, b):
+        """
+        Combines two limits into the one that satisfies both. 0 means no limit.
+
+        >>> CamFeeder._merge_limit(None, 5)
+        5
+        >>> CamFeeder._merge_limit(5, 10)
+        10
+        >>> CamFeeder._merge_limit(5, 0)
+        0
+        """
+        if a is None:
+            return b
+        if a == 0 or b == 0:
+            return 0
+        return max(a, b)
+
     @staticmethod
     def _rotated(data: bytes, rotation: float) -> bytes:
         """
@@ -167,8 +236,17 @@ class CamFeeder(object):
         :return:
         """
 
+        cam_key = "{}:cams:{}".format(self._redis_prefix, self._cam_name)
+
+        # The frame and its sequence number are set atomically, so that the server can tell whether the frame changed
+        # without transferring it.
+        pipe = self._rdb.pipeline()
+
         # Set a relatively early expire to ensure that wrong images do not stay for long
-        self._rdb.setex("{}:cams:{}:lastframe".format(self._redis_prefix, self._cam_name), CamFeeder.IMAGE_EXPIRE_TIME, frame)
+        pipe.setex(cam_key + ":lastframe", CamFeeder.IMAGE_EXPIRE_TIME, frame)
+        pipe.incr(cam_key + ":frameseq")
+        pipe.expire(cam_key + ":frameseq", CamFeeder.IMAGE_EXPIRE_TIME)
+        pipe.execute()
 
         self._notify_frame_put()
 
@@ -0,0 +1,408 @@
+"""
+This module re-muxes the Annex-B H.264 stream that the H264Feeder publishes into fragmented MP4, so that browsers can
+play it through Media Source Extensions (with hardware-accelerated decoding) instead of decoding H.264 in JavaScript.
+
+The packaging is done once per camera:
+ - The init segment (ftyp + moov) is stored in redis, in the <prefix>:cams:<cam>:fmp4:init key.
+ - Every access unit (picture) becomes a moof + mdat fragment, published through the <cam>/fmp4 channel. Each message
+ is prefixed by a single byte which is FRAGMENT_KEYFRAME or FRAGMENT_DELTA, so that listeners can start at a keyframe.
+"""
+
+import struct
+import time
+import traceback
+
+import gevent
+import redis
+
+# NAL unit types that we care about.
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+SHORT_START_CODE = b'\x00\x00\x01'
+
+FRAGMENT_DELTA = b'\x00'
+FRAGMENT_KEYFRAME = b'\x01'
+
+TIMESCALE = 90000
+TRACK_ID = 1
+
+# trun sample flags.
+SAMPLE_FLAGS_KEYFRAME = 0x02000000  # Does not depend on other samples.
+SAMPLE_FLAGS_DELTA = 0x01010000  # Depends on other samples, and is not a sync sample.
+
+UNITY_MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def box(box_type: bytes, *payloads: bytes) -> bytes:
+    """
+    Builds an ISO BMFF box.
+    :param box_type: Four-character type.
+    :param payloads: Contents of the box.
+    :return:
+    """
+    payload = b''.join(payloads)
+    return struct.pack('>I', 8 + len(payload)) + box_type + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, *payloads: bytes) -> bytes:
+    """
+    Builds an ISO BMFF full box (a box with version and flags).
+    """
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+class BitReader(object):
+    """
+    Reads the exp-golomb coded fields of an SPS.
+    """
+
+    def __init__(self, data: bytes):
+        # Remove the emulation prevention bytes (00 00 03 -> 00 00).
+        self._data = data.replace(b'\x00\x00\x03', b'\x00\x00')
+        self._pos = 0
+
+    def u(self, bits: int) -> int:
+        value = 0
+        for _ in range(bits):
+            byte = self._data[self._pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self._pos & 7))) & 1)
+            self._pos += 1
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def parse_sps_dimensions(sps: bytes) -> (int, int):
+    """
+    Parses the picture dimensions from an SPS.
+    :param sps: SPS NAL unit, without start code.
+    :return: (width, height)
+    """
+    r = BitReader(sps[1:])
+    profile_idc = r.u(8)
+    r.u(16)  # Constraint flags and level.
+    r.ue()  # seq_parameter_set_id
+
+    chroma_format_idc = 1
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = r.ue()
+        if chroma_format_idc == 3:
+            r.u(1)  # separate_colour_plane_flag
+        r.ue()  # bit_depth_luma_minus8
+        r.ue()  # bit_depth_chroma_minus8
+        r.u(1)  # qpprime_y_zero_transform_bypass_flag
+        if r.u(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if r.u(1):
+                    last_scale = next_scale = 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next_scale != 0:
+                            next_scale = (last_scale + r.se() + 256) % 256
+                        last_scale = next_scale if next_scale != 0 else last_scale
+
+    r.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = r.ue()
+    if pic_order_cnt_type == 0:
+        r.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif pic_order_cnt_type == 1:
+        r.u(1)  # delta_pic_order_always_zero_flag
+        r.se()  # offset_for_non_ref_pic
+        r.se()  # offset_for_top_to_bottom_field
+        for _ in range(r.ue()):
+            r.se()
+
+    r.ue()  # max_num_ref_frames
+    r.u(1)  # gaps_in_frame_num_value_allowed_flag
+    width_in_mbs = r.ue() + 1
+    height_in_map_units = r.ue() + 1
+    frame_mbs_only = r.u(1)
+    if not frame_mbs_only:
+        r.u(1)  # mb_adaptive_frame_field_flag
+    r.u(1)  # direct_8x8_inference_flag
+
+    crop_left = crop_right = crop_top = crop_bottom = 0
+    if r.u(1):  # frame_cropping_flag
+        crop_left, crop_right, crop_top, crop_bottom = r.ue(), r.ue(), r.ue(), r.ue()
+
+    if chroma_format_idc == 0:
+        crop_unit_x, crop_unit_y = 1, 2 - frame_mbs_only
+    else:
+        sub_width = 1 if chroma_format_idc == 3 else 2
+        sub_height = 2 if chroma_format_idc == 1 else 1
+        crop_unit_x, crop_unit_y = sub_width, sub_height * (2 - frame_mbs_only)
+
+    width = width_in_mbs * 16 - (crop_left + crop_right) * crop_unit_x
+    height = (2 - frame_mbs_only) * height_in_map_units * 16 - (crop_top + crop_bottom) * crop_unit_y
+    return width, height
+
+
+def build_init_segment(sps: bytes, pps: bytes) -> bytes:
+    """
+    Builds the init segment (ftyp + moov) for the specified parameter sets.
+    :param sps: SPS NAL unit, without start code.
+    :param pps: PPS NAL unit, without start code.
+    :return:
+    """
+    width, height = parse_sps_dimensions(sps)
+
+    ftyp = box(b'ftyp', b'isom', struct.pack('>I', 512), b'isom', b'iso6', b'avc1', b'mp41')
+
+    mvhd = full_box(b'mvhd', 0, 0,
+                    struct.pack('>IIII', 0, 0, 1000, 0),  # creation, modification, timescale, duration
+                    struct.pack('>IH', 0x00010000, 0x0100), b'\x00' * 10,  # rate, volume, reserved
+                    UNITY_MATRIX, b'\x00' * 24,  # matrix, pre_defined
+                    struct.pack('>I', TRACK_ID + 1))  # next_track_ID
+
+    tkhd = full_box(b'tkhd', 0, 0x000003,  # Enabled and in movie.
+                    struct.pack('>IIIII', 0, 0, TRACK_ID, 0, 0),  # creation, modification, track_ID, reserved, duration
+                    b'\x00' * 8, struct.pack('>hhhH', 0, 0, 0, 0),  # reserved, layer, alternate_group, volume, reserved
+                    UNITY_MATRIX, struct.pack('>II', width << 16, height << 16))
+
+    mdhd = full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0, 0x55C4, 0))  # Language: und
+    hdlr = full_box(b'hdlr', 0, 0, struct.pack('>I', 0), b'vide', b'\x00' * 12, b'VideoHandler\x00')
+
+    avcc = box(b'avcC', bytes([1, sps[1], sps[2], sps[3], 0xFF, 0xE1]), struct.pack('>H', len(sps)), sps,
+               bytes([1]), struct.pack('>H', len(pps)), pps)
+    avc1 = box(b'avc1', b'\x00' * 6, struct.pack('>H', 1),  # reserved, data_reference_index
+               b'\x00' * 16, struct.pack('>HH', width, height),  # pre_defined, reserved, width, height
+               struct.pack('>IIIH', 0x00480000, 0x00480000, 0, 1),  # resolutions, reserved, frame_count
+               b'\x00' * 32, struct.pack('>Hh', 0x0018, -1),  # compressorname, depth, pre_defined
+               avcc)
+    stsd = full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1)
+
+    stbl = box(b'stbl', stsd,
+               full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+               full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+               full_box(b'stco', 0, 0, struct.pack('>I', 0)))
+    dinf = box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1), full_box(b'url ', 0, 1)))
+    minf = box(b'minf', full_box(b'vmhd', 0, 1, b'\x00' * 8), dinf, stbl)
+
+    trak = box(b'trak', tkhd, box(b'mdia', mdhd, hdlr, minf))
+    mvex = box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>IIIII', TRACK_ID, 1, 0, 0, 0)))
+
+    return ftyp + box(b'moov', mvhd, trak, mvex)
+
+
+def build_fragment(sequence_number: int, decode_time: int, duration: int, nals: list, keyframe: bool) -> bytes:
+    """
+    Builds a moof + mdat fragment with a single sample (access unit).
+    :param sequence_number: Fragment sequence number.
+    :param decode_time: Decode time of the sample, in TIMESCALE units.
+    :param duration: Duration of the sample, in TIMESCALE units.
+    :param nals: NAL units of the access unit, without start codes.
+    :param keyframe: Whether the access unit is an IDR picture.
+    :return:
+    """
+    sample = b''.join(struct.pack('>I', len(nal)) + nal for nal in nals)
+    flags = SAMPLE_FLAGS_KEYFRAME if keyframe else SAMPLE_FLAGS_DELTA
+
+    def moof(data_offset):
+        trun = full_box(b'trun', 0, 0x000701,  # data-offset, sample-duration, sample-size and sample-flags present
+                        struct.pack('>IiIII', 1, data_offset, duration, len(sample), flags))
+        traf = box(b'traf',
+                   full_box(b'tfhd', 0, 0x020000, struct.pack('>I', TRACK_ID)),  # default-base-is-moof
+                   full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time)),
+                   trun)
+        return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', sequence_number)), traf)
+
+    # The data offset is relative to the start of the moof, and the moof size does not depend on its value.
+    moof_size = len(moof(0))
+    return moof(moof_size + 8) + box(b'mdat', sample)
+
+
+def codec_string(sps: bytes) -> str:
+    """
+    RFC 6381 codec string for the specified SPS, as MSE expects it (such as avc1.42c01e).
+    """
+    return 'avc1.{:02x}{:02x}{:02x}'.format(sps[1], sps[2], sps[3])
+
+
+class FMP4Packager(object):
+    """
+    The FMP4 packager listens to the H.264 stream of a camera, which the H264Feeder publishes through redis, and
+    re-publishes it as fragmented MP4. There should be a single packager per camera, so that the work is done once
+    no matter how many viewers there are.
+
+    Access units are delimited as they arrive, and their timestamps are the (local) arrival times, since the
+    Annex-B stream carries none.
+    """
+
+    def __init__(self, rdb: redis.StrictRedis, redis_prefix: str, cam_name: str):
+        """
+        :param rdb: Redis connection. It must not decode responses, since the H.264 stream is binary.
+        """
+        pool = getattr(rdb, 'connection_pool', None)
+        if pool is not None and pool.connection_kwargs.get('decode_responses', False):
+            raise ValueError("The FMP4 packager needs a redis connection with decode_responses=False")
+
+        self._g = []
+        self._rdb = rdb
+        self._redis_prefix = redis_prefix
+        self._cam_name = cam_name
+
+        self._h264_channel = '{}/h264'.format(cam_name)
+        self._fmp4_channel = '{}/fmp4'.format(cam_name)
+        self._init_key = '{}:cams:{}:fmp4:init'.format(redis_prefix, cam_name)
+        self._codec_key = '{}:cams:{}:fmp4:codec'.format(redis_prefix, cam_name)
+
+        self._buffer = bytearray()
+        self._sps = None
+        self._pps = None
+        self._init_segment = None
+
+        self._au_nals = []  # NAL units of the access unit being assembled.
+        self._au_has_slice = False
+        self._au_keyframe = False
+        self._au_time = None  # Arrival time of the access unit being assembled.
+
+        self._last_decode_time = None
+        self._last_duration = TIMESCALE // 30
+        self._sequence_number = 0
+
+    def get_init_segment(self) -> bytes:
+        """
+        Returns the current init segment, or None if no SPS and PPS have been received yet.
+        """
+        return self._init_segment
+
+    def feed(self, data: bytes) -> list:
+        """
+        Feeds a chunk of the H.264 stream.
+        :param data: Chunk, as published by the H264Feeder.
+        :return: List with the fragments that were completed, each prefixed by the keyframe flag.
+        """
+        self._buffer.extend(data)
+        now = time.time()
+
+        fragments = []
+        while True:
+            # NAL units may be delimited by either 4-byte or 3-byte start codes. NAL units never end with a zero
+            # byte, so trailing zeros belong to the next 4-byte start code.
+            splits = self._buffer.split(SHORT_START_CODE, 1)
+            if len(splits) < 2:
+                break
+            nal, self._buffer = splits
+            nal = bytes(nal).rstrip(b'\x00')
+            if len(nal) > 0:
+                fragment = self._handle_nal(nal, now)
+                if fragment is not None:
+                    fragments.append(fragment)
+        return fragments
+
+    def start(self):
+        g = gevent.spawn(self._run)
+        self._g.append(g)
+
+    def _run(self):
+        rchannel = self._rdb.pubsub()
+        rchannel.subscribe([self._h264_channel])
+
+        print("FMP4 packager for {} subscribed to {}".format(self._cam_name, self._h264_channel))
+
+        while True:
+            try:
+                for item in rchannel.listen():
+                    if item['type'] != 'message':
+                        continue
+                    for fragment in self.feed(item['data']):
+                        self._rdb.publish(self._fmp4_channel, fragment)
+            except Exception:
+                traceback.print_exc()
+                gevent.sleep(1)
+
+    def _handle_nal(self, nal: bytes, now: float):
+        """
+        Adds the NAL unit to the access unit being assembled.
+        :return: The fragment for the previous access unit, if this NAL unit starts a new one.
+        """
+        ntype = nal[0] & 0x1F
+        fragment = None
+
+        # A new access unit starts with an AUD, SPS, PPS or SEI after a slice, or with the first slice of a picture.
+        starts_au = False
+        if ntype in (NAL_AUD, NAL_SPS, NAL_PPS, NAL_SEI):
+            starts_au = self._au_has_slice
+        elif ntype in (NAL_SLICE, NAL_IDR):
+            first_mb_in_slice_is_zero = len(nal) > 1 and (nal[1] & 0x80) != 0
+            starts_au = self._au_has_slice and first_mb_in_slice_is_zero
+
+        if starts_au:
+            fragment = self._flush_au(now)
+
+        if self._au_time is None:
+            self._au_time = now
+
+        if ntype == NAL_SPS:
+            self._update_parameter_sets(sps=nal)
+        elif ntype == NAL_PPS:
+            self._update_parameter_sets(pps=nal)
+        elif ntype in (NAL_SLICE, NAL_IDR):
+            self._au_has_slice = True
+            self._au_keyframe = self._au_keyframe or ntype == NAL_IDR
+            self._au_nals.append(nal)
+        elif ntype != NAL_AUD:
+            self._au_nals.append(nal)
+
+        return fragment
+
+    def _update_parameter_sets(self, sps=None, pps=None):
+        if sps is not None:
+            self._sps = sps
+        if pps is not None:
+            self._pps = pps
+        if self._sps is None or self._pps is None:
+            return
+
+        init_segment = build_init_segment(self._sps, self._pps)
+        if init_segment != self._init_segment:
+            self._init_segment = init_segment
+            self._rdb.set(self._init_key, init_segment)
+            self._rdb.set(self._codec_key, codec_string(self._sps))
+
+    def _flush_au(self, now: float):
+        """
+        Packages the access unit that has been assembled.
+        :param now: Arrival time of the next access unit, which determines the duration of this one.
+        :return: The fragment, prefixed by the keyframe flag, or None if it cannot be packaged.
+        """
+        nals, keyframe, au_time = self._au_nals, self._au_keyframe, self._au_time
+        self._au_nals = []
+        self._au_has_slice = False
+        self._au_keyframe = False
+        self._au_time = None
+
+        # Nothing can be decoded before the init segment and the first keyframe.
+        if self._init_segment is None or (self._last_decode_time is None and not keyframe):
+            return None
+
+        # Timestamps are contiguous: every sample starts where the previous one ended.
+        if self._last_decode_time is None:
+            decode_time = 0
+        else:
+            decode_time = self._last_decode_time + self._last_duration
+
+        duration = int((now - au_time) * TIMESCALE)
+        if duration <= 0:
+            # Chunks that arrive together get the same arrival time.
+            duration = self._last_duration
+        self._last_duration = duration
+
+        self._last_decode_time = decode_time
+        self._sequence_number += 1
+
+        fragment = build_fragment(self._sequence_number, decode_time, duration, nals, keyframe)
+        return (FRAGMENT_KEYFRAME if keyframe else FRAGMENT_DELTA) + fragment
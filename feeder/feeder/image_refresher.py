@@ -56,7 +56,7 @@ class ImageRefreshCamFeeder(CamFeeder):
             self._check_active()
 
             elapsed = time.time() - update_start_time
-            intended_period = 1 / self._max_fps  # That's the approximate time a frame should take.
+            intended_period = 1 / self.get_target_fps()  # That's the approximate time a frame should take.
 
             time_left = intended_period - elapsed
             # print("Time left: {}".format(time_left))
@@ -48,6 +48,10 @@ class MJPEGCamFeeder(CamFeeder):
 
     WAIT_ON_ERROR = 0.1  # Time to wait when an error occurs.
 
+    # Tolerance when deciding whether a frame arrived too early to be stored, so that small jitter in the camera
+    # timing does not halve the frame rate.
+    DECIMATION_SLACK = 0.8
+
     def __init__(self, rdb: redis.StrictRedis, redis_prefix: str, cam_name: str, url: str, max_fps: int,
                  rotation: float = None):
         super(MJPEGCamFeeder, self).__init__(rdb, redis_prefix, cam_name, url, max_fps, rotation)
@@ -63,6 +67,9 @@ class MJPEGCamFeeder(CamFeeder):
 
         self._stats_live_control_restablish = 0
 
+        self._last_put_time = 0  # Local time at which the last frame was stored.
+        self._frames_skipped = 0  # Frames read but not stored because no viewer needs them.
+
     # Override
     def _push_stats(self):
         """
@@ -75,6 +82,7 @@ class MJPEGCamFeeder(CamFeeder):
 
         self._rdb.setex(base_key + 'cycle_live_control_restablish', CamFeeder.IMAGE_EXPIRE_TIME * 3,
                         self._stats_live_control_restablish)
+        self._rdb.setex(base_key + 'cycle_frames_skipped', CamFeeder.IMAGE_EXPIRE_TIME * 3, self._frames_skipped)
 
     def _run_until_inactive(self):
         """
@@ -122,8 +130,16 @@ class MJPEGCamFeeder(CamFeeder):
                         self._local_sync_time = time.time()
                     self._server_frame_time = date
                     self._local_frame_time = time.time()
+
+                    # The camera sets the rate, so every frame must be read. But frames that arrive faster than
+                    # any viewer requested are neither rotated nor stored.
+                    if self._should_skip_frame():
+                        self._frames_skipped += 1
+                        continue
+
                     frame = self._rotated(frame, self._rotation)
                     self._put_frame(frame)
+                    self._last_put_time = self._local_frame_time
                 except Exception as ex:
                     print("Restarting connection. Cause: {}".format(ex), flush=True)
                     self._request_response = None
@@ -136,6 +152,14 @@ class MJPEGCamFeeder(CamFeeder):
                 self._request_response = None
                 gevent.sleep(MJPEGCamFeeder.WAIT_ON_ERROR)
 
+    def _should_skip_frame(self) -> bool:
+        """
+        Checks whether the frame that was just read arrived too soon after the last stored one for the target FPS.
+        :return:
+        """
+        min_period = MJPEGCamFeeder.DECIMATION_SLACK / self.get_target_fps()
+        return self._local_frame_time - self._last_put_time < min_period
+
     def _parse_next_image(self) -> (bytes, int):
         """
         Retrieves the next image from the stream.
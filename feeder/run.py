@@ -14,6 +14,7 @@ from feeder.image_refresher import ImageRefreshCamFeeder
 from feeder.mjpeg import MJPEGCamFeeder
 from feeder.mpeg import MPEGFeeder
 from feeder.h264_to_frames import H264ToFramesFeeder
+from feeder.fmp4 import FMP4Packager
 
 from feeder import config
 
@@ -102,6 +103,15 @@ def run():
                     cam_feeders[cam_name + '/h264'] = h264_cf
                     h264_cf.start()
 
+                    # Re-mux the H.264 stream into fragmented MP4 for Media Source Extensions clients.
+                    # The H.264 stream is binary, so the packager needs a connection that does not decode responses.
+                    if cam.get('fmp4') is True:
+                        binary_rdb = redis.StrictRedis(host=config.REDIS_HOST, port=config.REDIS_PORT,
+                                                       db=config.REDIS_DB, decode_responses=False)
+                        fmp4_packager = FMP4Packager(binary_rdb, config.REDIS_PREFIX, cam_name)
+                        cam_feeders[cam_name + '/fmp4'] = fmp4_packager
+                        fmp4_packager.start()
+
                 cam_feeders[cam_name] = cf
                 cf.start()
 
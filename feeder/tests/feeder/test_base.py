@@ -63,6 +63,46 @@ class TestBasic(FeederTestBase):
         self.assertEquals(frame, self.rdb.get('wilsat:cams:archimedes:lastframe'))
         self.assertEquals(1, self.cf._frames_this_cycle)
 
+    def test_put_frame_numbers_frames(self):
+        self.cf._put_frame(b'abcd')
+        self.cf._put_frame(b'efgh')
+        self.assertEqual(b'2', self.rdb.get('wilsat:cams:archimedes:frameseq'))
+        self.assertGreater(self.rdb.ttl('wilsat:cams:archimedes:frameseq'), 0)
+
+    def test_demand_limits_target_fps(self):
+        self.assertEqual(self.cf.get_target_fps(), 10)
+
+        now = int(time.time())
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server1:1', '5,320,{}'.format(now))
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server1:2', '2,640,{}'.format(now))
+        self.cf._check_demand()
+        self.assertEqual(self.cf.get_target_fps(), 5)
+        self.assertEqual(self.cf._demand_width, 640)
+
+        # Demands above max_fps are capped.
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server2:1', '30,0,{}'.format(now))
+        self.cf._check_demand()
+        self.assertEqual(self.cf.get_target_fps(), 10)
+
+    def test_fractional_demand(self):
+        now = int(time.time())
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server1:1', '7.5,320,{}'.format(now))
+        self.cf._check_demand()
+        self.assertEqual(self.cf.get_target_fps(), 8)
+
+    def test_stale_demand_is_ignored(self):
+        old = int(time.time()) - CamFeeder.DEMAND_MAX_AGE - 10
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server1:1', '5,0,{}'.format(old))
+        self.cf._check_demand()
+        self.assertEqual(self.cf.get_target_fps(), 10)
+
+    def test_unlimited_demand(self):
+        now = int(time.time())
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server1:1', '5,0,{}'.format(now))
+        self.rdb.hset('wilsat:cams:archimedes:demand', 'server1:2', '0,0,{}'.format(now))
+        self.cf._check_demand()
+        self.assertEqual(self.cf.get_target_fps(), 10)
+
     def test_check_active(self):
         # Set active flag:
         self.rdb.setex('wilsat:cams:archimedes:active', 10, 1)
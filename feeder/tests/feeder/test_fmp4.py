@@ -0,0 +1,136 @@
+import os
+import struct
+import threading
+import time
+import unittest
+
+import redis
+from mockredis import mock_strict_redis_client
+
+from feeder import config
+
+from feeder.fmp4 import FMP4Packager, parse_sps_dimensions, FRAGMENT_KEYFRAME, FRAGMENT_DELTA
+from tests.base import FeederTestBase
+
+# Fix the working path
+abspath = os.path.abspath(__file__)
+dname = os.path.dirname(abspath)
+os.chdir(os.path.join(dname, '..'))
+
+
+def top_level_boxes(data):
+    """
+    Returns the types of the top-level boxes, checking that their sizes add up.
+    """
+    types = []
+    pos = 0
+    while pos < len(data):
+        size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+        types.append(box_type)
+        pos += size
+    assert pos == len(data)
+    return types
+
+
+class TestFMP4Packager(FeederTestBase):
+
+    def setUp(self):
+        self.rdb = mock_strict_redis_client()
+        self.packager = FMP4Packager(self.rdb, 'wilsat', 'archimedes')
+
+        data = open('data/stream.h264', 'rb').read()
+        self.fragments = []
+        for i in range(0, len(data), 2048):
+            self.fragments.extend(self.packager.feed(data[i:i + 2048]))
+
+    def test_pass(self):
+        pass
+
+    def test_init_segment(self):
+        init = self.packager.get_init_segment()
+        self.assertEqual(top_level_boxes(init), [b'ftyp', b'moov'])
+        self.assertIn(b'avcC', init)
+
+        # The init segment is cached in redis, along with the MSE codec string.
+        self.assertEqual(self.rdb.get('wilsat:cams:archimedes:fmp4:init'), init)
+        self.assertTrue(self.rdb.get('wilsat:cams:archimedes:fmp4:codec').startswith(b'avc1.'))
+
+    def test_sps_dimensions(self):
+        self.assertEqual(parse_sps_dimensions(self.packager._sps), (640, 360))
+
+    def test_fragments(self):
+        self.assertGreater(len(self.fragments), 10)
+
+        # The first fragment is always a keyframe, so that it can be decoded.
+        self.assertEqual(self.fragments[0][:1], FRAGMENT_KEYFRAME)
+        self.assertEqual(self.fragments[1][:1], FRAGMENT_DELTA)
+
+        for fragment in self.fragments:
+            self.assertEqual(top_level_boxes(fragment[1:]), [b'moof', b'mdat'])
+
+
+class TestFMP4PackagerPubSub(FeederTestBase):
+    """
+    Runs the packager against a real redis, with the H.264 stream going through pubsub as the H264Feeder publishes it.
+    """
+
+    def setUp(self):
+        try:
+            self.rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest("Redis is not available")
+
+        self.cam_name = 'fmp4_pubsub_{}'.format(os.getpid())
+        self.packager = FMP4Packager(self.rdb, 'wilsat', self.cam_name)
+
+        self.rchannel = self.rdb.pubsub()
+        self.rchannel.subscribe(['{}/fmp4'.format(self.cam_name)])
+
+        # The packager loop blocks on its pubsub connection, so it runs in its own thread.
+        thread = threading.Thread(target=self.packager._run, daemon=True)
+        thread.start()
+
+    def tearDown(self):
+        if hasattr(self, 'rchannel'):
+            self.rchannel.close()
+
+    def _wait_for_subscription(self, channel):
+        deadline = time.time() + 5
+        while self.rdb.pubsub_numsub(channel)[0][1] == 0:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_fragments_from_pubsub(self):
+        h264_channel = '{}/h264'.format(self.cam_name)
+        self._wait_for_subscription(h264_channel)
+
+        data = open('data/stream.h264', 'rb').read()
+        for i in range(0, len(data), 2048):
+            self.rdb.publish(h264_channel, data[i:i + 2048])
+
+        fragments = []
+        deadline = time.time() + 5
+        while len(fragments) < 10 and time.time() < deadline:
+            item = self.rchannel.get_message(timeout=0.5)
+            if item is not None and item['type'] == 'message':
+                fragments.append(item['data'])
+
+        self.assertGreaterEqual(len(fragments), 10)
+        self.assertEqual(fragments[0][:1], FRAGMENT_KEYFRAME)
+        for fragment in fragments:
+            self.assertEqual(top_level_boxes(fragment[1:]), [b'moof', b'mdat'])
+
+        self.assertEqual(top_level_boxes(self.rdb.get('wilsat:cams:{}:fmp4:init'.format(self.cam_name))),
+                         [b'ftyp', b'moov'])
+        self.rdb.delete('wilsat:cams:{}:fmp4:init'.format(self.cam_name),
+                        'wilsat:cams:{}:fmp4:codec'.format(self.cam_name))
+
+    def test_decoding_connection_rejected(self):
+        rdb = redis.StrictRedis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=config.REDIS_DB,
+                                decode_responses=True)
+        with self.assertRaises(ValueError):
+            FMP4Packager(rdb, 'wilsat', self.cam_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
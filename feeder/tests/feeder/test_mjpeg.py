@@ -124,6 +124,20 @@ class TestBasic(FeederTestBase):
     def test_start_streaming(self):
         self.cf._start_streaming_request()
 
+    def test_skips_frames_beyond_demand(self):
+        # 10 FPS max: frames 50 ms apart are too close.
+        self.cf._last_put_time = 100.0
+        self.cf._local_frame_time = 100.05
+        self.assertTrue(self.cf._should_skip_frame())
+        self.cf._local_frame_time = 100.1
+        self.assertFalse(self.cf._should_skip_frame())
+
+        # If the viewers only need 2 FPS, frames 100 ms apart are skipped too.
+        self.cf._demand_fps = 2
+        self.assertTrue(self.cf._should_skip_frame())
+        self.cf._local_frame_time = 100.5
+        self.assertFalse(self.cf._should_skip_frame())
+
 
 # These tests fail under certain conditions.
 # Probably because for some reason sometimes the whole file is read on the first requests call.
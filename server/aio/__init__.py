@@ -0,0 +1,25 @@
+"""
+Optional asyncio serving engine for the frame endpoints and the plain streaming protocols.
+
+The default engine (the app package) runs on gevent, which monkey-patches the standard library at import time: a call
+that blocks without going through gevent (a C extension, a lock) silently stalls every stream of the worker, and
+profilers only see the hub. This engine serves the hot endpoints with plain asyncio instead, as an ASGI app, with an
+async redis client and the same redis key layout, so it can run next to (or instead of) the gevent workers against the
+same feeders:
+
+    GET /cams/<cam_id>                  Last frame (tfps parameter).
+    GET /cams/<cam_id>/mjpeg            MJPEG stream (tfps and keepalive parameters).
+    WebSocket /ws/cams/<cam_id>/mjpeg   Plain WebSocket MJPEG stream (tfps and keepalive parameters).
+    WebSocket /ws/cams/<cam_id>/h264    Plain WebSocket H.264 stream, starting at the next keyframe.
+    GET /healthcheck
+
+The responses and messages are the same as those of the gevent engine (see app/main/views.py and
+app/main/websockets.py). The cameras are marked active and their viewers counted the same way, so the feeders cannot
+tell the engines apart. Neither the Socket.IO namespaces, nor the frame transformations (rotate and crop), nor the
+admission control and egress scheduling are served by this engine.
+
+It does not import the app package, which would monkey-patch the process. Run it with uvicorn (see
+requirements_asgi.txt), from the server directory:
+
+    uvicorn aio.app:app --host 0.0.0.0 --port 8600 --workers 4
+"""
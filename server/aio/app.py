@@ -0,0 +1,355 @@
+"""
+ASGI application of the asyncio engine (see the package docstring).
+
+Every connection is served by a coroutine of the worker event loop. Streams are paced by a shared Ticker per FPS tier,
+as in the gevent engine, and H.264 is read from a per-process pubsub Hub. A disconnection of the client cancels the
+coroutine of its stream, which then releases its viewer and subscriptions.
+"""
+
+import asyncio
+import importlib.util
+import json
+import os
+import struct
+import time
+from urllib.parse import parse_qs
+
+from config import config
+
+from .hub import Hub, GAP
+from .store import Store
+from .ticker import Ticker
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOT_AVAILABLE_IMAGE = os.path.join(SERVER_DIR, 'app', 'static', 'no_image_available.png')
+
+# The NAL unit parser of the gevent engine has no dependencies, but importing it through the app package would
+# monkey-patch the process: it is loaded from its file instead.
+_spec = importlib.util.spec_from_file_location('aio_h264_nal', os.path.join(SERVER_DIR, 'app', 'main', 'h264_nal.py'))
+h264_nal = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(h264_nal)
+
+# Same as app.main.multipart and app.main.websockets.
+BOUNDARY = b'frame'
+MJPEG_MIMETYPE = b'multipart/x-mixed-replace; boundary=frame'
+MESSAGE_KIND_JPEG = 1
+MESSAGE_KIND_H264 = 2
+HEADER = struct.Struct('!BI')
+
+# Frame id for the "not available" image.
+NOT_AVAILABLE = 'not_available'
+
+# Flags of the gevent engine frame routes that crop the frames. This engine does not transform the frames.
+CROP_PARAMS = ('crop_top', 'crop_bottom', 'crop_right', 'crop_left')
+
+
+def build_part(body, frame_id=None, content_type=b'image/jpeg'):
+    """
+    Serializes a multipart part, as app.main.multipart.build_part.
+    """
+    lines = [b'--' + BOUNDARY, b'Content-Type: ' + content_type, b'Content-Length: ' + str(len(body)).encode()]
+    if frame_id is not None:
+        if not isinstance(frame_id, bytes):
+            frame_id = str(frame_id).encode()
+        lines.append(b'X-Frame-Id: ' + frame_id)
+    return b''.join((b'\r\n'.join(lines), b'\r\n\r\n', body, b'\r\n'))
+
+
+class Delivery(object):
+    """
+    Skips unchanged frames, as app.main.delivery.FrameDelivery.
+    """
+
+    def __init__(self, keepalive):
+        self._keepalive = keepalive
+        self._last_id = None
+        self._last_time = 0
+
+    def should_send(self, frame_id):
+        if frame_id != self._last_id:
+            return True
+        return bool(self._keepalive) and time.time() - self._last_time >= self._keepalive
+
+    def sent(self, frame_id):
+        self._last_id = frame_id
+        self._last_time = time.time()
+
+
+class BadRequest(Exception):
+    pass
+
+
+class App(object):
+
+    def __init__(self, cfg):
+        """
+        :param cfg: Config class, as in config.py.
+        """
+        self.config = cfg
+        self.store = None
+        self.hub = None
+        self.tickers = {}  # FPS -> Ticker.
+        self._parts = {}  # Cam -> (seq, multipart part) of its last frame.
+        self._flusher = None
+
+        with open(NOT_AVAILABLE_IMAGE, 'rb') as f:
+            self.not_available = f.read()
+        self.not_available_part = build_part(self.not_available, content_type=b'image/png')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        self.start()
+        try:
+            route, cam_id = self._route(scope)
+            query = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+            args = {name: values[-1] for name, values in query.items()}
+            if route is None:
+                await self._respond(scope, send, 404, b'text/plain', b'Not Found')
+            elif scope['type'] == 'websocket':
+                await self._websocket(route, cam_id, args, receive, send)
+            elif args.get('rotate', '0') not in ('0', '0.0') or any(name in args for name in CROP_PARAMS):
+                await self._respond(scope, send, 501, b'text/plain', b'Frame transformations are not supported')
+            elif route == 'healthcheck':
+                await self._respond(scope, send, 200, b'application/json', json.dumps(
+                    {'result': 'success', 'engine': 'asyncio', 'viewers': self.store.get_viewers()}).encode())
+            elif route == 'snapshot':
+                await self._snapshot(cam_id, args, send)
+            elif route == 'mjpeg':
+                # Arguments are checked before the stream starts: once it runs, errors can no longer become a 400.
+                tfps = self._int_arg(args, 'tfps', 5)
+                keepalive = self._keepalive_arg(args)
+                await self._until_disconnect(receive, self._mjpeg(cam_id, tfps, keepalive, send), 'http.disconnect')
+            else:
+                await self._respond(scope, send, 404, b'text/plain', b'Not Found')
+        except BadRequest as ex:
+            await self._respond(scope, send, 400, b'text/plain', str(ex).encode())
+
+    def start(self):
+        """
+        Creates the redis client and starts the activity flushes, if not done yet. Must be called from the event loop.
+        """
+        if self.store is not None:
+            return
+        self.store = Store(getattr(self.config, 'REDIS_URL', 'redis://localhost:6379/0'), self.config.REDIS_PREFIX,
+                           self.config.ACTIVITY_FLUSH_INTERVAL)
+        self.hub = Hub(self.store.redis, self.config.HUB_QUEUE_SIZE)
+        self._flusher = asyncio.ensure_future(self.store.run())
+
+    async def stop(self):
+        if self.store is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self.store.flush()
+        except Exception as ex:
+            print("[aio]: Could not flush the camera activity: {}".format(ex))
+        await self.store.redis.aclose()
+        self.store = None
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _route(scope):
+        """
+        :return: (route, cam_id). route is None if the path is not served.
+        """
+        parts = scope['path'].strip('/').split('/')
+        if scope['type'] == 'http':
+            if parts == ['healthcheck']:
+                return 'healthcheck', None
+            if len(parts) == 2 and parts[0] == 'cams':
+                return 'snapshot', parts[1]
+            if len(parts) == 3 and parts[0] == 'cams' and parts[2] == 'mjpeg':
+                return 'mjpeg', parts[1]
+        elif scope['type'] == 'websocket':
+            if len(parts) == 4 and parts[:2] == ['ws', 'cams'] and parts[3] in ('mjpeg', 'h264'):
+                return parts[3], parts[2]
+        return None, None
+
+    @staticmethod
+    def _int_arg(args, name, default):
+        try:
+            return int(args[name]) if name in args else default
+        except ValueError:
+            raise BadRequest("Wrong value: {} must be an integer".format(name))
+
+    def _keepalive_arg(self, args):
+        try:
+            return float(args['keepalive']) if 'keepalive' in args else self.config.KEEPALIVE_RESEND_INTERVAL
+        except ValueError:
+            raise BadRequest("Wrong value: keepalive must be a float")
+
+    def _get_ticker(self, fps):
+        ticker = self.tickers.get(fps)
+        if ticker is None:
+            ticker = self.tickers[fps] = Ticker(fps, self.store, self.tickers)
+        return ticker
+
+    def _get_part(self, cam_id, fetched):
+        """
+        Returns the multipart part of the frame, built once for every client of the camera.
+        """
+        seq, part = self._parts.get(cam_id, (None, None))
+        if part is None or seq != fetched.seq:
+            part = build_part(fetched.frame, fetched.seq)
+            self._parts[cam_id] = (fetched.seq, part)
+        return part
+
+    @staticmethod
+    async def _respond(scope, send, status, content_type, body):
+        if scope['type'] == 'websocket':
+            # Rejects the handshake.
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    async def _until_disconnect(receive, stream, disconnect_type):
+        """
+        Runs the stream coroutine until it ends or the client disconnects, whichever happens first.
+        """
+        async def wait_disconnect():
+            while (await receive())['type'] != disconnect_type:
+                pass
+
+        stream = asyncio.ensure_future(stream)
+        disconnect = asyncio.ensure_future(wait_disconnect())
+        try:
+            await asyncio.wait([stream, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (stream, disconnect):
+                task.cancel()
+            await asyncio.gather(stream, disconnect, return_exceptions=True)
+
+    async def _snapshot(self, cam_id, args, send):
+        # Rate at which the client refreshes the image, if it tells. It is only used as a hint for the feeder.
+        tfps = self._int_arg(args, 'tfps', None)
+
+        while True:
+            fetched = await self.store.fetch_frame(cam_id, fps=tfps)
+            if fetched.frame is not None:
+                await send({'type': 'http.response.start', 'status': 200,
+                            'headers': [(b'content-type', b'image/jpeg'),
+                                        (b'content-length', str(len(fetched.frame)).encode())]})
+                await send({'type': 'http.response.body', 'body': fetched.frame})
+                return
+
+            # If the feeder is alive and the webcam reports no error, the image should be available soon.
+            if fetched.alive and not fetched.error and getattr(self.config, 'WAIT_FOR_WEBCAM', False):
+                await asyncio.sleep(getattr(self.config, 'WAIT_FOR_WEBCAM_TIME', 0.1))
+                continue
+
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': [(b'content-type', b'image/png'),
+                                    (b'content-length', str(len(self.not_available)).encode())]})
+            await send({'type': 'http.response.body', 'body': self.not_available})
+            return
+
+    async def _frames(self, cam_id, tfps, keepalive):
+        """
+        Generates the frames of the camera to send to a client, at the ticks of its FPS tier.
+        :return: Async generator of FetchedFrame. The frame is None if the camera is not available.
+        """
+        delivery = Delivery(keepalive)
+        ticker = self._get_ticker(tfps)
+        ticker.subscribe()
+        await self.store.add_viewer(cam_id)
+        try:
+            while True:
+                await ticker.wait()
+                fetched = await ticker.get_frame(cam_id)
+
+                if fetched.frame is None:
+                    # If there is no error, we just retry on the next tick: the image should be available soon.
+                    if fetched.alive and getattr(self.config, 'WAIT_FOR_WEBCAM', False):
+                        continue
+                    frame_id = NOT_AVAILABLE
+                else:
+                    frame_id = fetched.seq
+
+                if not delivery.should_send(frame_id):
+                    continue
+                yield fetched
+                delivery.sent(frame_id)
+        finally:
+            ticker.unsubscribe()
+            self.store.remove_viewer(cam_id)
+
+    async def _mjpeg(self, cam_id, tfps, keepalive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', MJPEG_MIMETYPE)]})
+        frames = self._frames(cam_id, tfps, keepalive)
+        try:
+            async for fetched in frames:
+                part = self.not_available_part if fetched.frame is None else self._get_part(cam_id, fetched)
+                # Waits until the server has handed the part to the socket, so slow clients are not buffered for.
+                await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+        finally:
+            await frames.aclose()
+
+    async def _websocket(self, route, cam_id, args, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if route == 'mjpeg':
+            tfps = self._int_arg(args, 'tfps', 5)
+            keepalive = self._keepalive_arg(args)
+            await send({'type': 'websocket.accept'})
+            stream = self._ws_mjpeg(cam_id, tfps, keepalive, send)
+        else:
+            await send({'type': 'websocket.accept'})
+            stream = self._ws_h264(cam_id, send)
+        await self._until_disconnect(receive, stream, 'websocket.disconnect')
+
+    async def _ws_mjpeg(self, cam_id, tfps, keepalive, send):
+        seq = 0
+        frames = self._frames(cam_id, tfps, keepalive)
+        try:
+            async for fetched in frames:
+                frame = self.not_available if fetched.frame is None else fetched.frame
+                await send({'type': 'websocket.send', 'bytes': HEADER.pack(MESSAGE_KIND_JPEG, seq) + frame})
+                seq = (seq + 1) & 0xFFFFFFFF
+        finally:
+            await frames.aclose()
+
+    async def _ws_h264(self, cam_id, send):
+        splitter = h264_nal.NALSplitter()
+        waiting_for_keyframe = True
+        seq = 0
+        await self.store.add_viewer(cam_id, 'h264')
+        subscription = await self.hub.subscribe("{}/h264".format(cam_id))
+        try:
+            while True:
+                data = await subscription.get()
+                if data is GAP:
+                    # We lagged behind and lost data: resume at the next keyframe.
+                    splitter = h264_nal.NALSplitter()
+                    waiting_for_keyframe = True
+                    continue
+
+                for nal in splitter.feed(data):
+                    if waiting_for_keyframe:
+                        if h264_nal.nal_type(nal) not in (h264_nal.NAL_SPS, h264_nal.NAL_IDR):
+                            continue
+                        waiting_for_keyframe = False
+                    await send({'type': 'websocket.send', 'bytes': HEADER.pack(MESSAGE_KIND_H264, seq) + nal})
+                    seq = (seq + 1) & 0xFFFFFFFF
+        finally:
+            self.store.remove_viewer(cam_id, 'h264')
+            await asyncio.shield(subscription.close())
+
+
+app = App(config[os.environ.get('FLASK_CONFIG', 'production')])
@@ -0,0 +1,105 @@
+"""
+Per-process pubsub hub of the asyncio engine, as app/main/hub.py: every channel is subscribed to once per process,
+whatever its number of viewers, and its messages are fanned out to a bounded queue per viewer. Viewers that lag behind
+further lose the queued messages, and get GAP instead so that they can resync.
+"""
+
+import asyncio
+
+# Put in the queue of a viewer in place of the messages it lost.
+GAP = None
+
+
+class Subscription(object):
+
+    def __init__(self, hub, channel, queue_size):
+        self._hub = hub
+        self.channel = channel
+        self._queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+
+    def put(self, data):
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+                self.dropped += 1
+            self._queue.put_nowait(GAP)
+            try:
+                self._queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def get(self):
+        """
+        :return: The next message, or GAP if messages were lost.
+        """
+        return await self._queue.get()
+
+    async def close(self):
+        await self._hub.unsubscribe(self)
+
+
+class Hub(object):
+
+    def __init__(self, redis, queue_size):
+        self._redis = redis
+        self._queue_size = queue_size
+        self._pubsub = None
+        self._subscriptions = {}  # Channel -> set of Subscription.
+        self._reader = None
+        self._lock = asyncio.Lock()  # Serializes the (un)subscribe round trips.
+
+    async def subscribe(self, channel):
+        """
+        :return: Subscription to the channel. It must be closed.
+        """
+        subscription = Subscription(self, channel, self._queue_size)
+        async with self._lock:
+            subscriptions = self._subscriptions.get(channel)
+            if subscriptions is None:
+                if self._pubsub is None:
+                    self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                await self._pubsub.subscribe(channel)
+                subscriptions = self._subscriptions[channel] = set()
+            subscriptions.add(subscription)
+            if self._reader is None:
+                self._reader = asyncio.ensure_future(self._read())
+        return subscription
+
+    async def unsubscribe(self, subscription):
+        async with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if len(subscriptions) == 0:
+                del self._subscriptions[subscription.channel]
+                await self._pubsub.unsubscribe(subscription.channel)
+
+    async def _read(self):
+        """
+        Task that dispatches the messages to the viewers, while there are any.
+        """
+        try:
+            while self._subscriptions:
+                try:
+                    message = await self._pubsub.get_message(timeout=1.0)
+                except Exception as ex:
+                    # The messages published until the connection is restored are lost.
+                    print("[aio]: Pubsub read failed: {}".format(ex))
+                    for subscriptions in self._subscriptions.values():
+                        for subscription in subscriptions:
+                            subscription.put(GAP)
+                    await asyncio.sleep(1)
+                    continue
+                if message is None or message['type'] != 'message':
+                    continue
+                channel = message['channel']
+                if isinstance(channel, bytes):
+                    channel = channel.decode('utf-8')
+                for subscription in list(self._subscriptions.get(channel, ())):
+                    subscription.put(message['data'])
+        finally:
+            self._reader = None
@@ -0,0 +1,183 @@
+"""
+Redis access of the asyncio engine: frame lookups, through the same Lua script as the gevent engine, and the camera
+activity, demand and viewer counts, with the key layout and coalescing of app/main/activity.py.
+"""
+
+import asyncio
+import math
+import os
+import socket
+import time
+from collections import defaultdict, namedtuple
+
+import redis.asyncio as aioredis
+
+FETCH_FRAME_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'main', 'lua',
+                                  'fetch_frame.lua')
+
+# Seconds that a camera stays active after it was last flushed.
+ACTIVE_TTL = 30
+
+# Same as app.main.redis_funcs.FetchedFrame.
+FetchedFrame = namedtuple('FetchedFrame', ['seq', 'alive', 'error', 'frame', 'unchanged'])
+
+
+def merge_demand(a, b):
+    """
+    Combines two (fps, width) demands into the one that satisfies both. 0 means no limit.
+    """
+    if a is None:
+        return b
+    return tuple(0 if x == 0 or y == 0 else max(x, y) for x, y in zip(a, b))
+
+
+class Store(object):
+
+    def __init__(self, redis_url, redis_prefix, flush_interval):
+        self.redis = aioredis.Redis.from_url(redis_url)
+        self._redis_prefix = redis_prefix
+        self._flush_interval = flush_interval
+        self._process_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        with open(FETCH_FRAME_SCRIPT, 'r') as f:
+            self._fetch_frame_script = self.redis.register_script(f.read())
+
+        self._demanded = set()  # Active keys demanded since the last flush.
+        self._flushed_at = {}  # Active key -> time at which it was last written.
+        self._viewers = defaultdict(int)  # Active key -> number of open streams.
+        self._published_viewers = {}  # Cam key -> viewer count published in the last flush.
+        self._demand = {}  # Cam key -> (fps, width) demanded since the last flush.
+        self._published_demand = {}  # Cam key -> (fps, width) published.
+
+    def cam_key(self, cam_name):
+        return self._redis_prefix + ":cams:" + cam_name
+
+    def active_key(self, cam_name, stream_format=None):
+        cam_key = self.cam_key(cam_name)
+        return cam_key + ":active" if stream_format is None else cam_key + ":active:" + stream_format
+
+    async def fetch_frame(self, cam_name, since_seq=None, fps=None):
+        """
+        Marks the camera as active and retrieves its last frame, along with the feeder alive and camera error state.
+        :param since_seq: Sequence number of the frame that the caller already has. If the last frame is that same one,
+        it is not transferred again.
+        :param fps: Frame rate at which the caller serves the camera, if known. Published as demand for the feeder.
+        :return: FetchedFrame
+        """
+        await self.mark(self.active_key(cam_name), fps)
+
+        cam_key = self.cam_key(cam_name)
+        keys = [cam_key + ":lastframe", cam_key + ":frameseq", cam_key + ":error",
+                self._redis_prefix + ":feeder:alive"]
+        result = await self._fetch_frame_script(keys=keys, args=[since_seq if since_seq is not None else ''])
+
+        seq = result[0] if result[0] != b'' else None
+        frame = result[3] if len(result) > 3 else None
+        unchanged = frame is None and seq is not None and since_seq is not None and seq == since_seq
+        return FetchedFrame(seq, result[1] == 1, result[2] == 1, frame, unchanged)
+
+    async def mark(self, active_key, fps=None, width=None):
+        """
+        Records demand for the active key. Only writes to redis if the key is not known to be active, or if the demand
+        is higher than the published one.
+        """
+        flushed_at = self._flushed_at.get(active_key)
+        if flushed_at is None or time.time() - flushed_at > ACTIVE_TTL - self._flush_interval:
+            self._flushed_at[active_key] = time.time()
+            await self.redis.setex(active_key, ACTIVE_TTL, 1)
+        else:
+            self._demanded.add(active_key)
+
+        # Marks without any demand only keep the key active (see app.main.activity).
+        if fps is None and width is None:
+            return
+
+        cam_key = active_key.rsplit(":active", 1)[0]
+        demand = merge_demand(self._demand.get(cam_key), (fps or 0, width or 0))
+        self._demand[cam_key] = demand
+
+        published = self._published_demand.get(cam_key)
+        if published is None or merge_demand(published, demand) != published:
+            published = merge_demand(published, demand)
+            self._published_demand[cam_key] = published
+            pipe = self.redis.pipeline(transaction=False)
+            self._write_demand(pipe, cam_key, published)
+            await pipe.execute()
+
+    async def add_viewer(self, cam_name, stream_format=None):
+        """
+        Registers an open stream. The camera is kept active until the viewer is removed.
+        """
+        active_key = self.active_key(cam_name, stream_format)
+        self._viewers[active_key] += 1
+        await self.mark(active_key)
+
+    def remove_viewer(self, cam_name, stream_format=None):
+        active_key = self.active_key(cam_name, stream_format)
+        self._viewers[active_key] -= 1
+        if self._viewers[active_key] <= 0:
+            del self._viewers[active_key]
+
+    def get_viewers(self):
+        return sum(self._viewers.values())
+
+    async def flush(self):
+        """
+        Refreshes every demanded key and publishes the viewer counts and demand, in a single round trip.
+        """
+        now = time.time()
+        keys = self._demanded | set(self._viewers.keys())
+        self._demanded = set()
+
+        viewers = defaultdict(int)
+        for key, n in self._viewers.items():
+            viewers[key.rsplit(":active", 1)[0]] += n
+        # Cams whose viewers went away are published once more, with zero viewers, and then forgotten.
+        for cam_key in self._published_viewers:
+            viewers.setdefault(cam_key, 0)
+
+        demand, self._demand = self._demand, {}
+        if len(keys) == 0 and len(viewers) == 0 and len(demand) == 0 and len(self._published_demand) == 0:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        for cam_key, cam_demand in demand.items():
+            self._write_demand(pipe, cam_key, cam_demand)
+        for cam_key in self._published_demand:
+            if cam_key not in demand:
+                pipe.hdel(cam_key + ":demand", self._process_id)
+        self._published_demand = demand
+
+        for key in keys:
+            pipe.setex(key, ACTIVE_TTL, 1)
+            self._flushed_at[key] = now
+        for cam_key, n in viewers.items():
+            viewers_key = cam_key + ":viewers:" + self._process_id
+            if n > 0:
+                pipe.setex(viewers_key, ACTIVE_TTL, n)
+            else:
+                pipe.delete(viewers_key)
+        await pipe.execute()
+
+        self._published_viewers = {cam_key: n for cam_key, n in viewers.items() if n > 0}
+        for key, flushed_at in list(self._flushed_at.items()):
+            if now - flushed_at > ACTIVE_TTL:
+                del self._flushed_at[key]
+
+    def _write_demand(self, pipe, cam_key, demand):
+        fps, width = demand
+        # Rounded up to an integer, as the feeder expects.
+        fps = int(math.ceil(fps))
+        pipe.hset(cam_key + ":demand", self._process_id, "{},{},{}".format(fps, width, int(time.time())))
+        pipe.expire(cam_key + ":demand", ACTIVE_TTL)
+
+    async def run(self):
+        """
+        Task that flushes the activity periodically.
+        """
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as ex:
+                print("[aio]: Could not flush the camera activity: {}".format(ex))
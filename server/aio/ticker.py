@@ -0,0 +1,95 @@
+"""
+Shared tick scheduler of the asyncio engine, as app/main/ticker.py: a single task per FPS tier wakes all the clients of
+the tier at wall-clock multiples of the period, and the frame of each camera is looked up once per tick.
+"""
+
+import asyncio
+import math
+import time
+
+
+class Ticker(object):
+
+    def __init__(self, fps, store, tickers):
+        self.fps = fps
+        self.period = 1.0 / fps
+        self.tick = 0
+
+        self._store = store
+        self._tickers = tickers  # Tickers of the process, by FPS. The ticker removes itself once it has no clients.
+        self._tick_event = asyncio.Event()
+        self._clients = 0
+        self._task = None
+
+        self._lookups = {}  # Cam -> future of the frame lookup of the current tick.
+        self._last_frames = {}  # Cam -> (seq, frame), so that unchanged frames are not transferred again.
+
+        self.jitters = []  # Recent wake-up delays, in seconds.
+
+    def subscribe(self):
+        self._clients += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def unsubscribe(self):
+        self._clients -= 1
+
+    async def wait(self):
+        """
+        Waits until the next tick.
+        :return: The tick number.
+        """
+        await self._tick_event.wait()
+        return self.tick
+
+    async def get_frame(self, cam_name):
+        """
+        Looks up the frame of the camera for the current tick. The first client of the tick starts the fetch, and all
+        of them get the same result.
+        :return: FetchedFrame. The frame is always set if there is one.
+        """
+        lookup = self._lookups.get(cam_name)
+        if lookup is None:
+            # The fetch runs in its own task rather than in the first client's, so that a client that disconnects
+            # (and is cancelled) while waiting does not leave the rest without a result.
+            lookup = asyncio.ensure_future(self._fetch(cam_name))
+            lookup.add_done_callback(_retrieve_exception)
+            self._lookups[cam_name] = lookup
+        return await asyncio.shield(lookup)
+
+    async def _fetch(self, cam_name):
+        last_seq, last_frame = self._last_frames.get(cam_name, (None, None))
+        fetched = await self._store.fetch_frame(cam_name, since_seq=last_seq, fps=self.fps)
+        if fetched.unchanged:
+            fetched = fetched._replace(frame=last_frame, unchanged=False)
+        elif fetched.frame is not None:
+            self._last_frames[cam_name] = (fetched.seq, fetched.frame)
+        else:
+            self._last_frames.pop(cam_name, None)
+        return fetched
+
+    async def _run(self):
+        try:
+            while self._clients > 0:
+                now = time.time()
+                scheduled = (math.floor(now / self.period) + 1) * self.period
+                await asyncio.sleep(scheduled - now)
+
+                self.jitters.append(max(time.time() - scheduled, 0))
+                del self.jitters[:-1000]
+
+                self.tick = int(round(scheduled / self.period))
+                self._lookups = {}
+                tick_event, self._tick_event = self._tick_event, asyncio.Event()
+                tick_event.set()
+        finally:
+            self._task = None
+            self._last_frames = {}
+            if self._tickers.get(self.fps) is self:
+                del self._tickers[self.fps]
+
+
+def _retrieve_exception(lookup):
+    # Retrieved, so that it is not reported as never retrieved if every client of the tick went away.
+    if not lookup.cancelled():
+        lookup.exception()
@@ -3,16 +3,14 @@ monkey.patch_all()
 
 from flask_socketio import SocketIO
 from flask import Flask
-from flask_bootstrap import Bootstrap
-from flask_mail import Mail
-from flask_moment import Moment
 from flask_redis import FlaskRedis
 
 from config import config
 
-bootstrap = Bootstrap()
-mail = Mail()
-moment = Moment()
+# Page extensions (see the PAGE_EXTENSIONS setting). None unless enabled.
+bootstrap = None
+mail = None
+moment = None
 # db = SQLAlchemy()
 socketio = SocketIO()
 rdb = FlaskRedis(strict=True)
@@ -26,12 +24,49 @@ def create_app(config_name):
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
+    if app.config['PAGE_EXTENSIONS']:
+        _init_page_extensions(app)
+    # db.init_app(app)
+
+    rdb.init_app(app)
+    socketio.init_app(app, async_mode='gevent', engine_io_logger=app.config['SOCKETIO_ENGINEIO_LOGGER'],
+                      message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                      channel=app.config['REDIS_PREFIX'] + '-socketio')
+
+    if app.config['FAST_PATH']:
+        # The hot frame routes skip the Flask dispatch.
+        from .main.fastpath import FastPath
+        app.wsgi_app = FastPath(app, app.wsgi_app)
+
+    return app
+
+
+def _init_page_extensions(app):
+    global bootstrap, mail, moment
+    from flask_bootstrap import Bootstrap
+    from flask_mail import Mail
+    from flask_moment import Moment
+
+    if bootstrap is None:
+        bootstrap, mail, moment = Bootstrap(), Mail(), Moment()
     bootstrap.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
-    # db.init_app(app)
 
-    rdb.init_app(app)
-    socketio.init_app(app, async_mode='gevent', engine_io_logger=True)
 
-    return app
\ No newline at end of file
+def warm_up(app):
+    """
+    Loads what the app would otherwise load on the first requests: the modules that are imported lazily, the static
+    assets and the Lua scripts. It does not connect to redis. Meant for a server process that preloads the app before
+    forking its workers (see gunicorn.conf.py), so that the workers start with them already loaded, and share their
+    memory.
+    :param app:
+    :return:
+    """
+    from PIL import Image, JpegImagePlugin
+    from .main.assets import get_not_available
+    from .main.redis_funcs import _get_fetch_frame_script
+
+    with app.app_context():
+        get_not_available()
+        _get_fetch_frame_script()
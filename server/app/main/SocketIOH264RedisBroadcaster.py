@@ -1,10 +1,19 @@
 import json
+import time
 
 import gevent
 from gevent import monkey
 monkey.patch_all()
 
-from app import socketio, rdb
+from flask import current_app
+
+from app import socketio
+from app.main import stats
+from app.main.egress import get_scheduler
+from app.main.hub import get_hub
+from app.main.redis_funcs import add_viewer, remove_viewer
+from app.main.h264_nal import NALSplitter, nal_type, is_slice, starts_access_unit, START_CODE, NAL_IDR, NAL_SPS, \
+    NAL_PPS
 
 
 class SocketIOH264RedisBroadcaster(object):
@@ -18,24 +27,74 @@ class SocketIOH264RedisBroadcaster(object):
     a different socktio channel (event name) in order to ensure that multiple users can eventually be seamlessly
     supported.
 
-    TODO: Exit the threadlet when inactive, or whatever.
+    Keyframe catch-up:
+     - Forwarding starts at the first IDR frame (or the SPS that precedes it), because the client cannot decode
+     anything before that.
+     - If the client requests it (ack=True in the 'start' event), it acks every NAL unit, and the broadcaster keeps
+     track of the bytes that have been sent but not acked yet. When they exceed the H264_CLIENT_QUEUE_BUDGET the
+     client is lagging: the incoming NAL units are discarded (P-frames cannot be skipped on their own) and the
+     client is resumed at the next IDR frame, once its queue has drained below half the budget.
+
+    Batching:
+     - If the client requests it (batch=True in the 'start' event), the NAL units of every picture (access unit) are
+     emitted together, as a single binary event with the concatenated NAL units (each still prefixed by its start
+     code), rather than one event per SPS, PPS, SEI and slice. An access unit is emitted as soon as the beginning of
+     the next one arrives, which is when its last NAL unit is complete anyway. In ack mode, the whole access unit is
+     acked at once.
+
+    Lifecycle:
+     - The broadcaster is started and stopped through the broadcaster registry. Once stopped, it exits within a second
+     (its hub subscription is polled).
     """
 
     SOCKETIO_NAMESPACE = "/h264"
 
-    FRAME_SEPARATOR = b'\x00\x00\x00\x01'
+    FRAME_SEPARATOR = START_CODE
+
+    # Default maximum number of un-acked bytes before a client is considered to be lagging.
+    DEFAULT_QUEUE_BUDGET = 512 * 1024
 
-    def __init__(self, cam_name, client_sid):
+    def __init__(self, cam_name, client_sid, ack=False, namespace=None, client_class=None, batch=False):
         """
         Creates the SocketIOMPEGRedisBroadcaster object.
         :param cam_name: Name of the camera.
         :param client_sid: SocketIO SID for the client that we will send the data to. (We cannot just use the flask
         request because I think we do not have access to it here).
+        :param ack: Whether the client acks the NAL units, so that its queue can be kept within budget.
+        :param namespace: Namespace to emit the NAL units to. If set (such as for the multiplexed /cams namespace),
+        they are tagged with the camera: {'cam': <cam>, 'nal': <nal>}. Otherwise they are emitted untagged to the /h264
+        namespace.
+        :param client_class: Client class, for the egress scheduler.
+        :param batch: Whether to emit the NAL units of every access unit together.
         """
         self._cam_name = cam_name
+        self._namespace = namespace or SocketIOH264RedisBroadcaster.SOCKETIO_NAMESPACE
+        self._tagged = namespace is not None
         self._channel = "{}/h264".format(cam_name)  # Redis channel to listen to.
         self._client_sid = client_sid
+        self._client_class = client_class
+        self._flow = None  # Egress flow. Only set while running.
         self._should_stop = False
+        self._last_activity = time.time()  # Time of the last NAL unit sent, or of the start.
+
+        # The broadcaster runs in its own greenlet, outside of the request context.
+        self._app = current_app._get_current_object()
+
+        self._ack = ack
+        self._queue_budget = current_app.config.get('H264_CLIENT_QUEUE_BUDGET',
+                                                    SocketIOH264RedisBroadcaster.DEFAULT_QUEUE_BUDGET)
+        self._unacked_bytes = 0
+
+        # We wait for a keyframe both at the beginning and when catching up.
+        self._waiting_for_keyframe = True
+        self._sps = None  # Latest SPS and PPS, to re-send them if we resume right at an IDR.
+        self._pps = None
+        self._resyncs = 0
+
+        # NAL units of the access unit being batched. Only used in batch mode.
+        self._batch = batch
+        self._batched = []
+        self._batched_picture = False  # Whether a slice has been batched already.
 
     def stop(self):
         """
@@ -45,15 +104,168 @@ class SocketIOH264RedisBroadcaster(object):
         """
         self._should_stop = True
 
-    def run(self):
+    def get_last_activity(self):
+        """
+        Time at which the last NAL unit was sent (or the broadcaster created, if none was).
+        :return:
+        """
+        return self._last_activity
 
-        print("Running SocketIO H264 Redis broadcaster")
+    def get_resyncs(self):
+        """
+        Number of times the client lagged beyond its budget and had to be resumed at a keyframe.
+        :return:
+        """
+        return self._resyncs
+
+    def _emit(self, nal):
+        """
+        Emits a NAL unit (or, in batch mode, an access unit) to the client. In ack mode, keeps track of the bytes that
+        are not acked yet.
+        :param nal:
+        :return:
+        """
+        self._last_activity = time.time()
+        stats.incr('h264_sio_emits')
+        payload = {'cam': self._cam_name, 'nal': nal} if self._tagged else nal
+
+        # The client is connected to this worker: the data does not need to go through the message queue, if any.
+        if not self._ack:
+            socketio.emit('stream', payload, namespace=self._namespace, room=self._client_sid, ignore_queue=True)
+            return
+
+        size = len(nal)
+        self._unacked_bytes += size
+
+        def on_ack(*args):
+            self._unacked_bytes -= size
+
+        socketio.emit('stream', payload, namespace=self._namespace, room=self._client_sid, callback=on_ack,
+                      ignore_queue=True)
+
+    def _forward(self, nal):
+        """
+        Forwards the NAL unit to the client, unless the client is lagging or we are waiting for a keyframe.
+        :param nal: NAL unit, prefixed by the start code.
+        :return:
+        """
+        ntype = nal_type(nal)
+        if ntype == NAL_SPS:
+            self._sps = nal
+        elif ntype == NAL_PPS:
+            self._pps = nal
+
+        if not self._waiting_for_keyframe and self._ack and self._unacked_bytes > self._queue_budget:
+            print("[h264]: Client [{}] is lagging ({} bytes queued). Resuming at the next keyframe.".format(
+                self._client_sid, self._unacked_bytes))
+            self._waiting_for_keyframe = True
+            self._discard_batch()
+            self._resyncs += 1
+            stats.incr('h264_resyncs')
+
+        if self._waiting_for_keyframe:
+            if ntype not in (NAL_SPS, NAL_IDR) or self._unacked_bytes > self._queue_budget / 2:
+                stats.incr('h264_nals_dropped')
+                return
+
+            self._waiting_for_keyframe = False
 
-        # First, we need to subscribe to the Redis channel.
-        rchannel = rdb.pubsub()
-        rchannel.subscribe([self._channel])
+            # If we resume right at the IDR the decoder still needs the parameter sets.
+            if ntype == NAL_IDR:
+                for parameter_set in (self._sps, self._pps):
+                    if parameter_set is not None:
+                        if self._batch:
+                            self._add_to_batch(parameter_set)
+                        else:
+                            self._emit(parameter_set)
 
-        print("Subscribed to REDIS channel...")
+        if self._batch:
+            self._add_to_batch(nal)
+            return
+
+        if self._flow is not None and not self._flow.send(len(nal)):
+            # The uplink is saturated. P-frames cannot be skipped on their own: resume at the next keyframe.
+            self._waiting_for_keyframe = True
+            stats.incr('h264_nals_dropped')
+            return
+
+        self._emit(nal)
+
+    def _add_to_batch(self, nal):
+        """
+        Adds a NAL unit to the access unit being batched. If it starts a new access unit, the batched one is emitted
+        first.
+        :param nal:
+        :return:
+        """
+        if self._batched_picture and starts_access_unit(nal):
+            self._flush_batch()
+        self._batched.append(nal)
+        if is_slice(nal):
+            self._batched_picture = True
+
+    def _flush_batch(self):
+        """
+        Emits the batched access unit, as a single event.
+        :return:
+        """
+        if not self._batched:
+            return
+        nals = len(self._batched)
+        access_unit = b''.join(self._batched)
+        self._batched = []
+        self._batched_picture = False
+
+        if self._flow is not None and not self._flow.send(len(access_unit)):
+            # The uplink is saturated. P-frames cannot be skipped on their own: resume at the next keyframe.
+            self._waiting_for_keyframe = True
+            stats.incr('h264_nals_dropped', nals)
+            return
+
+        self._emit(access_unit)
+
+    def _discard_batch(self):
+        """
+        Drops the access unit being batched, such as when the client is resynced at a keyframe.
+        :return:
+        """
+        if self._batched:
+            stats.incr('h264_nals_dropped', len(self._batched))
+        self._batched = []
+        self._batched_picture = False
+
+    def _feed(self, splitter, data):
+        """
+        Forwards the NAL units completed by a chunk of the stream.
+        :param splitter: NALSplitter of the stream.
+        :param data: Chunk, as received from the Redis channel.
+        :return:
+        """
+        # For the H.264 format, the client expects to receive the packets split by \x00\x00\x00\x01.
+        for nal in splitter.feed(data):
+            self._forward(nal)
+
+        # The batched access unit is complete as soon as the next one starts, even if the NAL unit that starts it has
+        # not fully arrived yet.
+        if self._batched_picture:
+            upcoming = splitter.peek()
+            if upcoming is not None and starts_access_unit(upcoming):
+                self._flush_batch()
+
+    def run(self):
+        with self._app.app_context():
+            add_viewer(self._cam_name, 'h264')
+            # The NAL units share the uplink of the worker with the other streams.
+            self._flow = get_scheduler().open_flow(self._cam_name, self._client_class)
+            try:
+                self._run()
+            finally:
+                self._flow.close()
+                remove_viewer(self._cam_name, 'h264')
+
+    def _run(self):
+
+        print("Running SocketIO H264 Redis broadcaster")
         print("We are serving client {}...".format(self._client_sid))
 
         # NOTE: This is here for reference, and the client still supports canvas initialization, but it is no longer
@@ -69,31 +281,21 @@ class SocketIOH264RedisBroadcaster(object):
         # socketio.emit('cmd', json.dumps(init), namespace=SocketIOH264RedisBroadcaster.SOCKETIO_NAMESPACE,
         #       room=self._client_sid)
 
-        buffer = bytearray()
-
-        while not self._should_stop:
-
-            for item in rchannel.listen():
-
-                # Print commented out because it works and spams the console.
-                # print('Received: {}'.format(item))
-                if item['type'] == 'message':
-                    # print('Emitting {}'.format(repr(item)))
-                    buffer.extend(item['data'])
-
-                    while True:
-                        # Try to extract a packet.
-                        splits = buffer.split(SocketIOH264RedisBroadcaster.FRAME_SEPARATOR, 1)
-                        if len(splits) < 2:
-                            break
+        splitter = NALSplitter()
 
-                        packet, buffer = splits[:]
+        # The channel is subscribed to once per worker process, and fanned out to its viewers by the hub.
+        with get_hub().subscribe(self._channel) as subscription:
+            for data in subscription.messages(lambda: self._should_stop):
+                if data is None:
+                    # We lagged behind the hub and lost data: resume at the next keyframe.
+                    splitter = NALSplitter()
+                    self._waiting_for_keyframe = True
+                    self._discard_batch()
+                    self._resyncs += 1
+                    stats.incr('h264_resyncs')
+                    continue
 
-                        # For the H.264 format, the client expects to receive the packets split by \x00\x00\x00\x01.
-                        socketio.emit('stream', SocketIOH264RedisBroadcaster.FRAME_SEPARATOR + packet, namespace=SocketIOH264RedisBroadcaster.SOCKETIO_NAMESPACE,
-                                      room=self._client_sid)
-                else:
-                    print("Msg of type: {}".format(item['type']))
-                    pass
+                self._feed(splitter, data)
 
-        print("OUT")
+        print("SocketIO H264 broadcaster stopped for client [{}]. Resyncs: {}.".format(self._client_sid,
+                                                                                        self._resyncs))
@@ -5,7 +5,15 @@ monkey.patch_all()
 import time
 
 from flask import current_app
-from app import socketio, rdb
+from app import socketio
+from app.main import stats
+from app.main.assets import get_not_available
+from app.main.delivery import FrameDelivery, NOT_AVAILABLE
+from app.main.egress import get_scheduler
+from app.main.multipart import get_part_cache
+from app.main.rate_control import AdaptiveQuality, reencode
+from app.main.redis_funcs import add_viewer, remove_viewer
+from app.main.ticker import get_ticker
 
 
 class SocketIOMJPEGBroadcaster(object):
@@ -17,18 +25,50 @@ class SocketIOMJPEGBroadcaster(object):
      - Clients start receiving the stream by sending a 'start' event.
      - The 'frame' events are directed to the specific client.
 
+    Flow control:
+     - If the client requests it (ack=True in the 'start' event) every frame is emitted with an acknowledgement
+     callback, and the client is expected to ack each frame once it has rendered it. At most one frame is
+     in-flight (sent but not yet acked) and at most one frame is pending. A newer frame replaces the pending one
+     (latest frame wins), so that slow links never make frames pile up in the engine.io queues.
+     - The effective FPS adapts to the client: frames are never emitted faster than they are acked.
+     - Clients that do not ack are served at the target FPS, as before.
+     - In ack mode, if the client asks for it (quality='auto' in the 'start' event), the throughput of the client is
+     estimated from the ack round trip times, and it is sent smaller or more compressed frames (MJPEG_QUALITY_LADDER)
+     when it cannot take the full frames at the target FPS.
+     - Frames are only sent when they change (or, if the client asks for a keepalive, every <keepalive> seconds).
+
     Possible improvements:
      - It might be possible and more efficient to truly broadcast to a room, but in that case
      there would be a single instance of this class.
 
-    Issues:
-     - We need an efficient way to know when we should exit the threadlet (remote user no longer listening).
+    Lifecycle:
+     - The broadcaster is started and stopped through the broadcaster registry, which stops it when the client
+     disconnects or is idle.
     """
 
     SOCKETIO_NAMESPACE = '/mjpeg'
 
-    def __init__(self, cam_name, client_sid, fps=5):
+    # If an ack takes longer than this (in seconds) we assume it was lost and stop waiting for it, so that a single
+    # lost ack does not stall the stream forever.
+    ACK_TIMEOUT = 5
+
+    # Weight of the latest ack round trip time in its moving average.
+    RTT_ALPHA = 0.2
+
+    def __init__(self, cam_name, client_sid, fps=5, ack=False, keepalive=None, namespace=None, client_class=None,
+                 adaptive_quality=False):
+        """
+        :param namespace: Namespace to emit the frames to. If set (such as for the multiplexed /cams namespace), the
+        frames are tagged with the camera: {'cam': <cam>, 'frame': <frame>}. Otherwise the frames are emitted
+        untagged to the /mjpeg namespace.
+        :param client_class: Client class, for the egress scheduler.
+        :param adaptive_quality: Whether to adapt the quality of the frames to the throughput of the client. Only in
+        ack mode.
+        """
         self._cam_name = cam_name
+        self._namespace = namespace or SocketIOMJPEGBroadcaster.SOCKETIO_NAMESPACE
+        self._tagged = namespace is not None
+        self._client_class = client_class
         self._fps = fps
         self._target_sleep = 1.0 / self._fps
         self._should_stop = False
@@ -36,7 +76,28 @@ class SocketIOMJPEGBroadcaster(object):
         print("CLIENT SID IS: ", client_sid)
         self._client_sid = client_sid
 
-        self._cam_key = '{}:cams:{}'.format(current_app.config['REDIS_PREFIX'], self._cam_name)
+        # The broadcaster runs in its own greenlet, outside of the request context.
+        self._app = current_app._get_current_object()
+
+        # Flow control state. Only used in ack mode.
+        self._ack = ack
+        self._in_flight = False  # Whether a frame has been sent but not acked yet.
+        self._in_flight_since = None  # Time at which the in-flight frame was emitted.
+        self._pending = None  # Latest frame that could not be sent yet because another one was in flight.
+        self._rtt = None  # Moving average of the ack round trip time.
+        self._in_flight_size = 0  # Size of the in-flight frame.
+
+        # Quality of the frames, adapted to the throughput measured through the acks.
+        self._quality = None
+        if ack and adaptive_quality:
+            self._quality = AdaptiveQuality(self._app.config['MJPEG_QUALITY_LADDER'], fps)
+
+        self._frames_sent = 0
+        self._frames_dropped = 0
+        self._last_activity = time.time()  # Time of the last frame sent, or of the start.
+
+        # Frames are only sent when they change, or every <keepalive> seconds.
+        self._delivery = FrameDelivery(keepalive)
 
     def stop(self):
         """
@@ -45,34 +106,195 @@ class SocketIOMJPEGBroadcaster(object):
         :return:
         """
         self._should_stop = True
+        self._set_pending(None)
+        self._set_in_flight(False)
+
+    def get_queue_depth(self):
+        """
+        Number of frames currently queued for this client: the in-flight one plus the pending one.
+        :return:
+        """
+        return int(self._in_flight) + int(self._pending is not None)
+
+    def get_last_activity(self):
+        """
+        Time at which the last frame was sent (or the broadcaster created, if none was).
+        :return:
+        """
+        return self._last_activity
+
+    def get_frames_dropped(self):
+        """
+        Number of frames that were replaced by a newer one before they could be sent.
+        :return:
+        """
+        return self._frames_dropped
+
+    def get_effective_fps(self):
+        """
+        FPS the client is actually being served at. In ack mode, it is bounded by the ack round trip time.
+        :return:
+        """
+        return 1.0 / self._get_frame_period()
+
+    def _get_frame_period(self):
+        """
+        Time between frames, bounded both by the target FPS and, in ack mode, by how fast the client acks.
+        :return:
+        """
+        if self._ack and self._rtt is not None:
+            return max(self._target_sleep, self._rtt)
+        return self._target_sleep
+
+    def _set_in_flight(self, in_flight):
+        if in_flight != self._in_flight:
+            stats.gauge_add('mjpeg_sio_queue_depth', 1 if in_flight else -1)
+        self._in_flight = in_flight
+        self._in_flight_since = time.time() if in_flight else None
+
+    def _set_pending(self, frame):
+        if (frame is None) != (self._pending is None):
+            stats.gauge_add('mjpeg_sio_queue_depth', -1 if frame is None else 1)
+        self._pending = frame
+
+    def _emit(self, frame):
+        """
+        Emits the frame to the client. In ack mode, asks the client for an acknowledgement.
+        :param frame:
+        :return:
+        """
+        self._frames_sent += 1
+        self._last_activity = time.time()
+        stats.incr('mjpeg_sio_frames_sent')
+
+        payload = {'cam': self._cam_name, 'frame': frame} if self._tagged else frame
+
+        # The client is connected to this worker: the frame does not need to go through the message queue, if any.
+        if not self._ack:
+            socketio.emit('frame', payload, namespace=self._namespace, room=self._client_sid, ignore_queue=True)
+            return
+
+        self._set_in_flight(True)
+        self._in_flight_size = len(frame)
+        socketio.emit('frame', payload, namespace=self._namespace, room=self._client_sid, callback=self._on_ack,
+                      ignore_queue=True)
+
+    def _offer(self, frame):
+        """
+        Offers a new frame to the client. It is sent immediately unless a frame is in-flight, in which case it
+        becomes the pending frame, replacing (and dropping) any previous pending one.
+        :param frame:
+        :return:
+        """
+        if not self._ack:
+            self._emit(frame)
+            return
+
+        if self._in_flight and time.time() - self._in_flight_since > SocketIOMJPEGBroadcaster.ACK_TIMEOUT:
+            print("[mjpeg]: Ack timed out for client [{}]".format(self._client_sid))
+            stats.incr('mjpeg_sio_ack_timeouts')
+            self._set_in_flight(False)
+
+        if self._in_flight:
+            if self._pending is not None:
+                self._frames_dropped += 1
+                stats.incr('mjpeg_sio_frames_dropped')
+            self._set_pending(frame)
+        else:
+            self._emit(frame)
+
+    def _on_ack(self, *args):
+        """
+        Called when the client acknowledges the in-flight frame.
+        :return:
+        """
+        if not self._in_flight:
+            # Late ack for a frame that had already timed out.
+            return
+
+        rtt = time.time() - self._in_flight_since
+        if self._rtt is None:
+            self._rtt = rtt
+        else:
+            self._rtt = (1 - SocketIOMJPEGBroadcaster.RTT_ALPHA) * self._rtt + SocketIOMJPEGBroadcaster.RTT_ALPHA * rtt
+
+        if self._quality is not None and self._quality.record(self._in_flight_size, rtt):
+            width, quality = self._quality.get_rung()
+            print("[mjpeg]: Serving cam {} to client [{}] at width {} and quality {}".format(
+                self._cam_name, self._client_sid, width or 'original', quality or 'original'))
+
+        self._set_in_flight(False)
+
+        if self._pending is not None and not self._should_stop:
+            frame = self._pending
+            self._set_pending(None)
+            self._emit(frame)
+
+    def _get_rung_frame(self, seq, frame):
+        """
+        Returns the frame at the current rung of the adaptive quality. Every rung is encoded once per frame, and shared
+        with the other clients (including the MJPEG HTTP streams) through the part cache.
+        :return:
+        """
+        width, quality = self._quality.get_rung()
+        if not width and not quality:
+            return frame
+        return get_part_cache().get_frame(self._cam_name, (0, False, False, False, False, width, quality), seq, frame,
+                                          lambda original: reencode(original, width, quality))
 
     def run(self):
-        print("Running SocketIO MJPEG broadcaster at {} target FPS".format(self._fps))
+        with self._app.app_context():
+            add_viewer(self._cam_name)
+            try:
+                self._run()
+            finally:
+                remove_viewer(self._cam_name)
 
-        not_available = open("app/static/no_image_available.png", "rb").read()
+    def _run(self):
+        print("Running SocketIO MJPEG broadcaster at {} target FPS".format(self._fps))
 
-        while not self._should_stop:
+        not_available = get_not_available()
 
-            frame_start_time = time.time()
+        # The broadcasters of the same FPS tier are woken together by a shared ticker, which also fetches the frame
+        # once per tick for all of them.
+        ticker = get_ticker(self._fps)
+        # The frames share the uplink of the worker with the other streams.
+        flow = get_scheduler().open_flow(self._cam_name, self._client_class)
+        ticker.subscribe()
+        try:
+            last_offer_time = 0
+            while not self._should_stop:
+                ticker.wait()
 
-            frame = rdb.get(self._cam_key + ":lastframe")
+                # In ack mode the client may be slower than the target FPS: ticks are skipped until a frame period
+                # (bounded by the ack round trip time) has elapsed. Half a tick of slack absorbs the wake-up jitter.
+                if time.time() - last_offer_time < self._get_frame_period() - self._target_sleep / 2:
+                    continue
 
-            # Mark the cam as active. This signals the feeder so that it starts working on this. It could potentially
-            # be made more efficient by working in a background
-            # thread, but that would be overkill for now.
-            rdb.setex(self._cam_key + ":active", 30, 1)
+                # Marks the cam as active (which signals the feeder so that it starts working on this) and fetches
+                # the frame in a single round trip.
+                fetched = ticker.get_frame(self._cam_name)
 
-            if frame is not None:
-                r = socketio.emit('frame', frame, namespace=SocketIOMJPEGBroadcaster.SOCKETIO_NAMESPACE,
-                              room=self._client_sid)
-            else:
-                r = socketio.emit('frame', not_available, namespace=SocketIOMJPEGBroadcaster.SOCKETIO_NAMESPACE,
-                              room=self._client_sid)
+                # Unchanged frames are not sent again.
+                frame_id = fetched.seq if fetched.frame is not None else NOT_AVAILABLE
+                if not self._delivery.should_send(frame_id):
+                    continue
+                frame = fetched.frame if fetched.frame is not None else not_available
+                if fetched.frame is not None and self._quality is not None:
+                    frame = self._get_rung_frame(fetched.seq, frame)
 
-            time_to_sleep = self._target_sleep - (time.time() - frame_start_time)
-            if(time_to_sleep < 0):
-                time_to_sleep = 0
+                if not flow.send(len(frame)):
+                    # The uplink is saturated: a later frame will be sent instead.
+                    self._frames_dropped += 1
+                    stats.incr('mjpeg_sio_frames_dropped')
+                    continue
+                last_offer_time = time.time()
 
-            gevent.sleep(time_to_sleep)
+                self._offer(frame)
+                self._delivery.sent(frame_id)
+        finally:
+            ticker.unsubscribe()
+            flow.close()
 
-        print("SocketIO MJPEG broadcaster stopped for client [{}]".format(self._client_sid))
+        print("SocketIO MJPEG broadcaster stopped for client [{}]. Sent: {}. Dropped: {}.".format(
+            self._client_sid, self._frames_sent, self._frames_dropped))
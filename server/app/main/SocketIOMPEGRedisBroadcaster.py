@@ -4,8 +4,14 @@ from gevent import monkey
 monkey.patch_all()
 
 import struct
+import time
 
-from app import socketio, rdb
+from flask import current_app
+
+from app import socketio
+from app.main import stats
+from app.main.egress import get_scheduler
+from app.main.hub import get_hub
 from io import BytesIO
 
 
@@ -21,31 +27,48 @@ class SocketIOMPEGRedisBroadcaster(object):
     a different socktio channel (event name) in order to ensure that multiple users can eventually be seamlessly
     supported.
 
-    TODO: Exit the threadlet when inactive, or whatever.
+    The broadcaster is started and stopped through the broadcaster registry. Once stopped, it exits within a second
+    (its hub subscription is polled).
     """
 
     SOCKETIO_NAMESPACE = "/mpeg"
 
-    def __init__(self, cam_name, client_sid):
+    def __init__(self, cam_name, client_sid, client_class=None):
         """
         Creates the SocketIOMPEGRedisBroadcaster object.
         :param cam_name: Name of the camera.
         :param client_sid: SocketIO SID for the client that we will send the data to. (We cannot just use the flask
         request because I think we do not have access to it here).
+        :param client_class: Client class, for the egress scheduler.
         """
         self._cam_name = cam_name
         self._channel = "{}/mpeg".format(cam_name)  # Redis channel to listen to.
         self._client_sid = client_sid
+        self._client_class = client_class
+        self._should_stop = False
+        self._last_activity = time.time()  # Time of the last data sent, or of the start.
+
+        # The broadcaster runs in its own greenlet, outside of the request context.
+        self._app = current_app._get_current_object()
+
+    def stop(self):
+        """
+        Stops the broadcaster. It should be stopped, for instance, when the client loses connection.
+        :return:
+        """
+        self._should_stop = True
+
+    def get_last_activity(self):
+        return self._last_activity
 
     def run(self):
+        with self._app.app_context():
+            self._run()
 
-        print("Running SocketIO MPEG Redis broadcaster")
+    def _run(self):
 
-        # First, we need to subscribe to the Redis channel.
-        rchannel = rdb.pubsub()
-        rchannel.subscribe([self._channel])
+        print("Running SocketIO MPEG Redis broadcaster")
 
-        print("Subscribed to REDIS channel...")
         print("We are serving client {}...".format(self._client_sid))
 
         b = BytesIO()
@@ -59,20 +82,24 @@ class SocketIOMPEGRedisBroadcaster(object):
 
         print('Emitted to "stream" on namespace {}'.format(SocketIOMPEGRedisBroadcaster.SOCKETIO_NAMESPACE))
 
+        # The client is connected to this worker: the data does not need to go through the message queue, if any.
         socketio.emit('stream', b.getvalue(), namespace=SocketIOMPEGRedisBroadcaster.SOCKETIO_NAMESPACE,
-                      room=self._client_sid)
-
-        while True:
-            for item in rchannel.listen():
-
-                # Print commented out because it works and spams the console.
-                # print('Received: {}'.format(item))
-                if item['type'] == 'message':
-                    # print('Emitting {}'.format(repr(item)))
-                    socketio.emit('stream', item['data'], namespace=SocketIOMPEGRedisBroadcaster.SOCKETIO_NAMESPACE,
-                                  room=self._client_sid)
-                else:
-                    print("Msg of type: {}".format(item['type']))
-                    pass
-
-        print("OUT")
+                      room=self._client_sid, ignore_queue=True)
+
+        # The channel is subscribed to once per worker process, and fanned out to its viewers by the hub.
+        # The data shares the uplink of the worker with the other streams.
+        with get_hub().subscribe(self._channel) as subscription, \
+                get_scheduler().open_flow(self._cam_name, self._client_class) as flow:
+            for data in subscription.messages(lambda: self._should_stop):
+                if data is None:
+                    # Data was lost because we lagged behind. MPEG-1 recovers on its own.
+                    continue
+                if not flow.send(len(data)):
+                    # The uplink is saturated. Dropped data is like lost data.
+                    stats.incr('mpeg_chunks_dropped')
+                    continue
+                self._last_activity = time.time()
+                socketio.emit('stream', data, namespace=SocketIOMPEGRedisBroadcaster.SOCKETIO_NAMESPACE,
+                              room=self._client_sid, ignore_queue=True)
+
+        print("SocketIO MPEG broadcaster stopped for client [{}].".format(self._client_sid))
@@ -3,4 +3,4 @@ from flask import Blueprint
 
 main = Blueprint('main', __name__)
 
-from . import views, events, errors
\ No newline at end of file
+from . import views, events, errors, websockets, hls, mosaic, batch
@@ -0,0 +1,233 @@
+"""
+Coalesced activity marking.
+
+Cameras are marked active (through their :active or :active:<fmt> keys, with a TTL) so that the feeder works on them.
+Rather than refreshing the key for every served frame, every server process records the demand in memory and
+refreshes all the keys that were demanded through a single pipelined flush every ACTIVITY_FLUSH_INTERVAL seconds.
+Keys that were not active yet are written immediately, so that the feeder starts as soon as possible.
+
+Along with the activity, the tracker publishes the highest frame rate and width that the viewers of every camera
+requested, so that the feeders do not work more than needed. Every process keeps a field in the
+<prefix>:cams:<cam>:demand hash, with "<fps>,<width>,<timestamp>" as value (0 meaning no limit). Demand increases are
+written immediately. Marks that do not specify any demand leave it unchanged.
+
+The tracker also counts the viewers (open streams) of every camera. Keys with viewers are kept active even if they do
+not request frames (such as pub/sub based streams), and the counts are published in per-process keys:
+<prefix>:cams:<cam>:viewers:<host>:<pid>.
+"""
+
+import math
+import os
+import socket
+import time
+from collections import defaultdict
+
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
+from flask import current_app
+
+from app import rdb
+from . import stats
+
+# Seconds that a camera stays active after it was last flushed.
+ACTIVE_TTL = 30
+
+
+class ActivityTracker(object):
+
+    def __init__(self, redis_prefix, flush_interval):
+        self._redis_prefix = redis_prefix
+        self._flush_interval = flush_interval
+        self._process_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+        self._demanded = set()  # Active keys demanded since the last flush.
+        self._flushed_at = {}  # Active key -> time at which it was last written.
+        self._viewers = defaultdict(int)  # Active key -> number of open streams.
+
+        self._published_viewers = {}  # Cam -> viewer count published in the last flush.
+
+        self._demand = {}  # Cam -> (fps, width) demanded since the last flush.
+        self._published_demand = {}  # Cam -> (fps, width) published.
+
+    def mark(self, active_key, fps=None, width=None):
+        """
+        Records demand for the active key. Only writes to redis if the key is not known to be active, or if the demand
+        is higher than the published one.
+        :param active_key: <prefix>:cams:<cam>:active or <prefix>:cams:<cam>:active:<fmt>
+        :param fps: Frame rate that the viewer needs. 0 for no limit, None if unknown.
+        :param width: Width that the viewer needs. 0 for full resolution, None if unknown.
+        :return:
+        """
+        flushed_at = self._flushed_at.get(active_key)
+        if flushed_at is None or time.time() - flushed_at > ACTIVE_TTL - self._flush_interval:
+            rdb.setex(active_key, ACTIVE_TTL, 1)
+            self._flushed_at[active_key] = time.time()
+            stats.incr('activity_writes')
+        else:
+            self._demanded.add(active_key)
+
+        # Marks without any demand (such as the ones of new viewers or H.264 streams) only keep the key active. Taking
+        # them as "no limit" would make the feeder work at its full rate until the next flush.
+        if fps is None and width is None:
+            return
+
+        cam_key = self._cam_of(active_key)
+        demand = merge_demand(self._demand.get(cam_key), (fps or 0, width or 0))
+        self._demand[cam_key] = demand
+
+        published = self._published_demand.get(cam_key)
+        if published is None or merge_demand(published, demand) != published:
+            published = merge_demand(published, demand)
+            pipe = rdb.pipeline(transaction=False)
+            self._write_demand(pipe, cam_key, published)
+            pipe.execute()
+            self._published_demand[cam_key] = published
+            stats.incr('demand_writes')
+
+    def add_viewer(self, active_key):
+        """
+        Registers an open stream. The key is kept active until the viewer is removed.
+        :param active_key:
+        :return:
+        """
+        self._viewers[active_key] += 1
+        self.mark(active_key)
+
+    def remove_viewer(self, active_key):
+        self._viewers[active_key] -= 1
+        if self._viewers[active_key] <= 0:
+            del self._viewers[active_key]
+
+    def get_viewers(self, cam_name):
+        """
+        Number of open streams of this process for the camera, in any format.
+        :param cam_name:
+        :return:
+        """
+        cam_key = self._cam_key(cam_name)
+        return sum(n for key, n in self._viewers.items() if self._cam_of(key) == cam_key)
+
+    def flush(self):
+        """
+        Refreshes every demanded key and publishes the viewer counts, in a single round trip.
+        :return:
+        """
+        now = time.time()
+        keys = self._demanded | set(self._viewers.keys())
+        self._demanded = set()
+
+        viewers = defaultdict(int)
+        for key, n in self._viewers.items():
+            viewers[self._cam_of(key)] += n
+
+        # Cams whose viewers went away are published once more, with zero viewers, and then forgotten.
+        for cam_key in self._published_viewers:
+            viewers.setdefault(cam_key, 0)
+
+        demand, self._demand = self._demand, {}
+
+        if len(keys) == 0 and len(viewers) == 0 and len(demand) == 0 and len(self._published_demand) == 0:
+            return
+
+        pipe = rdb.pipeline(transaction=False)
+
+        for cam_key, cam_demand in demand.items():
+            self._write_demand(pipe, cam_key, cam_demand)
+        for cam_key in self._published_demand:
+            if cam_key not in demand:
+                pipe.hdel(cam_key + ":demand", self._process_id)
+        self._published_demand = demand
+
+        for key in keys:
+            pipe.setex(key, ACTIVE_TTL, 1)
+            self._flushed_at[key] = now
+        for cam_key, n in viewers.items():
+            viewers_key = cam_key + ":viewers:" + self._process_id
+            if n > 0:
+                pipe.setex(viewers_key, ACTIVE_TTL, n)
+            else:
+                pipe.delete(viewers_key)
+            stats.gauge_set('viewers:' + cam_key.rsplit(':', 1)[-1], n)
+        pipe.execute()
+
+        self._published_viewers = {cam_key: n for cam_key, n in viewers.items() if n > 0}
+
+        # Keys that expired in redis will be written immediately on their next demand.
+        for key, flushed_at in list(self._flushed_at.items()):
+            if now - flushed_at > ACTIVE_TTL:
+                del self._flushed_at[key]
+
+        stats.incr('activity_flushes')
+        stats.incr('activity_writes', len(keys))
+
+    def _write_demand(self, pipe, cam_key, demand):
+        fps, width = demand
+        # The feeder parses integers, and fractional rates (such as a Socket.IO tfps of 7.5) are rounded up so that
+        # the clients still get every frame they asked for.
+        fps = int(math.ceil(fps))
+        pipe.hset(cam_key + ":demand", self._process_id, "{},{},{}".format(fps, width, int(time.time())))
+        pipe.expire(cam_key + ":demand", ACTIVE_TTL)
+        stats.gauge_set('demand_fps:' + cam_key.rsplit(':', 1)[-1], fps)
+
+    def run(self):
+        """
+        Greenlet that flushes the demand periodically.
+        :return:
+        """
+        while True:
+            gevent.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                print("Could not flush the camera activity: {}".format(ex))
+
+    def _cam_key(self, cam_name):
+        return self._redis_prefix + ":cams:" + cam_name
+
+    @staticmethod
+    def _cam_of(active_key):
+        return active_key.rsplit(":active", 1)[0]
+
+
+def merge_demand(a, b):
+    """
+    Combines two (fps, width) demands into the one that satisfies both. 0 means no limit.
+    :param a: Demand, or None.
+    :param b: Demand.
+    :return:
+    """
+    if a is None:
+        return b
+    return tuple(0 if x == 0 or y == 0 else max(x, y) for x, y in zip(a, b))
+
+
+# Activity tracker of this process. Created on first use, so that every worker process gets its own.
+_tracker = None
+_flush_greenlet = None
+
+
+def get_tracker():
+    """
+    Returns the activity tracker of this process.
+    :return:
+    """
+    global _tracker, _flush_greenlet
+    if _tracker is None:
+        config = current_app.config
+        _tracker = ActivityTracker(config['REDIS_PREFIX'], config['ACTIVITY_FLUSH_INTERVAL'])
+        _flush_greenlet = gevent.spawn(_tracker.run)
+    return _tracker
+
+
+def reset():
+    """
+    Drops the activity tracker of this process. Mostly useful for testing.
+    :return:
+    """
+    global _tracker, _flush_greenlet
+    if _flush_greenlet is not None:
+        _flush_greenlet.kill()
+    _tracker = None
+    _flush_greenlet = None
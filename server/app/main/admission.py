@@ -0,0 +1,252 @@
+"""
+Admission control for the streaming endpoints.
+
+Every new stream (MJPEG over HTTP, WebSocket or Socket.IO, H.264, MPEG, mosaics) asks the admission controller of its
+worker process for a ticket, and releases it when the stream ends. The controller compares the load of the worker
+against the configured limits (0 disables a limit):
+
+    ADMISSION_MAX_STREAMS: concurrent streams of the worker.
+    ADMISSION_MAX_CAM_STREAMS: concurrent streams of a single camera.
+    ADMISSION_MAX_EGRESS: aggregate bytes per second sent by the worker.
+    ADMISSION_MAX_HUB_LAG: seconds that the tickers fire late, which tells how saturated the gevent hub is.
+
+Below ADMISSION_DEGRADE_RATIO of every limit, streams are admitted as requested. Above it, new streams that can be
+degraded are admitted at ADMISSION_DEGRADED_FPS (and, where supported, as ADMISSION_DEGRADED_WIDTH thumbnails). At the
+limit, new streams are refused: HTTP clients get a 503 with a Retry-After header, and Socket.IO and WebSocket clients
+the equivalent. Streams that are already being served are never affected, so that a surge of new clients does not
+degrade everyone together.
+
+The limits, current load and rejections are reported by /healthcheck.
+"""
+
+import random
+import time
+from collections import defaultdict
+
+from flask import current_app, make_response
+
+from . import stats
+from .ticker import TICKERS
+
+
+class Ticket(object):
+    """
+    Outcome of an admission request. Admitted tickets must be released when the stream ends.
+    """
+
+    def __init__(self, controller, cam_name, admitted, fps, width=None, reason=None, retry_after=None):
+        self._controller = controller
+        self.cam_name = cam_name
+        self.admitted = admitted
+        self.degraded = False
+        self.fps = fps
+        self.width = width
+        self.reason = reason
+        self.retry_after = retry_after
+        self._released = not admitted
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+
+class AdmissionController(object):
+
+    # Seconds over which the egress rate is measured.
+    EGRESS_WINDOW = 1.0
+
+    def __init__(self, max_streams, max_cam_streams, max_egress, max_hub_lag, degrade_ratio, degraded_fps,
+                 degraded_width, retry_after):
+        """
+        :param max_streams: Maximum number of concurrent streams (0 for no limit).
+        :param max_cam_streams: Maximum number of concurrent streams of a camera (0 for no limit).
+        :param max_egress: Maximum egress, in bytes per second (0 for no limit).
+        :param max_hub_lag: Maximum ticker lateness, in seconds (0 for no limit).
+        :param degrade_ratio: Fraction of the limits above which new streams are degraded.
+        :param degraded_fps: FPS of the degraded streams.
+        :param degraded_width: Width of the degraded streams, where supported (0 to keep the original size).
+        :param retry_after: Seconds after which refused clients should retry. The actual value is spread over up to
+        twice that, so that a refused surge does not come back all at once.
+        """
+        self._max_streams = max_streams
+        self._max_cam_streams = max_cam_streams
+        self._max_egress = max_egress
+        self._max_hub_lag = max_hub_lag
+        self._degrade_ratio = degrade_ratio
+        self._degraded_fps = degraded_fps
+        self._degraded_width = degraded_width
+        self._retry_after = retry_after
+
+        self._streams = 0
+        self._cam_streams = defaultdict(int)
+
+        self._egress = 0  # Bytes per second, over the last window.
+        self._egress_bytes = stats.COUNTERS['egress_bytes']
+        self._egress_time = time.time()
+
+    def admit(self, cam_name, fps, can_degrade=True):
+        """
+        Decides whether a new stream is admitted.
+        :param cam_name: Camera of the stream, or None if it is not a single camera (such as a mosaic).
+        :param fps: Requested FPS.
+        :param can_degrade: Whether the stream can be served at a lower FPS (H.264, for instance, cannot).
+        :return: Ticket
+        """
+        load, reason = self.get_load(cam_name)
+
+        if load >= 1:
+            retry_after = random.randint(self._retry_after, 2 * self._retry_after)
+            stats.incr('admission_rejected')
+            stats.incr('admission_rejected:' + reason)
+            print("[admission]: Refusing a stream of {} ({} limit reached). Retry after {}s.".format(
+                cam_name, reason, retry_after))
+            return Ticket(self, cam_name, False, fps, reason=reason, retry_after=retry_after)
+
+        ticket = Ticket(self, cam_name, True, fps)
+        if load >= self._degrade_ratio and can_degrade:
+            ticket.degraded = True
+            ticket.reason = reason
+            ticket.fps = min(fps, self._degraded_fps)
+            ticket.width = self._degraded_width or None
+            stats.incr('admission_degraded')
+
+        self._streams += 1
+        if cam_name is not None:
+            self._cam_streams[cam_name] += 1
+        stats.incr('admission_admitted')
+        stats.gauge_set('admission_streams', self._streams)
+        return ticket
+
+    def get_load(self, cam_name=None):
+        """
+        Returns the load of the worker (and camera) relative to the limits: 1 means that a limit is reached.
+        :param cam_name:
+        :return: (load, name of the limit that is the closest to being reached)
+        """
+        loads = [(0, None)]
+        if self._max_streams:
+            loads.append((self._streams / self._max_streams, 'streams'))
+        if self._max_cam_streams and cam_name is not None:
+            loads.append((self._cam_streams.get(cam_name, 0) / self._max_cam_streams, 'cam_streams'))
+        if self._max_egress:
+            loads.append((self.get_egress() / self._max_egress, 'egress'))
+        if self._max_hub_lag:
+            loads.append((self.get_hub_lag() / self._max_hub_lag, 'hub_lag'))
+        return max(loads, key=lambda l: l[0])
+
+    def get_egress(self):
+        """
+        Bytes per second sent by the streams of this worker (as counted in the egress_bytes counter), over the last
+        EGRESS_WINDOW seconds.
+        :return:
+        """
+        now = time.time()
+        elapsed = now - self._egress_time
+        if elapsed >= AdmissionController.EGRESS_WINDOW:
+            sent = stats.COUNTERS['egress_bytes']
+            # The counter may have been reset.
+            self._egress = max(sent - self._egress_bytes, 0) / elapsed
+            self._egress_bytes = sent
+            self._egress_time = now
+        return self._egress
+
+    @staticmethod
+    def get_hub_lag():
+        """
+        How late the tickers fire (moving average, in seconds, of the worst tier). Greenlets only run when the hub
+        gets to them, so a busy hub delays every tick.
+        :return:
+        """
+        return max([ticker.get_jitter() for ticker in list(TICKERS.values())] or [0])
+
+    def get_health(self):
+        """
+        Returns the limits, the current load and the rejections, for /healthcheck.
+        :return:
+        """
+        load, reason = self.get_load()
+        return {
+            'load': round(load, 3),
+            'limiting': reason,
+            'overloaded': load >= 1,
+            'degrading': load >= self._degrade_ratio,
+            'streams': self._streams,
+            'busiest_cams': dict(sorted(self._cam_streams.items(), key=lambda c: -c[1])[:10]),
+            'egress': round(self.get_egress()),
+            'hub_lag': round(self.get_hub_lag(), 4),
+            'limits': {
+                'streams': self._max_streams,
+                'cam_streams': self._max_cam_streams,
+                'egress': self._max_egress,
+                'hub_lag': self._max_hub_lag,
+                'degrade_ratio': self._degrade_ratio,
+            },
+            'admitted': stats.COUNTERS.get('admission_admitted', 0),
+            'degraded': stats.COUNTERS.get('admission_degraded', 0),
+            'rejected': stats.COUNTERS.get('admission_rejected', 0),
+            'rejected_by_limit': {name.split(':', 1)[1]: count for name, count in stats.COUNTERS.items()
+                                  if name.startswith('admission_rejected:')},
+        }
+
+    def _release(self, ticket):
+        self._streams -= 1
+        if ticket.cam_name is not None:
+            self._cam_streams[ticket.cam_name] -= 1
+            if self._cam_streams[ticket.cam_name] <= 0:
+                del self._cam_streams[ticket.cam_name]
+        stats.gauge_set('admission_streams', self._streams)
+
+
+def release_on_close(ticket, response):
+    """
+    Holds the ticket until the response is closed. The server closes it whether or not the body was ever iterated (such
+    as for HEAD requests, or clients that go away before the first part), unlike the finally of a generator that never
+    started.
+    :param ticket:
+    :param response:
+    :return: The response.
+    """
+    response.call_on_close(ticket.release)
+    return response
+
+
+def overloaded_response(ticket):
+    """
+    503 response for a refused stream.
+    :param ticket:
+    :return:
+    """
+    response = make_response("The server is overloaded ({} limit reached). Please retry later.".format(ticket.reason),
+                             503)
+    response.headers['Retry-After'] = str(ticket.retry_after)
+    return response
+
+
+# Admission controller of this process.
+_controller = None
+
+
+def get_controller():
+    """
+    Returns the admission controller of this process.
+    :return:
+    """
+    global _controller
+    if _controller is None:
+        config = current_app.config
+        _controller = AdmissionController(config['ADMISSION_MAX_STREAMS'], config['ADMISSION_MAX_CAM_STREAMS'],
+                                          config['ADMISSION_MAX_EGRESS'], config['ADMISSION_MAX_HUB_LAG'],
+                                          config['ADMISSION_DEGRADE_RATIO'], config['ADMISSION_DEGRADED_FPS'],
+                                          config['ADMISSION_DEGRADED_WIDTH'], config['ADMISSION_RETRY_AFTER'])
+    return _controller
+
+
+def reset():
+    """
+    Drops the admission controller of this process. Mostly useful for testing.
+    :return:
+    """
+    global _controller
+    _controller = None
@@ -0,0 +1,42 @@
+"""
+Static assets that the streams serve, read from disk once per process rather than on every request or stream.
+"""
+
+import os
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+
+# Image served while a camera has no frame.
+NOT_AVAILABLE_FILE = 'no_image_available.png'
+
+_assets = {}
+
+
+def get_asset(name):
+    """
+    Returns the contents of a file of the static directory.
+    :param name: File name, relative to the static directory.
+    :return:
+    """
+    data = _assets.get(name)
+    if data is None:
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            data = f.read()
+        _assets[name] = data
+    return data
+
+
+def get_not_available():
+    """
+    Returns the image (PNG) that is served while a camera has no frame.
+    :return:
+    """
+    return get_asset(NOT_AVAILABLE_FILE)
+
+
+def reset():
+    """
+    Drops the assets loaded by this process. Mostly useful for testing.
+    :return:
+    """
+    _assets.clear()
@@ -0,0 +1,206 @@
+"""
+Batch snapshots of several cameras.
+
+/cams/batch returns the last frame of a list of cameras (cams parameter, comma-separated) or of every camera that
+matches a glob (glob parameter, such as archimedes*), fetched through a single redis MGET. Frames can optionally be
+scaled down to thumbnails (width parameter), which are built once per frame and width.
+
+Two output formats are supported (format parameter):
+
+    multipart (default): multipart/mixed response with one part per camera. Every part has the X-Camera-Id, X-Frame-Id
+    and X-Camera-State (ok, unavailable or error) headers. Cameras without a frame get an empty part.
+
+    bundle: compact binary bundle (application/x-wilsa-bundle). It starts with the BUNDLE_MAGIC bytes and the number
+    of frames (2 bytes), followed by, for every camera:
+
+        2 bytes: length of the camera name
+        8 bytes: frame sequence number (0 if unknown)
+        1 byte: flags (FLAG_AVAILABLE, FLAG_ERROR, FLAG_FEEDER_ALIVE)
+        4 bytes: length of the frame
+        the camera name (UTF-8) and the frame
+
+    All integers are big-endian and unsigned.
+"""
+
+import fnmatch
+import io
+import struct
+from collections import OrderedDict
+
+from flask import current_app, request, make_response, Response
+
+from app import rdb
+from . import main, stats
+from .mosaic import decode_scaled
+from .multipart import build_part, BOUNDARY
+from .redis_funcs import fetch_frames
+
+BUNDLE_MAGIC = b'WBN1'
+BUNDLE_MIMETYPE = 'application/x-wilsa-bundle'
+
+BUNDLE_HEADER = struct.Struct('!4sH')
+BUNDLE_ENTRY = struct.Struct('!HQBI')
+
+FLAG_AVAILABLE = 1
+FLAG_ERROR = 2
+FLAG_FEEDER_ALIVE = 4
+
+# Height / width ratio of the box that the thumbnails fit in.
+THUMBNAIL_ASPECT = 3 / 4
+
+
+class ThumbnailCache(object):
+    """
+    Keeps the last thumbnail of every (camera, width), so that it is built once per frame.
+    """
+
+    def __init__(self, max_entries, quality):
+        self._max_entries = max_entries
+        self._quality = quality
+        self._entries = OrderedDict()  # (cam_name, width) -> (seq, thumbnail)
+
+    def get(self, cam_name, width, seq, frame):
+        key = (cam_name, width)
+        entry = self._entries.get(key)
+        if entry is not None and seq is not None and entry[0] == seq:
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        img = decode_scaled(frame, width, int(width * THUMBNAIL_ASPECT))
+        out = io.BytesIO()
+        img.save(out, 'jpeg', quality=self._quality)
+        img.close()
+        thumbnail = out.getvalue()
+        stats.incr('thumbnails_built')
+
+        if seq is not None:
+            self._entries[key] = (seq, thumbnail)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return thumbnail
+
+
+# Thumbnail cache of this process.
+_thumbnails = None
+
+
+def get_thumbnail_cache():
+    global _thumbnails
+    if _thumbnails is None:
+        config = current_app.config
+        _thumbnails = ThumbnailCache(config['BATCH_THUMBNAIL_CACHE_ENTRIES'], config['MOSAIC_QUALITY'])
+    return _thumbnails
+
+
+def reset():
+    """
+    Drops the thumbnail cache of this process. Mostly useful for testing.
+    :return:
+    """
+    global _thumbnails
+    _thumbnails = None
+
+
+def find_cams(pattern, limit):
+    """
+    Finds the cameras whose name matches the glob, through SCAN (rather than KEYS, which would block redis).
+    :param pattern: Glob, such as archimedes*.
+    :param limit: Maximum number of cameras.
+    :return: Sorted camera names.
+    """
+    prefix = current_app.config['REDIS_PREFIX'] + ":cams:"
+    suffix = ":lastframe"
+    cams = set()
+    for key in rdb.scan_iter(match=prefix + pattern + suffix, count=1000):
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        cam = key[len(prefix):-len(suffix)]
+        # The glob could also have matched across the ':' separators.
+        if ':' not in cam and fnmatch.fnmatchcase(cam, pattern):
+            cams.add(cam)
+            if len(cams) >= limit:
+                break
+    return sorted(cams)
+
+
+@main.route('/cams/batch')
+def cams_batch():
+    """
+    Returns the last frame of several cameras in a single response.
+    :return:
+    """
+    config = current_app.config
+    limit = config['BATCH_MAX_CAMS']
+
+    if 'glob' in request.values:
+        cams = find_cams(request.values['glob'], limit)
+    else:
+        cams = [cam for cam in request.values.get('cams', '').split(',') if cam]
+        if len(cams) == 0 or len(cams) > limit:
+            return make_response("Wrong value: cams must be a comma-separated list of up to {} cameras".format(limit),
+                                 400)
+
+    width = request.values.get('width', None, type=int)
+    if width is not None and not 16 <= width <= config['MOSAIC_MAX_TILE_WIDTH']:
+        return make_response("Wrong value: width must be between 16 and {}".format(config['MOSAIC_MAX_TILE_WIDTH']),
+                             400)
+
+    output = request.values.get('format', 'multipart')
+    if output not in ('multipart', 'bundle'):
+        return make_response("Wrong value: format must be multipart or bundle", 400)
+
+    fetched = fetch_frames(cams, width)
+    stats.incr('batch_requests')
+    stats.incr('batch_frames', len(cams))
+
+    frames = []
+    for cam, f in zip(cams, fetched):
+        frame = f.frame
+        if frame is not None and width is not None:
+            try:
+                frame = get_thumbnail_cache().get(cam, width, f.seq, frame)
+            except (IOError, SyntaxError) as ex:
+                print("[batch]: Could not scale the frame of cam {}: {}".format(cam, ex))
+                frame = None
+        frames.append(frame)
+
+    if output == 'bundle':
+        return Response(_bundle(cams, fetched, frames), status=200, mimetype=BUNDLE_MIMETYPE)
+
+    parts = [_multipart_part(cam, f, frame) for cam, f, frame in zip(cams, fetched, frames)]
+    parts.append(b'--' + BOUNDARY + b'--\r\n')
+    return Response(b''.join(parts), status=200, mimetype='multipart/mixed; boundary=' + BOUNDARY.decode())
+
+
+def _multipart_part(cam, fetched, frame):
+    if frame is not None:
+        state = b'ok'
+    elif fetched.error:
+        state = b'error'
+    else:
+        state = b'unavailable'
+    return build_part(frame or b'', fetched.seq, headers=[(b'X-Camera-Id', cam.encode('utf-8')),
+                                                          (b'X-Camera-State', state)])
+
+
+def _bundle(cams, fetched, frames):
+    chunks = [BUNDLE_HEADER.pack(BUNDLE_MAGIC, len(cams))]
+    for cam, f, frame in zip(cams, fetched, frames):
+        flags = 0
+        if frame is not None:
+            flags |= FLAG_AVAILABLE
+        if f.error:
+            flags |= FLAG_ERROR
+        if f.alive:
+            flags |= FLAG_FEEDER_ALIVE
+        name = cam.encode('utf-8')
+        frame = frame or b''
+        try:
+            seq = int(f.seq) if f.seq is not None else 0
+        except ValueError:
+            seq = 0
+        chunks.append(BUNDLE_ENTRY.pack(len(name), seq, flags, len(frame)))
+        chunks.append(name)
+        chunks.append(frame)
+    return b''.join(chunks)
@@ -0,0 +1,53 @@
+"""
+Skipping of unchanged frames on the push paths.
+
+Clients are paced at their target FPS, which is often higher than the FPS of the camera. Rather than sending the same
+frame on every tick, every push path keeps a FrameDelivery per client, which remembers the id of the last frame
+delivered and only lets new frames through. Clients that need frames to keep coming (for instance, browsers that only
+render a multipart part once the next one starts) can still get the last frame again every KEEPALIVE_RESEND_INTERVAL
+seconds.
+"""
+
+import time
+
+from . import stats
+
+# Frame id for the "not available" image.
+NOT_AVAILABLE = 'not_available'
+
+
+class FrameDelivery(object):
+
+    def __init__(self, keepalive):
+        """
+        :param keepalive: Seconds after which the last frame is sent again even if it did not change. 0 or None to
+        never resend.
+        """
+        self._keepalive = keepalive
+        self._last_id = None
+        self._last_time = 0
+
+    def should_send(self, frame_id):
+        """
+        Whether the frame should be sent to the client.
+        :param frame_id: Id (sequence number) of the frame, or None if the frame cannot be identified (and is thus
+        always sent).
+        :return:
+        """
+        if frame_id is None or frame_id != self._last_id:
+            return True
+        if self._keepalive and time.time() - self._last_time >= self._keepalive:
+            stats.incr('keepalive_resends')
+            return True
+        stats.incr('unchanged_frames_skipped')
+        return False
+
+    def sent(self, frame_id):
+        """
+        Records that the frame was sent.
+        :param frame_id:
+        :return:
+        """
+        self._last_id = frame_id
+        self._last_time = time.time()
+
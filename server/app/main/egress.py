@@ -0,0 +1,298 @@
+"""
+Weighted fair egress scheduling.
+
+When the uplink of a worker is saturated, the greenlets that happen to run first get the bandwidth, so a popular camera
+can starve the others. Every stream (MJPEG over HTTP, WebSocket or Socket.IO, H.264, MPEG, fMP4, mosaics) sends its
+frames through a flow of the egress scheduler of its worker, which shares EGRESS_RATE (bytes per second) with deficit
+round-robin among the (camera, client class) groups that have data waiting:
+
+ - Each group gets a share proportional to its weight: the weight of its camera (EGRESS_CAM_WEIGHTS) times the weight
+ of its client class (EGRESS_CLASS_WEIGHTS). The share of a group is split among its streams, so many viewers of a
+ camera do not add up to more than its share.
+ - Bandwidth that a group does not use goes to the others.
+ - Frames that cannot be sent within EGRESS_MAX_WAIT seconds are dropped, and the stream resumes with a later frame
+ (or, for H.264 and fMP4, at the next keyframe). The lowest priority groups wait the longest, so they are degraded
+ first.
+
+The client class is chosen by the page that embeds the stream (class parameter, or 'class' in the Socket.IO start
+event). Unknown classes are served as 'default'.
+
+With EGRESS_RATE = 0 frames are sent as soon as possible, as before, but the throughput is still accounted per class.
+The bytes sent and dropped per class are exported through the stats module, and the throughput per class through
+/healthcheck.
+
+    with get_scheduler().open_flow(cam_id, request.values.get('class')) as flow:
+        ...
+        if flow.send(len(frame)):
+            ws.send(frame)
+"""
+
+import time
+from collections import deque
+
+import gevent
+from gevent.event import Event
+from flask import current_app
+
+from . import stats
+
+DEFAULT_CLASS = 'default'
+
+# Weight of the groups whose weights are not positive, so that they are still served eventually.
+MIN_WEIGHT = 0.01
+
+
+class _Request(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.granted = False
+        self.event = Event()
+
+
+class _Group(object):
+    """
+    Streams of a camera and client class, which share the bandwidth of the group in order of arrival.
+    """
+
+    def __init__(self, cam_name, client_class, weight):
+        self.cam_name = cam_name
+        self.client_class = client_class
+        self.weight = max(weight, MIN_WEIGHT)
+        self.flows = 0
+        self.pending = deque()  # _Request waiting to be granted.
+        self.deficit = 0
+        self.active = False  # Whether it is in the round-robin.
+
+
+class Flow(object):
+    """
+    Stream of a client, through which it asks for permission to send. It is open within its with block.
+    """
+
+    def __init__(self, scheduler, group):
+        self._scheduler = scheduler
+        self._group = group
+        self.client_class = group.client_class
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def send(self, size, droppable=True):
+        """
+        Waits until size bytes can be sent by this flow, and accounts them.
+        :param size: Number of bytes to send.
+        :param droppable: If True, gives up after EGRESS_MAX_WAIT seconds. Otherwise waits for as long as needed.
+        :return: Whether the data can be sent. If not, it must be dropped.
+        """
+        return self._scheduler._send(self._group, size, droppable)
+
+    def close(self):
+        if self._group is not None:
+            self._scheduler._close(self._group)
+            self._group = None
+
+
+class EgressScheduler(object):
+
+    # Seconds over which the throughput per class is measured.
+    THROUGHPUT_WINDOW = 1.0
+
+    def __init__(self, rate, burst, quantum, max_wait, cam_weights, class_weights):
+        """
+        :param rate: Bytes per second shared among the flows (0 to send everything as soon as possible).
+        :param burst: Bytes that can be sent at once after an idle period.
+        :param quantum: Bytes that a group of weight 1 can send per round.
+        :param max_wait: Seconds after which droppable data that could not be sent is dropped.
+        :param cam_weights: Dict with the weight of the cameras. The rest weigh 1.
+        :param class_weights: Dict with the weight of the client classes. Unknown classes are served as 'default'.
+        """
+        self._rate = rate
+        self._burst = burst
+        self._quantum = quantum
+        self._max_wait = max_wait
+        self._cam_weights = cam_weights
+        self._class_weights = class_weights
+
+        self._tokens = burst
+        self._refill_time = time.time()
+
+        self._groups = {}  # (cam, client class) -> _Group
+        self._active = deque()  # _Group with pending requests, in round-robin order.
+        self._greenlet = None
+
+        self._throughput = {}
+        self._throughput_sent = self._get_class_bytes()
+        self._throughput_time = time.time()
+
+    def get_class(self, client_class):
+        """
+        Returns the client class that a request for the specified class is served as.
+        :param client_class: Requested class, or None.
+        :return:
+        """
+        return client_class if client_class in self._class_weights else DEFAULT_CLASS
+
+    def open_flow(self, cam_name, client_class=None):
+        """
+        Opens a flow for a stream.
+        :param cam_name: Camera of the stream, or None if it is not a single camera (such as a mosaic).
+        :param client_class: Requested client class, or None for the default one.
+        :return: Flow
+        """
+        client_class = self.get_class(client_class)
+        key = (cam_name, client_class)
+        group = self._groups.get(key)
+        if group is None:
+            weight = self._cam_weights.get(cam_name, 1) * self._class_weights.get(client_class, 1)
+            group = _Group(cam_name, client_class, weight)
+            self._groups[key] = group
+        group.flows += 1
+        stats.gauge_add('egress_flows', 1)
+        return Flow(self, group)
+
+    def get_throughput(self):
+        """
+        Bytes per second sent to every client class, over the last THROUGHPUT_WINDOW seconds.
+        :return:
+        """
+        now = time.time()
+        elapsed = now - self._throughput_time
+        if elapsed >= EgressScheduler.THROUGHPUT_WINDOW:
+            sent = self._get_class_bytes()
+            self._throughput = {cls: round(max(count - self._throughput_sent.get(cls, 0), 0) / elapsed)
+                                for cls, count in sent.items()}
+            self._throughput_sent = sent
+            self._throughput_time = now
+        return self._throughput
+
+    def get_health(self):
+        """
+        Returns the configuration, the throughput per class and the drops, for /healthcheck.
+        :return:
+        """
+        return {
+            'rate': self._rate,
+            'throughput': self.get_throughput(),
+            'waiting': sum(len(group.pending) for group in self._active),
+            'dropped': {name.split(':', 1)[1]: count for name, count in stats.COUNTERS.items()
+                        if name.startswith('egress_dropped:')},
+        }
+
+    @staticmethod
+    def _get_class_bytes():
+        return {name.split(':', 1)[1]: count for name, count in stats.COUNTERS.items()
+                if name.startswith('egress_bytes:')}
+
+    def _send(self, group, size, droppable):
+        if self._rate:
+            self._refill()
+            # Nobody is waiting: no need to go through the round-robin.
+            if self._active or self._tokens < min(size, self._burst):
+                if not self._wait(group, size, droppable):
+                    stats.incr('egress_dropped')
+                    stats.incr('egress_dropped:' + group.client_class)
+                    return False
+            else:
+                self._tokens -= size
+
+        stats.incr('egress_bytes', size)
+        stats.incr('egress_bytes:' + group.client_class, size)
+        return True
+
+    def _wait(self, group, size, droppable):
+        request = _Request(size)
+        group.pending.append(request)
+        if not group.active:
+            group.active = True
+            self._active.append(group)
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+        try:
+            request.event.wait(timeout=self._max_wait if droppable else None)
+        finally:
+            if not request.granted:
+                # Withdrawn (or the stream was killed). The round-robin skips its group once it has nothing pending.
+                group.pending.remove(request)
+        return request.granted
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self._tokens + (now - self._refill_time) * self._rate, self._burst)
+        self._refill_time = now
+
+    def _run(self):
+        """
+        Grants the pending requests, in deficit round-robin among the groups, as fast as the rate allows.
+        :return:
+        """
+        try:
+            while self._active:
+                group = self._active.popleft()
+                group.deficit += self._quantum * group.weight
+
+                while group.pending and group.pending[0].size <= group.deficit:
+                    request = group.pending[0]
+
+                    # Data larger than the burst is granted once a burst is available, and borrows the rest.
+                    self._refill()
+                    needed = min(request.size, self._burst)
+                    if self._tokens < needed:
+                        gevent.sleep((needed - self._tokens) / self._rate)
+                        # The request may have been withdrawn meanwhile.
+                        continue
+
+                    self._tokens -= request.size
+                    group.deficit -= request.size
+                    group.pending.popleft()
+                    request.granted = True
+                    request.event.set()
+
+                if group.pending:
+                    self._active.append(group)
+                else:
+                    # Groups do not accumulate credit while they have nothing to send.
+                    group.active = False
+                    group.deficit = 0
+        finally:
+            self._greenlet = None
+
+    def _close(self, group):
+        group.flows -= 1
+        stats.gauge_add('egress_flows', -1)
+        if group.flows <= 0 and not group.pending:
+            key = (group.cam_name, group.client_class)
+            if self._groups.get(key) is group:
+                del self._groups[key]
+
+
+# Egress scheduler of this process.
+_scheduler = None
+
+
+def get_scheduler():
+    """
+    Returns the egress scheduler of this process.
+    :return:
+    """
+    global _scheduler
+    if _scheduler is None:
+        config = current_app.config
+        _scheduler = EgressScheduler(config['EGRESS_RATE'], config['EGRESS_BURST'], config['EGRESS_QUANTUM'],
+                                     config['EGRESS_MAX_WAIT'], config['EGRESS_CAM_WEIGHTS'],
+                                     config['EGRESS_CLASS_WEIGHTS'])
+    return _scheduler
+
+
+def reset():
+    """
+    Drops the egress scheduler of this process. Mostly useful for testing.
+    :return:
+    """
+    global _scheduler
+    _scheduler = None
@@ -1,16 +1,55 @@
-import gevent
-from flask import request
+from flask import request, current_app
+from flask_socketio import emit
 
 from app.main.SocketIOH264RedisBroadcaster import SocketIOH264RedisBroadcaster
 from app.main.SocketIOH264StaticBroadcaster import SocketIOH264StaticBroadcaster
 from app.main.SocketIOMJPEGBroadcaster import SocketIOMJPEGBroadcaster
 from app.main.SocketIOMPEGRedisBroadcaster import SocketIOMPEGRedisBroadcaster
+from app.main.admission import get_controller
 from app.main.redis_funcs import mark_active
+from app.main.registry import get_registry
 from .. import socketio
 
 
-# Store the local broadcasters so that we can later disconnect them.
-BROADCASTERS = {}
+# Namespace through which a single connection can subscribe to several cameras and formats.
+CAMS_NAMESPACE = '/cams'
+
+CAMS_FORMATS = ('mjpeg', 'h264')
+
+
+def _disconnected(namespace):
+    """
+    Stops every broadcaster of the client that just disconnected.
+    :param namespace:
+    :return:
+    """
+    client_sid = request.sid
+    stopped = get_registry().stop_client(client_sid, namespace)
+    print("[{}]: Client [{}] disconnected. Stopped {} broadcaster(s).".format(namespace.lstrip('/'), client_sid,
+                                                                             stopped))
+
+
+def _is_adaptive_quality(data):
+    """
+    Whether the client of a 'start' or 'subscribe' event wants the quality of the MJPEG frames adapted to its link.
+    :param data: Event data. Its 'quality' is 'auto' or 'full' (default: MJPEG_ADAPTIVE_QUALITY).
+    :return:
+    """
+    default_quality = 'auto' if current_app.config.get('MJPEG_ADAPTIVE_QUALITY', False) else 'full'
+    return data.get('quality', default_quality) == 'auto'
+
+
+def _admit(cam, fmt, fps, can_degrade=True):
+    """
+    Asks the admission controller for a ticket. If the stream is refused, the client gets a 'rejected' event with the
+    camera, the format, the limit that was reached and the seconds after which it may retry.
+    :return: The ticket, or None if refused.
+    """
+    ticket = get_controller().admit(cam, fps, can_degrade)
+    if ticket.admitted:
+        return ticket
+    emit('rejected', {'cam': cam, 'format': fmt, 'reason': ticket.reason, 'retry_after': ticket.retry_after})
+    return None
 
 
 @socketio.on_error(namespace='/mjpeg')
@@ -19,14 +58,17 @@ def chat_error_handler(e):
 
 @socketio.on('disconnect', namespace='/mjpeg')
 def mjpeg_disconnect(*args):
-    client_sid = request.sid
-    print("Client [{}] disconnected.".format(client_sid))
+    _disconnected('/mjpeg')
+
+
+@socketio.on('disconnect', namespace='/mpeg')
+def mpeg_disconnect(*args):
+    _disconnected('/mpeg')
 
-    if client_sid in BROADCASTERS:
-        print("Stopping the broadcaster.")
-        broadcaster = BROADCASTERS[client_sid]
-        broadcaster.stop()
-        del BROADCASTERS[client_sid]
+
+@socketio.on('disconnect', namespace='/h264')
+def h264_disconnect(*args):
+    _disconnected('/h264')
 
 
 #@socketio.on('disconnect', namespace='/')
@@ -50,18 +92,30 @@ def mjpeg_stream_start(data):
     # Target FPS.
     tfps = data.get('tfps', 5)
 
+    # Whether the client acks every frame, so that the stream can be paced to what it can take.
+    ack = data.get('ack', False)
+
+    # Seconds after which an unchanged frame is sent again.
+    keepalive = data.get('keepalive', current_app.config['KEEPALIVE_RESEND_INTERVAL'])
+
     # request.sid contains the unique identifier of the client that sent ht events, which is also the channel
     # name that should enable us to send messages specifically to that client.
     client_sid = request.sid
 
-    # Start the broadcaster
-    t = SocketIOMJPEGBroadcaster(cam, client_sid, tfps)
+    # New streams are degraded (lower FPS) or refused when the worker is overloaded.
+    get_registry().stop((client_sid, cam, 'mjpeg'))
+    ticket = _admit(cam, 'mjpeg', tfps)
+    if ticket is None:
+        return
 
-    # Store the Broadcaster so that we can stop it when the client disconnects.
-    # Should be tested but it should work.
-    BROADCASTERS[client_sid] = t
+    # Start the broadcaster
+    # The client class (optional) weighs the stream in the egress scheduler.
+    # With quality='auto' (and ack), the frames are adapted to the throughput of the client.
+    t = SocketIOMJPEGBroadcaster(cam, client_sid, ticket.fps, ack, keepalive, client_class=data.get('class'),
+                                 adaptive_quality=_is_adaptive_quality(data))
 
-    gevent.spawn(t.run)
+    # The registry runs it, and stops it when the client disconnects.
+    get_registry().start((client_sid, cam, 'mjpeg'), '/mjpeg', t, ticket)
 
 
 @socketio.on('start', namespace='/mpeg')
@@ -70,6 +124,12 @@ def mpeg_stream_start(data):
 
     cam = data['cam']
 
+    # Starting again replaces the previous stream, which must not count against the admission limits.
+    get_registry().stop((request.sid, cam, 'mpeg'))
+    ticket = _admit(cam, 'mpeg', None, can_degrade=False)
+    if ticket is None:
+        return
+
     # Mark in Redis the stream as alive.
     mark_active(cam, 'mpeg')
 
@@ -80,9 +140,10 @@ def mpeg_stream_start(data):
     # Start the broadcaster
     # Though there might be some more efficient ways through broadcasting, for now we create a broadcaster greenlet
     # for every client, and we pass it the client_sid so that it can send data to a specific client.
-    t = SocketIOMPEGRedisBroadcaster(cam, client_sid)
+    t = SocketIOMPEGRedisBroadcaster(cam, client_sid, client_class=data.get('class'))
 
-    gevent.spawn(t.run)
+    # The registry runs it, and stops it when the client disconnects.
+    get_registry().start((client_sid, cam, 'mpeg'), '/mpeg', t, ticket)
 
 
 @socketio.on('start', namespace='/h264')
@@ -91,6 +152,15 @@ def h264_stream_start(data):
 
     cam = data['cam']
 
+    # Whether the client acks every NAL unit, so that we can detect that it is lagging and resync it at a keyframe.
+    ack = data.get('ack', False)
+
+    # H.264 cannot be served at a lower FPS: it is either admitted or refused.
+    get_registry().stop((request.sid, cam, 'h264'))
+    ticket = _admit(cam, 'h264', None, can_degrade=False)
+    if ticket is None:
+        return
+
     # Mark in Redis the stream as alive.
     mark_active(cam, 'h264')
 
@@ -101,10 +171,70 @@ def h264_stream_start(data):
     # Start the broadcaster
     # Though there might be some more efficient ways through broadcasting, for now we create a broadcaster greenlet
     # for every client, and we pass it the client_sid so that it can send data to a specific client.
-    t = SocketIOH264RedisBroadcaster(cam, client_sid)
+    # With batch, the NAL units of every picture are emitted together.
+    t = SocketIOH264RedisBroadcaster(cam, client_sid, ack, client_class=data.get('class'),
+                                     batch=data.get('batch', False))
+
+    # The registry runs it, and stops it when the client disconnects.
+    get_registry().start((client_sid, cam, 'h264'), '/h264', t, ticket)
+
+
+@socketio.on('subscribe', namespace=CAMS_NAMESPACE)
+def cams_subscribe(data):
+    """
+    Subscribes the client to a camera, in the specified format (mjpeg or h264). A single connection can subscribe to
+    several cameras and formats: the frames (or NAL units) are tagged with the camera, as {'cam': <cam>, 'frame':
+    <frame>} in 'frame' events and {'cam': <cam>, 'nal': <nal>} in 'stream' events (with batch, 'nal' holds the NAL
+    units of a whole access unit). Subscribing again to the same camera and format replaces the previous subscription
+    (for instance, to change the target FPS).
+    :param data: {cam, format, class (optional client class), and the options of the format: tfps, ack, keepalive and
+    quality for mjpeg, ack and batch for h264}
+    :return: Whether the subscription was accepted (to the client callback, if any). Subscriptions refused because
+    the server is overloaded also get a 'rejected' event.
+    """
+    cam = data.get('cam')
+    fmt = data.get('format', 'mjpeg')
+    if not cam or fmt not in CAMS_FORMATS:
+        print("[cams]: Wrong subscription: {}".format(data))
+        return False
+
+    client_sid = request.sid
+    ack = data.get('ack', False)
+
+    print("[cams]: Client [{}] subscribes to {} ({})".format(client_sid, cam, fmt))
+
+    # The previous subscription is dropped first, so that it does not count against the admission limits.
+    get_registry().stop((client_sid, cam, fmt))
+    ticket = _admit(cam, fmt, data.get('tfps', 5), can_degrade=fmt == 'mjpeg')
+    if ticket is None:
+        return False
+
+    if fmt == 'mjpeg':
+        keepalive = data.get('keepalive', current_app.config['KEEPALIVE_RESEND_INTERVAL'])
+        t = SocketIOMJPEGBroadcaster(cam, client_sid, ticket.fps, ack, keepalive, namespace=CAMS_NAMESPACE,
+                                     client_class=data.get('class'), adaptive_quality=_is_adaptive_quality(data))
+    else:
+        mark_active(cam, 'h264')
+        t = SocketIOH264RedisBroadcaster(cam, client_sid, ack, namespace=CAMS_NAMESPACE, client_class=data.get('class'),
+                                         batch=data.get('batch', False))
+
+    get_registry().start((client_sid, cam, fmt), CAMS_NAMESPACE, t, ticket)
+    return True
+
+
+@socketio.on('unsubscribe', namespace=CAMS_NAMESPACE)
+def cams_unsubscribe(data):
+    """
+    Unsubscribes the client from a camera and format.
+    :param data: {cam, format}
+    :return: Whether the client was subscribed.
+    """
+    cam = data.get('cam')
+    fmt = data.get('format', 'mjpeg')
+    print("[cams]: Client [{}] unsubscribes from {} ({})".format(request.sid, cam, fmt))
+    return get_registry().stop((request.sid, cam, fmt))
 
-    # Store the Broadcaster so that we can stop it when the client disconnects.
-    # Should be tested but it should work.
-    BROADCASTERS[client_sid] = t
 
-    gevent.spawn(t.run)
+@socketio.on('disconnect', namespace=CAMS_NAMESPACE)
+def cams_disconnect(*args):
+    _disconnected(CAMS_NAMESPACE)
@@ -0,0 +1,138 @@
+"""
+Lean dispatch of the frame routes.
+
+/cams/<cam_id> (snapshot) and /cams/<cam_id>/mjpeg are by far the most requested routes. Serving them through Flask
+means URL routing, a request context, the parsing of request.values and a Response object for every request (and, for
+the MJPEG streams, stream_with_context). The FastPath WSGI middleware serves the GET requests of these two routes
+directly: it matches the path with a split, parses the query string only if there is one, and only pushes the app
+context that the redis and stream helpers need. Everything that does not depend on the request (the configuration,
+the routes that are not cameras, the not-available image) is computed once.
+
+The URL contract is the one of the Flask views (cam and cam_mjpeg), which still serve everything else: other methods
+and routes, and the uncommon cases of these routes (such as a camera without a frame, or a wrong rotate parameter),
+which are passed to Flask unchanged. It is enabled with FAST_PATH.
+"""
+
+from functools import partial
+from urllib.parse import parse_qs
+
+from werkzeug.wsgi import ClosingIterator
+
+from . import stats
+from .admission import overloaded_response
+from .redis_funcs import fetch_frame
+from .views import open_mjpeg_stream, _is_transformed, _transform_frame, CROP_PARAMS, MJPEG_MIMETYPE
+
+
+class FastPath(object):
+
+    def __init__(self, app, wsgi_app):
+        """
+        :param app: Flask app.
+        :param wsgi_app: WSGI app that serves the rest of the requests (the original wsgi_app of the Flask app).
+        """
+        self._app = app
+        self.wsgi_app = wsgi_app
+
+        # Routes such as /cams/batch, which are not cameras.
+        self._reserved = set()
+        for rule in app.url_map.iter_rules():
+            segments = rule.rule.split('/')
+            if len(segments) == 3 and segments[1] == 'cams' and '<' not in segments[2]:
+                self._reserved.add(segments[2])
+
+        self._keepalive = app.config['KEEPALIVE_RESEND_INTERVAL']
+        self._default_quality = 'auto' if app.config.get('MJPEG_ADAPTIVE_QUALITY', False) else 'full'
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'GET':
+            # The WSGI server decodes the path as latin-1.
+            segments = environ.get('PATH_INFO', '').encode('latin-1').decode('utf-8', 'replace').split('/')
+            if 3 <= len(segments) <= 4 and segments[1] == 'cams' and segments[2] and \
+                    segments[2] not in self._reserved:
+                result = None
+                if len(segments) == 3:
+                    result = self._snapshot(segments[2], self._parse_args(environ), start_response)
+                elif segments[3] == 'mjpeg':
+                    result = self._mjpeg(segments[2], self._parse_args(environ), environ, start_response)
+                if result is not None:
+                    stats.incr('fastpath_requests')
+                    return result
+
+        return self.wsgi_app(environ, start_response)
+
+    @staticmethod
+    def _parse_args(environ):
+        """
+        Parses the query string. Like request.values.get, only the first value of every parameter is kept.
+        :return: Dict
+        """
+        query = environ.get('QUERY_STRING')
+        if not query:
+            return {}
+        return {name: values[0] for name, values in parse_qs(query, keep_blank_values=True).items()}
+
+    def _snapshot(self, cam_id, args, start_response):
+        """
+        Serves the last frame of the camera, as the cam view does.
+        :return: The response body, or None to let Flask serve the request.
+        """
+        try:
+            rotate = float(args.get('rotate', 0))
+        except ValueError:
+            return None
+        try:
+            tfps = int(args['tfps']) if 'tfps' in args else None
+        except ValueError:
+            tfps = None
+        crops = [name in args for name in CROP_PARAMS]
+
+        with self._app.app_context():
+            frame = fetch_frame(cam_id, fps=tfps).frame
+            if frame is None:
+                # The view reports the feeder or camera error, or waits for the frame.
+                return None
+            if _is_transformed(rotate, *crops):
+                frame = _transform_frame(frame, rotate, *crops)
+
+        start_response('200 OK', [('Content-Type', 'image/jpeg'), ('Content-Length', str(len(frame)))])
+        return [frame]
+
+    def _mjpeg(self, cam_id, args, environ, start_response):
+        """
+        Serves an MJPEG stream of the camera, as the cam_mjpeg view does.
+        :return: The response body, or None to let Flask serve the request.
+        """
+        try:
+            tfps = int(args.get('tfps', 5))
+            rotate = float(args.get('rotate', 0))
+        except ValueError:
+            return None
+        try:
+            keepalive = float(args['keepalive']) if 'keepalive' in args else self._keepalive
+        except ValueError:
+            keepalive = self._keepalive
+        adaptive_quality = args.get('quality', self._default_quality) == 'auto'
+        crops = tuple(name in args for name in CROP_PARAMS)
+
+        with self._app.app_context():
+            ticket, stream = open_mjpeg_stream(cam_id, tfps, rotate, crops, keepalive, args.get('class'),
+                                               adaptive_quality)
+            if stream is None:
+                return overloaded_response(ticket)(environ, start_response)
+
+        start_response('200 OK', [('Content-Type', MJPEG_MIMETYPE)])
+        # The server closes the body even if it never iterated it, which a generator's finally would not notice.
+        return ClosingIterator(self._in_app_context(stream), [partial(self._close_in_app_context, stream),
+                                                              ticket.release])
+
+    def _in_app_context(self, stream):
+        """
+        Runs the stream within an app context. Closing it closes the stream, within the context as well.
+        """
+        with self._app.app_context():
+            yield from stream
+
+    def _close_in_app_context(self, stream):
+        with self._app.app_context():
+            stream.close()
@@ -0,0 +1,338 @@
+"""
+In-process cache of the last frame of every camera.
+
+Many greenlets of a server process read the same frame within milliseconds of each other. The cache keeps the last
+frame (and its sequence number and error flag) of each camera in memory, bounded by FRAME_CACHE_MAX_BYTES and evicted
+in LRU order, so that each frame is read from redis once per process. The feeder alive flag, which is shared by every
+camera, is cached along with them: a cached frame is only served while the alive flag is cached too.
+
+Coherence relies on redis 6 client-side caching: a greenlet keeps a connection subscribed to __redis__:invalidate,
+and a second connection enables broadcast tracking (CLIENT TRACKING ON BCAST) of the feeder alive key, redirected to
+the first one. The frame, sequence and error keys of every camera are added as prefixes the first time that its frame
+is cached, so that the frequent writes of the other camera keys (:active, :demand, :viewers) cause no invalidation
+messages. Whenever one of those keys is modified, the entry is dropped, and so is the alive flag whenever the alive
+key is refreshed or expires. Redis 6.0 servers cannot add prefixes to a tracking connection: the whole camera prefix
+is tracked then, and the invalidations of the other keys are ignored. If tracking is not available (older redis
+servers, or while reconnecting) entries expire after FRAME_CACHE_TTL seconds instead.
+"""
+
+import time
+from collections import OrderedDict
+
+import gevent
+import gevent.queue
+from gevent import monkey
+monkey.patch_all()
+
+import redis
+from flask import current_app
+
+from app import rdb
+from . import stats
+
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+# Keys whose modification invalidates the cached frame of a camera.
+FRAME_KEY_SUFFIXES = (b':lastframe', b':frameseq', b':error')
+
+# Connection parameters that are reused for the invalidation connections.
+CONNECTION_KWARGS = ('host', 'port', 'path', 'db', 'username', 'password')
+
+# Seconds to wait before reconnecting the invalidation connections.
+RECONNECT_WAIT = 5
+
+
+class FrameCache(object):
+
+    def __init__(self, max_bytes, ttl, alive_key, cams_prefix):
+        """
+        :param max_bytes: Maximum size of the cached frames, in bytes.
+        :param ttl: Seconds that an entry is valid for when invalidation messages are not available.
+        :param alive_key: <prefix>:feeder:alive
+        :param cams_prefix: <prefix>:cams:, which is tracked as a whole if cameras cannot be tracked one by one.
+        """
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._alive_key = alive_key.encode('utf-8')
+        self._cams_prefix = cams_prefix
+
+        self._entries = OrderedDict()  # cam_key -> (seq, frame, error, stored_at)
+        self._bytes = 0
+
+        self._alive = None  # (alive, stored_at), or None if unknown.
+
+        # Increased whenever the keys of a camera (or the alive key) are invalidated, so that a frame that was
+        # invalidated while it was being fetched is not stored. The epoch is increased when everything is.
+        self._generations = {}  # cam_key -> generation
+        self._alive_generation = 0
+        self._epoch = 0
+
+        # Cameras whose frame keys are tracked by the current tracking connection. Until a camera is, its frames are
+        # not cached, since nothing would invalidate them. Cameras are queued to be tracked on their first put.
+        self._tracked = set()
+        self._track_requested = set()
+        self._track_queue = gevent.queue.Queue()
+        # Whether cameras are tracked one by one, or the whole cams prefix is (redis 6.0).
+        self._per_cam = True
+
+        # Whether invalidation messages are currently being received.
+        self.tracking = False
+
+        self._hits = 0
+        self._misses = 0
+
+    def get_generation(self, cam_key):
+        """
+        :param cam_key: <prefix>:cams:<cam>
+        :return: Opaque value to pass to put, to tell whether the camera was invalidated in between.
+        """
+        return self._epoch, self._alive_generation, self._generations.get(cam_key, 0)
+
+    def get(self, cam_key):
+        """
+        Returns the cached (seq, frame, alive, error) for the camera, or None.
+        :param cam_key: <prefix>:cams:<cam>
+        :return:
+        """
+        entry = self._entries.get(cam_key)
+        if entry is not None and not self.tracking and time.time() - entry[3] > self._ttl:
+            self._remove(cam_key)
+            entry = None
+
+        if self._alive is not None and not self.tracking and time.time() - self._alive[1] > self._ttl:
+            self._alive = None
+
+        # Without the alive flag the entry is incomplete, so it is a miss as well.
+        if entry is None or self._alive is None:
+            entry = None
+            self._misses += 1
+            stats.incr('frame_cache_misses')
+        else:
+            self._entries.move_to_end(cam_key)
+            self._hits += 1
+            stats.incr('frame_cache_hits')
+
+        stats.gauge_set('frame_cache_hit_ratio', self.get_hit_ratio())
+        return (entry[0], entry[1], self._alive[0], entry[2]) if entry is not None else None
+
+    def put(self, cam_key, seq, frame, alive, error, generation):
+        """
+        Stores the frame of a camera, along with its error flag and the feeder alive flag that were read with it.
+        :param generation: Value of get_generation() from before the frame was fetched. If the camera or the alive key
+        were invalidated since, the frame may already be stale and it is not stored.
+        :return:
+        """
+        if generation != self.get_generation(cam_key):
+            return
+
+        now = time.time()
+        self._alive = (alive, now)
+
+        if self.tracking and self._per_cam and cam_key not in self._tracked:
+            if cam_key not in self._track_requested:
+                self._track_requested.add(cam_key)
+                self._track_queue.put(cam_key)
+            return
+
+        if len(frame) > self._max_bytes:
+            return
+
+        self._remove(cam_key)
+        self._entries[cam_key] = (seq, frame, error, now)
+        self._bytes += len(frame)
+
+        while self._bytes > self._max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            stats.incr('frame_cache_evictions')
+
+        self._update_gauges()
+
+    def invalidate(self, keys):
+        """
+        Handles an invalidation message.
+        :param keys: Modified keys. None means that every key was invalidated (such as after a FLUSHALL).
+        :return:
+        """
+        if keys is None:
+            self.clear()
+            return
+
+        for key in keys:
+            if isinstance(key, str):
+                key = key.encode('utf-8')
+            if key == self._alive_key:
+                self._alive = None
+                self._alive_generation += 1
+                continue
+            for suffix in FRAME_KEY_SUFFIXES:
+                if key.endswith(suffix):
+                    self._invalidate_cam(key[:-len(suffix)].decode('utf-8'))
+                    break
+
+        self._update_gauges()
+
+    def _invalidate_cam(self, cam_key):
+        self._generations[cam_key] = self._generations.get(cam_key, 0) + 1
+        if self._remove(cam_key):
+            stats.incr('frame_cache_invalidations')
+
+    def clear(self):
+        self._epoch += 1
+        self._entries.clear()
+        self._alive = None
+        self._bytes = 0
+        self._update_gauges()
+
+    def get_hit_ratio(self):
+        total = self._hits + self._misses
+        return self._hits / total if total > 0 else 0
+
+    def get_bytes(self):
+        return self._bytes
+
+    def _remove(self, cam_key):
+        entry = self._entries.pop(cam_key, None)
+        if entry is None:
+            return False
+        self._bytes -= len(entry[1])
+        return True
+
+    def _update_gauges(self):
+        stats.gauge_set('frame_cache_bytes', self._bytes)
+        stats.gauge_set('frame_cache_entries', len(self._entries))
+
+    def run_invalidations(self):
+        """
+        Greenlet that receives the invalidation messages of the tracked keys. Reconnects whenever the connection is
+        lost, and gives up if the server does not support client-side caching.
+        :return:
+        """
+        while True:
+            subscriber = _connect()
+            tracker = _connect()
+            try:
+                subscriber.send_command('CLIENT', 'ID')
+                client_id = subscriber.read_response()
+                subscriber.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+                subscriber.read_response()
+
+                # Tracking only lasts while the tracker connection is open.
+                prefixes = [self._alive_key.decode('utf-8')]
+                if not self._per_cam:
+                    prefixes.append(self._cams_prefix)
+                _track(tracker, client_id, prefixes)
+            except Exception as ex:
+                subscriber.disconnect()
+                tracker.disconnect()
+                if 'unknown' in str(ex).lower() or 'syntax' in str(ex).lower():
+                    print("Redis client-side caching not supported. Frame cache entries will expire after {}s."
+                          .format(self._ttl))
+                    return
+                print("Could not enable redis client-side caching: {}".format(ex))
+                gevent.sleep(RECONNECT_WAIT)
+                continue
+
+            # Frames cached before tracking was enabled could be stale, and the cameras are tracked again.
+            self._tracked = set()
+            self._track_requested = set()
+            self._track_queue = gevent.queue.Queue()
+            self.clear()
+            self.tracking = True
+            track_greenlet = gevent.spawn(self._track_cams, tracker, client_id, subscriber)
+            try:
+                while True:
+                    message = subscriber.read_response()
+                    if message[0] == b'message':
+                        self.invalidate(message[2])
+            except Exception as ex:
+                print("Lost the redis invalidation connection: {}".format(ex))
+            finally:
+                self.tracking = False
+                track_greenlet.kill()
+                subscriber.disconnect()
+                tracker.disconnect()
+
+            gevent.sleep(RECONNECT_WAIT)
+
+    def _track_cams(self, tracker, client_id, subscriber):
+        """
+        Greenlet that adds the frame keys of the queued cameras to the tracking prefixes.
+        :return:
+        """
+        queue = self._track_queue
+        while True:
+            cam_key = queue.get()
+            try:
+                _track(tracker, client_id, [cam_key + suffix.decode('utf-8') for suffix in FRAME_KEY_SUFFIXES])
+            except redis.exceptions.ResponseError as ex:
+                # Redis 6.0 cannot add prefixes once tracking is on. The connections are dropped, so that the whole
+                # cams prefix is tracked from the next one on.
+                print("Could not track the frame keys of {} ({}). Tracking every camera key instead."
+                      .format(cam_key, ex))
+                self._per_cam = False
+                subscriber.disconnect()
+                return
+
+            # Frames fetched before the keys were tracked may already be stale.
+            self._invalidate_cam(cam_key)
+            self._tracked.add(cam_key)
+
+
+def _track(tracker, client_id, prefixes):
+    """
+    Adds the prefixes to the broadcast tracking of the tracker connection, redirected to client_id.
+    """
+    args = ['CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST']
+    for prefix in prefixes:
+        args += ['PREFIX', prefix]
+    tracker.send_command(*args)
+    tracker.read_response()
+
+
+def _connect():
+    """
+    Creates a dedicated connection to the redis server of the app. Only the address and credentials are reused: the
+    connection blocks on reads (no socket timeout) and speaks RESP2, so that invalidations are plain pub/sub messages.
+    :return:
+    """
+    pool = rdb.connection_pool
+    kwargs = {k: v for k, v in pool.connection_kwargs.items() if k in CONNECTION_KWARGS}
+    try:
+        return pool.connection_class(protocol=2, **kwargs)
+    except TypeError:
+        # Clients that predate RESP3 have no protocol parameter.
+        return pool.connection_class(**kwargs)
+
+
+# Frame cache of this process. Created on first use, so that every worker process gets its own.
+_cache = None
+_invalidations_greenlet = None
+
+
+def get_cache():
+    """
+    Returns the frame cache of this process, or None if it is disabled (FRAME_CACHE_MAX_BYTES is 0).
+    :return:
+    """
+    global _cache, _invalidations_greenlet
+    if _cache is None:
+        config = current_app.config
+        if config.get('FRAME_CACHE_MAX_BYTES', 0) <= 0:
+            return None
+        _cache = FrameCache(config['FRAME_CACHE_MAX_BYTES'], config['FRAME_CACHE_TTL'],
+                            config['REDIS_PREFIX'] + ':feeder:alive', config['REDIS_PREFIX'] + ':cams:')
+        _invalidations_greenlet = gevent.spawn(_cache.run_invalidations)
+    return _cache
+
+
+def reset():
+    """
+    Drops the frame cache of this process. Mostly useful for testing.
+    :return:
+    """
+    global _cache, _invalidations_greenlet
+    if _invalidations_greenlet is not None:
+        _invalidations_greenlet.kill()
+    _cache = None
+    _invalidations_greenlet = None
@@ -0,0 +1,105 @@
+"""
+Helpers to handle the Annex-B H.264 stream that the H264Feeder publishes through Redis.
+
+The stream arrives in arbitrary chunks, so the NAL units need to be re-assembled by splitting on the
+start code (\\x00\\x00\\x00\\x01).
+
+The NAL units of a picture (its parameter sets, SEI and slices) form an access unit, which can be sent to the clients
+at once. An access unit ends where the next one starts (see starts_access_unit).
+"""
+
+START_CODE = b'\x00\x00\x00\x01'
+
+# NAL unit types that we care about.
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+
+def is_slice(nal):
+    """
+    Whether the NAL unit is a slice of a picture (IDR or not).
+    """
+    return nal_type(nal) in (NAL_SLICE, NAL_IDR)
+
+
+def starts_access_unit(nal):
+    """
+    Whether the NAL unit, following a slice, starts the access unit of a new picture: an access unit delimiter, a
+    parameter set, an SEI, or the first slice of a picture (first_mb_in_slice = 0, whose Exp-Golomb code is a single
+    1 bit). Simplified from section 7.4.1.2.3 of the H.264 spec, for streams that do not use arbitrary slice order.
+    :param nal: NAL unit, prefixed by the start code. Only its first two bytes after the start code are needed.
+    :return:
+    """
+    ntype = nal_type(nal)
+    if ntype in (NAL_AUD, NAL_SEI, NAL_SPS, NAL_PPS) or (ntype is not None and 14 <= ntype <= 18):
+        return True
+    if ntype in (NAL_SLICE, NAL_IDR):
+        payload = nal[len(START_CODE) + 1:] if nal.startswith(START_CODE) else nal[1:]
+        return len(payload) > 0 and payload[0] & 0x80 != 0
+    return False
+
+
+def nal_type(nal):
+    """
+    Returns the type of the specified NAL unit.
+    :param nal: NAL unit. It may or may not be prefixed by the start code.
+    :return: NAL unit type, or None if the unit is empty.
+    """
+    if nal.startswith(START_CODE):
+        nal = nal[len(START_CODE):]
+    if len(nal) == 0:
+        return None
+    return nal[0] & 0x1F
+
+
+class NALSplitter(object):
+    """
+    Re-assembles NAL units from the chunks of an Annex-B stream.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._synced = False  # Whether a start code has been found, so that the buffer holds the next NAL unit.
+
+    def peek(self):
+        """
+        Returns the beginning of the NAL unit that is not complete yet, so that its type is known before the rest of
+        it arrives.
+        :return: Start code and the first two bytes of the NAL unit, or None if they have not arrived yet.
+        """
+        if not self._synced or len(self._buffer) < 2:
+            return None
+        return START_CODE + bytes(self._buffer[:2])
+
+    def feed(self, data):
+        """
+        Feeds a chunk of the stream.
+        :param data: Chunk, as received from the Redis channel.
+        :return: List with the NAL units that were completed by this chunk, each prefixed by the start code,
+        which is how the client expects to receive them.
+        """
+        self._buffer.extend(data)
+
+        nals = []
+        while True:
+            # Try to extract a packet.
+            splits = self._buffer.split(START_CODE, 1)
+            if len(splits) < 2:
+                break
+
+            packet, self._buffer = splits[:]
+
+            # The data before the very first start code is not a NAL unit (or not a whole one, when joining
+            # mid-stream), so it is dropped.
+            if not self._synced:
+                self._synced = True
+                continue
+
+            if len(packet) > 0:
+                nals.append(START_CODE + bytes(packet))
+
+        return nals
@@ -0,0 +1,365 @@
+"""
+Low-latency segmented HTTP delivery (LL-HLS style) of the fragmented MP4 stream.
+
+Every server process keeps, per camera, a bounded in-memory SegmentStore that is fed by a single greenlet listening to
+the <cam>/fmp4 channel (published by the feeder FMP4Packager). The fragments are grouped into parts (of about
+HLS_PART_DURATION seconds) and the parts into segments (of about HLS_SEGMENT_DURATION seconds, always starting at a
+keyframe). Playlists, parts and segments are then served as plain, cacheable HTTP GETs, so that a caching proxy or CDN
+in front of the server can fan them out: the server only sees one request per distinct URL, whatever the number of
+viewers.
+
+Supported LL-HLS features: parts, preload hints, and blocking playlist reloads (_HLS_msn and _HLS_part).
+"""
+
+import math
+import struct
+import time
+from collections import deque
+
+import gevent
+import gevent.event
+from gevent import monkey
+monkey.patch_all()
+
+from flask import current_app, request, make_response, Response
+
+from app import rdb
+from . import main, stats
+from .redis_funcs import ChannelListener, mark_active
+from .websockets import FMP4_FRAGMENT_KEYFRAME
+
+# Timescale used by the feeder FMP4Packager.
+FMP4_TIMESCALE = 90000
+
+PLAYLIST_MIMETYPE = 'application/vnd.apple.mpegurl'
+SEGMENT_MIMETYPE = 'video/mp4'
+
+# Segments and parts never change once published, so they can be cached for as long as they are in the playlist.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=60, immutable'
+PLAYLIST_CACHE_CONTROL = 'public, max-age=1'
+
+# Tolerance when comparing the accumulated durations against the targets.
+DURATION_EPSILON = 0.001
+
+
+def fragment_duration(fragment):
+    """
+    Returns the duration (in seconds) of a fragment built by the feeder FMP4Packager, which contains a single sample
+    whose duration is the first field after the data offset in the trun box.
+    :param fragment: moof + mdat fragment, without the keyframe flag.
+    :return:
+    """
+    pos = fragment.find(b'trun')
+    if pos < 0:
+        return 0
+    # version/flags, sample_count, data_offset, sample_duration
+    duration, = struct.unpack('>I', fragment[pos + 16:pos + 20])
+    return duration / FMP4_TIMESCALE
+
+
+class Part(object):
+
+    def __init__(self, independent):
+        self.independent = independent
+        self.fragments = []
+        self.duration = 0
+        self.data = None  # Set once the part is complete.
+
+
+class Segment(object):
+
+    def __init__(self, msn):
+        self.msn = msn
+        self.parts = []
+        self.duration = 0
+        self.data = None  # Set once the segment is complete.
+
+    @property
+    def complete(self):
+        return self.data is not None
+
+
+class SegmentStore(object):
+    """
+    Keeps the latest segments of a camera in memory, and builds its playlist.
+    """
+
+    def __init__(self, cam_id, segment_duration, part_duration, max_segments):
+        self._cam_id = cam_id
+        self._segment_duration = segment_duration
+        self._part_duration = part_duration
+        self._segments = deque(maxlen=max_segments)
+        self._next_msn = 0
+
+        self.init_segment = None
+        self.last_request = time.time()
+        self.greenlet = None
+
+        # Set (and replaced) whenever a part is completed, to wake up blocking requests.
+        self._changed = gevent.event.Event()
+
+    def add_fragment(self, fragment, duration, keyframe):
+        """
+        Adds a fragment (a single picture) to the store.
+        :param fragment: moof + mdat fragment.
+        :param duration: Duration of the fragment, in seconds.
+        :param keyframe: Whether the fragment is a keyframe. Only keyframes can start segments.
+        :return:
+        """
+        segment = self._segments[-1] if len(self._segments) > 0 else None
+
+        if segment is None or segment.complete:
+            if not keyframe:
+                # Segments must be independently decodable.
+                return
+            segment = self._start_segment()
+
+        elif keyframe and segment.duration + DURATION_EPSILON >= self._segment_duration:
+            self._complete_segment(segment)
+            segment = self._start_segment()
+
+        part = segment.parts[-1] if len(segment.parts) > 0 else None
+        if part is None or part.data is not None:
+            part = Part(independent=keyframe)
+            segment.parts.append(part)
+
+        part.fragments.append(fragment)
+        part.duration += duration
+        segment.duration += duration
+
+        if part.duration + DURATION_EPSILON >= self._part_duration:
+            self._complete_part(part)
+
+    def _start_segment(self):
+        segment = Segment(self._next_msn)
+        self._next_msn += 1
+        self._segments.append(segment)
+        return segment
+
+    def _complete_part(self, part):
+        part.data = b''.join(part.fragments)
+        part.fragments = None
+        stats.incr('hls_parts')
+        self._notify()
+
+    def _complete_segment(self, segment):
+        if len(segment.parts) > 0 and segment.parts[-1].data is None:
+            self._complete_part(segment.parts[-1])
+        segment.data = b''.join(part.data for part in segment.parts)
+        stats.incr('hls_segments')
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, gevent.event.Event()
+        changed.set()
+
+    def get_segment(self, msn):
+        for segment in self._segments:
+            if segment.msn == msn:
+                return segment
+        return None
+
+    def get_part(self, msn, part_index):
+        segment = self.get_segment(msn)
+        if segment is None or part_index >= len(segment.parts):
+            return None
+        part = segment.parts[part_index]
+        return part if part.data is not None else None
+
+    def has_part(self, msn, part_index):
+        """
+        Checks whether the specified part (or a later one) is available, as blocking reloads require.
+        :param msn: Media sequence number.
+        :param part_index: Part index. If None, the whole segment must be complete.
+        :return:
+        """
+        segment = self.get_segment(msn)
+        if segment is None:
+            return msn < self._next_msn - 1 or (len(self._segments) > 0 and msn < self._segments[0].msn)
+        if part_index is None:
+            return segment.complete
+        return segment.complete or self.get_part(msn, part_index) is not None
+
+    @property
+    def last_msn(self):
+        """
+        Media sequence number of the last segment (complete or in progress), or None if there are no segments yet.
+        """
+        return self._next_msn - 1 if len(self._segments) > 0 else None
+
+    def wait(self, predicate, timeout):
+        """
+        Waits until the predicate is true, or the timeout expires.
+        :return: The final value of the predicate.
+        """
+        deadline = time.time() + timeout
+        while not predicate():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._changed.wait(remaining)
+        return True
+
+    def playlist(self):
+        """
+        Builds the media playlist.
+        :return:
+        """
+        segments = list(self._segments)
+        complete = [s for s in segments if s.complete]
+        target_duration = max([s.duration for s in complete] + [self._segment_duration])
+
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:9',
+            '#EXT-X-TARGETDURATION:{}'.format(int(math.ceil(target_duration))),
+            '#EXT-X-PART-INF:PART-TARGET={:.3f}'.format(self._part_duration),
+            '#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={:.3f}'.format(3 * self._part_duration),
+            '#EXT-X-MEDIA-SEQUENCE:{}'.format(segments[0].msn if len(segments) > 0 else 0),
+            '#EXT-X-MAP:URI="init.mp4"'
+        ]
+
+        next_part = None
+        for segment in segments:
+            for i, part in enumerate(segment.parts):
+                if part.data is None:
+                    next_part = (segment.msn, i)
+                    break
+                lines.append('#EXT-X-PART:DURATION={:.3f},URI="part{}.{}.m4s"{}'.format(
+                    part.duration, segment.msn, i, ',INDEPENDENT=YES' if part.independent else ''))
+            else:
+                if not segment.complete:
+                    next_part = (segment.msn, len(segment.parts))
+
+            if segment.complete:
+                lines.append('#EXTINF:{:.3f},'.format(segment.duration))
+                lines.append('seg{}.m4s'.format(segment.msn))
+
+        if next_part is not None:
+            lines.append('#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part{}.{}.m4s"'.format(*next_part))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Segment stores of this process, by camera.
+STORES = {}
+
+
+def _feed_store(store, cam_id, redis_prefix, idle_timeout):
+    """
+    Greenlet that feeds the segment store of a camera from the <cam>/fmp4 channel, until nobody requests it for a while.
+    :return:
+    """
+    init_key = redis_prefix + ":cams:" + cam_id + ":fmp4:init"
+
+    try:
+        with ChannelListener(["{}/fmp4".format(cam_id)]) as listener:
+            for data in listener.messages(lambda: time.time() - store.last_request >= idle_timeout):
+                keyframe = data[0] == FMP4_FRAGMENT_KEYFRAME
+                if keyframe:
+                    # The init segment may change along with the parameter sets, which are always sent with a
+                    # keyframe.
+                    store.init_segment = rdb.get(init_key)
+
+                fragment = data[1:]
+                store.add_fragment(fragment, fragment_duration(fragment), keyframe)
+    finally:
+        if STORES.get(cam_id) is store:
+            del STORES[cam_id]
+        stats.gauge_set('hls_stores', len(STORES))
+
+
+def get_store(cam_id):
+    """
+    Returns the segment store for the camera, starting it if needed.
+    :param cam_id:
+    :return:
+    """
+    store = STORES.get(cam_id)
+    if store is None:
+        config = current_app.config
+        store = SegmentStore(cam_id, config['HLS_SEGMENT_DURATION'], config['HLS_PART_DURATION'],
+                             config['HLS_SEGMENTS_KEPT'])
+        STORES[cam_id] = store
+        stats.gauge_set('hls_stores', len(STORES))
+
+        store.greenlet = gevent.spawn(_feed_store, store, cam_id, config['REDIS_PREFIX'],
+                                      config['HLS_IDLE_TIMEOUT'])
+
+    # The activity tracker coalesces the marks, so this does not cost a redis write per request.
+    mark_active(cam_id, 'h264')
+
+    store.last_request = time.time()
+    return store
+
+
+def _cacheable(data, mimetype, cache_control):
+    response = Response(data, status=200, mimetype=mimetype)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def _blocking_timeout():
+    return 3 * current_app.config['HLS_SEGMENT_DURATION']
+
+
+@main.route('/hls/<cam_id>/playlist.m3u8')
+def hls_playlist(cam_id):
+    """
+    Returns the LL-HLS media playlist. Supports blocking reloads through the _HLS_msn and _HLS_part parameters.
+    :param cam_id:
+    :return:
+    """
+    stats.incr('hls_requests')
+    store = get_store(cam_id)
+
+    msn = request.values.get('_HLS_msn', type=int)
+    part_index = request.values.get('_HLS_part', type=int)
+    if msn is not None:
+        # LL-HLS requires an immediate error for requests more than two segments ahead of the playlist, rather than
+        # blocking until they time out.
+        last_msn = store.last_msn
+        if last_msn is not None and msn > last_msn + 2:
+            return make_response("The requested segment is too far ahead of the live edge", 400)
+        if not store.wait(lambda: store.has_part(msn, part_index), _blocking_timeout()):
+            return make_response("The requested part is not available", 503)
+    elif not store.wait(lambda: store.init_segment is not None and store.has_part(0, 0), _blocking_timeout()):
+        return make_response("No fragmented MP4 stream is available for this camera", 503)
+
+    return _cacheable(store.playlist(), PLAYLIST_MIMETYPE, PLAYLIST_CACHE_CONTROL)
+
+
+@main.route('/hls/<cam_id>/init.mp4')
+def hls_init(cam_id):
+    stats.incr('hls_requests')
+    store = get_store(cam_id)
+    if store.init_segment is None:
+        return make_response("No fragmented MP4 stream is available for this camera", 404)
+    return _cacheable(store.init_segment, SEGMENT_MIMETYPE, PLAYLIST_CACHE_CONTROL)
+
+
+@main.route('/hls/<cam_id>/seg<int:msn>.m4s')
+def hls_segment(cam_id, msn):
+    stats.incr('hls_requests')
+    store = get_store(cam_id)
+    segment = store.get_segment(msn)
+    if segment is None or not segment.complete:
+        return make_response("Segment not available", 404)
+    return _cacheable(segment.data, SEGMENT_MIMETYPE, IMMUTABLE_CACHE_CONTROL)
+
+
+@main.route('/hls/<cam_id>/part<int:msn>.<int:part_index>.m4s')
+def hls_part(cam_id, msn, part_index):
+    """
+    Returns a part. Parts that are not available yet (such as the preload hint) are waited for.
+    :return:
+    """
+    stats.incr('hls_requests')
+    store = get_store(cam_id)
+    if not store.wait(lambda: store.has_part(msn, part_index), _blocking_timeout()):
+        return make_response("Part not available", 404)
+    part = store.get_part(msn, part_index)
+    if part is None:
+        return make_response("Part not available", 404)
+    return _cacheable(part.data, SEGMENT_MIMETYPE, IMMUTABLE_CACHE_CONTROL)
+
@@ -0,0 +1,193 @@
+"""
+Per-camera fan-out of the redis pubsub channels.
+
+Without a hub, every H.264, MPEG or fMP4 viewer holds its own pubsub subscription, so redis delivers every message once
+per viewer and holds a connection per viewer. The hub of a worker process subscribes once per channel, and fans the
+messages out to the local viewers through in-process queues. Redis then delivers every message once per camera and
+worker, whatever the number of viewers, which is what lets the server scale out to several worker processes.
+
+The subscription of a channel is dropped once its last viewer leaves.
+
+Viewers that do not keep up (their queue is full) lose the queued messages, and get a gap (None) instead, so that they
+can resume at the next keyframe:
+
+    with get_hub().subscribe("archimedes/h264") as subscription:
+        for data in subscription.messages(lambda: self._should_stop):
+            if data is None:
+                # Messages were dropped.
+                ...
+"""
+
+import gevent
+from gevent.queue import Queue, Empty, Full
+
+from flask import current_app
+
+from . import stats
+from .redis_funcs import ChannelListener
+
+# Queued in place of the messages that a subscriber lost.
+_GAP = object()
+
+
+class Subscription(object):
+
+    def __init__(self, hub, channel, queue_size):
+        self._hub = hub
+        self.channel = channel
+        self.active = False
+        self._queue = Queue(queue_size)
+        self._channel = None  # _Channel that it is subscribed to.
+
+    def __enter__(self):
+        self.active = True
+        self._hub._add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.active = False
+        self._hub._remove(self)
+        return False
+
+    def messages(self, should_stop, poll_interval=1):
+        """
+        Yields the messages of the channel (or None for a gap), until should_stop returns True.
+        :param should_stop: Function, checked after every message and every poll_interval seconds without messages.
+        :param poll_interval:
+        :return:
+        """
+        while not should_stop():
+            try:
+                data = self._queue.get(timeout=poll_interval)
+            except Empty:
+                continue
+            yield None if data is _GAP else data
+
+    def _put(self, data):
+        try:
+            self._queue.put_nowait(data)
+        except Full:
+            # The subscriber is lagging: what it has queued is stale anyway.
+            dropped = self._queue.qsize()
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(_GAP)
+            try:
+                # It resumes with the newest message.
+                self._queue.put_nowait(data)
+            except Full:
+                dropped += 1
+            stats.incr('hub_messages_dropped', dropped)
+
+
+class _Channel(object):
+
+    def __init__(self, hub, name):
+        self._hub = hub
+        self.name = name
+        self.subscribers = set()
+        self.closing = False
+        self.greenlet = None
+
+    def run(self):
+        try:
+            with ChannelListener([self.name]) as listener:
+                for data in listener.messages(lambda: not self.subscribers):
+                    stats.incr('hub_messages')
+                    stats.incr('hub_deliveries', len(self.subscribers))
+                    for subscription in list(self.subscribers):
+                        subscription._put(data)
+                # No yield between the last subscriber check and this.
+                self.closing = True
+        except Exception as ex:
+            print("[hub]: Subscription to {} failed: {}".format(self.name, ex))
+            stats.incr('hub_channel_errors')
+        finally:
+            self.closing = True
+            self._hub._closed(self)
+
+
+class ChannelHub(object):
+
+    def __init__(self, queue_size):
+        """
+        :param queue_size: Maximum number of messages queued per subscriber.
+        """
+        self._queue_size = queue_size
+        self._channels = {}  # name -> _Channel
+
+    def subscribe(self, channel):
+        """
+        Returns a subscription to the channel. It is active within its with block.
+        :param channel: Name of the redis channel, such as archimedes/h264.
+        :return: Subscription
+        """
+        return Subscription(self, channel, self._queue_size)
+
+    def get_channel_count(self):
+        return len(self._channels)
+
+    def get_subscriber_count(self, channel=None):
+        if channel is not None:
+            ch = self._channels.get(channel)
+            return len(ch.subscribers) if ch is not None else 0
+        return sum(len(ch.subscribers) for ch in self._channels.values())
+
+    def _add(self, subscription):
+        channel = self._channels.get(subscription.channel)
+        if channel is None or channel.closing:
+            channel = _Channel(self, subscription.channel)
+            self._channels[subscription.channel] = channel
+            channel.greenlet = gevent.spawn(channel.run)
+        channel.subscribers.add(subscription)
+        subscription._channel = channel
+        self._update_gauges()
+
+    def _remove(self, subscription):
+        if subscription._channel is not None:
+            subscription._channel.subscribers.discard(subscription)
+            subscription._channel = None
+        self._update_gauges()
+
+    def _closed(self, channel):
+        if self._channels.get(channel.name) is channel:
+            del self._channels[channel.name]
+        if channel.subscribers:
+            # The subscription failed (for instance, the redis connection dropped): the subscribers move to a new one.
+            gevent.spawn_later(1, self._reopen, list(channel.subscribers))
+        self._update_gauges()
+
+    def _reopen(self, subscriptions):
+        for subscription in subscriptions:
+            if subscription.active:
+                subscription._put(_GAP)
+                self._add(subscription)
+
+    def _update_gauges(self):
+        stats.gauge_set('hub_channels', len(self._channels))
+        stats.gauge_set('hub_subscribers', self.get_subscriber_count())
+
+
+# Channel hub of this process.
+_hub = None
+
+
+def get_hub():
+    """
+    Returns the channel hub of this process.
+    :return:
+    """
+    global _hub
+    if _hub is None:
+        _hub = ChannelHub(current_app.config['HUB_QUEUE_SIZE'])
+    return _hub
+
+
+def reset():
+    """
+    Drops the channel hub of this process. Its channels are closed once their subscribers leave. Mostly useful for
+    testing.
+    :return:
+    """
+    global _hub
+    _hub = None
@@ -0,0 +1,30 @@
+-----------------------------------
+-- Fetches the last frame of a camera in a single round trip. Activity marking is done separately (and coalesced) by
+-- the server activity tracker.
+--
+-- KEYS[1]: <prefix>:cams:<cam>:lastframe
+-- KEYS[2]: <prefix>:cams:<cam>:frameseq
+-- KEYS[3]: <prefix>:cams:<cam>:error
+-- KEYS[4]: <prefix>:feeder:alive
+-- ARGV[1]: Sequence number of the frame that the caller already has, or an empty string.
+--
+-- Returns {seq, alive, error[, frame]}. The frame comes last (and is omitted when missing or unchanged) because nil
+-- values would truncate the reply. The seq is an empty string if the feeder has not numbered any frame yet.
+-----------------------------------
+
+local seq = redis.call('get', KEYS[2]) or ''
+local alive = redis.call('exists', KEYS[4])
+local err = redis.call('exists', KEYS[3])
+
+-- Frames are only compared for equality, so that a reset of the sequence (such as a key expiry) is never mistaken
+-- for an old frame.
+if ARGV[1] ~= '' and seq ~= '' and seq == ARGV[1] then
+  return {seq, alive, err}
+end
+
+local frame = redis.call('get', KEYS[1])
+if not frame then
+  return {seq, alive, err}
+end
+
+return {seq, alive, err, frame}
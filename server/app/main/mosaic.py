@@ -0,0 +1,275 @@
+"""
+Multi-camera mosaics.
+
+A mosaic composes the last frames of a grid of cameras into a single downscaled JPEG, so that a control-room screen
+opens one stream instead of one per camera. Frames are decoded in JPEG draft mode, which lets the decoder downscale
+(by 1/2, 1/4 or 1/8) while decoding, so the cost of a tile is a fraction of a full decode.
+
+A mosaic is only rendered when one of its frames changes, and at most once per tick of the shared ticker: every viewer
+of the same mosaic gets the same multipart part (see the multipart module).
+
+Endpoints:
+    /mosaic?cams=<cam1>,<cam2>,...&cols=<n>&width=<tile width>: single JPEG.
+    /mosaic/mjpeg?cams=...&tfps=<fps>: multipart/x-mixed-replace stream.
+"""
+
+import io
+import math
+from collections import OrderedDict
+
+from gevent import monkey
+monkey.patch_all()
+
+from flask import current_app, request, make_response, render_template, Response, stream_with_context
+
+from . import main, stats
+from .admission import get_controller, overloaded_response, release_on_close
+from .delivery import FrameDelivery
+from .egress import get_scheduler
+from .multipart import build_part
+from .redis_funcs import fetch_frames, add_viewer, remove_viewer
+from .ticker import get_ticker
+
+# Color of the tiles whose camera has no frame available.
+EMPTY_TILE_COLOR = (40, 40, 40)
+
+# Height / width ratio of the tiles.
+TILE_ASPECT = 3 / 4
+
+
+class MosaicLayout(object):
+
+    def __init__(self, cams, cols, tile_width, quality):
+        self.cams = tuple(cams)
+        self.cols = max(1, min(cols, len(self.cams)))
+        self.rows = int(math.ceil(len(self.cams) / self.cols))
+        self.tile_width = tile_width
+        self.tile_height = int(tile_width * TILE_ASPECT)
+        self.quality = quality
+
+    @property
+    def key(self):
+        return self.cams, self.cols, self.tile_width, self.quality
+
+    def render(self, frames):
+        """
+        Composes the mosaic.
+        :param frames: JPEG frame (or None) for every camera, in order.
+        :return: The mosaic, as a JPEG.
+        """
+        from PIL import Image
+
+        canvas = Image.new('RGB', (self.cols * self.tile_width, self.rows * self.tile_height), EMPTY_TILE_COLOR)
+        for i, frame in enumerate(frames):
+            if frame is None:
+                continue
+            try:
+                tile = self._tile(frame)
+            except (IOError, SyntaxError) as ex:
+                print("[mosaic]: Could not decode the frame of cam {}: {}".format(self.cams[i], ex))
+                continue
+
+            # Centered within its cell, as the aspect ratios may differ.
+            x = (i % self.cols) * self.tile_width + (self.tile_width - tile.size[0]) // 2
+            y = (i // self.cols) * self.tile_height + (self.tile_height - tile.size[1]) // 2
+            canvas.paste(tile, (x, y))
+            tile.close()
+
+        out = io.BytesIO()
+        canvas.save(out, 'jpeg', quality=self.quality)
+        canvas.close()
+        stats.incr('mosaic_renders')
+        return out.getvalue()
+
+    def _tile(self, frame):
+        return decode_scaled(frame, self.tile_width, self.tile_height)
+
+
+def decode_scaled(frame, width, height):
+    """
+    Decodes a JPEG frame scaled down to fit the specified size, keeping its aspect ratio.
+    :param frame:
+    :param width:
+    :param height:
+    :return: RGB Image
+    """
+    # PIL is only needed to transform the frames, and is thus imported on first use.
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(frame))  # type: Image
+
+    # Lets the JPEG decoder downscale while decoding, to the smallest scale that still covers the box (with the aspect
+    # ratio of the frame).
+    w, h = img.size
+    scale = min(width / w, height / h)
+    img.draft('RGB', (int(w * scale), int(h * scale)))
+    img = img.convert('RGB')
+    img.thumbnail((width, height))
+    return img
+
+
+class MosaicCache(object):
+    """
+    Keeps the last rendered part of every mosaic, along with the ids of the frames it was rendered from.
+    """
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()  # layout key -> (frame ids, jpeg, part)
+
+    def get(self, layout, frame_ids, frames):
+        """
+        Returns the (jpeg, part) of the mosaic, rendering it if its frames changed.
+        :param layout: MosaicLayout
+        :param frame_ids: Ids (sequence numbers) of the frames. If any of them is None, the frames cannot be
+        identified and the mosaic is rendered again.
+        :param frames:
+        :return:
+        """
+        entry = self._entries.get(layout.key)
+        if entry is not None and None not in frame_ids and entry[0] == frame_ids:
+            self._entries.move_to_end(layout.key)
+            stats.incr('mosaic_cache_hits')
+            return entry[1], entry[2]
+
+        jpeg = layout.render(frames)
+        part = build_part(jpeg, ','.join(str(i) for i in frame_ids))
+        self._entries[layout.key] = (frame_ids, jpeg, part)
+        self._entries.move_to_end(layout.key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return jpeg, part
+
+
+# Mosaic cache of this process.
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = MosaicCache(current_app.config['MOSAIC_CACHE_ENTRIES'])
+    return _cache
+
+
+def reset():
+    """
+    Drops the mosaic cache of this process. Mostly useful for testing.
+    :return:
+    """
+    global _cache
+    _cache = None
+
+
+def _frame_id(fetched):
+    if fetched.frame is None:
+        return 'none'
+    return fetched.seq.decode() if isinstance(fetched.seq, bytes) else fetched.seq
+
+
+def _get_layout():
+    """
+    Builds the layout from the request parameters.
+    :return: MosaicLayout, or None if the parameters are not valid.
+    """
+    config = current_app.config
+    cams = [cam for cam in request.values.get('cams', '').split(',') if cam]
+    if len(cams) == 0 or len(cams) > config['MOSAIC_MAX_CAMS']:
+        return None
+    cols = request.values.get('cols', int(math.ceil(math.sqrt(len(cams)))), type=int)
+    width = request.values.get('width', config['MOSAIC_TILE_WIDTH'], type=int)
+    if cols is None or width is None or not 16 <= width <= config['MOSAIC_MAX_TILE_WIDTH']:
+        return None
+    return MosaicLayout(cams, cols, width, config['MOSAIC_QUALITY'])
+
+
+def _invalid_layout():
+    return make_response("Wrong value: cams must be a comma-separated list of up to {} cameras, and width at most {}"
+                         .format(current_app.config['MOSAIC_MAX_CAMS'], current_app.config['MOSAIC_MAX_TILE_WIDTH']),
+                         400)
+
+
+@main.route('/mosaic')
+def mosaic():
+    """
+    Returns a single mosaic JPEG of the specified cameras.
+    :return:
+    """
+    layout = _get_layout()
+    if layout is None:
+        return _invalid_layout()
+
+    fetched = fetch_frames(layout.cams, layout.tile_width)
+    jpeg, part = get_cache().get(layout, tuple(_frame_id(f) for f in fetched), [f.frame for f in fetched])
+    return Response(jpeg, status=200, mimetype="image/jpeg")
+
+
+@main.route('/mosaic/mjpeg')
+def mosaic_mjpeg():
+    """
+    Returns a MJPEG stream of the mosaic of the specified cameras, at the target FPS (tfps parameter).
+    :return:
+    """
+    layout = _get_layout()
+    if layout is None:
+        return _invalid_layout()
+
+    tfps = request.values.get('tfps', 5, type=int)
+    keepalive = request.values.get('keepalive', current_app.config['KEEPALIVE_RESEND_INTERVAL'], type=float)
+
+    # A mosaic counts as a single stream of the worker. When overloaded, its FPS is degraded (but not its size).
+    ticket = get_controller().admit(None, tfps)
+    if not ticket.admitted:
+        return overloaded_response(ticket)
+
+    stream = _generate_mosaic(layout, ticket.fps, keepalive, request.values.get('class'))
+    return release_on_close(ticket, Response(stream_with_context(stream),
+                                             mimetype='multipart/x-mixed-replace; boundary=frame'))
+
+
+def _generate_mosaic(layout, tfps, keepalive, client_class=None):
+    ticker = get_ticker(tfps)
+    delivery = FrameDelivery(keepalive)
+    cache = get_cache()
+    # A mosaic is not a single camera: it has the weight of its client class only.
+    flow = get_scheduler().open_flow(None, client_class)
+
+    for cam in layout.cams:
+        add_viewer(cam)
+    ticker.subscribe()
+    try:
+        while True:
+            ticker.wait()
+
+            # The frames are looked up once per tick for all the viewers of the tier, and the mosaic is only
+            # rendered again if one of them changed.
+            fetched = [ticker.get_frame(cam) for cam in layout.cams]
+            frame_ids = tuple(_frame_id(f) for f in fetched)
+
+            mosaic_id = frame_ids if None not in frame_ids else None
+            if not delivery.should_send(mosaic_id):
+                continue
+
+            jpeg, part = cache.get(layout, frame_ids, [f.frame for f in fetched])
+            if not flow.send(len(part)):
+                # The uplink is saturated: a later mosaic will be sent instead.
+                stats.incr('mosaic_parts_dropped')
+                continue
+
+            stats.incr('mosaic_parts_served')
+            delivery.sent(mosaic_id)
+            yield part
+    finally:
+        ticker.unsubscribe()
+        flow.close()
+        for cam in layout.cams:
+            remove_viewer(cam)
+
+
+@main.route('/exps/mosaic')
+def exp_mosaic():
+    """
+    Control-room dashboard: a single mosaic stream of several cameras (cams parameter).
+    :return:
+    """
+    return render_template('dash.html', query=request.query_string.decode())
@@ -0,0 +1,118 @@
+"""
+Pre-serialized multipart parts for the MJPEG HTTP streams.
+
+Every part of a multipart/x-mixed-replace stream (boundary, headers, JPEG body and trailer) is built once per frame and
+variant (rotation, cropping, and the size and JPEG quality of the adaptive quality ladder) and then shared, as an
+immutable bytes object, by every client that streams the same camera. Serving a frame to one more client is then a
+reference to an existing buffer: neither the JPEG is copied into a new part nor re-encoded for the variant.
+
+The parts carry a Content-Length header, so that clients do not need to scan for the boundary, and an X-Frame-Id
+header with the frame sequence number.
+"""
+
+from collections import OrderedDict
+
+from flask import current_app
+
+from . import stats
+
+BOUNDARY = b'frame'
+
+
+def build_part(body, frame_id=None, content_type=b'image/jpeg', headers=None):
+    """
+    Serializes a multipart part.
+    :param body: Contents of the part.
+    :param frame_id: Sequence number of the frame, if known.
+    :param content_type:
+    :param headers: Additional headers, as (name, value) bytes pairs.
+    :return:
+    """
+    lines = [b'--' + BOUNDARY, b'Content-Type: ' + content_type, b'Content-Length: ' + str(len(body)).encode()]
+    if frame_id is not None:
+        if not isinstance(frame_id, bytes):
+            frame_id = str(frame_id).encode()
+        lines.append(b'X-Frame-Id: ' + frame_id)
+    for name, value in headers or ():
+        lines.append(name + b': ' + value)
+
+    part = b''.join((b'\r\n'.join(lines), b'\r\n\r\n', body, b'\r\n'))
+    stats.incr('mjpeg_parts_built')
+    stats.incr('mjpeg_part_bytes_built', len(part))
+    return part
+
+
+class PartCache(object):
+
+    def __init__(self, max_entries):
+        """
+        :param max_entries: Maximum number of (camera, variant) parts kept. Only the latest frame of each is kept.
+        """
+        self._max_entries = max_entries
+        self._entries = OrderedDict()  # (cam_name, variant) -> (seq, part, transformed frame)
+
+    def get_part(self, cam_name, variant, seq, frame, transform=None):
+        """
+        Returns the multipart part for the frame, building it if it is not cached yet.
+        :param cam_name:
+        :param variant: Hashable description of the transformation (such as the rotation and crop parameters).
+        :param seq: Sequence number of the frame. If None, the frame cannot be identified and the part is not cached.
+        :param frame: JPEG frame, as stored by the feeder.
+        :param transform: Function that applies the variant to the frame, or None for the original frame.
+        :return:
+        """
+        return self._get_entry(cam_name, variant, seq, frame, transform)[1]
+
+    def get_frame(self, cam_name, variant, seq, frame, transform=None):
+        """
+        Returns the frame transformed for the variant (without the multipart framing), for the streams that are not
+        multipart, such as Socket.IO. It shares the transformation with the part of the same variant.
+        :return:
+        """
+        return self._get_entry(cam_name, variant, seq, frame, transform)[2]
+
+    def _get_entry(self, cam_name, variant, seq, frame, transform):
+        key = (cam_name, variant)
+        entry = self._entries.get(key)
+        if entry is not None and seq is not None and entry[0] == seq:
+            self._entries.move_to_end(key)
+            stats.incr('mjpeg_part_cache_hits')
+            return entry
+
+        stats.incr('mjpeg_part_cache_misses')
+        if transform is not None:
+            frame = transform(frame)
+            stats.incr('mjpeg_transforms')
+        entry = (seq, build_part(frame, seq), frame)
+
+        if seq is not None:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        stats.gauge_set('mjpeg_part_cache_entries', len(self._entries))
+        return entry
+
+
+# Part cache of this process.
+_cache = None
+
+
+def get_part_cache():
+    """
+    Returns the part cache of this process.
+    :return:
+    """
+    global _cache
+    if _cache is None:
+        _cache = PartCache(current_app.config['MJPEG_PART_CACHE_ENTRIES'])
+    return _cache
+
+
+def reset():
+    """
+    Drops the part cache of this process. Mostly useful for testing.
+    :return:
+    """
+    global _cache
+    _cache = None
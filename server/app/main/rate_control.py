@@ -0,0 +1,200 @@
+"""
+Adaptive frame rate and quality for the MJPEG streams.
+
+The streams are paced by the shared ticker of their target FPS tier (see the ticker module). When a client cannot keep
+up, it is served only one of every <interval> ticks, so that it keeps sharing the ticker and the frame lookups of the
+tier while it gets fewer frames.
+
+Whether the client keeps up is measured through the time it takes to flush each frame: a generator is only resumed
+once the server has written the previously yielded chunk to the socket, which blocks while the socket buffers are
+full. The interval follows AIMD: it doubles (halving the FPS) whenever a flush takes more than a fraction of the frame
+period, and decreases by one tick once the flushes have been fast for about a second.
+
+Before lowering the FPS, the streams that allow it (quality=auto) lower the quality: the frames are sent down a ladder
+of smaller and more compressed re-encodes (MJPEG_QUALITY_LADDER), each computed once per frame and shared by every
+client on that rung (see the multipart module). The rung is chosen from the throughput of the client, estimated from
+the time it takes to send each frame (the flush time for HTTP, the ack round trip for Socket.IO), so that a frame of
+the rung can be sent well within the period of the requested FPS. The FPS only goes down at the lowest rung.
+"""
+
+import io
+import math
+
+from . import stats
+from .mosaic import decode_scaled
+
+# A flush that takes more than this fraction of the frame period signals congestion.
+CONGESTION_RATIO = 0.5
+
+# Flushes that take less than this fraction of the frame period leave headroom to increase the rate.
+HEADROOM_RATIO = 0.2
+
+# Weight of the latest flush time in its moving average.
+FLUSH_ALPHA = 0.3
+
+
+class AdaptiveRate(object):
+
+    def __init__(self, target_fps, min_fps):
+        """
+        :param target_fps: FPS that the client requested. The rate never goes above it.
+        :param min_fps: The rate never goes below it (unless the target is lower).
+        """
+        self._target_fps = target_fps
+        self._max_interval = max(int(math.ceil(target_fps / min_fps)), 1)
+
+        self.interval = 1  # Ticks per served frame.
+        self._flush_time = 0  # Moving average, in seconds.
+        self._fast_frames = 0  # Consecutive frames with headroom.
+
+    def get_fps(self):
+        """
+        FPS the client is currently being served at.
+        :return:
+        """
+        return self._target_fps / self.interval
+
+    def get_flush_time(self):
+        return self._flush_time
+
+    def should_serve(self, tick):
+        """
+        Whether a frame should be served to the client on this tick.
+        :param tick: Tick number, from the ticker.
+        :return:
+        """
+        return tick % self.interval == 0
+
+    def record(self, flush_time):
+        """
+        Records the time it took to flush a frame to the client, and adapts the rate.
+        :param flush_time: Seconds.
+        :return: True if the rate changed.
+        """
+        self._flush_time = (1 - FLUSH_ALPHA) * self._flush_time + FLUSH_ALPHA * flush_time
+        period = self.interval / self._target_fps
+
+        if flush_time > CONGESTION_RATIO * period:
+            self._fast_frames = 0
+            if self.interval < self._max_interval:
+                self.interval = min(self.interval * 2, self._max_interval)
+                stats.incr('mjpeg_rate_decreases')
+                return True
+            return False
+
+        if self._flush_time < HEADROOM_RATIO * period:
+            self._fast_frames += 1
+            # About a second of fast flushes before increasing.
+            if self.interval > 1 and self._fast_frames >= self.get_fps():
+                self._fast_frames = 0
+                self.interval -= 1
+                stats.incr('mjpeg_rate_increases')
+                return True
+        else:
+            self._fast_frames = 0
+
+        return False
+
+
+# Assumed size of a rung, relative to the next lower one, while it has not been sent yet.
+RUNG_SIZE_RATIO = 2.0
+
+# Weight of the latest send time per byte in its moving average.
+THROUGHPUT_ALPHA = 0.3
+
+
+class AdaptiveQuality(object):
+
+    def __init__(self, ladder, target_fps):
+        """
+        :param ladder: List of (width, JPEG quality) rungs, from the best to the worst. 0 keeps the original width
+        (or quality).
+        :param target_fps: FPS that the client requested. The quality is chosen so that it can be kept.
+        """
+        self._ladder = ladder
+        self._period = 1.0 / target_fps
+        self._target_fps = target_fps
+
+        self.level = 0  # Index of the current rung.
+        self._sizes = {}  # Last size sent of every rung.
+        self._seconds_per_byte = 0  # Moving average.
+        self._fast_frames = 0  # Consecutive frames with headroom for the higher rung.
+
+    def get_rung(self):
+        """
+        Returns the (width, quality) of the current rung. They are None to keep the original.
+        :return:
+        """
+        width, quality = self._ladder[self.level]
+        return width or None, quality or None
+
+    def is_lowest(self):
+        return self.level == len(self._ladder) - 1
+
+    def get_throughput(self):
+        """
+        Estimated throughput of the client, in bytes per second (None until a frame has taken measurable time to
+        send).
+        :return:
+        """
+        return 1.0 / self._seconds_per_byte if self._seconds_per_byte else None
+
+    def record(self, size, seconds):
+        """
+        Records the time it took to send a frame of the current rung, and adapts the rung.
+        :param size: Bytes of the frame.
+        :param seconds: Time it took to send it.
+        :return: True if the rung changed.
+        """
+        if size <= 0:
+            return False
+        self._sizes[self.level] = size
+        self._seconds_per_byte = (1 - THROUGHPUT_ALPHA) * self._seconds_per_byte + THROUGHPUT_ALPHA * seconds / size
+
+        # Fraction of the frame period that sending a frame of the current rung takes.
+        if size * self._seconds_per_byte > CONGESTION_RATIO * self._period:
+            self._fast_frames = 0
+            if not self.is_lowest():
+                self.level += 1
+                stats.incr('mjpeg_quality_decreases')
+                return True
+            return False
+
+        if self.level > 0:
+            higher_size = self._sizes.get(self.level - 1, size * RUNG_SIZE_RATIO)
+            if higher_size * self._seconds_per_byte < HEADROOM_RATIO * self._period:
+                self._fast_frames += 1
+                # About a second of fast frames before going up.
+                if self._fast_frames >= self._target_fps:
+                    self._fast_frames = 0
+                    self.level -= 1
+                    stats.incr('mjpeg_quality_increases')
+                    return True
+            else:
+                self._fast_frames = 0
+
+        return False
+
+
+def reencode(frame, width=None, quality=None):
+    """
+    Re-encodes a JPEG frame scaled down to the specified width (keeping its aspect ratio) and with the specified JPEG
+    quality.
+    :param frame:
+    :param width: None to keep the original width.
+    :param quality: None for the default quality.
+    :return: The JPEG frame.
+    """
+    if width:
+        # Scaling is done while decoding.
+        img = decode_scaled(frame, width, width * 4)
+    else:
+        from PIL import Image
+        img = Image.open(io.BytesIO(frame))
+    out = io.BytesIO()
+    if quality:
+        img.save(out, 'jpeg', quality=quality)
+    else:
+        img.save(out, 'jpeg')
+    img.close()
+    return out.getvalue()
@@ -1,6 +1,148 @@
+import os
+from collections import namedtuple
+
 from flask import current_app
 
 from app import rdb
+from . import activity, frame_cache, stats
+
+# Result of fetch_frame. The frame is None if it is not available, or if it is the one the caller already has
+# (the unchanged flag tells them apart).
+FetchedFrame = namedtuple('FetchedFrame', ['seq', 'alive', 'error', 'frame', 'unchanged'])
+
+_fetch_frame_script = None
+
+
+def _get_fetch_frame_script():
+    """
+    Registers the fetch_frame Lua script on first use. It is then run through EVALSHA.
+    :return:
+    """
+    global _fetch_frame_script
+    if _fetch_frame_script is None:
+        path = os.path.join(os.path.dirname(__file__), 'lua', 'fetch_frame.lua')
+        with open(path, 'r') as f:
+            _fetch_frame_script = rdb.register_script(f.read())
+    return _fetch_frame_script
+
+
+def fetch_frame(cam_name, stream_format=None, since_seq=None, fps=None, width=None):
+    """
+    Marks the camera as active (through the activity tracker) and retrieves its last frame, along with the feeder
+    alive and camera error state, in a single redis round trip.
+    :param cam_name:
+    :param stream_format: If set, the camera is marked active for that format (:active:<fmt>) rather than in general.
+    :param since_seq: Sequence number of the frame that the caller already has. If the last frame is that same one,
+    it is not transferred again.
+    :param fps: Frame rate at which the caller serves the camera, if known. Published as demand for the feeder.
+    :param width: Width at which the caller serves the camera, if known.
+    :return: FetchedFrame
+    """
+    REDIS_PREFIX = current_app.config['REDIS_PREFIX']
+    cam_key = REDIS_PREFIX + ":cams:" + cam_name
+
+    activity.get_tracker().mark(get_active_key(cam_name, stream_format), fps, width)
+
+    cache = frame_cache.get_cache()
+    if cache is not None:
+        cached = cache.get(cam_key)
+        if cached is not None:
+            seq, frame, alive, error = cached
+            if seq is not None and since_seq is not None and seq == since_seq:
+                return FetchedFrame(seq, alive, error, None, True)
+            return FetchedFrame(seq, alive, error, frame, False)
+        generation = cache.get_generation(cam_key)
+
+    keys = [cam_key + ":lastframe", cam_key + ":frameseq", cam_key + ":error", REDIS_PREFIX + ":feeder:alive"]
+    args = [since_seq if since_seq is not None else '']
+
+    result = _get_fetch_frame_script()(keys=keys, args=args)
+    stats.incr('redis_round_trips')
+
+    seq = result[0] if result[0] != b'' else None
+    alive = result[1] == 1
+    error = result[2] == 1
+    frame = result[3] if len(result) > 3 else None
+    unchanged = frame is None and seq is not None and since_seq is not None and seq == since_seq
+
+    if cache is not None and frame is not None:
+        cache.put(cam_key, seq, frame, alive, error, generation)
+
+    return FetchedFrame(seq, alive, error, frame, unchanged)
+
+
+def fetch_frames(cam_names, width=None):
+    """
+    Marks the cameras as active and retrieves their last frames, along with the feeder alive and camera error states.
+    Frames in the frame cache are not transferred again, and the rest are fetched through a single MGET.
+    :param cam_names:
+    :param width: Width at which the caller serves the frames, if known.
+    :return: List with a FetchedFrame for every camera, in order.
+    """
+    REDIS_PREFIX = current_app.config['REDIS_PREFIX']
+    tracker = activity.get_tracker()
+    cache = frame_cache.get_cache()
+
+    results = [None] * len(cam_names)
+    missing = []
+    for i, cam_name in enumerate(cam_names):
+        tracker.mark(get_active_key(cam_name), None, width)
+        cached = cache.get(REDIS_PREFIX + ":cams:" + cam_name) if cache is not None else None
+        if cached is not None:
+            seq, frame, alive, error = cached
+            results[i] = FetchedFrame(seq, alive, error, frame, False)
+        else:
+            missing.append(i)
+
+    if len(missing) == 0:
+        return results
+
+    keys = [REDIS_PREFIX + ":feeder:alive"]
+    generations = {}
+    for i in missing:
+        cam_key = REDIS_PREFIX + ":cams:" + cam_names[i]
+        keys += [cam_key + ":lastframe", cam_key + ":frameseq", cam_key + ":error"]
+        if cache is not None:
+            generations[cam_key] = cache.get_generation(cam_key)
+
+    values = rdb.mget(keys)
+    stats.incr('redis_round_trips')
+
+    alive = values[0] is not None
+    for n, i in enumerate(missing):
+        frame, seq, error = values[1 + 3 * n:4 + 3 * n]
+        error = error is not None
+        if cache is not None and frame is not None:
+            cam_key = REDIS_PREFIX + ":cams:" + cam_names[i]
+            cache.put(cam_key, seq, frame, alive, error, generations[cam_key])
+        results[i] = FetchedFrame(seq, alive, error, frame, False)
+
+    return results
+
+
+def get_active_key(cam_name, stream_format=None):
+    """
+    Returns the key that marks the camera as active, in general or for the specified format.
+    :param cam_name:
+    :param stream_format:
+    :return:
+    """
+    cam_key = current_app.config['REDIS_PREFIX'] + ":cams:" + cam_name
+    return cam_key + ":active" if stream_format is None else cam_key + ":active:" + stream_format
+
+
+def add_viewer(cam_name, stream_format=None):
+    """
+    Registers an open stream for the camera. The camera is kept active until the viewer is removed.
+    :param cam_name:
+    :param stream_format:
+    :return:
+    """
+    activity.get_tracker().add_viewer(get_active_key(cam_name, stream_format))
+
+
+def remove_viewer(cam_name, stream_format=None):
+    activity.get_tracker().remove_viewer(get_active_key(cam_name, stream_format))
 
 
 def mark_active(cam_name, stream_format):
@@ -11,9 +153,7 @@ def mark_active(cam_name, stream_format):
     :param stream_format:
     :return:
     """
-    REDIS_PREFIX = current_app.config['REDIS_PREFIX']
-    cam_key = REDIS_PREFIX + ":cams:" + cam_name + ":active:" + stream_format
-    rdb.setex(cam_key, 30, 1)
+    activity.get_tracker().mark(get_active_key(cam_name, stream_format))
 
 
 def is_active(cam_name, stream_format):
@@ -27,3 +167,50 @@ def is_active(cam_name, stream_format):
     cam_key = REDIS_PREFIX + ":cams:" + cam_name + ":active:" + stream_format
     result = rdb.get(cam_key)
     return result is not None
+
+
+class ChannelListener(object):
+    """
+    Subscription to redis pubsub channels that can be stopped. Unlike pubsub.listen(), which blocks until the next
+    message arrives (forever, if the camera stopped publishing), messages are polled with a timeout so that the
+    listener notices it should stop within poll_interval seconds. Leaving the with block unsubscribes and returns the
+    connection to the pool.
+
+        with ChannelListener(["archimedes/h264"]) as listener:
+            for data in listener.messages(lambda: self._should_stop):
+                ...
+    """
+
+    def __init__(self, channels, poll_interval=1):
+        self._channels = channels
+        self._poll_interval = poll_interval
+        self._pubsub = None
+
+    def __enter__(self):
+        self._pubsub = rdb.pubsub()
+        self._pubsub.subscribe(self._channels)
+        stats.gauge_add('redis_pubsubs', 1)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._pubsub.unsubscribe()
+        except Exception as ex:
+            # The connection may be broken already. It is closed anyway.
+            print("[pubsub]: Could not unsubscribe from {}: {}".format(self._channels, ex))
+        finally:
+            self._pubsub.close()
+            self._pubsub = None
+            stats.gauge_add('redis_pubsubs', -1)
+        return False
+
+    def messages(self, should_stop):
+        """
+        Yields the data of the messages published to the channels, until should_stop returns True.
+        :param should_stop: Function, checked after every message and every poll_interval seconds without messages.
+        :return:
+        """
+        while not should_stop():
+            item = self._pubsub.get_message(timeout=self._poll_interval)
+            if item is not None and item['type'] == 'message':
+                yield item['data']
@@ -0,0 +1,211 @@
+"""
+Lifecycle of the Socket.IO broadcasters.
+
+Every broadcaster runs in its own greenlet, which holds redis connections (pubsub subscriptions) and viewer
+registrations until it exits. The registry owns these greenlets:
+
+ - Broadcasters are started and stopped through it, keyed by (client sid, camera, format). Starting a broadcaster for
+ a key that already has one stops the previous one.
+ - Broadcasters are asked to stop (stop()) when their client disconnects. They notice it within a poll interval, and
+ release their redis connections on the way out. Those that are still running BROADCASTER_STOP_GRACE seconds later
+ are leaked: their greenlet is killed.
+ - A reaper greenlet, every BROADCASTER_REAP_INTERVAL seconds, stops the broadcasters whose client is no longer
+ connected (in case the disconnect event was missed) and those that did not send anything for
+ BROADCASTER_IDLE_TIMEOUT seconds.
+
+The live, stopping and leaked counts are exported through the stats module.
+"""
+
+import time
+
+import gevent
+from flask import current_app
+
+from app import socketio
+from . import stats
+
+
+class _Entry(object):
+
+    def __init__(self, key, namespace, broadcaster, ticket):
+        self.key = key
+        self.namespace = namespace
+        self.broadcaster = broadcaster
+        self.ticket = ticket
+        self.greenlet = None
+        self.stop_time = None  # When it was asked to stop.
+
+
+class BroadcasterRegistry(object):
+
+    def __init__(self, idle_timeout, reap_interval, stop_grace):
+        """
+        :param idle_timeout: Seconds without sending anything after which a broadcaster is stopped (0 to never).
+        :param reap_interval: Seconds between the reaper runs.
+        :param stop_grace: Seconds that a broadcaster has to exit once stopped, before its greenlet is killed.
+        """
+        self._idle_timeout = idle_timeout
+        self._reap_interval = reap_interval
+        self._stop_grace = stop_grace
+
+        self._live = {}  # key -> _Entry
+        self._stopping = set()  # _Entry that were asked to stop but did not exit yet.
+        self._reaper = None
+
+    def start(self, key, namespace, broadcaster, ticket=None):
+        """
+        Starts a broadcaster in a new greenlet. Any previous broadcaster with the same key is stopped.
+        :param key: (client_sid, cam, format)
+        :param namespace: Socket.IO namespace of the client.
+        :param broadcaster: Object with run(), stop() and get_last_activity() methods.
+        :param ticket: Admission ticket of the stream, released once the broadcaster exits.
+        :return:
+        """
+        self.stop(key)
+
+        entry = _Entry(key, namespace, broadcaster, ticket)
+        self._live[key] = entry
+        entry.greenlet = gevent.spawn(broadcaster.run)
+        entry.greenlet.link(lambda g: self._on_exit(entry))
+        stats.incr('broadcasters_started')
+        self._update_gauges()
+
+        if self._reaper is None:
+            self._reaper = gevent.spawn(self._run_reaper)
+
+    def stop(self, key):
+        """
+        Asks the broadcaster with the specified key to stop.
+        :param key:
+        :return: Whether there was such a broadcaster.
+        """
+        entry = self._live.pop(key, None)
+        if entry is None:
+            return False
+
+        entry.broadcaster.stop()
+        if entry.ticket is not None:
+            # It is no longer serving the client, whether or not it has exited already.
+            entry.ticket.release()
+        if not entry.greenlet.dead:
+            entry.stop_time = time.time()
+            self._stopping.add(entry)
+        self._update_gauges()
+        return True
+
+    def stop_client(self, client_sid, namespace=None):
+        """
+        Stops all the broadcasters of a client.
+        :param client_sid:
+        :param namespace: If set, only the broadcasters of that namespace are stopped.
+        :return: Number of broadcasters stopped.
+        """
+        keys = [key for key, entry in self._live.items()
+                if key[0] == client_sid and (namespace is None or entry.namespace == namespace)]
+        for key in keys:
+            self.stop(key)
+        return len(keys)
+
+    def get(self, key):
+        entry = self._live.get(key)
+        return entry.broadcaster if entry is not None else None
+
+    def keys(self):
+        return list(self._live.keys())
+
+    def get_live_count(self):
+        return len(self._live)
+
+    def get_stopping_count(self):
+        return len(self._stopping)
+
+    def reap(self):
+        """
+        Stops the broadcasters of disconnected or idle clients, and kills the greenlets of the broadcasters that did
+        not exit within the grace period.
+        :return:
+        """
+        now = time.time()
+
+        for key, entry in list(self._live.items()):
+            if not socketio.server.manager.is_connected(key[0], entry.namespace):
+                print("[registry]: Client [{}] is gone. Stopping its {} broadcaster for {}.".format(
+                    key[0], key[2], key[1]))
+                stats.incr('broadcasters_reaped_disconnected')
+                self.stop(key)
+            elif self._idle_timeout and now - entry.broadcaster.get_last_activity() > self._idle_timeout:
+                print("[registry]: The {} broadcaster of client [{}] for {} is idle. Stopping it.".format(
+                    key[2], key[0], key[1]))
+                stats.incr('broadcasters_reaped_idle')
+                self.stop(key)
+
+        for entry in list(self._stopping):
+            if now - entry.stop_time > self._stop_grace:
+                print("[registry]: The {} broadcaster of client [{}] for {} did not stop. Killing it.".format(
+                    entry.key[2], entry.key[0], entry.key[1]))
+                stats.incr('broadcasters_leaked')
+                entry.greenlet.kill(block=False)
+
+    def stop_all(self):
+        """
+        Stops every broadcaster and the reaper, killing the greenlets that do not exit within the grace period.
+        :return:
+        """
+        for key in list(self._live):
+            self.stop(key)
+        greenlets = [entry.greenlet for entry in self._stopping]
+        gevent.joinall(greenlets, timeout=self._stop_grace)
+        gevent.killall([g for g in greenlets if not g.dead])
+        if self._reaper is not None:
+            self._reaper.kill()
+            self._reaper = None
+
+    def _on_exit(self, entry):
+        if entry.ticket is not None:
+            entry.ticket.release()
+        self._stopping.discard(entry)
+        if self._live.get(entry.key) is entry:
+            # It exited on its own (for instance, on an error).
+            del self._live[entry.key]
+            stats.incr('broadcasters_exited')
+        self._update_gauges()
+
+    def _update_gauges(self):
+        stats.gauge_set('broadcasters_live', len(self._live))
+        stats.gauge_set('broadcasters_stopping', len(self._stopping))
+
+    def _run_reaper(self):
+        while True:
+            gevent.sleep(self._reap_interval)
+            try:
+                self.reap()
+            except Exception as ex:
+                print("[registry]: Error while reaping the broadcasters: {}".format(ex))
+
+
+# Broadcaster registry of this process.
+_registry = None
+
+
+def get_registry():
+    """
+    Returns the broadcaster registry of this process.
+    :return:
+    """
+    global _registry
+    if _registry is None:
+        config = current_app.config
+        _registry = BroadcasterRegistry(config['BROADCASTER_IDLE_TIMEOUT'], config['BROADCASTER_REAP_INTERVAL'],
+                                        config['BROADCASTER_STOP_GRACE'])
+    return _registry
+
+
+def reset():
+    """
+    Stops every broadcaster and drops the registry of this process. Mostly useful for testing.
+    :return:
+    """
+    global _registry
+    if _registry is not None:
+        _registry.stop_all()
+    _registry = None
@@ -0,0 +1,60 @@
+"""
+Process-wide streaming statistics.
+
+Broadcasters and generators report counters (monotonically increasing, such as dropped frames) and gauges
+(point-in-time values, such as the current queue depth) here, and the /stats endpoint exports them. Values are
+kept per server process: with several workers each one reports its own.
+"""
+
+from collections import defaultdict
+
+COUNTERS = defaultdict(int)
+GAUGES = defaultdict(int)
+
+
+def incr(name, amount=1):
+    """
+    Increases the specified counter.
+    :param name: Name of the counter.
+    :param amount: Amount to add.
+    :return:
+    """
+    COUNTERS[name] += amount
+
+
+def gauge_add(name, amount):
+    """
+    Adds (or, if negative, subtracts) the specified amount to a gauge. Meant for values that several
+    clients contribute to, such as the total number of queued frames.
+    :param name: Name of the gauge.
+    :param amount: Amount to add.
+    :return:
+    """
+    GAUGES[name] += amount
+
+
+def gauge_set(name, value):
+    """
+    Sets a gauge to the specified value.
+    :param name: Name of the gauge.
+    :param value: Value to set.
+    :return:
+    """
+    GAUGES[name] = value
+
+
+def snapshot():
+    """
+    Returns a copy of the current statistics.
+    :return: Dictionary with the 'counters' and 'gauges' dictionaries.
+    """
+    return {'counters': dict(COUNTERS), 'gauges': dict(GAUGES)}
+
+
+def reset():
+    """
+    Clears every statistic. Mostly useful for testing.
+    :return:
+    """
+    COUNTERS.clear()
+    GAUGES.clear()
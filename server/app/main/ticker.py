@@ -0,0 +1,160 @@
+"""
+Shared tick scheduler for the fixed-FPS streaming clients.
+
+Rather than every client pacing itself with its own gevent.sleep (one hub timer per client, firing at slightly
+different moments), every server process keeps a single Ticker per FPS tier. Its greenlet sleeps until the next
+wall-clock multiple of the period and then wakes all the clients of the tier at once. Within a tick, the frame of each
+camera is looked up once and shared by every client of the tier (see Ticker.get_frame).
+
+The wake-up jitter of every tier (how late the tick fired) and the number of active tickers and clients are reported
+through the stats module.
+"""
+
+import math
+import time
+
+import gevent
+import gevent.event
+from gevent import monkey
+monkey.patch_all()
+
+from flask import current_app
+
+from . import stats
+from .redis_funcs import fetch_frame
+
+# Weight of the latest wake-up jitter in its moving average.
+JITTER_ALPHA = 0.1
+
+
+class Ticker(object):
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.period = 1.0 / fps
+        self.tick = 0  # Number of the last tick (wall-clock time divided by the period).
+
+        self._tick_event = gevent.event.Event()
+        self._clients = 0
+        self._greenlet = None
+
+        # Frame lookups of the current tick, by camera.
+        self._lookups = {}
+        # Last frame looked up for every camera (seq, frame), so that unchanged frames are not transferred again.
+        self._last_frames = {}
+
+        self._jitter = 0  # Moving average, in seconds.
+        self._max_jitter = 0
+
+    def subscribe(self):
+        """
+        Registers a client. The ticker runs while it has clients.
+        :return:
+        """
+        self._clients += 1
+        stats.gauge_add('ticker_clients', 1)
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+            stats.gauge_set('ticker_timers', len([t for t in TICKERS.values() if t._greenlet is not None]))
+
+    def unsubscribe(self):
+        self._clients -= 1
+        stats.gauge_add('ticker_clients', -1)
+
+    def wait(self):
+        """
+        Waits until the next tick.
+        :return: The tick number.
+        """
+        self._tick_event.wait()
+        return self.tick
+
+    def get_frame(self, cam_name):
+        """
+        Looks up the frame of the camera for the current tick. The first client of the tick fetches it, and the rest
+        of them (even if they ask while the fetch is still going on) get the same result.
+        :param cam_name:
+        :return: FetchedFrame. Unlike with fetch_frame, the frame is always set if there is one.
+        """
+        lookup = self._lookups.get(cam_name)
+        if lookup is not None:
+            stats.incr('ticker_shared_lookups')
+            return lookup.get()
+
+        # The fetch runs in its own greenlet rather than in the client's, so that a client that goes away while
+        # waiting (killed by the registry, or interrupted by a gevent.Timeout) does not leave the rest without a
+        # result.
+        lookup = gevent.spawn(self._fetch, current_app._get_current_object(), cam_name)
+        self._lookups[cam_name] = lookup
+        stats.incr('ticker_lookups')
+        return lookup.get()
+
+    def _fetch(self, app, cam_name):
+        """
+        Greenlet that fetches the frame of the camera for the current tick.
+        :return: FetchedFrame, with the frame set if there is one.
+        """
+        with app.app_context():
+            last_seq, last_frame = self._last_frames.get(cam_name, (None, None))
+            fetched = fetch_frame(cam_name, since_seq=last_seq, fps=self.fps)
+            if fetched.unchanged:
+                fetched = fetched._replace(frame=last_frame, unchanged=False)
+            elif fetched.frame is not None:
+                self._last_frames[cam_name] = (fetched.seq, fetched.frame)
+            else:
+                self._last_frames.pop(cam_name, None)
+            return fetched
+
+    def get_jitter(self):
+        """
+        :return: Moving average of the wake-up delay, in seconds.
+        """
+        return self._jitter
+
+    def _run(self):
+        """
+        Greenlet that fires the ticks, aligned to wall-clock multiples of the period, while there are clients.
+        :return:
+        """
+        tier = '{:g}'.format(self.fps)
+        while self._clients > 0:
+            now = time.time()
+            scheduled = (math.floor(now / self.period) + 1) * self.period
+            gevent.sleep(scheduled - now)
+
+            jitter = max(time.time() - scheduled, 0)
+            self._jitter = (1 - JITTER_ALPHA) * self._jitter + JITTER_ALPHA * jitter
+            self._max_jitter = max(self._max_jitter, jitter)
+
+            self.tick = int(round(scheduled / self.period))
+            self._lookups = {}
+
+            tick_event, self._tick_event = self._tick_event, gevent.event.Event()
+            tick_event.set()
+
+            stats.incr('ticker_ticks')
+            stats.gauge_set('ticker_jitter_ms:' + tier, round(self._jitter * 1000, 3))
+            stats.gauge_set('ticker_max_jitter_ms:' + tier, round(self._max_jitter * 1000, 3))
+
+        self._greenlet = None
+        self._last_frames = {}
+        if TICKERS.get(self.fps) is self:
+            del TICKERS[self.fps]
+        stats.gauge_set('ticker_timers', len([t for t in TICKERS.values() if t._greenlet is not None]))
+
+
+# Tickers of this process, by FPS.
+TICKERS = {}
+
+
+def get_ticker(fps):
+    """
+    Returns the ticker for the FPS tier, creating it if needed.
+    :param fps:
+    :return:
+    """
+    ticker = TICKERS.get(fps)
+    if ticker is None:
+        ticker = Ticker(fps)
+        TICKERS[fps] = ticker
+    return ticker
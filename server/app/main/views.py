@@ -7,11 +7,34 @@ monkey.patch_all()
 import io
 import time
 
-from PIL import Image
 from flask import render_template, current_app, make_response, Response, request, stream_with_context, jsonify
 
 from app import rdb
-from . import main
+from . import main, stats
+from .admission import get_controller, overloaded_response, release_on_close
+from .assets import get_not_available
+from .redis_funcs import fetch_frame, add_viewer, remove_viewer
+from .delivery import FrameDelivery, NOT_AVAILABLE
+from .egress import get_scheduler
+from .multipart import build_part, get_part_cache
+from .rate_control import AdaptiveRate, AdaptiveQuality, reencode
+from .ticker import get_ticker
+
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+
+# Flags of the frame routes that crop the (top, bottom, right, left) of the frames.
+CROP_PARAMS = ('crop_top', 'crop_bottom', 'crop_right', 'crop_left')
+
+
+@main.app_context_processor
+def inject_socketio_transports():
+    """
+    Socket.IO transports that the pages should use. With several workers and no sticky sessions, only the websocket
+    transport works, as its connection stays on the worker that accepted it.
+    :return:
+    """
+    transports = ['websocket'] if current_app.config['SOCKETIO_WEBSOCKET_ONLY'] else None
+    return dict(socketio_transports=transports)
 
 
 @main.route('/')
@@ -20,7 +43,21 @@ def index():
 
 @main.route('/healthcheck')
 def healthcheck():
-    return jsonify(result='success')
+    """
+    Reports that the server process is up, along with its admission control limits, load and rejections, and its
+    egress throughput per client class.
+    :return:
+    """
+    return jsonify(result='success', admission=get_controller().get_health(), egress=get_scheduler().get_health())
+
+
+@main.route('/stats')
+def stats_view():
+    """
+    Exports the streaming statistics of this server process.
+    :return:
+    """
+    return jsonify(stats.snapshot())
 
 
 @main.route('/exps/imgrefresh/<cam>')
@@ -56,7 +93,21 @@ def exp_mjpegjs(cam):
     """
     tfps = request.values.get('tfps', 5)
     path = current_app.config.get('SOCKETIO_PATH', '')
-    return render_template('exps/camera_mjpeg_js.html', cam=cam, socketio_path=path, tfps=tfps)
+    # transport=ws uses the plain WebSocket endpoint instead of Socket IO.
+    use_ws = request.values.get('transport') == 'ws'
+    return render_template('exps/camera_mjpeg_js.html', cam=cam, socketio_path=path, tfps=tfps, use_ws=use_ws)
+
+
+@main.route('/exps/mux')
+def exp_mux():
+    """
+    Several MJPEG JS cameras (cams parameter, comma-separated) sharing a single Socket IO connection.
+    :return:
+    """
+    cams = [cam for cam in request.values.get('cams', '').split(',') if cam]
+    tfps = request.values.get('tfps', 5, type=int)
+    path = current_app.config.get('SOCKETIO_PATH', '')
+    return render_template('exps/camera_mux.html', cams=cams, socketio_path=path, tfps=tfps)
 
 
 @main.route('/exps/mpegjs/<cam>')
@@ -69,111 +120,245 @@ def exp_mpegjs(cam):
 def exp_h264js(cam):
     path = current_app.config.get('SOCKETIO_PATH', '')
     qr = request.values.get('qr', 0)
-    return render_template('exps/camera_h264_js.html', cam=cam, socketio_path=path, qr=qr)
-
+    # transport=ws uses the plain WebSocket endpoint instead of Socket IO.
+    use_ws = request.values.get('transport') == 'ws'
+    return render_template('exps/camera_h264_js.html', cam=cam, socketio_path=path, qr=qr, use_ws=use_ws)
 
-count = 0
 
-
-def generator_mjpeg(cam_id, not_available, redis_prefix, rotate, tfps):
+def generator_mjpeg(cam_id, not_available, redis_prefix, rotate, tfps, keepalive=None, width=None, client_class=None,
+                    adaptive_quality=False, crops=(False, False, False, False)):
+    """
+    :param crops: Whether to crop the (top, bottom, right, left) of the frames.
+    """
     try:
         rotate = float(rotate)
     except ValueError:
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + not_available + b'\r\n')
+        yield build_part(not_available, content_type=b'image/png')
         yield make_response("Wrong value: Rotate must be a float", 400)
         return  # Return in a generator must be empty.
 
-    crop_top = "crop_top" in request.values
-    crop_bottom = "crop_bottom" in request.values
-    crop_right = "crop_right" in request.values
-    crop_left = "crop_left" in request.values
+    crop_top, crop_bottom, crop_right, crop_left = crops
 
-    cam_key = redis_prefix + ":cams:" + cam_id
+    # FPS rate limiting: the clients of the same FPS tier are woken together by a shared ticker. Clients that cannot
+    # keep up are served fewer of its ticks.
+    ticker = get_ticker(tfps)
+    rate = None
+    if current_app.config.get('MJPEG_ADAPTIVE_FPS', False):
+        rate = AdaptiveRate(tfps, current_app.config['MJPEG_MIN_FPS'])
 
-    target_fps = tfps
+    # Clients that cannot keep up are first sent smaller, more compressed frames, and only then fewer of them.
+    quality = None
+    if adaptive_quality:
+        quality = AdaptiveQuality(current_app.config['MJPEG_QUALITY_LADDER'], tfps)
 
-    last_frame_start_time = 0
+    # The frames share the uplink of the worker with the other streams, according to the weight of the camera and of
+    # the client class.
+    flow = get_scheduler().open_flow(cam_id, client_class)
+
+    start_time = time.time()
+    served = 0
+    ticker.subscribe()
+    try:
+        for part in _mjpeg_parts(ticker, rate, quality, FrameDelivery(keepalive), flow, cam_id, not_available,
+                                 (rotate, crop_top, crop_bottom, crop_right, crop_left, width)):
+            served += 1
+            yield part
+    finally:
+        ticker.unsubscribe()
+        flow.close()
+        elapsed = time.time() - start_time
+        print("[mjpeg]: Stream for cam {} closed. Served {} frames in {:.1f}s ({:.1f} FPS, requested {}).".format(
+            cam_id, served, elapsed, served / elapsed if elapsed > 0 else 0, tfps))
+
+
+def _mjpeg_parts(ticker, rate, quality, delivery, flow, cam_id, not_available, variant):
+    """
+    Generates the multipart parts of the stream. The parts are built once per frame and variant, and shared by every
+    client that streams the camera (see the multipart module).
+    :param rate: AdaptiveRate for the client, or None to always serve at the ticker FPS.
+    :param quality: AdaptiveQuality for the client, or None to always serve the frames at their original quality.
+    :param delivery: FrameDelivery for the client. Unchanged frames are not served again.
+    :param flow: Egress flow of the client. Frames that it does not get to send in time are dropped.
+    :param variant: (rotate, crop_top, crop_bottom, crop_right, crop_left, width)
+    :return:
+    """
+    not_available_part = None  # Built when first needed.
+    parts = get_part_cache()
+
+    # Sequence number, variant and part of the last frame, so that unchanged frames are not looked up again.
+    last_seq = None
+    last_variant = None
+    last_part = None
 
     while True:
+        tick = ticker.wait()
+        if rate is not None and not rate.should_serve(tick):
+            continue
 
-        global count
-        print("[DBG]: Serving MJPEG frame: %d" % count)
-        count += 1
+        # Marks the cam as active (which signals the feeder so that it starts working on this) and fetches the
+        # frame in a single round trip, once per tick for all the clients of the tier.
+        fetched = ticker.get_frame(cam_id)
 
-        # FPS rate limiting
-        target_frame_time = 1.0 / target_fps
-        current_time = time.time()
-        time_since_last_frame_start = current_time - last_frame_start_time
+        if fetched.frame is None:
+            last_seq = None
+
+            # If there is no error, we just retry on the next tick: the webcam image should be available soon.
+            # We check whether the feeder itself is alive to be able to give a proper error, even if, for now, we
+            # don't.
+            if fetched.alive and current_app.config.get('WAIT_FOR_WEBCAM', False):
+                continue
 
-        time_to_wait = target_frame_time - time_since_last_frame_start
-        if time_to_wait > 0:
-            print("Sleeping for: %f" % time_to_wait)
-            gevent.sleep(time_to_wait)
-            last_frame_start_time = current_time + time_to_wait
+            if not delivery.should_send(NOT_AVAILABLE):
+                continue
+            if not_available_part is None:
+                not_available_part = build_part(not_available, content_type=b'image/png')
+            delivery.sent(NOT_AVAILABLE)
+            yield not_available_part
         else:
-            print("Sleeping for 0")
-            # We cannot keep up. Maybe we should lower the target FPS.
-            last_frame_start_time = current_time
+            if not delivery.should_send(fetched.seq):
+                continue
 
-        frame = rdb.get(cam_key + ":lastframe")
+            frame_variant = _quality_variant(variant, quality)
+            if last_seq is None or fetched.seq != last_seq or frame_variant != last_variant:
+                transform = None
+                if _is_transformed(*frame_variant):
+                    transform = lambda frame: _transform_frame(frame, *frame_variant)
+                last_part = parts.get_part(cam_id, frame_variant, fetched.seq, fetched.frame, transform)
+                last_seq = fetched.seq
+                last_variant = frame_variant
+
+            if not flow.send(len(last_part)):
+                # The uplink is saturated: a later frame will be sent instead.
+                stats.incr('mjpeg_parts_dropped')
+                continue
 
-        # Mark the cam as active. This signals the feeder so that it starts working on this. It could potentially
-        # be made more efficient by working in a background
-        # thread, but that would be overkill for now.
-        rdb.setex(cam_key + ":active", 30, 1)
+            stats.incr('mjpeg_parts_served')
+            delivery.sent(fetched.seq)
 
-        if frame is None:
-            # We check whether the feeder itself is alive to be able to give a proper error,
-            # even if, for now, we don't.
-            alive = rdb.get(redis_prefix + ":feeder:alive")
-            if alive is None:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + not_available + b'\r\n')
+            # The generator is resumed once the server has written the part to the socket, so the time it takes
+            # tells whether the client keeps up.
+            flush_start = time.time()
+            yield last_part
+            flush_time = time.time() - flush_start
 
-            # If there is no error, we just retry: the webcam image should be available soon.
-            if current_app.config.get('WAIT_FOR_WEBCAM', False):
-                gevent.sleep(current_app.config.get('WAIT_FOR_WEBCAM_TIME', 0.1))
+            if quality is not None and quality.record(len(last_part), flush_time):
+                width, jpeg_quality = quality.get_rung()
+                print("[mjpeg]: Serving cam {} at width {} and quality {} (estimated throughput {:.0f} KB/s)".format(
+                    cam_id, width or 'original', jpeg_quality or 'original', (quality.get_throughput() or 0) / 1024))
+
+            # The FPS is only lowered once the quality cannot go any lower (and then recovered before the quality).
+            if quality is not None and not quality.is_lowest() and rate is not None and rate.interval == 1:
                 continue
+            if rate is not None and rate.record(flush_time):
+                print("[mjpeg]: Serving cam {} at {:.1f} FPS (requested {}, flush time {:.0f} ms)".format(
+                    cam_id, rate.get_fps(), ticker.fps, rate.get_flush_time() * 1000))
 
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + not_available + b'\r\n')
-        else:
-            if rotate > 0 or crop_top or crop_bottom or crop_right or crop_left:
-                sio_in = io.BytesIO(frame)
-                img = Image.open(sio_in)  # type: Image
 
-                # Support crop_top
-                if crop_top:
-                    w, h = img.size
-                    img = img.crop((0, 0, w, h/2))
+def _quality_variant(variant, quality):
+    """
+    Returns the variant of the frames at the current rung of the adaptive quality.
+    :param variant: (rotate, crop_top, crop_bottom, crop_right, crop_left, width)
+    :param quality: AdaptiveQuality, or None.
+    :return: (rotate, crop_top, crop_bottom, crop_right, crop_left, width, quality)
+    """
+    if quality is None:
+        return variant + (None,)
+    width, jpeg_quality = quality.get_rung()
+    if variant[5] and (width is None or variant[5] < width):
+        width = variant[5]
+    return variant[:5] + (width, jpeg_quality)
 
-                # Support crop_bottom
-                elif crop_bottom:
-                    w, h = img.size
-                    img = img.crop((0, h/2, w, h))
 
-                # Support crop_right
-                if crop_right:
-                    w, h = img.size
-                    img = img.crop((w/2, 0, w, h))
+def _is_transformed(rotate, crop_top, crop_bottom, crop_right, crop_left, width=None, quality=None):
+    return rotate > 0 or crop_top or crop_bottom or crop_right or crop_left or bool(width) or bool(quality)
 
-                # Support crop_left
-                elif crop_left:
-                    w, h = img.size
-                    img = img.crop((0, 0, w/2, h))
 
-                # Support rotation.
-                if rotate > 0:
-                    img = img.rotate(rotate, expand=True)
+def _transform_frame(frame, rotate, crop_top, crop_bottom, crop_right, crop_left, width=None, quality=None):
+    """
+    Crops, rotates, scales down and re-encodes a JPEG frame.
+    :param width: If set, the frame is scaled down to this width (keeping its aspect ratio).
+    :param quality: If set, the JPEG quality of the transformed frame.
+    :return: The transformed JPEG frame.
+    """
+    if not (rotate > 0 or crop_top or crop_bottom or crop_right or crop_left):
+        # Scaling alone is done while decoding.
+        return reencode(frame, width, quality)
+
+    # PIL is only needed for the transformations, and is thus imported on first use.
+    from PIL import Image
+
+    sio_in = io.BytesIO(frame)
+    img = Image.open(sio_in)  # type: Image
+
+    # Support crop_top
+    if crop_top:
+        w, h = img.size
+        img = img.crop((0, 0, w, h/2))
+
+    # Support crop_bottom
+    elif crop_bottom:
+        w, h = img.size
+        img = img.crop((0, h/2, w, h))
+
+    # Support crop_right
+    if crop_right:
+        w, h = img.size
+        img = img.crop((w/2, 0, w, h))
+
+    # Support crop_left
+    elif crop_left:
+        w, h = img.size
+        img = img.crop((0, 0, w/2, h))
+
+    # Support rotation.
+    if rotate > 0:
+        img = img.rotate(rotate, expand=True)
+
+    if width:
+        img.thumbnail((width, img.size[1]))
+
+    sio_out = io.BytesIO()
+    if quality:
+        img.save(sio_out, 'jpeg', quality=quality)
+    else:
+        img.save(sio_out, 'jpeg')
+    frame = sio_out.getvalue()
+    img.close()
+    return frame
+
+
+@main.route('/exps/fmp4mse/<cam>')
+def exp_fmp4mse(cam):
+    """
+    Plays the fragmented MP4 packaging of the H.264 stream through Media Source Extensions.
+    :param cam:
+    :return:
+    """
+    return render_template('exps/camera_fmp4_mse.html', cam=cam)
 
-                sio_out = io.BytesIO()
-                img.save(sio_out, 'jpeg')
-                frame = sio_out.getvalue()
-                img.close()
 
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+@main.route('/exps/llhls/<cam>')
+def exp_llhls(cam):
+    """
+    Plays the low-latency HLS stream of the camera through hls.js.
+    :param cam:
+    :return:
+    """
+    return render_template('exps/camera_llhls.html', cam=cam)
+
+
+@main.route('/cams/<cam_id>/fmp4/init.mp4')
+def cam_fmp4_init(cam_id):
+    """
+    Returns the fragmented MP4 init segment for the camera, as cached by the feeder packager.
+    :param cam_id:
+    :return:
+    """
+    REDIS_PREFIX = current_app.config['REDIS_PREFIX']
+    init = rdb.get(REDIS_PREFIX + ":cams:" + cam_id + ":fmp4:init")
+    if init is None:
+        return make_response("No fragmented MP4 stream is available for this camera", 404)
+    return Response(init, status=200, mimetype="video/mp4")
 
 
 @main.route('/cams/<cam_id>/mpeg')
@@ -188,22 +373,65 @@ def cam_mjpeg(cam_id):
     :param cam_id:
     :return:
     """
-    tfps = request.values.get("tfps", 5)
-    tfps = int(tfps)
+    try:
+        tfps = int(request.values.get("tfps", 5))
+    except ValueError:
+        return make_response("Wrong value: tfps must be an integer", 400)
     rotate = request.values.get("rotate", 0)
-    REDIS_PREFIX = current_app.config['REDIS_PREFIX']
-    # TODO: Not pretty.
-    not_available = open("app/static/no_image_available.png", "rb").read()
-    return Response(stream_with_context(generator_mjpeg(cam_id, not_available, REDIS_PREFIX, rotate, tfps)),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+    # Seconds after which an unchanged frame is sent again, for clients that need frames to keep coming.
+    keepalive = request.values.get("keepalive", current_app.config['KEEPALIVE_RESEND_INTERVAL'], type=float)
+
+    # With quality=auto, smaller or more compressed frames are sent to clients whose link cannot keep up.
+    default_quality = 'auto' if current_app.config.get('MJPEG_ADAPTIVE_QUALITY', False) else 'full'
+    adaptive_quality = request.values.get("quality", default_quality) == 'auto'
+
+    crops = tuple(name in request.values for name in CROP_PARAMS)
+
+    ticket, stream = open_mjpeg_stream(cam_id, tfps, rotate, crops, keepalive, request.values.get("class"),
+                                       adaptive_quality)
+    if not ticket.admitted:
+        return overloaded_response(ticket)
+    return release_on_close(ticket, Response(stream_with_context(stream), mimetype=MJPEG_MIMETYPE))
+
+
+def open_mjpeg_stream(cam_id, tfps, rotate, crops, keepalive, client_class, adaptive_quality):
+    """
+    Admits a new MJPEG stream and prepares it.
+    :return: (ticket, stream). If the ticket is not admitted, stream is None. Otherwise, the stream generates the
+    multipart parts and counts the viewer for as long as it is being served. The caller must release the ticket once
+    the response is closed, whether or not the stream was started.
+    """
+    # New streams are degraded (lower FPS, thumbnails) or refused when the worker is overloaded.
+    ticket = get_controller().admit(cam_id, tfps)
+    if not ticket.admitted:
+        return ticket, None
+
+    stream = _with_viewer(cam_id, generator_mjpeg(cam_id, get_not_available(), current_app.config['REDIS_PREFIX'],
+                                                  rotate, ticket.fps, keepalive, ticket.width, client_class,
+                                                  adaptive_quality, crops))
+    return ticket, stream
+
+
+def _with_viewer(cam_id, stream):
+    """
+    Counts the stream as a viewer of the camera for as long as it is being served.
+    :param cam_id:
+    :param stream:
+    :return:
+    """
+    add_viewer(cam_id)
+    try:
+        for part in stream:
+            yield part
+    finally:
+        remove_viewer(cam_id)
 
 
 def test_gen(data):
-    n = 0
+    part = build_part(data)
     while True:
-        n += 1
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + data + b'\r\n')
+        yield part
 
 
 @main.route('/cams/<cam_id>')
@@ -213,41 +441,34 @@ def cam(cam_id):
     :param cam_id:
     :return:
     """
-    REDIS_PREFIX = current_app.config['REDIS_PREFIX']
     rotate = request.values.get("rotate", 0)
 
+    # Rate at which the client refreshes the image, if it tells. It is only used as a hint for the feeder.
+    tfps = request.values.get("tfps", None, type=int)
+
     try:
         rotate = float(rotate)
     except ValueError:
         return make_response("Wrong value: Rotate must be a float", 400)
 
-    crop_top = "crop_top" in request.values
-    crop_bottom = "crop_bottom" in request.values
-    crop_right = "crop_right" in request.values
-    crop_left = "crop_left" in request.values
-
-    cam_key = REDIS_PREFIX + ":cams:" + cam_id
+    crop_top, crop_bottom, crop_right, crop_left = (name in request.values for name in CROP_PARAMS)
 
     # We will retry under some circumstances.
     while True:
 
-        frame = rdb.get(cam_key + ":lastframe")
-
-        # Mark the cam as active. This signals the feeder so that it starts working on this. It could potentially
-        # be made more efficient by working in a background
-        # thread, but that would be overkill for now.
-        rdb.setex(cam_key + ":active", 30, 1)
+        # Marks the cam as active (which signals the feeder so that it starts working on this) and fetches the
+        # frame, the feeder alive state and the webcam error state in a single round trip.
+        fetched = fetch_frame(cam_id, fps=tfps)
+        frame = fetched.frame
 
         if frame is None:
             # We check whether the feeder itself is alive to be able to give a proper error.
-            alive = rdb.get(REDIS_PREFIX + ":feeder:alive")
-            if alive is None:
+            if not fetched.alive:
                 print("Feeder component does not seem to be alive.", file=sys.stderr)
                 return current_app.send_static_file('no_image_available.png'), 503
 
             # Check whether the webcam is explicitly reporting an error. If it does, we just return not-available.
-            err = rdb.get(cam_key + ":error")
-            if err is not None:
+            if fetched.error:
                 print("Webcam seems to be reporting an error", file=sys.stderr)
                 return current_app.send_static_file('no_image_available.png'), 503
 
@@ -256,37 +477,7 @@ def cam(cam_id):
                 gevent.sleep(current_app.config.get('WAIT_FOR_WEBCAM_TIME', 0.1))
                 continue
         else:
-            if rotate > 0 or crop_top or crop_bottom or crop_right or crop_left:
-                sio_in = io.BytesIO(frame)
-                img = Image.open(sio_in)  # type: Image
-
-                # Support crop_top
-                if crop_top:
-                    w, h = img.size
-                    img = img.crop((0, 0, w, h/2))
-
-                # Support crop_bottom
-                elif crop_bottom:
-                    w, h = img.size
-                    img = img.crop((0, h/2, w, h))
-
-                # Support crop_right
-                if crop_right:
-                    w, h = img.size
-                    img = img.crop((w/2, 0, w, h))
-
-                # Support crop_left
-                elif crop_left:
-                    w, h = img.size
-                    img = img.crop((0, 0, w/2, h))
-
-                # Support rotation.
-                if rotate > 0:
-                    img = img.rotate(rotate, expand=True)
-
-                sio_out = io.BytesIO()
-                img.save(sio_out, 'jpeg')
-                frame = sio_out.getvalue()
-                img.close()
+            if _is_transformed(rotate, crop_top, crop_bottom, crop_right, crop_left):
+                frame = _transform_frame(frame, rotate, crop_top, crop_bottom, crop_right, crop_left)
 
             return Response(frame, status=200, mimetype="image/jpeg")
@@ -0,0 +1,291 @@
+"""
+Plain WebSocket streaming endpoints.
+
+They serve the same streams as the /mjpeg and /h264 Socket.IO namespaces, but every frame (or NAL unit) is sent as a
+single binary WebSocket message, without the engine.io / Socket.IO framing and attachment packets. Each message
+starts with a minimal 5-byte header:
+
+    1 byte: kind of payload (MESSAGE_KIND_JPEG, MESSAGE_KIND_H264, MESSAGE_KIND_MP4_INIT or MESSAGE_KIND_MP4_FRAGMENT)
+    4 bytes: message sequence number (big-endian, unsigned)
+
+H.264 payloads always start with a \\x00 byte (the start code), so clients can also tell them apart from a payload
+without the header.
+
+The WebSocket handshake is handled by gevent-websocket, so the server must be run with its gunicorn worker
+(geventwebsocket.gunicorn.workers.GeventWebSocketWorker), which also keeps Socket.IO working.
+"""
+
+import struct
+
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
+from flask import current_app, request, make_response
+
+from app import rdb
+from . import main, stats
+from .admission import get_controller
+from .assets import get_not_available
+from .h264_nal import NALSplitter, nal_type, NAL_IDR, NAL_SPS
+from .delivery import FrameDelivery, NOT_AVAILABLE
+from .egress import get_scheduler
+from .hub import get_hub
+from .redis_funcs import add_viewer, remove_viewer
+from .ticker import get_ticker
+
+MESSAGE_KIND_JPEG = 1
+MESSAGE_KIND_H264 = 2
+MESSAGE_KIND_MP4_INIT = 3
+MESSAGE_KIND_MP4_FRAGMENT = 4
+
+# Flag byte that the feeder FMP4Packager prefixes to the fragments it publishes.
+FMP4_FRAGMENT_KEYFRAME = 1
+
+HEADER = struct.Struct('!BI')
+
+
+def _get_websocket():
+    """
+    Returns the WebSocket for the current request, or None if the request is not a WebSocket upgrade.
+    :return:
+    """
+    return request.environ.get('wsgi.websocket')
+
+
+def _not_a_websocket():
+    return make_response("A WebSocket connection is expected", 400)
+
+
+# Close code for refused connections ("Try Again Later").
+CLOSE_TRY_AGAIN_LATER = 1013
+# Close code for connections with wrong parameters ("Policy Violation").
+CLOSE_POLICY_VIOLATION = 1008
+
+
+def _bad_request(ws, message):
+    """
+    Refuses a request with wrong parameters. gevent-websocket completes the handshake before the view runs, so an
+    upgraded connection cannot get the 400 response anymore: it is closed with CLOSE_POLICY_VIOLATION and the message
+    as reason instead.
+    :return: The 400 response, for requests that were not upgraded.
+    """
+    if ws is not None:
+        try:
+            ws.close(CLOSE_POLICY_VIOLATION, message.encode())
+        except Exception:
+            pass
+    return make_response(message, 400)
+
+
+def _admit(ws, cam_id, fps, can_degrade=True):
+    """
+    Asks the admission controller for a ticket. If the stream is refused, the WebSocket (which is already open) is
+    closed with the CLOSE_TRY_AGAIN_LATER code and the number of seconds to wait as reason.
+    :return: The ticket, or None if refused.
+    """
+    ticket = get_controller().admit(cam_id, fps, can_degrade)
+    if ticket.admitted:
+        return ticket
+    try:
+        ws.close(CLOSE_TRY_AGAIN_LATER, str(ticket.retry_after).encode())
+    except Exception:
+        pass
+    return None
+
+
+@main.route('/ws/cams/<cam_id>/mjpeg')
+def ws_cam_mjpeg(cam_id):
+    """
+    Streams the camera JPEG frames through a plain WebSocket at the target FPS (tfps parameter).
+    :param cam_id:
+    :return:
+    """
+    ws = _get_websocket()
+
+    # The parameters are checked before anything else, so that wrong ones never take an admission ticket.
+    try:
+        tfps = int(request.values.get("tfps", 5))
+    except ValueError:
+        return _bad_request(ws, "Wrong value: tfps must be an integer")
+    try:
+        keepalive = float(request.values.get("keepalive", current_app.config['KEEPALIVE_RESEND_INTERVAL']))
+    except ValueError:
+        return _bad_request(ws, "Wrong value: keepalive must be a float")
+
+    if ws is None:
+        return _not_a_websocket()
+
+    ticket = _admit(ws, cam_id, tfps)
+    if ticket is None:
+        return ''
+    tfps = ticket.fps
+
+    # Frames are only sent when they change, or every <keepalive> seconds.
+    delivery = FrameDelivery(keepalive)
+
+    not_available = get_not_available()
+
+    # The clients of the same FPS tier are woken together by a shared ticker, which also fetches the frame once per
+    # tick for all of them.
+    ticker = get_ticker(tfps)
+
+    # The frames share the uplink of the worker with the other streams.
+    flow = get_scheduler().open_flow(cam_id, request.values.get("class"))
+
+    seq = 0
+    add_viewer(cam_id)
+    ticker.subscribe()
+    try:
+        while not ws.closed:
+            ticker.wait()
+
+            # Marks the cam as active (which signals the feeder so that it starts working on this) and fetches the
+            # frame in a single round trip.
+            fetched = ticker.get_frame(cam_id)
+
+            frame_id = fetched.seq if fetched.frame is not None else NOT_AVAILABLE
+            if not delivery.should_send(frame_id):
+                continue
+            frame = fetched.frame if fetched.frame is not None else not_available
+            if not flow.send(len(frame)):
+                # The uplink is saturated: a later frame will be sent instead.
+                stats.incr('ws_mjpeg_frames_dropped')
+                continue
+
+            try:
+                ws.send(HEADER.pack(MESSAGE_KIND_JPEG, seq) + frame, binary=True)
+            except Exception:
+                break
+            delivery.sent(frame_id)
+            seq = (seq + 1) & 0xFFFFFFFF
+            stats.incr('ws_mjpeg_frames_sent')
+    finally:
+        ticker.unsubscribe()
+        flow.close()
+        remove_viewer(cam_id)
+        ticket.release()
+
+    return ''
+
+
+@main.route('/ws/cams/<cam_id>/h264')
+def ws_cam_h264(cam_id):
+    """
+    Streams the camera H.264 NAL units through a plain WebSocket, starting at the next keyframe.
+    :param cam_id:
+    :return:
+    """
+    ws = _get_websocket()
+    if ws is None:
+        return _not_a_websocket()
+
+    # H.264 cannot be served at a lower FPS: it is either admitted or refused.
+    ticket = _admit(ws, cam_id, None, can_degrade=False)
+    if ticket is None:
+        return ''
+
+    splitter = NALSplitter()
+    waiting_for_keyframe = True
+    seq = 0
+    add_viewer(cam_id, 'h264')
+    try:
+        with get_hub().subscribe("{}/h264".format(cam_id)) as subscription, \
+                get_scheduler().open_flow(cam_id, request.values.get("class")) as flow:
+            for data in subscription.messages(lambda: ws.closed):
+                if data is None:
+                    # We lagged behind and lost data: resume at the next keyframe.
+                    splitter = NALSplitter()
+                    waiting_for_keyframe = True
+                    continue
+
+                for nal in splitter.feed(data):
+                    if waiting_for_keyframe:
+                        if nal_type(nal) not in (NAL_SPS, NAL_IDR):
+                            continue
+                        waiting_for_keyframe = False
+
+                    if not flow.send(len(nal)):
+                        # The uplink is saturated. P-frames cannot be skipped on their own: resume at the next
+                        # keyframe.
+                        stats.incr('ws_h264_nals_dropped')
+                        waiting_for_keyframe = True
+                        continue
+
+                    ws.send(HEADER.pack(MESSAGE_KIND_H264, seq) + nal, binary=True)
+                    seq = (seq + 1) & 0xFFFFFFFF
+                    stats.incr('ws_h264_nals_sent')
+    except Exception:
+        # The client went away.
+        pass
+    finally:
+        remove_viewer(cam_id, 'h264')
+        ticket.release()
+
+    return ''
+
+
+@main.route('/ws/cams/<cam_id>/fmp4')
+def ws_cam_fmp4(cam_id):
+    """
+    Streams the camera as fragmented MP4, for Media Source Extensions players. The init segment is sent first, and then
+    the fragments, starting at the next keyframe. The packaging itself is done once per camera by the feeder.
+    :param cam_id:
+    :return:
+    """
+    ws = _get_websocket()
+    if ws is None:
+        return _not_a_websocket()
+
+    init_key = current_app.config['REDIS_PREFIX'] + ":cams:" + cam_id + ":fmp4:init"
+
+    ticket = _admit(ws, cam_id, None, can_degrade=False)
+    if ticket is None:
+        return ''
+
+    init_sent = False
+    waiting_for_keyframe = False
+    seq = 0
+    add_viewer(cam_id, 'h264')
+    try:
+        with get_hub().subscribe("{}/fmp4".format(cam_id)) as subscription, \
+                get_scheduler().open_flow(cam_id, request.values.get("class")) as flow:
+            for data in subscription.messages(lambda: ws.closed):
+                if data is None:
+                    # We lagged behind and lost fragments: resume at the next keyframe (the init segment is not sent
+                    # again, the MSE player keeps it).
+                    waiting_for_keyframe = True
+                    continue
+                if waiting_for_keyframe:
+                    if data[0] != FMP4_FRAGMENT_KEYFRAME:
+                        continue
+                    waiting_for_keyframe = False
+
+                if not init_sent:
+                    # Start at a keyframe, and with the init segment that applies to it.
+                    if data[0] != FMP4_FRAGMENT_KEYFRAME:
+                        continue
+                    init = rdb.get(init_key)
+                    if init is None:
+                        continue
+                    ws.send(HEADER.pack(MESSAGE_KIND_MP4_INIT, seq) + init, binary=True)
+                    seq = (seq + 1) & 0xFFFFFFFF
+                    init_sent = True
+
+                if not flow.send(len(data) - 1):
+                    # The uplink is saturated: resume at the next keyframe.
+                    stats.incr('ws_fmp4_fragments_dropped')
+                    waiting_for_keyframe = True
+                    continue
+
+                ws.send(HEADER.pack(MESSAGE_KIND_MP4_FRAGMENT, seq) + data[1:], binary=True)
+                seq = (seq + 1) & 0xFFFFFFFF
+                stats.incr('ws_fmp4_fragments_sent')
+    except Exception:
+        # The client went away.
+        pass
+    finally:
+        remove_viewer(cam_id, 'h264')
+        ticket.release()
+
+    return ''
@@ -4388,6 +4388,20 @@ var WSAvcPlayer = new Class({
         this.avc.decode(data);
     },
 
+    decodeNALs: function (data) {
+        // Splits the data on the start codes, and decodes every NAL unit separately, as if they had been received one
+        // by one.
+        var start = 0;
+        for (var i = 4; i + 3 < data.length; i++) {
+            if (data[i] == 0 && data[i + 1] == 0 && data[i + 2] == 0 && data[i + 3] == 1) {
+                this.decode(data.subarray(start, i));
+                start = i;
+                i += 3;
+            }
+        }
+        this.decode(data.subarray(start));
+    },
+
     connect: function (url) {
 
         // Websocket cleanup
@@ -4410,14 +4424,19 @@ var WSAvcPlayer = new Class({
                 console.log("WSAvcPlayer: Connected (through SIO)");
             }.bind(this));
 
-            this.sioClient.on('stream', function(bytes) {
+            this.sioClient.on('stream', function(bytes, ack) {
                 this.pktnum++;
                 var data = new Uint8Array(bytes);
                 console.log("WSAvcPlayer: [Pkt " + this.pktnum + " (" + data.byteLength + " bytes)]");
                 var date = new Date();
                 this.rcvtime = date.getTime();
-                this.decode(data);
+                // If the client asked for batching, the packet is a whole access unit (several NAL units).
+                this.decodeNALs(data);
                 this.prevframe = data;
+
+                // If the server asked for it, let it know that we have consumed the packet.
+                if (ack !== undefined)
+                    ack();
             }.bind(this));
 
             this.sioClient.on('cmd', function(bytes) {
@@ -4444,6 +4463,12 @@ var WSAvcPlayer = new Class({
 
                 this.pktnum++;
                 var data = new Uint8Array(evt.data);
+
+                // The WILSA WebSocket endpoints prefix every NAL unit with a 5-byte header (kind and sequence number).
+                // NAL units always start with the 0x00 of the start code, so the header is easy to tell apart.
+                if (data.byteLength > 5 && data[0] !== 0)
+                    data = data.subarray(5);
+
                 console.log("WSAvcPlayer: [Pkt " + this.pktnum + " (" + evt.data.byteLength + " bytes)]");
                 var date = new Date();
                 this.rcvtime = date.getTime();
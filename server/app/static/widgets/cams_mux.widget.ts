@@ -0,0 +1,164 @@
+/// <reference path="typedefs/socket.io-client.d.ts" />
+
+
+/**
+ * Handler of the frames (MJPEG) or NAL units (H.264) of a subscription. The ack callback, if any, must be called
+ * once the data has been processed.
+ */
+type CamsMuxHandler = (data: ArrayBuffer, ack?: Function) => void;
+
+interface CamsMuxSubscription
+{
+    cam : string;
+    format : string;
+    options : any;
+    handler : CamsMuxHandler;
+}
+
+/**
+ * Single Socket.IO connection (to the /cams namespace) shared by all the cameras of a page. Every camera and format is
+ * a subscription on this connection, and the data is dispatched to the handler of its camera, so that a page with N
+ * cameras needs a single transport and a single heartbeat instead of N.
+ */
+class CamsMux
+{
+    private mSocketIOURL : string;
+    private mSocketIOPath : string;
+    private mTransports : string[];
+
+    private mClient : SocketIOClient.Socket; // Not aliased, as this file is referenced by the camera widgets.
+
+    private mSubscriptions : { [key: string]: CamsMuxSubscription } = {};
+
+
+    /**
+     * Creates the multiplexer. It connects on the first subscription.
+     * @param socketIOURL: URL to the /cams Socket IO namespace.
+     * @param socketIOPath: Path to the socketio endpoint. Optional.
+     * @param transports: Socket.IO transports to use, such as ['websocket'] when the server runs several workers
+     * without sticky sessions. Optional. Default: polling, upgraded to websocket.
+     */
+    public constructor(socketIOURL: string, socketIOPath: string, transports?: string[])
+    {
+        this.mSocketIOURL = socketIOURL;
+        this.mSocketIOPath = socketIOPath;
+        this.mTransports = transports;
+
+        if(socketIOPath === undefined)
+            this.mSocketIOPath = "";
+    } // !ctor
+
+    /**
+     * Subscribes to a camera. Subscribing again to the same camera and format replaces the previous subscription.
+     * @param cam: Name of the camera.
+     * @param format: mjpeg or h264.
+     * @param options: Options of the format, such as tfps, ack and keepalive for mjpeg, or ack and batch for h264.
+     * @param handler: Called with the data of every frame (or NAL unit) of the camera. With batch, the data of h264
+     * is a whole access unit: the NAL units of a picture, each prefixed by its start code.
+     */
+    public subscribe(cam: string, format: string, options: any, handler: CamsMuxHandler)
+    {
+        let sub : CamsMuxSubscription = {cam: cam, format: format, options: options || {}, handler: handler};
+        this.mSubscriptions[CamsMux.getKey(cam, format)] = sub;
+
+        if(this.mClient === undefined)
+            this.connect();
+        else if(this.mClient.connected)
+            this.sendSubscribe(sub);
+    } // !subscribe
+
+    /**
+     * Unsubscribes from a camera. The connection is closed once there are no subscriptions left.
+     * @param cam
+     * @param format
+     */
+    public unsubscribe(cam: string, format: string)
+    {
+        let key = CamsMux.getKey(cam, format);
+        if(!(key in this.mSubscriptions))
+            return;
+        delete this.mSubscriptions[key];
+
+        if(this.mClient === undefined)
+            return;
+
+        if(Object.keys(this.mSubscriptions).length === 0)
+        {
+            this.mClient.close();
+            this.mClient = undefined;
+        }
+        else
+        {
+            this.mClient.emit('unsubscribe', {'cam': cam, 'format': format});
+        }
+    } // !unsubscribe
+
+    private connect()
+    {
+        this.mClient = io.connect(this.mSocketIOURL, this.getConnectOptions());
+
+        // The server forgets the subscriptions of a connection when it drops, so they are all sent again on every
+        // (re)connection.
+        this.mClient.on('connect', () => {
+            console.log("[cams]: Client connected to the server");
+            for(let key in this.mSubscriptions)
+                this.sendSubscribe(this.mSubscriptions[key]);
+        });
+
+        this.mClient.on('frame', (msg: any, ack?: Function) => {
+            this.dispatch(msg.cam, 'mjpeg', msg.frame, ack);
+        });
+
+        this.mClient.on('stream', (msg: any, ack?: Function) => {
+            this.dispatch(msg.cam, 'h264', msg.nal, ack);
+        });
+
+        // The server is overloaded: the subscription is sent again once it tells us to retry.
+        this.mClient.on('rejected', (msg: any) => {
+            console.warn("[cams]: Subscription to " + msg.cam + " refused (" + msg.reason + "). Retrying in " +
+                msg.retry_after + "s.");
+            setTimeout(() => {
+                let sub = this.mSubscriptions[CamsMux.getKey(msg.cam, msg.format)];
+                if(sub !== undefined && this.mClient !== undefined && this.mClient.connected)
+                    this.sendSubscribe(sub);
+            }, msg.retry_after * 1000);
+        });
+    } // !connect
+
+    private sendSubscribe(sub: CamsMuxSubscription)
+    {
+        let data : any = {'cam': sub.cam, 'format': sub.format};
+        for(let name in sub.options)
+            data[name] = sub.options[name];
+        this.mClient.emit('subscribe', data);
+    } // !sendSubscribe
+
+    private dispatch(cam: string, format: string, data: ArrayBuffer, ack?: Function)
+    {
+        let sub = this.mSubscriptions[CamsMux.getKey(cam, format)];
+        if(sub === undefined)
+        {
+            // Late data of a camera we just unsubscribed from.
+            if(ack !== undefined)
+                ack();
+            return;
+        }
+        sub.handler(data, ack);
+    } // !dispatch
+
+    private static getKey(cam: string, format: string): string
+    {
+        return format + "/" + cam;
+    } // !getKey
+
+    /**
+     * Options of the Socket.IO connection.
+     */
+    private getConnectOptions() : any
+    {
+        let options : any = {path: this.mSocketIOPath};
+        if(this.mTransports)
+            options.transports = this.mTransports;
+        return options;
+    } // !getConnectOptions
+} // !CamsMux
@@ -0,0 +1,192 @@
+/// <reference path="typedefs/jquery.d.ts" />
+
+class FMP4MSECamera
+{
+    // Kinds of messages sent by the /ws/cams/<cam>/fmp4 endpoint (first byte of the 5-byte header).
+    private static MESSAGE_KIND_MP4_INIT : number = 3;
+    private static MESSAGE_KIND_MP4_FRAGMENT : number = 4;
+
+    // If we lag behind the live edge by more than this (in seconds) we jump forward.
+    private static MAX_LATENCY : number = 1.0;
+
+    private mVideoElement : HTMLVideoElement;
+    private mWebSocketURL : string;
+    private mCamName : string;
+
+    private mWebSocket : WebSocket;
+    private mMediaSource : MediaSource;
+    private mSourceBuffer : SourceBuffer;
+    private mQueue : ArrayBuffer[] = []; // Fragments waiting for the SourceBuffer to be ready.
+
+    private mRunning : boolean;
+
+    private mTimeStarted : number;
+    private mFragmentsReceived : number = 0;
+    private mStoppedTime : number; // Time the camera was stopped, to calc FPS when not active.
+
+
+    /**
+     * Creates a Camera object, that will rely on Media Source Extensions to play the fragmented MP4 packaging
+     * of the H.264 stream, so that the browser can use hardware-accelerated decoding.
+     * @param videoElement: Video element on which we will play.
+     * @param webSocketURL: URL to the /ws/cams/<cam>/fmp4 endpoint.
+     * @param camName: Name of the camera.
+     */
+    public constructor(videoElement: HTMLVideoElement, webSocketURL: string, camName: string)
+    {
+        this.mVideoElement = videoElement;
+        this.mWebSocketURL = webSocketURL;
+        this.mCamName = camName;
+
+        if(!(videoElement instanceof HTMLVideoElement))
+            throw Error('videoElement must be an HTMLVideoElement');
+        if(camName === undefined)
+            throw Error('camName must be defined');
+    } // !ctor
+
+    /**
+     * Checks whether the camera is currently running.
+     */
+    public isRunning() : boolean
+    {
+        return this.mRunning;
+    } // !isRunning
+
+    /**
+     * Starts playing.
+     */
+    public start()
+    {
+        this.mTimeStarted = Date.now();
+        this.mFragmentsReceived = 0;
+        this.mQueue = [];
+        this.mRunning = true;
+
+        this.mMediaSource = new MediaSource();
+        this.mVideoElement.src = URL.createObjectURL(this.mMediaSource);
+
+        this.mMediaSource.addEventListener('sourceopen', () => {
+            this.mWebSocket = new WebSocket(this.mWebSocketURL);
+            this.mWebSocket.binaryType = "arraybuffer";
+            this.mWebSocket.onmessage = this.onMessage.bind(this);
+        });
+    } // !start
+
+    /**
+     * Called when a message is received from the WebSocket.
+     * @param evt
+     */
+    private onMessage(evt: MessageEvent)
+    {
+        let data : ArrayBuffer = evt.data;
+        let kind : number = new Uint8Array(data)[0];
+        let payload : ArrayBuffer = data.slice(5);
+
+        if(kind === FMP4MSECamera.MESSAGE_KIND_MP4_INIT)
+        {
+            if(this.mSourceBuffer === undefined)
+            {
+                let mime = 'video/mp4; codecs="' + FMP4MSECamera.getCodecString(new Uint8Array(payload)) + '"';
+                this.mSourceBuffer = this.mMediaSource.addSourceBuffer(mime);
+                this.mSourceBuffer.mode = "sequence";
+                this.mSourceBuffer.addEventListener('updateend', this.onUpdateEnd.bind(this));
+            }
+        }
+        else if(kind === FMP4MSECamera.MESSAGE_KIND_MP4_FRAGMENT)
+        {
+            this.mFragmentsReceived += 1;
+        }
+
+        this.mQueue.push(payload);
+        this.appendNext();
+    } // !onMessage
+
+    /**
+     * Appends the next queued segment, if the SourceBuffer is ready for it.
+     */
+    private appendNext()
+    {
+        if(this.mSourceBuffer === undefined || this.mSourceBuffer.updating || this.mQueue.length === 0)
+            return;
+        this.mSourceBuffer.appendBuffer(this.mQueue.shift());
+    } // !appendNext
+
+    /**
+     * Called when the SourceBuffer has finished appending a segment. Keeps the playback close to the live edge.
+     */
+    private onUpdateEnd()
+    {
+        let buffered = this.mVideoElement.buffered;
+        if(buffered.length > 0)
+        {
+            let end = buffered.end(buffered.length - 1);
+            if(end - this.mVideoElement.currentTime > FMP4MSECamera.MAX_LATENCY)
+                this.mVideoElement.currentTime = end - 0.1;
+            if(this.mVideoElement.paused)
+                this.mVideoElement.play();
+        }
+        this.appendNext();
+    } // !onUpdateEnd
+
+    /**
+     * Gets the average FPS during the current active period or the latest period if we are stopped.
+     * Every fragment contains a single picture.
+     * @returns {number}
+     */
+    public getAverageFPS(): number
+    {
+        let finalTime : number;
+        if(this.isRunning())
+            finalTime = Date.now();
+        else
+            finalTime = this.mStoppedTime;
+
+        let elapsed : number = finalTime - this.mTimeStarted;
+        if(elapsed === 0)
+        {
+            return 0;
+        }
+
+        return this.mFragmentsReceived / (elapsed/1000);
+    } // !getAverageFPS
+
+    /**
+     * Stops playing.
+     */
+    public stop()
+    {
+        this.mRunning = false;
+        this.mWebSocket.close();
+        this.mStoppedTime = Date.now();
+    } // !stop
+
+    /**
+     * Retrieves the number of fragments (pictures) received in the last active period.
+     */
+    public getSuccessfulFrames(): number
+    {
+        return this.mFragmentsReceived;
+    }
+
+    /**
+     * Builds the MSE codec string (such as avc1.42c01e) from the avcC box of the init segment.
+     * @param init
+     * @returns {string}
+     */
+    private static getCodecString(init: Uint8Array): string
+    {
+        for(let i = 0; i < init.length - 8; i++)
+        {
+            // 'avcC', followed by the configuration version and the profile, compatibility and level bytes.
+            if(init[i] === 0x61 && init[i+1] === 0x76 && init[i+2] === 0x63 && init[i+3] === 0x43)
+            {
+                let codec = "avc1.";
+                for(let j = i + 5; j < i + 8; j++)
+                    codec += ("0" + init[j].toString(16)).slice(-2);
+                return codec;
+            }
+        }
+        return "avc1.42e01e";
+    } // !getCodecString
+
+} // !Camera
@@ -5,18 +5,22 @@ var H264JSCamera = (function () {
      * Creates a Camera object, that will rely on HTML5 Canvas and SocketIO for receiving and rendering
      * a MJPEG stream.
      * @param canvasElement: Canvas element on which we will draw.
-     * @param socketIOURL: URL to the Socket IO URL. Namespace must be included.
+     * @param socketIOURL: URL to the Socket IO URL. Namespace must be included. A ws:// or wss:// URL to the plain
+     * WebSocket endpoint (/ws/cams/<cam>/h264) can be provided instead.
      * @param camName: Name of the camera.
      * @param socketIOPath: The specific socketio path. This is used in case the /socket.io endpoint is not located
      * in the domain's root.
+     * @param transports: Socket.IO transports to use, such as ['websocket'] when the server runs several workers
+     * without sticky sessions. Optional. Default: polling, upgraded to websocket.
      */
-    function H264JSCamera(canvasElement, socketIOURL, camName, socketIOPath) {
+    function H264JSCamera(canvasElement, socketIOURL, camName, socketIOPath, transports) {
         this.mFailedFrames = 0; // To track the number of successful frames in this period.
         this.mFramesRendered = 0;
         this.mCanvasElement = canvasElement;
         this.mSocketIOURL = socketIOURL;
         this.mCamName = camName;
         this.mSocketIOPath = socketIOPath;
+        this.mTransports = transports;
         if (!(canvasElement instanceof HTMLCanvasElement))
             throw Error('canvasElement must be an HTMLCanvasElement');
         if (camName === undefined)
@@ -37,13 +41,22 @@ var H264JSCamera = (function () {
     H264JSCamera.prototype.start = function () {
         this.mTimeStarted = Date.now();
         this.mRunning = true;
+        // Plain WebSocket endpoints (ws:// or wss:// URLs) are used directly, without Socket.IO.
+        if (H264JSCamera.isWebSocketURL(this.mSocketIOURL)) {
+            this.mWSAvc = new WSAvcPlayer(this.mCanvasElement, "webgl", 1, 35);
+            this.mWSAvc.initCanvas(this.mCanvasElement.width, this.mCanvasElement.height);
+            this.mWSAvc.connect(this.mSocketIOURL);
+            return;
+        }
         var that = this;
-        this.mClient = io.connect(this.mSocketIOURL, { path: this.mSocketIOPath });
+        this.mClient = io.connect(this.mSocketIOURL, this.getConnectOptions());
         console.debug("Connecting to URL: " + this.mSocketIOURL);
         console.debug("Connecting to Socket IO Path: " + this.mSocketIOPath);
         this.mClient.on('connect', function () {
             console.log("Client connected to the server");
-            that.mClient.emit('start', { 'cam': that.mCamName });
+            // We ack every NAL unit so that the server can resync us at a keyframe if we lag behind. The NAL units of
+            // every picture are received together (batch), which the player splits again.
+            that.mClient.emit('start', { 'cam': that.mCamName, 'ack': true, 'batch': true });
             that.mWSAvc = new WSAvcPlayer(that.mCanvasElement, "webgl", 1, 35);
             // Force a Canvas initialization. The original player does not do this. Instead, it waits for the
             // init 'cmd' sent by the server. It should work, though.
@@ -75,10 +88,21 @@ var H264JSCamera = (function () {
      */
     H264JSCamera.prototype.stop = function () {
         this.mRunning = false;
-        this.mClient.close();
         this.mStoppedTime = Date.now();
+        if (this.mClient === undefined) {
+            this.mWSAvc.disconnect();
+            return;
+        }
+        this.mClient.close();
         this.mWSAvc.stopStream();
     }; // !stop
+    /**
+     * Checks whether the URL is a plain WebSocket one, rather than a Socket IO one.
+     * @param url
+     */
+    H264JSCamera.isWebSocketURL = function (url) {
+        return url.indexOf("ws://") === 0 || url.indexOf("wss://") === 0;
+    }; // !isWebSocketURL
     /**
      * Resets the FPS counter.
      */
@@ -93,5 +117,14 @@ var H264JSCamera = (function () {
         return this.mWSAvc.mDecodedFrames;
         // return this.mJSMPEG.framesRendered;
     };
+    /**
+     * Options of the Socket.IO connection.
+     */
+    H264JSCamera.prototype.getConnectOptions = function () {
+        var options = { path: this.mSocketIOPath };
+        if (this.mTransports)
+            options.transports = this.mTransports;
+        return options;
+    }; // !getConnectOptions
     return H264JSCamera;
 }()); // !Camera
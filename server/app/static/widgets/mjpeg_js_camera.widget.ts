@@ -1,5 +1,6 @@
 /// <reference path="typedefs/jquery.d.ts" />
 /// <reference path="typedefs/socket.io-client.d.ts" />
+/// <reference path="cams_mux.widget.ts" />
 
 
 import Socket = SocketIOClient.Socket;
@@ -9,10 +10,13 @@ class MJPEGJSCamera
     private mCanvasElement : HTMLCanvasElement;
     private mSocketIOURL : string;
     private mSocketIOPath: string;
+    private mTransports : string[];
     private mCamName : string;
     private mTargetFPS : number;
 
     private mClient : Socket;
+    private mWebSocket : WebSocket; // Only used with the plain WebSocket endpoint.
+    private mMux : CamsMux; // Only used when sharing a multiplexed connection with other cameras.
 
     private mRunning : boolean;
 
@@ -26,17 +30,24 @@ class MJPEGJSCamera
      * Creates a Camera object, that will rely on HTML5 Canvas and SocketIO for receiving and rendering
      * a MJPEG stream.
      * @param canvasElement: Canvas element on which we will draw.
-     * @param socketIOURL: URL to the Socket IO URL. Namespace must be included.
+     * @param socketIOURL: URL to the Socket IO URL. Namespace must be included. A ws:// or wss:// URL to the plain
+     * WebSocket endpoint (/ws/cams/<cam>/mjpeg) can be provided instead, or a CamsMux shared with other cameras.
      * @param camName: Name of the camera.
      * @param socketIOPath: Path to the socketio endpoint. Optional.
      * @param targetFPS: Target FPS to ask from the server. Optional. Default: 5.
+     * @param transports: Socket.IO transports to use, such as ['websocket'] when the server runs several workers
+     * without sticky sessions. Optional. Default: polling, upgraded to websocket.
      */
-    public constructor(canvasElement: HTMLCanvasElement, socketIOURL: string, camName: string, socketIOPath: string, targetFPS: number)
+    public constructor(canvasElement: HTMLCanvasElement, socketIOURL: string | CamsMux, camName: string, socketIOPath: string, targetFPS: number, transports?: string[])
     {
         this.mCanvasElement = canvasElement;
-        this.mSocketIOURL = socketIOURL;
+        if(socketIOURL instanceof CamsMux)
+            this.mMux = socketIOURL;
+        else
+            this.mSocketIOURL = socketIOURL;
         this.mCamName = camName;
         this.mSocketIOPath = socketIOPath;
+        this.mTransports = transports;
         this.mTargetFPS = targetFPS;
 
         if(!(canvasElement instanceof HTMLCanvasElement))
@@ -67,24 +78,56 @@ class MJPEGJSCamera
         this.mFramesRendered = 0;
         this.mRunning = true;
 
+        // Multiplexed connection: the frames of this camera are tagged and dispatched to us by the mux.
+        if(this.mMux !== undefined)
+        {
+            this.mMux.subscribe(this.mCamName, 'mjpeg', {'tfps': this.mTargetFPS, 'ack': true},
+                this.onFrameReceived.bind(this));
+            return;
+        }
+
+        // Plain WebSocket endpoints (ws:// or wss:// URLs) are used directly, without Socket.IO. Every message
+        // carries a 5-byte header (kind and sequence number) before the JPEG data.
+        if(this.mSocketIOURL.indexOf("ws://") === 0 || this.mSocketIOURL.indexOf("wss://") === 0)
+        {
+            this.mWebSocket = new WebSocket(this.mSocketIOURL + "?tfps=" + this.mTargetFPS);
+            this.mWebSocket.binaryType = "arraybuffer";
+            this.mWebSocket.onmessage = (evt: MessageEvent) => {
+                this.onFrameReceived((<ArrayBuffer>evt.data).slice(5));
+            };
+            return;
+        }
+
         // Connect to the socketio URL.
-        this.mClient = io.connect(this.mSocketIOURL, {path: this.mSocketIOPath});
+        this.mClient = io.connect(this.mSocketIOURL, this.getConnectOptions());
 
         let that = this;
 		this.mClient.on('connect', function () {
             console.log("Client connected to the server");
-            that.mClient.emit('start', {'cam': that.mCamName, 'tfps': that.mTargetFPS});
+            // We ack every frame so that the server can pace the stream to what we can render.
+            that.mClient.emit('start', {'cam': that.mCamName, 'tfps': that.mTargetFPS, 'ack': true});
         });
 
         this.mClient.on('frame', this.onFrameReceived.bind(this));
+
+        // The server is overloaded: we start again once it tells us to retry.
+        this.mClient.on('rejected', function (msg: any) {
+            console.warn("[mjpeg]: Stream refused (" + msg.reason + "). Retrying in " + msg.retry_after + "s.");
+            setTimeout(function () {
+                if(that.mRunning)
+                    that.mClient.emit('start', {'cam': that.mCamName, 'tfps': that.mTargetFPS, 'ack': true});
+            }, msg.retry_after * 1000);
+        });
     } // !start
 
 
     /**
      * Called when new frame data is received and should be rendered.
      * @param imageData
+     * @param ack: Acknowledgement callback. It is called once the frame has been rendered (or has failed to),
+     * so that the server sends the next one.
      */
-    private onFrameReceived(imageData: ArrayBuffer)
+    private onFrameReceived(imageData: ArrayBuffer, ack?: Function)
     {
         let ctx:CanvasRenderingContext2D = this.mCanvasElement.getContext("2d");
 
@@ -97,11 +140,15 @@ class MJPEGJSCamera
         img.onload = () => {
             ctx.drawImage(img, 0, 0, 640, 480);
             this.mFramesRendered += 1;
+            if(ack !== undefined)
+                ack();
         };
 
         img.onerror = () => {
             console.error("[mjpeg]: Image error");
             this.mFailedFrames += 1;
+            if(ack !== undefined)
+                ack();
         };
     } // !onFrameReceived
 
@@ -133,7 +180,12 @@ class MJPEGJSCamera
     public stop()
     {
         this.mRunning = false;
-        this.mClient.close();
+        if(this.mMux !== undefined)
+            this.mMux.unsubscribe(this.mCamName, 'mjpeg');
+        else if(this.mWebSocket !== undefined)
+            this.mWebSocket.close();
+        else
+            this.mClient.close();
         this.mStoppedTime = Date.now();
     } // !stop
 
@@ -172,4 +224,14 @@ class MJPEGJSCamera
         }
     } // !getTimestampedURL
 
+    /**
+     * Options of the Socket.IO connection.
+     */
+    private getConnectOptions() : any
+    {
+        let options : any = {path: this.mSocketIOPath};
+        if(this.mTransports)
+            options.transports = this.mTransports;
+        return options;
+    } // !getConnectOptions
 } // !Camera
\ No newline at end of file
@@ -9,14 +9,17 @@ var MPEGJSCamera = (function () {
      * @param camName: Name of the camera.
      * @param socketIOPath: The specific socketio path. This is used in case the /socket.io endpoint is not located
      * in the domain's root.
+     * @param transports: Socket.IO transports to use, such as ['websocket'] when the server runs several workers
+     * without sticky sessions. Optional. Default: polling, upgraded to websocket.
      */
-    function MPEGJSCamera(canvasElement, socketIOURL, camName, socketIOPath) {
+    function MPEGJSCamera(canvasElement, socketIOURL, camName, socketIOPath, transports) {
         this.mFailedFrames = 0; // To track the number of successful frames in this period.
         this.mFramesRendered = 0;
         this.mCanvasElement = canvasElement;
         this.mSocketIOURL = socketIOURL;
         this.mCamName = camName;
         this.mSocketIOPath = socketIOPath;
+        this.mTransports = transports;
         if (!(canvasElement instanceof HTMLCanvasElement))
             throw Error('canvasElement must be an HTMLCanvasElement');
         if (camName === undefined)
@@ -40,7 +43,7 @@ var MPEGJSCamera = (function () {
         this.mFramesRendered = 0;
         this.mRunning = true;
         var that = this;
-        this.mClient = io.connect(this.mSocketIOURL, { path: this.mSocketIOPath });
+        this.mClient = io.connect(this.mSocketIOURL, this.getConnectOptions());
         console.debug("Connecting to URL: " + this.mSocketIOURL);
         console.debug("Connecting to Socket IO Path: " + this.mSocketIOPath);
         this.mClient.on('connect', function () {
@@ -97,6 +100,15 @@ var MPEGJSCamera = (function () {
             return url + "?__ts=" + tsr;
         }
     }; // !getTimestampedURL
+    /**
+     * Options of the Socket.IO connection.
+     */
+    MPEGJSCamera.prototype.getConnectOptions = function () {
+        var options = { path: this.mSocketIOPath };
+        if (this.mTransports)
+            options.transports = this.mTransports;
+        return options;
+    }; // !getConnectOptions
     return MPEGJSCamera;
 })(); // !Camera
 //# sourceMappingURL=mpeg_js_camera.widget.js.map
\ No newline at end of file
@@ -10,6 +10,7 @@ class MPEGJSCamera
     private mCanvasElement : HTMLCanvasElement;
     private mSocketIOURL : string;
     private mSocketIOPath : string;
+    private mTransports : string[];
     private mCamName : string;
 
     private mClient : Socket;
@@ -32,13 +33,16 @@ class MPEGJSCamera
      * @param camName: Name of the camera.
      * @param socketIOPath: The specific socketio path. This is used in case the /socket.io endpoint is not located
      * in the domain's root.
+     * @param transports: Socket.IO transports to use, such as ['websocket'] when the server runs several workers
+     * without sticky sessions. Optional. Default: polling, upgraded to websocket.
      */
-    public constructor(canvasElement: HTMLCanvasElement, socketIOURL: string, camName: string, socketIOPath: string)
+    public constructor(canvasElement: HTMLCanvasElement, socketIOURL: string, camName: string, socketIOPath: string, transports?: string[])
     {
         this.mCanvasElement = canvasElement;
         this.mSocketIOURL = socketIOURL;
         this.mCamName = camName;
         this.mSocketIOPath = socketIOPath;
+        this.mTransports = transports;
 
         if(!(canvasElement instanceof HTMLCanvasElement))
             throw Error('canvasElement must be an HTMLCanvasElement');
@@ -68,7 +72,7 @@ class MPEGJSCamera
         this.mRunning = true;
 
         let that = this;
-        this.mClient = io.connect(this.mSocketIOURL, {path: this.mSocketIOPath});
+        this.mClient = io.connect(this.mSocketIOURL, this.getConnectOptions());
         console.debug("Connecting to URL: " + this.mSocketIOURL);
         console.debug("Connecting to Socket IO Path: " + this.mSocketIOPath);
 		this.mClient.on('connect', function () {
@@ -140,4 +144,14 @@ class MPEGJSCamera
         }
     } // !getTimestampedURL
 
+    /**
+     * Options of the Socket.IO connection.
+     */
+    private getConnectOptions() : any
+    {
+        let options : any = {path: this.mSocketIOPath};
+        if(this.mTransports)
+            options.transports = this.mTransports;
+        return options;
+    } // !getConnectOptions
 } // !Camera
\ No newline at end of file
@@ -0,0 +1,237 @@
+"""
+Compares the asyncio engine (aio package, served by uvicorn) with the gevent engine (the app package, served as in
+scaling_bench) under the same load: a single worker process of each engine serves a growing number of MJPEG HTTP
+viewers and H.264 WebSocket viewers.
+
+A simulated feeder stores the frames and publishes the NAL units with the time at which they were produced appended,
+so that the viewers can measure how late they receive them. The feeder writes FEEDER_LEAD seconds before the ticks of
+the MJPEG FPS tier (which both engines align to wall-clock multiples of the period), so that the MJPEG latency is
+FEEDER_LEAD plus the time that the engine takes to serve the frame. A NAL unit is only delimited, and thus sent, once
+the next one is published: its latency is one feeder period plus that of the engine.
+
+For every engine and number of viewers, it reports:
+ - The MJPEG frames/s and H.264 NAL units/s received by the viewers.
+ - The p50 and p99 latency of the MJPEG frames and of the H.264 NAL units.
+ - The CPU load of the worker, and the connections per core: viewers divided by the fraction of a core the worker
+   used, that is, the viewers that a fully used core would serve at this load.
+
+The worker shares the cores with the feeder and the clients. The number of cores is reported along with the results.
+
+Example:
+    python -m benchmark.aio_bench -v 100,200,400 -c 4 -t 20 -f ../feeder/tests/data/img.jpg
+"""
+
+import math
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import time
+from optparse import OptionParser
+
+import redis
+
+from .scaling_bench import REDIS_PREFIX, IDR_NAL, run_worker, process_cpu, wait_for_port
+
+PORT = 8592
+
+TIMESTAMP = struct.Struct('!d')
+
+# Seconds before the ticks at which the feeder writes the frames.
+FEEDER_LEAD = 0.01
+
+
+def cam_names(cams):
+    return ['aiobench{}'.format(n) for n in range(cams)]
+
+
+def run_aio_worker(port, redis_url):
+    """
+    Worker process: serves the asyncio engine on the port.
+    """
+    os.environ['REDIS_URL'] = redis_url
+    os.environ['FLASK_CONFIG'] = 'benchmark'
+    server_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    os.chdir(server_dir)
+    sys.path.insert(0, server_dir)
+
+    import uvicorn
+    uvicorn.run('aio.app:app', host='127.0.0.1', port=port, log_level='warning')
+
+
+def run_feeder(redis_url, cams, fps, frame, nal_size, stop_event):
+    """
+    Feeder process: stores a frame and publishes an H.264 NAL unit for every camera, fps times per second, each with
+    the time at which it was produced appended.
+    """
+    rdb = redis.StrictRedis.from_url(redis_url)
+    nal = IDR_NAL + b'\x01' * nal_size
+    period = 1.0 / fps
+    while not stop_event.is_set():
+        now = time.time()
+        time.sleep((math.floor((now + FEEDER_LEAD) / period) + 1) * period - FEEDER_LEAD - now)
+        stamp = TIMESTAMP.pack(time.time())
+        pipe = rdb.pipeline()
+        pipe.setex(REDIS_PREFIX + ':feeder:alive', 10, 1)
+        for cam in cam_names(cams):
+            cam_key = '{}:cams:{}'.format(REDIS_PREFIX, cam)
+            pipe.setex(cam_key + ':lastframe', 10, frame + stamp)
+            pipe.incr(cam_key + ':frameseq')
+            pipe.publish(cam + '/h264', nal + stamp)
+        pipe.execute()
+
+
+def run_clients(port, cams, mjpeg_viewers, h264_viewers, tfps, seconds, warmup, results):
+    """
+    Client process: opens the MJPEG and H.264 streams (spread over the cameras) and records how late every frame and
+    NAL unit arrives, after the warmup.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    import websocket
+
+    measured = {'mjpeg': [], 'h264': [], 'errors': 0}
+    start = time.time() + warmup
+    deadline = time.time() + warmup + seconds
+    names = cam_names(cams)
+
+    def record(kind, payload):
+        now = time.time()
+        if now >= start:
+            measured[kind].append(now - TIMESTAMP.unpack(payload[-TIMESTAMP.size:])[0])
+
+    def mjpeg_viewer(cam):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall('GET /cams/{}/mjpeg?tfps={}&quality=full HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(
+                cam, tfps).encode())
+            stream = sock.makefile('rb')
+            # Response headers.
+            while stream.readline() not in (b'\r\n', b''):
+                pass
+            while time.time() < deadline:
+                length = None
+                line = stream.readline()
+                if not line:
+                    break
+                while line not in (b'\r\n', b''):
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                    line = stream.readline()
+                if length is None:
+                    # The chunked transfer encoding line of the gevent server, or the blank line after a part.
+                    continue
+                record('mjpeg', stream.read(length))
+            sock.close()
+        except Exception as ex:
+            print("[aio_bench]: MJPEG viewer failed: {}".format(ex))
+            measured['errors'] += 1
+
+    def h264_viewer(cam):
+        try:
+            ws = websocket.create_connection('ws://127.0.0.1:{}/ws/cams/{}/h264'.format(port, cam))
+            ws.settimeout(1)
+            while time.time() < deadline:
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                record('h264', message)
+            ws.close()
+        except Exception as ex:
+            print("[aio_bench]: H.264 viewer failed: {}".format(ex))
+            measured['errors'] += 1
+
+    greenlets = [gevent.spawn(mjpeg_viewer, names[n % cams]) for n in range(mjpeg_viewers)]
+    greenlets += [gevent.spawn(h264_viewer, names[n % cams]) for n in range(h264_viewers)]
+    gevent.joinall(greenlets, timeout=warmup + seconds + 5)
+    # Sent through a plain pipe: a multiprocessing queue relies on a thread, which gevent turns into a greenlet.
+    results.send(measured)
+    results.close()
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(engines, viewers_list, cams, h264_ratio, tfps, fps, seconds, frame, client_processes, redis_url):
+    ctx = multiprocessing.get_context('spawn')
+    workers = {'gevent': run_worker, 'asyncio': run_aio_worker}
+
+    print("cores: {}".format(os.cpu_count()))
+    print("engine,viewers,mjpeg_frames_s,mjpeg_p50_ms,mjpeg_p99_ms,h264_nals_s,h264_p50_ms,h264_p99_ms,"
+          "worker_cpu_percent,connections_per_core,errors")
+    for engine in engines:
+        for viewers in viewers_list:
+            h264_viewers = int(viewers * h264_ratio)
+            mjpeg_viewers = viewers - h264_viewers
+
+            stop_event = ctx.Event()
+            feeder = ctx.Process(target=run_feeder, args=(redis_url, cams, fps, frame, 4096, stop_event))
+            feeder.start()
+            worker = ctx.Process(target=workers[engine], args=(PORT, redis_url))
+            worker.start()
+            wait_for_port(PORT)
+
+            # The streams ramp up during the first seconds, which are not measured.
+            warmup = min(3, seconds / 4)
+            pipes = [ctx.Pipe(duplex=False) for _ in range(client_processes)]
+            clients = [ctx.Process(target=run_clients, args=(PORT, cams, mjpeg_viewers // client_processes,
+                                                             h264_viewers // client_processes, tfps, seconds, warmup,
+                                                             sender))
+                       for _, sender in pipes]
+            for c in clients:
+                c.start()
+            time.sleep(warmup)
+
+            start = time.time()
+            cpu_start = process_cpu(worker.pid)
+            measured = {'mjpeg': [], 'h264': [], 'errors': 0}
+            for receiver, _ in pipes:
+                for key, value in receiver.recv().items():
+                    measured[key] += value
+            elapsed = time.time() - start
+            cpu = (process_cpu(worker.pid) - cpu_start) / elapsed
+
+            print("{},{},{:.1f},{:.1f},{:.1f},{:.1f},{:.1f},{:.1f},{:.1f},{:.0f},{}".format(
+                engine, viewers, len(measured['mjpeg']) / seconds, percentile(measured['mjpeg'], 0.5) * 1000,
+                percentile(measured['mjpeg'], 0.99) * 1000, len(measured['h264']) / seconds,
+                percentile(measured['h264'], 0.5) * 1000, percentile(measured['h264'], 0.99) * 1000, cpu * 100,
+                viewers / cpu if cpu > 0 else float('nan'), measured['errors']))
+
+            for c in clients:
+                c.join()
+            worker.terminate()
+            worker.join()
+            stop_event.set()
+            feeder.join()
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-e", "--engines", dest="engines", default="gevent,asyncio",
+                      help="Comma-separated engines to test (gevent, asyncio).")
+    parser.add_option("-v", "--viewers", dest="viewers", default="100,200,400",
+                      help="Comma-separated numbers of viewers to test.")
+    parser.add_option("-c", "--cams", dest="cams", default=4, type="int", help="Number of cameras.")
+    parser.add_option("-x", "--h264-ratio", dest="h264_ratio", default=0.25, type="float",
+                      help="Fraction of the viewers that stream H.264 rather than MJPEG.")
+    parser.add_option("-r", "--tfps", dest="tfps", default=10, type="int", help="FPS requested by the MJPEG viewers.")
+    parser.add_option("-p", "--fps", dest="fps", default=10, type="int", help="FPS of the simulated feeder.")
+    parser.add_option("-t", "--time", dest="seconds", default=20, type="float", help="Measured seconds per run.")
+    parser.add_option("-f", "--frame", dest="frame", default="../feeder/tests/data/img.jpg", help="JPEG frame.")
+    parser.add_option("-n", "--client-processes", dest="client_processes", default=2, type="int",
+                      help="Processes that run the viewers.")
+    parser.add_option("-u", "--redis-url", dest="redis_url", default="redis://localhost:6379/0")
+    (options, args) = parser.parse_args()
+
+    with open(options.frame, 'rb') as f:
+        frame = f.read()
+
+    run(options.engines.split(','), [int(v) for v in options.viewers.split(',')], options.cams, options.h264_ratio,
+        options.tfps, options.fps, options.seconds, frame, options.client_processes, options.redis_url)
@@ -0,0 +1,79 @@
+"""
+Compares the requests/s of the snapshot route (/cams/<cam_id>) through the fast path against the Flask view.
+
+The WSGI apps are called in-process, without a server or sockets, so that only the dispatch and the handler are
+measured: the same environ goes either to the FastPath middleware or to the Flask app that it wraps. The MJPEG route
+is not measured: its streams are paced by the ticker, so their cost is dominated by the frames rather than by the
+dispatch.
+
+It runs against the redis server at REDIS_URL, where it stores the frame for the 'fastbench' camera.
+
+Example:
+    python -m benchmark.fastpath_bench -n 20000 -f ../feeder/tests/data/img.jpg
+"""
+
+import time
+from optparse import OptionParser
+
+from gevent import monkey
+monkey.patch_all()
+
+from werkzeug.test import EnvironBuilder
+
+from app import create_app, rdb
+
+CAM = 'fastbench'
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def measure(name, wsgi_app, path, query, iterations):
+    environ = EnvironBuilder(path=path, query_string=query).get_environ()
+    start = time.time()
+    cpu_start = time.process_time()
+    for _ in range(iterations):
+        body = wsgi_app(dict(environ), start_response)
+        for _ in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+    elapsed = time.time() - start
+    cpu = time.process_time() - cpu_start
+    print("{},{},{},{:.0f},{:.1f}".format(name, path, query, iterations / elapsed, cpu / iterations * 1e6))
+
+
+def run(iterations, frame):
+    app = create_app('testing')
+    fast = app.wsgi_app
+    flask = fast.wsgi_app
+
+    with app.app_context():
+        prefix = app.config['REDIS_PREFIX']
+        cam_key = prefix + ":cams:" + CAM
+        rdb.set(cam_key + ":lastframe", frame, ex=600)
+        rdb.incr(cam_key + ":frameseq")
+        rdb.set(prefix + ":feeder:alive", 1, ex=600)
+
+    print("handler,path,query,requests_s,cpu_us_per_request")
+    for query in ('', 'tfps=5'):
+        measure('flask', flask, '/cams/' + CAM, query, iterations)
+        measure('fastpath', fast, '/cams/' + CAM, query, iterations)
+
+    with app.app_context():
+        rdb.delete(cam_key + ":lastframe", cam_key + ":frameseq")
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--iterations", type="int", dest="iterations", default=20000,
+                      help="Requests per measurement")
+    parser.add_option("-f", "--frame", dest="frame", default="../feeder/tests/data/img.jpg", help="JPEG frame")
+
+    (options, args) = parser.parse_args()
+
+    with open(options.frame, 'rb') as f:
+        frame = f.read()
+
+    run(options.iterations, frame)
@@ -0,0 +1,99 @@
+"""
+Compares emitting every H.264 NAL unit through Socket.IO against emitting whole access units (batch mode).
+
+A synthetic stream (SPS, PPS and SEI before every IDR, and a number of slices per picture) is fed, chunk by chunk as
+the hub delivers it, to the H.264 broadcasters of N viewers connected through Socket.IO test clients, which encode
+every event into its packets the way the server does for a real connection. For each mode it reports the emits per
+second of stream and the CPU time per viewer and second of stream.
+
+Example:
+    python -m benchmark.h264_batching -v 1,10,50 -s 4 -d 10
+"""
+
+import time
+from optparse import OptionParser
+
+from gevent import monkey
+monkey.patch_all()
+
+from app import create_app, socketio
+from app.main import stats
+from app.main.SocketIOH264RedisBroadcaster import SocketIOH264RedisBroadcaster
+from app.main.h264_nal import NALSplitter
+
+CAM = 'h264bench'
+NAMESPACE = SocketIOH264RedisBroadcaster.SOCKETIO_NAMESPACE
+
+START_CODE = b'\x00\x00\x00\x01'
+
+
+def slice_nal(header, first, size):
+    # first_mb_in_slice is 0 (a single 1 bit) for the first slice of a picture.
+    return START_CODE + bytes([header, 0x88 if first else 0x40]) + b'\x11' * size
+
+
+def synthetic_stream(fps, gop, slices, idr_size, p_size):
+    """
+    Returns one second of the stream, as the chunks that the feeder publishes (one per picture).
+    """
+    chunks = []
+    for n in range(fps):
+        if n % gop == 0:
+            picture = START_CODE + b'\x67' + b'\x22' * 10 + START_CODE + b'\x68' + b'\x33' * 4
+            picture += START_CODE + b'\x06' + b'\x05' * 20
+            picture += b''.join(slice_nal(0x65, s == 0, idr_size // slices) for s in range(slices))
+        else:
+            picture = b''.join(slice_nal(0x41, s == 0, p_size // slices) for s in range(slices))
+        chunks.append(picture)
+    return chunks
+
+
+def measure(app, viewers, batch, chunks, duration):
+    stats.reset()
+    clients = [socketio.test_client(app, namespace=NAMESPACE) for _ in range(viewers)]
+    broadcasters = []
+    for client in clients:
+        sid = socketio.server.manager.sid_from_eio_sid(client.eio_sid, NAMESPACE)
+        broadcasters.append((SocketIOH264RedisBroadcaster(CAM, sid, batch=batch), NALSplitter()))
+
+    cpu = 0
+    for _ in range(int(duration)):
+        start = time.process_time()
+        for chunk in chunks:
+            for broadcaster, splitter in broadcasters:
+                broadcaster._feed(splitter, chunk)
+        cpu += time.process_time() - start
+        # The test clients keep what they receive until it is read.
+        for client in clients:
+            client.get_received(NAMESPACE)
+
+    for client in clients:
+        client.disconnect(namespace=NAMESPACE)
+
+    emits = stats.COUNTERS.get('h264_sio_emits', 0)
+    print("{},{},{:.1f},{:.1f},{:.3f}".format('batch' if batch else 'nal', viewers, emits / duration,
+                                              emits / duration / viewers, cpu / duration / viewers * 1000))
+
+
+def run(viewer_counts, fps, gop, slices, duration):
+    app = create_app('testing')
+    chunks = synthetic_stream(fps, gop, slices, 30000, 3000)
+    with app.app_context():
+        print("mode,viewers,emits_s,emits_s_per_viewer,cpu_ms_per_viewer_s")
+        for viewers in viewer_counts:
+            measure(app, viewers, False, chunks, duration)
+            measure(app, viewers, True, chunks, duration)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-v", "--viewers", dest="viewers", default="1,10,50",
+                      help="Comma-separated numbers of viewers")
+    parser.add_option("-f", "--fps", type="int", dest="fps", default=25, help="FPS of the stream")
+    parser.add_option("-g", "--gop", type="int", dest="gop", default=25, help="Pictures per IDR")
+    parser.add_option("-s", "--slices", type="int", dest="slices", default=4, help="Slices per picture")
+    parser.add_option("-d", "--duration", type="float", dest="duration", default=10, help="Seconds of stream")
+
+    (options, args) = parser.parse_args()
+
+    run([int(v) for v in options.viewers.split(',')], options.fps, options.gop, options.slices, options.duration)
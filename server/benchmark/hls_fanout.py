@@ -0,0 +1,91 @@
+"""
+Measures how the LL-HLS delivery scales with the number of viewers.
+
+Every LL-HLS viewer makes, for every part, one (blocking) playlist request and one part request. Without a cache in
+front of the server, the origin serves all of them. With a caching proxy or CDN, identical requests are collapsed, so
+the origin serves each distinct URL once, whatever the number of viewers.
+
+The benchmark prefills a segment store with synthetic fragments and replays the requests of N viewers through the
+Flask test client, to measure the origin CPU cost of each request. It then reports the origin requests/s and CPU load
+with and without a shared cache.
+
+Example:
+    python -m benchmark.hls_fanout -v 1,10,100,1000 -s 20000
+"""
+
+import time
+from optparse import OptionParser
+
+from app import create_app
+from app.main import hls
+from app.main.hls import SegmentStore
+
+CAM = 'benchmark'
+
+
+def fill_store(store, fps, fragment_size, seconds, keyframe_interval):
+    frames = int(fps * seconds)
+    for n in range(frames):
+        keyframe = n % keyframe_interval == 0
+        store.add_fragment(b'\x00' * fragment_size, 1.0 / fps, keyframe)
+
+
+def viewer_requests(store):
+    """
+    Returns the requests that one viewer makes for every part: the blocking playlist reload and the part itself.
+    They target the latest complete segment, so that none of them blocks.
+    """
+    segments = [line for line in store.playlist().split('\n') if line.startswith('seg')]
+    msn = int(segments[-1][len('seg'):-len('.m4s')])
+    return [
+        '/hls/{}/playlist.m3u8?_HLS_msn={}&_HLS_part=0'.format(CAM, msn),
+        '/hls/{}/part{}.0.m4s'.format(CAM, msn)
+    ]
+
+
+def measure_request_cost(client, urls, iterations):
+    """
+    :return: CPU seconds spent per request.
+    """
+    start = time.process_time()
+    for i in range(iterations):
+        for url in urls:
+            response = client.get(url)
+            assert response.status_code == 200, url
+    return (time.process_time() - start) / (iterations * len(urls))
+
+
+def run(viewers_list, fps, fragment_size, iterations):
+    app = create_app('testing')
+    with app.app_context():
+        config = app.config
+        store = SegmentStore(CAM, config['HLS_SEGMENT_DURATION'], config['HLS_PART_DURATION'],
+                             config['HLS_SEGMENTS_KEPT'])
+        store.init_segment = b'\x00' * 1000
+        fill_store(store, fps, fragment_size, 10, int(fps * config['HLS_SEGMENT_DURATION']))
+        hls.STORES[CAM] = store
+
+        client = app.test_client()
+        cost = measure_request_cost(client, viewer_requests(store), iterations)
+
+        parts_per_second = 1.0 / config['HLS_PART_DURATION']
+        requests_per_viewer = 2 * parts_per_second
+
+        print("viewers,cache,origin_requests_s,origin_cpu_percent")
+        for viewers in viewers_list:
+            for cache, origin_rps in (('none', viewers * requests_per_viewer), ('shared', requests_per_viewer)):
+                print("{},{},{:.1f},{:.2f}".format(viewers, cache, origin_rps, origin_rps * cost * 100))
+
+        print("cpu_us_per_request: {:.1f}".format(cost * 1e6))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-v", "--viewers", dest="viewers", default="1,10,100,1000", help="Comma-separated viewer counts")
+    parser.add_option("-f", "--fps", type="int", dest="fps", default=30, help="Frames per second of the stream")
+    parser.add_option("-s", "--size", type="int", dest="size", default=10000, help="Average fragment size")
+    parser.add_option("-n", "--iterations", type="int", dest="iterations", default=500, help="Requests to time")
+
+    (options, args) = parser.parse_args()
+
+    run([int(v) for v in options.viewers.split(',')], options.fps, options.size, options.iterations)
@@ -0,0 +1,107 @@
+"""
+Measures the bytes copied per served MJPEG frame.
+
+N clients stream the same camera through /cams/<cam>/mjpeg (through the Flask test client) at 100 FPS, while the
+feeder is simulated by storing a new frame every few ticks. Every part is built once per frame and variant, and shared
+by all the clients, so the bytes built per served frame drop as the clients increase. Before, every client
+concatenated its own part, which copied the whole part for every served frame.
+
+It runs against the redis server at REDIS_URL (the benchmark stores a synthetic frame for the 'mpbench' camera).
+
+Example:
+    python -m benchmark.multipart_copies -c 1,10,100 -n 50
+"""
+
+import io
+from optparse import OptionParser
+
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
+from PIL import Image
+
+from app import create_app, rdb
+from app.main import stats, multipart
+
+CAM = 'mpbench'
+
+# FPS at which the clients stream.
+TFPS = 100
+
+
+def synthetic_jpeg(size):
+    img = Image.new('RGB', (size, size), (120, 30, 200))
+    out = io.BytesIO()
+    img.save(out, 'jpeg')
+    return out.getvalue()
+
+
+def put_frame(prefix, frame):
+    cam_key = prefix + ":cams:" + CAM
+    pipe = rdb.pipeline()
+    pipe.setex(cam_key + ":lastframe", 60, frame)
+    pipe.incr(cam_key + ":frameseq")
+    pipe.execute()
+
+
+def measure(app, clients, frames, update_every, frame, query):
+    prefix = app.config['REDIS_PREFIX']
+    stats.reset()
+    multipart.reset()
+    served_bytes = [0]
+
+    def stream_client():
+        # Every client runs in its own greenlet, as in the server.
+        response = app.test_client().get('/cams/{}/mjpeg?tfps={}{}'.format(CAM, TFPS, query), buffered=False)
+        stream = response.response
+        for i in range(frames):
+            part = next(stream)
+            served_bytes[0] += len(part)
+        response.close()
+
+    def feeder():
+        while True:
+            with app.app_context():
+                put_frame(prefix, frame)
+            gevent.sleep(update_every / TFPS)
+
+    feeder_greenlet = gevent.spawn(feeder)
+    gevent.joinall([gevent.spawn(stream_client) for _ in range(clients)])
+    feeder_greenlet.kill()
+    served_bytes = served_bytes[0]
+
+    served = stats.COUNTERS.get('mjpeg_parts_served', 0)
+    built = stats.COUNTERS.get('mjpeg_part_bytes_built', 0)
+    print("{},{},{},{:.0f},{:.0f},{}".format(query or 'original', clients, served, built / served,
+                                             served_bytes / served, stats.COUNTERS.get('mjpeg_transforms', 0)))
+
+
+def run(client_counts, frames, update_every, size):
+    app = create_app('testing')
+    with app.app_context():
+        prefix = app.config['REDIS_PREFIX']
+        frame = synthetic_jpeg(size)
+
+        # bytes_copied_per_frame: bytes built (copied into parts) per served frame. Per-client concatenation would
+        # copy part_bytes_per_frame instead.
+        print("variant,clients,frames_served,bytes_copied_per_frame,part_bytes_per_frame,transforms")
+        for clients in client_counts:
+            measure(app, clients, frames, update_every, frame, '')
+            measure(app, clients, frames, update_every, frame, '&rotate=90')
+
+        rdb.delete(prefix + ":cams:" + CAM + ":lastframe", prefix + ":cams:" + CAM + ":frameseq")
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c", "--clients", dest="clients", default="1,10,100",
+                      help="Comma-separated numbers of concurrent clients")
+    parser.add_option("-n", "--frames", type="int", dest="frames", default=50, help="Frames to serve to each client")
+    parser.add_option("-u", "--update-every", type="int", dest="update_every", default=3,
+                      help="Ticks per new frame from the feeder")
+    parser.add_option("-s", "--size", type="int", dest="size", default=640, help="Synthetic frame side, in pixels")
+
+    (options, args) = parser.parse_args()
+
+    run([int(c) for c in options.clients.split(',')], options.frames, options.update_every, options.size)
@@ -0,0 +1,111 @@
+"""
+Counts the redis round trips and the bytes transferred from redis per served frame.
+
+It runs against the redis server at REDIS_URL (the benchmark stores a synthetic frame for the 'rtbench' camera) and
+serves frames through the Flask test client, both as single images (/cams/<cam>) and as a MJPEG stream
+(/cams/<cam>/mjpeg). The feeder is simulated by storing a new frame every --update-every served frames, so that the
+"unchanged frame" path is also exercised. Frames served from the in-process frame cache take no round trip.
+
+Example:
+    python -m benchmark.round_trips -n 200 -u 3
+"""
+
+from optparse import OptionParser
+
+from app import create_app, rdb
+from app.main import stats
+
+CAM = 'rtbench'
+
+
+class CommandCounter(object):
+    """
+    Wraps the execute_command method of the redis client, to count round trips and reply bytes.
+    """
+
+    def __init__(self, client):
+        self.round_trips = 0
+        self.reply_bytes = 0
+        self._execute_command = client.execute_command
+        client.execute_command = self.execute_command
+
+    def execute_command(self, *args, **kwargs):
+        self.round_trips += 1
+        reply = self._execute_command(*args, **kwargs)
+        self.reply_bytes += self._size(reply)
+        return reply
+
+    def _size(self, reply):
+        if isinstance(reply, bytes):
+            return len(reply)
+        if isinstance(reply, (list, tuple)):
+            return sum(self._size(r) for r in reply)
+        return 0
+
+    def reset(self):
+        self.round_trips = 0
+        self.reply_bytes = 0
+
+
+def put_frame(prefix, frame):
+    """
+    Stores a new frame the way the feeder does.
+    """
+    cam_key = prefix + ":cams:" + CAM
+    pipe = rdb.pipeline()
+    pipe.setex(cam_key + ":lastframe", 60, frame)
+    pipe.incr(cam_key + ":frameseq")
+    pipe.execute()
+
+
+def run(frames, frame_size, update_every):
+    app = create_app('testing')
+    with app.app_context():
+        prefix = app.config['REDIS_PREFIX']
+        frame = b'\xff' * frame_size
+        put_frame(prefix, frame)
+
+        client = app.test_client()
+        counter = CommandCounter(rdb._redis_client)
+
+        print("endpoint,frames,round_trips_per_frame,redis_bytes_per_frame")
+
+        # Single images.
+        counter.reset()
+        for i in range(frames):
+            response = client.get('/cams/' + CAM)
+            assert response.status_code == 200
+        print("/cams/<cam>,{},{:.2f},{:.0f}".format(frames, counter.round_trips / frames, counter.reply_bytes / frames))
+
+        # MJPEG stream. The feeder updates are not counted.
+        response = client.get('/cams/{}/mjpeg?tfps=1000'.format(CAM), buffered=False)
+        stream = response.response
+        round_trips = 0
+        reply_bytes = 0
+        for i in range(frames):
+            if i % update_every == 0:
+                put_frame(prefix, frame)
+            counter.reset()
+            next(stream)
+            round_trips += counter.round_trips
+            reply_bytes += counter.reply_bytes
+        response.close()
+        print("/cams/<cam>/mjpeg,{},{:.2f},{:.0f}".format(frames, round_trips / frames, reply_bytes / frames))
+
+        gauges = stats.snapshot()['gauges']
+        print("frame_cache_hit_ratio: {:.2f}".format(gauges.get('frame_cache_hit_ratio', 0)))
+        print("frame_cache_bytes: {}".format(gauges.get('frame_cache_bytes', 0)))
+
+        rdb.delete(prefix + ":cams:" + CAM + ":lastframe", prefix + ":cams:" + CAM + ":frameseq")
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--frames", type="int", dest="frames", default=200, help="Frames to serve")
+    parser.add_option("-s", "--size", type="int", dest="size", default=30000, help="Synthetic frame size")
+    parser.add_option("-u", "--update-every", type="int", dest="update_every", default=3,
+                      help="Served frames per new frame from the feeder")
+
+    (options, args) = parser.parse_args()
+
+    run(options.frames, options.size, options.update_every)
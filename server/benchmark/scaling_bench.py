@@ -0,0 +1,240 @@
+"""
+Measures how the streaming throughput scales with the number of worker processes.
+
+It runs the server the way gunicorn does with WORKERS=N (see start_server.sh): a listening socket bound once, in the
+parent, and N processes that inherit it and serve the app through a gevent WSGI server (with WebSocket support), each
+accepting connections from that shared socket. A simulated feeder writes JPEG frames and publishes H.264 NAL units for every camera, and client processes open
+MJPEG HTTP streams and H.264 WebSocket streams.
+
+For every number of workers, it reports:
+ - The aggregate MJPEG frames/s and H.264 NAL units/s received by the viewers.
+ - The redis frame fetches/s (EVALSHA calls), which the frame cache bounds by cameras x workers x FPS.
+ - The redis pubsub subscriptions to the H.264 channels, which the per-camera hub bounds by cameras x workers.
+ - The CPU load of the workers.
+
+Throughput can only scale up to the number of cores, which are shared with the feeder and the clients. The number of
+cores is reported along with the results.
+
+Example:
+    python -m benchmark.scaling_bench -w 1,2,4 -c 4 -v 50 -t 20 -f ../feeder/tests/data/img.jpg
+"""
+
+import multiprocessing
+import os
+import socket
+import time
+from optparse import OptionParser
+
+import redis
+
+REDIS_PREFIX = 'wilsa'
+PORT = 8591
+
+# IDR NAL unit (start code + header), so that every unit is a keyframe that viewers can start at.
+IDR_NAL = b'\x00\x00\x00\x01\x65'
+
+
+def cam_names(cams):
+    return ['scalebench{}'.format(n) for n in range(cams)]
+
+
+def run_worker(listener, redis_url):
+    """
+    Worker process: serves the app on the shared listening socket.
+    """
+    os.environ['REDIS_URL'] = redis_url
+    os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+
+    from gevent.pywsgi import WSGIServer
+    from geventwebsocket.handler import WebSocketHandler
+    from app import create_app
+
+    app = create_app('benchmark')
+
+    listener.setblocking(False)
+
+    WSGIServer(listener, app, handler_class=WebSocketHandler, log=None).serve_forever()
+
+
+def run_feeder(redis_url, cams, fps, frame, nal_size, stop_event):
+    """
+    Feeder process: stores a frame and publishes an H.264 NAL unit for every camera, fps times per second.
+    """
+    rdb = redis.StrictRedis.from_url(redis_url)
+    nal = IDR_NAL + b'\x00' * nal_size
+    while not stop_event.is_set():
+        start = time.time()
+        pipe = rdb.pipeline()
+        pipe.setex(REDIS_PREFIX + ':feeder:alive', 10, 1)
+        for cam in cam_names(cams):
+            cam_key = '{}:cams:{}'.format(REDIS_PREFIX, cam)
+            pipe.setex(cam_key + ':lastframe', 10, frame)
+            pipe.incr(cam_key + ':frameseq')
+            pipe.publish(cam + '/h264', nal)
+        pipe.execute()
+        time.sleep(max(0, 1.0 / fps - (time.time() - start)))
+
+
+def run_clients(port, cams, mjpeg_viewers, h264_viewers, tfps, seconds, results):
+    """
+    Client process: opens the MJPEG and H.264 streams (spread over the cameras) and counts what they receive.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    import websocket
+
+    counts = {'mjpeg': 0, 'h264': 0, 'errors': 0}
+    deadline = time.time() + seconds
+    names = cam_names(cams)
+
+    def mjpeg_viewer(cam):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall('GET /cams/{}/mjpeg?tfps={} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(cam, tfps).encode())
+            tail = b''
+            while time.time() < deadline:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                # The boundary may be split across two reads.
+                chunk = tail + data
+                counts['mjpeg'] += chunk.count(b'--frame\r\n')
+                tail = chunk[-8:]
+            sock.close()
+        except Exception as ex:
+            print("[scaling_bench]: MJPEG viewer failed: {}".format(ex))
+            counts['errors'] += 1
+
+    def h264_viewer(cam):
+        try:
+            ws = websocket.create_connection('ws://127.0.0.1:{}/ws/cams/{}/h264'.format(port, cam))
+            ws.settimeout(1)
+            while time.time() < deadline:
+                try:
+                    ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                counts['h264'] += 1
+            ws.close()
+        except Exception as ex:
+            print("[scaling_bench]: H.264 viewer failed: {}".format(ex))
+            counts['errors'] += 1
+
+    greenlets = [gevent.spawn(mjpeg_viewer, names[n % cams]) for n in range(mjpeg_viewers)]
+    greenlets += [gevent.spawn(h264_viewer, names[n % cams]) for n in range(h264_viewers)]
+    gevent.joinall(greenlets, timeout=seconds + 5)
+    # Sent through a plain pipe: a multiprocessing queue relies on a thread, which gevent turns into a greenlet.
+    results.send(counts)
+    results.close()
+
+
+def process_cpu(pid):
+    """
+    CPU seconds used so far by a process (Linux only).
+    """
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def wait_for_worker(port, timeout=20):
+    """
+    Waits until a worker serves requests. The listening socket is bound by the parent, so a connection is queued as soon
+    as it is made: a worker is only known to be up once it answers.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.settimeout(timeout)
+    try:
+        sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        if not sock.recv(1):
+            raise Exception("The workers did not start")
+    finally:
+        sock.close()
+
+
+def run(workers_list, cams, viewers, h264_viewers, tfps, fps, seconds, frame, client_processes, redis_url):
+    ctx = multiprocessing.get_context('spawn')
+    rdb = redis.StrictRedis.from_url(redis_url)
+    channels = [cam + '/h264' for cam in cam_names(cams)]
+
+    # Bound once and inherited by the workers, as the gunicorn master does.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', PORT))
+    listener.listen(1024)
+
+    print("cores: {}".format(os.cpu_count()))
+    print("workers,mjpeg_frames_s,h264_nals_s,redis_fetches_s,redis_h264_subscriptions,worker_cpu_percent,errors")
+    for workers in workers_list:
+        stop_event = ctx.Event()
+        feeder = ctx.Process(target=run_feeder, args=(redis_url, cams, fps, frame, 4096, stop_event))
+        feeder.start()
+        procs = [ctx.Process(target=run_worker, args=(listener, redis_url)) for _ in range(workers)]
+        for p in procs:
+            p.start()
+        wait_for_worker(PORT)
+        # Give every worker the time to start accepting, so that they all get connections.
+        time.sleep(2)
+
+        pipes = [ctx.Pipe(duplex=False) for _ in range(client_processes)]
+        clients = [ctx.Process(target=run_clients, args=(PORT, cams, viewers // client_processes,
+                                                         h264_viewers // client_processes, tfps, seconds, sender))
+                   for _, sender in pipes]
+        # The streams ramp up during the first seconds, which are not measured.
+        warmup = min(2, seconds / 4)
+        for c in clients:
+            c.start()
+        time.sleep(warmup)
+
+        start = time.time()
+        cpu_start = sum(process_cpu(p.pid) for p in procs)
+        fetches_start = rdb.info('commandstats').get('cmdstat_evalsha', {}).get('calls', 0)
+        subscriptions = sum(count for _, count in rdb.pubsub_numsub(*channels))
+
+        counts = {'mjpeg': 0, 'h264': 0, 'errors': 0}
+        for receiver, _ in pipes:
+            for key, value in receiver.recv().items():
+                counts[key] += value
+        elapsed = time.time() - start
+        cpu = sum(process_cpu(p.pid) for p in procs) - cpu_start
+        fetches = rdb.info('commandstats').get('cmdstat_evalsha', {}).get('calls', 0) - fetches_start
+        # The clients counted during the warmup as well.
+        measured = elapsed + warmup
+
+        print("{},{:.1f},{:.1f},{:.1f},{},{:.1f},{}".format(
+            workers, counts['mjpeg'] / measured, counts['h264'] / measured, fetches / elapsed, subscriptions,
+            cpu / elapsed * 100, counts['errors']))
+
+        for c in clients:
+            c.join()
+        for p in procs:
+            p.terminate()
+            p.join()
+        stop_event.set()
+        feeder.join()
+
+    listener.close()
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-w", "--workers", dest="workers", default="1,2,4",
+                      help="Comma-separated numbers of worker processes to test.")
+    parser.add_option("-c", "--cams", dest="cams", default=4, type="int", help="Number of cameras.")
+    parser.add_option("-v", "--viewers", dest="viewers", default=50, type="int", help="MJPEG viewers.")
+    parser.add_option("-x", "--h264-viewers", dest="h264_viewers", default=20, type="int", help="H.264 viewers.")
+    parser.add_option("-r", "--tfps", dest="tfps", default=10, type="int", help="FPS requested by the MJPEG viewers.")
+    parser.add_option("-p", "--fps", dest="fps", default=10, type="int", help="FPS of the simulated feeder.")
+    parser.add_option("-t", "--time", dest="seconds", default=20, type="float", help="Seconds per run.")
+    parser.add_option("-f", "--frame", dest="frame", default="../feeder/tests/data/img.jpg", help="JPEG frame.")
+    parser.add_option("-n", "--client-processes", dest="client_processes", default=2, type="int",
+                      help="Processes that run the viewers.")
+    parser.add_option("-u", "--redis-url", dest="redis_url", default="redis://localhost:6379/0")
+    (options, args) = parser.parse_args()
+
+    with open(options.frame, 'rb') as f:
+        frame = f.read()
+
+    run([int(w) for w in options.workers.split(',')], options.cams, options.viewers, options.h264_viewers,
+        options.tfps, options.fps, options.seconds, frame, options.client_processes, options.redis_url)
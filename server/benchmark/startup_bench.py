@@ -0,0 +1,159 @@
+"""
+Measures how long a server worker takes to start serving frames.
+
+profile: imports the app and creates it in a fresh interpreter with -X importtime, and reports the median time of both
+phases over several runs, and the modules that take the longest to import (those imported by the app package and by
+create_app) in the last run.
+
+ttff: starts gunicorn with gunicorn.conf.py and one worker, with and without preloading the app, and measures the time
+to the first served frame (/cams/<cam_id>): after starting gunicorn, and after the worker is killed and replaced by the
+master, as on a crash or a max-requests recycle.
+
+It runs against the redis server at REDIS_URL, where it stores the frame for the 'startbench' camera.
+
+Example:
+    python -m benchmark.startup_bench -m profile,ttff -p 9 -r 5 -f ../feeder/tests/data/img.jpg
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from optparse import OptionParser
+
+import redis
+
+REDIS_PREFIX = 'wilsa'
+CAM = 'startbench'
+PORT = 8593
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PIDFILE = os.path.join(tempfile.gettempdir(), 'startup_bench.pid')
+
+PROFILE_SCRIPT = """
+import sys, time
+print('phase import_app', file=sys.stderr)
+start = time.time()
+from app import create_app
+imported = time.time()
+print('phase create_app', file=sys.stderr)
+create_app('benchmark')
+print('timing {} {}'.format(imported - start, time.time() - imported), file=sys.stderr)
+"""
+
+
+def profile(redis_url, runs, top):
+    env = dict(os.environ, REDIS_URL=redis_url)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROFILE_SCRIPT], cwd=SERVER_DIR, env=env,
+                                stderr=subprocess.PIPE, check=True).stderr.decode()
+        timings.append([float(t) for t in output.rsplit('timing ', 1)[1].split()])
+
+    modules = []
+    phase = 'interpreter'
+    for line in output.splitlines():
+        if line.startswith('phase '):
+            phase = line[len('phase '):]
+        elif line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            # Direct imports of the script, and of the app package.
+            level = (len(name) - len(name.lstrip())) // 2
+            if level <= 1 and cumulative.strip().isdigit():
+                modules.append((int(cumulative) / 1000, phase, name.strip()))
+
+    import_times, create_times = (sorted(times) for times in zip(*timings))
+    print("import_app_ms_median,create_app_ms_median")
+    print("{:.1f},{:.1f}".format(import_times[runs // 2] * 1000, create_times[runs // 2] * 1000))
+    print("phase,module,cumulative_ms")
+    for cumulative, phase, name in sorted(modules, reverse=True)[:top]:
+        print("{},{},{:.1f}".format(phase, name, cumulative))
+
+
+def get_frame(timeout):
+    """
+    Requests the frame until it is served.
+    :return: Time at which it was served.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/cams/{}'.format(PORT, CAM), timeout=timeout) as response:
+                if response.status == 200 and response.headers['Content-Type'] == 'image/jpeg':
+                    response.read()
+                    return time.time()
+        except OSError:
+            time.sleep(0.005)
+    raise Exception("No frame served within {} seconds".format(timeout))
+
+
+def get_workers(pid):
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def ttff(redis_url, restarts):
+    print("preload,first_frame_after_start_ms,first_frame_after_worker_restart_ms_median,"
+          "first_frame_after_worker_restart_ms_max")
+    for preload in ('0', '1'):
+        env = dict(os.environ, REDIS_URL=redis_url, BIND='127.0.0.1:{}'.format(PORT), WORKERS='1', PRELOAD=preload)
+        start = time.time()
+        master = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--pid', PIDFILE,
+                                   "app:create_app('benchmark')"], cwd=SERVER_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            first = get_frame(30) - start
+
+            restart_times = []
+            for _ in range(restarts):
+                workers = get_workers(master.pid)
+                # Requests wait in the backlog of the listening socket until the new worker accepts them.
+                killed = time.time()
+                for worker in workers:
+                    os.kill(worker, signal.SIGKILL)
+                restart_times.append(get_frame(30) - killed)
+                # The next worker is not killed while it is still starting.
+                time.sleep(0.5)
+            restart_times.sort()
+
+            print("{},{:.0f},{:.0f},{:.0f}".format(preload == '1', first * 1000,
+                                                  restart_times[len(restart_times) // 2] * 1000,
+                                                  restart_times[-1] * 1000))
+        finally:
+            master.send_signal(signal.SIGTERM)
+            master.wait()
+
+
+def run(modes, runs, restarts, top, frame, redis_url):
+    rdb = redis.StrictRedis.from_url(redis_url)
+    cam_key = '{}:cams:{}'.format(REDIS_PREFIX, CAM)
+    rdb.set(cam_key + ':lastframe', frame, ex=600)
+    rdb.incr(cam_key + ':frameseq')
+    rdb.set(REDIS_PREFIX + ':feeder:alive', 1, ex=600)
+
+    try:
+        if 'profile' in modes:
+            profile(redis_url, runs, top)
+        if 'ttff' in modes:
+            ttff(redis_url, restarts)
+    finally:
+        rdb.delete(cam_key + ':lastframe', cam_key + ':frameseq')
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-m", "--modes", dest="modes", default="profile,ttff", help="Comma-separated: profile, ttff.")
+    parser.add_option("-p", "--runs", dest="runs", default=9, type="int", help="Profiled runs.")
+    parser.add_option("-r", "--restarts", dest="restarts", default=5, type="int", help="Worker restarts measured.")
+    parser.add_option("-n", "--top", dest="top", default=15, type="int", help="Slowest imports reported.")
+    parser.add_option("-f", "--frame", dest="frame", default="../feeder/tests/data/img.jpg", help="JPEG frame.")
+    parser.add_option("-u", "--redis-url", dest="redis_url", default="redis://localhost:6379/0")
+    (options, args) = parser.parse_args()
+
+    with open(options.frame, 'rb') as f:
+        frame = f.read()
+
+    run(options.modes.split(','), options.runs, options.restarts, options.top, frame, options.redis_url)
@@ -0,0 +1,131 @@
+"""
+Compares per-client pacing loops against the shared per-FPS ticker.
+
+N clients stream the same camera at the same FPS for a number of seconds, either each pacing itself with its own
+gevent.sleep (as generator_mjpeg and the Socket.IO MJPEG broadcaster used to), or woken together by the shared ticker
+of their FPS tier. For each mode it reports the timer wake-ups, the frame lookups, the number of active hub watchers,
+the wake-up jitter (how late a client woke up relative to its schedule) and the CPU time.
+
+It runs against the redis server at REDIS_URL, where it stores a synthetic frame for the 'tickbench' camera.
+
+Example:
+    python -m benchmark.ticker_bench -c 1,10,100,1000 -f 15 -d 5
+"""
+
+import time
+from optparse import OptionParser
+
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
+from app import create_app, rdb
+from app.main import stats, ticker as ticker_module
+from app.main.redis_funcs import fetch_frame
+from app.main.ticker import get_ticker
+
+CAM = 'tickbench'
+
+
+class Measurements(object):
+
+    def __init__(self):
+        self.wakeups = 0
+        self.lookups = 0
+        self.jitters = []
+        self.max_watchers = 0
+
+    def wakeup(self, scheduled):
+        self.wakeups += 1
+        self.jitters.append(max(time.time() - scheduled, 0))
+
+    def sample_watchers(self, deadline):
+        """
+        Greenlet that samples the active hub watchers (mostly the pending timers) while the clients run.
+        """
+        while time.time() < deadline:
+            gevent.sleep(0.013)
+            self.max_watchers = max(self.max_watchers, gevent.get_hub().loop.activecnt - 1)
+
+
+def sleep_client(m, fps, deadline):
+    period = 1.0 / fps
+    last_seq = None
+    next_time = time.time()
+    while time.time() < deadline:
+        next_time += period
+        gevent.sleep(max(next_time - time.time(), 0))
+        m.wakeup(next_time)
+
+        fetched = fetch_frame(CAM, since_seq=last_seq, fps=fps)
+        m.lookups += 1
+        if fetched.frame is not None:
+            last_seq = fetched.seq
+
+
+def ticker_client(m, fps, deadline):
+    ticker = get_ticker(fps)
+    ticker.subscribe()
+    try:
+        while time.time() < deadline:
+            tick = ticker.wait()
+            m.wakeup(tick * ticker.period)
+            ticker.get_frame(CAM)
+    finally:
+        ticker.unsubscribe()
+
+
+def measure(app, client, clients, fps, duration):
+    m = Measurements()
+    stats.reset()
+    ticker_module.TICKERS.clear()
+
+    def run_client():
+        with app.app_context():
+            client(m, fps, deadline)
+
+    deadline = time.time() + duration
+    cpu_start = time.process_time()
+    sampler = gevent.spawn(m.sample_watchers, deadline)
+    gevent.joinall([gevent.spawn(run_client) for _ in range(clients)] + [sampler])
+    cpu = time.process_time() - cpu_start
+
+    if client is ticker_client:
+        # Wake-ups of the ticker greenlets themselves, which fire the timers.
+        m.wakeups = stats.COUNTERS.get('ticker_ticks', 0)
+        m.lookups = stats.COUNTERS.get('ticker_lookups', 0)
+
+    jitters = sorted(m.jitters) or [0]
+    p99 = jitters[min(int(len(jitters) * 0.99), len(jitters) - 1)]
+    print("{},{},{},{},{},{:.2f},{:.2f},{:.3f}".format(
+        'ticker' if client is ticker_client else 'sleep', clients, m.wakeups, m.lookups, m.max_watchers,
+        sum(jitters) / len(jitters) * 1000, p99 * 1000, cpu))
+
+
+def run(client_counts, fps, duration, frame_size):
+    app = create_app('testing')
+    with app.app_context():
+        prefix = app.config['REDIS_PREFIX']
+        cam_key = prefix + ":cams:" + CAM
+        rdb.setex(cam_key + ":lastframe", 600, b'\xff' * frame_size)
+        rdb.incr(cam_key + ":frameseq")
+
+        print("mode,clients,timer_wakeups,lookups,max_hub_watchers,jitter_mean_ms,jitter_p99_ms,cpu_s")
+        for clients in client_counts:
+            measure(app, sleep_client, clients, fps, duration)
+            measure(app, ticker_client, clients, fps, duration)
+
+        rdb.delete(cam_key + ":lastframe", cam_key + ":frameseq")
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c", "--clients", dest="clients", default="1,10,100,1000",
+                      help="Comma-separated numbers of concurrent clients")
+    parser.add_option("-f", "--fps", type="int", dest="fps", default=15, help="Target FPS of the clients")
+    parser.add_option("-d", "--duration", type="float", dest="duration", default=5, help="Seconds per measurement")
+    parser.add_option("-s", "--size", type="int", dest="size", default=30000, help="Synthetic frame size")
+
+    (options, args) = parser.parse_args()
+
+    run([int(c) for c in options.clients.split(',')], options.fps, options.duration, options.size)
@@ -0,0 +1,103 @@
+"""
+Compares the per-frame cost of the Socket.IO streaming path against the plain WebSocket endpoints.
+
+For every frame (or NAL unit) it measures:
+ - The bytes that go on the wire, including the WebSocket frame headers.
+ - The CPU time that the server spends encoding it for one viewer.
+
+The Socket.IO path sends every binary event as two WebSocket messages: the event packet with a placeholder, and
+the binary attachment. The plain WebSocket path sends a single binary message with a 5-byte header.
+
+Example:
+    python -m benchmark.transport_overhead -f ../feeder/tests/data/img.jpg -n 20000
+"""
+
+import struct
+import time
+from optparse import OptionParser
+
+import engineio.packet
+import socketio.packet
+
+# Same header as app.main.websockets. Not imported to avoid loading (and monkey-patching) the whole app.
+HEADER = struct.Struct('!BI')
+
+
+def ws_frame_header_size(payload_size):
+    """
+    Size of the header of a server-to-client (unmasked) WebSocket frame.
+    :param payload_size:
+    :return:
+    """
+    if payload_size < 126:
+        return 2
+    if payload_size < 65536:
+        return 4
+    return 10
+
+
+def encode_socketio(event, namespace, payload):
+    """
+    Encodes a binary event the way the Socket.IO server does, down to the engine.io packets.
+    :return: List with the messages that are sent through the WebSocket.
+    """
+    pkt = socketio.packet.Packet(socketio.packet.EVENT, data=[event, payload], namespace=namespace)
+    messages = []
+    for encoded in pkt.encode():
+        eio_pkt = engineio.packet.Packet(engineio.packet.MESSAGE, data=encoded)
+        messages.append(eio_pkt.encode())
+    return messages
+
+
+def encode_plain(kind, seq, payload):
+    """
+    Encodes a payload the way the plain WebSocket endpoints do.
+    :return: List with the messages that are sent through the WebSocket.
+    """
+    return [HEADER.pack(kind, seq) + payload]
+
+
+def wire_bytes(messages):
+    return sum(len(m) + ws_frame_header_size(len(m)) for m in messages)
+
+
+def measure(name, encoder, iterations):
+    start = time.process_time()
+    for i in range(iterations):
+        messages = encoder(i)
+    elapsed = time.process_time() - start
+    return name, wire_bytes(messages), elapsed / iterations * 1e6
+
+
+def run(payload, event, namespace, kind, iterations):
+    results = [
+        measure('socketio', lambda i: encode_socketio(event, namespace, payload), iterations),
+        measure('websocket', lambda i: encode_plain(kind, i, payload), iterations)
+    ]
+
+    print("payload_bytes,transport,wire_bytes,overhead_bytes,cpu_us_per_viewer")
+    for name, wire, cpu_us in results:
+        print("{},{},{},{},{:.2f}".format(len(payload), name, wire, wire - len(payload), cpu_us))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-f", "--file", dest="file", default=None, help="JPEG frame or H.264 NAL unit to send")
+    parser.add_option("-s", "--size", type="int", dest="size", default=30000, help="Synthetic payload size, if no file is given")
+    parser.add_option("-t", "--type", dest="type", default="mjpeg", help="mjpeg or h264")
+    parser.add_option("-n", "--iterations", type="int", dest="iterations", default=10000, help="Encodes to time")
+
+    (options, args) = parser.parse_args()
+
+    if options.file is not None:
+        payload = open(options.file, 'rb').read()
+    else:
+        payload = b'\xff' * options.size
+
+    if options.type == 'mjpeg':
+        run(payload, 'frame', '/mjpeg', 1, options.iterations)
+    elif options.type == 'h264':
+        run(payload, 'stream', '/h264', 2, options.iterations)
+    else:
+        parser.print_usage()
+        exit(1)
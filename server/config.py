@@ -9,6 +9,113 @@ class Config:
     REDIS_PREFIX = 'wilsa'
     SOCKETIO_PATH = ''
 
+    # Logs every engine.io packet. Useful for debugging but expensive when streaming.
+    SOCKETIO_ENGINEIO_LOGGER = False
+
+    # Several worker processes (see start_server.sh). A Socket.IO connection is served by the worker that accepted it,
+    # so clients must either use the websocket transport only (which needs no sticky sessions, and which
+    # SOCKETIO_WEBSOCKET_ONLY tells the pages to use), or go through a sticky-session front. SOCKETIO_MESSAGE_QUEUE
+    # (a redis URL) lets the workers share rooms and emit to each other's clients. The video data itself is always
+    # emitted by the worker of the client, and never goes through the queue.
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    SOCKETIO_WEBSOCKET_ONLY = bool(os.environ.get('SOCKETIO_WEBSOCKET_ONLY'))
+
+    # Serve the GET requests of the snapshot and MJPEG routes (/cams/<cam_id> and /cams/<cam_id>/mjpeg) through a lean
+    # WSGI handler rather than through the Flask dispatch (see app/main/fastpath.py). The URLs are the same.
+    FAST_PATH = True
+
+    # Initialize the Flask-Bootstrap, Flask-Mail and Flask-Moment extensions. None of the pages uses them, and they are
+    # only imported when enabled, as they slow down the startup of every worker.
+    PAGE_EXTENSIONS = False
+
+    # Messages queued per viewer by the per-camera pubsub hub. Viewers that lag behind further lose them.
+    HUB_QUEUE_SIZE = 256
+
+    # Maximum number of bytes sent to an H.264 client but not acked yet. Beyond that, the client is lagging and
+    # it is resumed at the next keyframe.
+    H264_CLIENT_QUEUE_BUDGET = 512 * 1024
+
+    # Low-latency HLS delivery. Segments start at keyframes, so they may be longer than HLS_SEGMENT_DURATION
+    # (in seconds) if the keyframe interval is.
+    HLS_SEGMENT_DURATION = 2.0
+    HLS_PART_DURATION = 0.5
+    HLS_SEGMENTS_KEPT = 6
+    # The segment store of a camera is dropped when nobody requests it for this long (seconds).
+    HLS_IDLE_TIMEOUT = 30
+
+    # In-process cache of the last frame of every camera (bytes, 0 to disable). It is kept coherent through redis
+    # client-side caching, or, if not available, entries expire after FRAME_CACHE_TTL seconds.
+    FRAME_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    FRAME_CACHE_TTL = 0.05
+
+    # Seconds between the flushes of the camera activity (and viewer counts) of every server process.
+    ACTIVITY_FLUSH_INTERVAL = 5
+
+    # Number of (camera, variant) multipart parts kept pre-serialized for the MJPEG HTTP streams.
+    MJPEG_PART_CACHE_ENTRIES = 256
+
+    # Lower the FPS of the native MJPEG streams (down to MJPEG_MIN_FPS) for clients that cannot keep up. Off by default,
+    # so that existing clients keep getting the FPS that they ask for.
+    MJPEG_ADAPTIVE_FPS = False
+    MJPEG_MIN_FPS = 1
+
+    # Serve smaller or more compressed frames to the MJPEG clients whose throughput cannot sustain their FPS (default of
+    # the quality parameter: auto if set, full otherwise, so that existing clients keep getting the original frames;
+    # clients can opt in with quality=auto). The rungs of the ladder are (width, JPEG quality), from the original frame
+    # down. A width of 0 keeps the original size, and a quality of 0 the original JPEG. Every rung is encoded once per
+    # frame, whatever its number of clients.
+    MJPEG_ADAPTIVE_QUALITY = False
+    MJPEG_QUALITY_LADDER = [(0, 0), (0, 60), (640, 60), (320, 50), (160, 40)]
+
+    # Frames are only pushed to a client when they change. Seconds after which an unchanged frame is sent again anyway
+    # (0 to never resend), for clients that need frames to keep coming. Clients can override it. Note that closed
+    # connections are only noticed when something is sent to them.
+    KEEPALIVE_RESEND_INTERVAL = 5
+
+    # Multi-camera mosaics: default and maximum tile width, maximum number of cameras, JPEG quality, and number of
+    # rendered mosaics kept per process.
+    MOSAIC_TILE_WIDTH = 320
+    MOSAIC_MAX_TILE_WIDTH = 1280
+    MOSAIC_MAX_CAMS = 16
+    MOSAIC_QUALITY = 70
+    MOSAIC_CACHE_ENTRIES = 32
+
+    # Maximum number of cameras in a /cams/batch request, and number of thumbnails kept per process.
+    BATCH_MAX_CAMS = 100
+    BATCH_THUMBNAIL_CACHE_ENTRIES = 256
+
+    # Socket.IO broadcasters that did not send anything for this long (seconds, 0 to never) are stopped. The reaper,
+    # which also stops the broadcasters of clients that are gone, runs every BROADCASTER_REAP_INTERVAL seconds.
+    # Broadcasters that do not exit within BROADCASTER_STOP_GRACE seconds of being stopped are killed.
+    BROADCASTER_IDLE_TIMEOUT = 600
+    BROADCASTER_REAP_INTERVAL = 10
+    BROADCASTER_STOP_GRACE = 5
+
+    # Admission control of the new streams, per worker process (see app/main/admission.py). 0 disables a limit.
+    # Concurrent streams, concurrent streams of a single camera, egress (bytes per second) and hub lag (seconds).
+    ADMISSION_MAX_STREAMS = 2000
+    ADMISSION_MAX_CAM_STREAMS = 500
+    ADMISSION_MAX_EGRESS = 0
+    ADMISSION_MAX_HUB_LAG = 0.5
+    # Above this fraction of a limit, new streams are served at ADMISSION_DEGRADED_FPS, and where supported as
+    # ADMISSION_DEGRADED_WIDTH thumbnails (0 to keep the size). At the limit they are refused, and told to retry after
+    # ADMISSION_RETRY_AFTER to twice as many seconds.
+    ADMISSION_DEGRADE_RATIO = 0.8
+    ADMISSION_DEGRADED_FPS = 2
+    ADMISSION_DEGRADED_WIDTH = 320
+    ADMISSION_RETRY_AFTER = 10
+
+    # Weighted fair sharing of the uplink of a worker among the streams (see app/main/egress.py). EGRESS_RATE is the
+    # bandwidth to share, in bytes per second (0 to send everything as soon as possible). The share of a (camera,
+    # client class) group is proportional to its camera weight times its class weight (1 if not listed). Frames that
+    # cannot be sent within EGRESS_MAX_WAIT seconds are dropped.
+    EGRESS_RATE = 0
+    EGRESS_BURST = 256 * 1024
+    EGRESS_QUANTUM = 16 * 1024
+    EGRESS_MAX_WAIT = 0.5
+    EGRESS_CAM_WEIGHTS = {}
+    EGRESS_CLASS_WEIGHTS = {'default': 1}
+
     @staticmethod
     def init_app(app):
         pass
@@ -19,6 +126,7 @@ class BenchmarkConfig(Config):
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    SOCKETIO_ENGINEIO_LOGGER = True
 
 
 class TestingConfig(Config):
@@ -0,0 +1,30 @@
+"""
+Gunicorn settings of the server (gunicorn -c gunicorn.conf.py wsgi_app:application, see start_server.sh).
+
+The app is preloaded: the master imports and creates it once, warms it up (see app.warm_up), and then forks the
+workers, which start serving right away instead of importing Flask, Socket.IO and the app themselves. A worker that
+dies or is recycled is replaced just as quickly. The drawback is that code changes need a full restart rather than a
+HUP, which only replaces the workers. PRELOAD=0 disables it.
+"""
+
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8500')
+
+# With more than one worker, see start_server.sh for the Socket.IO settings that they need. The master binds the
+# socket once and every worker accepts connections from it.
+workers = int(os.environ.get('WORKERS', 1))
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+
+pidfile = 'wilsa.server.pid'
+
+preload_app = os.environ.get('PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    """
+    Runs in the master once it is listening, before the workers are forked.
+    """
+    if server.cfg.preload_app:
+        from app import warm_up
+        warm_up(server.app.wsgi())
@@ -1,5 +1,15 @@
 #!/bin/bash
 
+# Number of worker processes (WORKERS=4 ./start_server.sh). With more than one, the workers accept connections from
+# the socket that the gunicorn master binds, the Socket.IO clients are told to use the websocket transport only, as it
+# does not need sticky sessions, and the workers share their Socket.IO rooms through redis. The rest of the gunicorn
+# settings, such as the preloading of the app (PRELOAD=0 to disable it), are in gunicorn.conf.py.
+export WORKERS=${WORKERS:-1}
+if [ "$WORKERS" -gt 1 ]; then
+    export SOCKETIO_WEBSOCKET_ONLY=1
+    export SOCKETIO_MESSAGE_QUEUE=${SOCKETIO_MESSAGE_QUEUE:-redis://localhost:6379/0}
+fi
+
 . /home/lrg/.virtualenvs/wilsa/bin/activate
 cd /home/lrg/labsland/wilsaproxy/server/src
-nohup gunicorn --bind 0.0.0.0:8500 -w 1 -k gevent --pid wilsa.server.pid wsgi_app:application > nohup.gunicorn.out &
+nohup gunicorn -c gunicorn.conf.py wsgi_app:application > nohup.gunicorn.out &
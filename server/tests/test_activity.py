@@ -0,0 +1,129 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from app.main import stats
+from app.main.activity import ActivityTracker, merge_demand
+from tests.base import BaseTestCase
+
+
+class TestActivityTracker(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+        patcher = patch('app.main.activity.rdb', self.rdb)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tracker = ActivityTracker('wilsa', 5)
+
+    def test_first_mark_is_immediate(self):
+        self.tracker.mark('wilsa:cams:cam1:active')
+        self.assertEqual(self.rdb.get('wilsa:cams:cam1:active'), b'1')
+
+    def test_marks_are_coalesced(self):
+        for i in range(100):
+            self.tracker.mark('wilsa:cams:cam1:active')
+            self.tracker.mark('wilsa:cams:cam2:active:mjpeg')
+        self.assertEqual(stats.COUNTERS['activity_writes'], 2)
+
+        self.rdb.delete('wilsa:cams:cam1:active', 'wilsa:cams:cam2:active:mjpeg')
+        self.tracker.flush()
+        self.assertEqual(self.rdb.get('wilsa:cams:cam1:active'), b'1')
+        self.assertEqual(self.rdb.get('wilsa:cams:cam2:active:mjpeg'), b'1')
+        self.assertEqual(stats.COUNTERS['activity_writes'], 4)
+
+        # Nothing was demanded since.
+        self.rdb.delete('wilsa:cams:cam1:active')
+        self.tracker.flush()
+        self.assertIsNone(self.rdb.get('wilsa:cams:cam1:active'))
+
+    def test_viewers(self):
+        self.tracker.add_viewer('wilsa:cams:cam1:active')
+        self.tracker.add_viewer('wilsa:cams:cam1:active:h264')
+        self.tracker.add_viewer('wilsa:cams:cam2:active')
+        self.assertEqual(self.tracker.get_viewers('cam1'), 2)
+
+        # Cameras with viewers are kept active, and their counts published.
+        self.rdb.delete('wilsa:cams:cam1:active:h264')
+        self.tracker.flush()
+        self.assertEqual(self.rdb.get('wilsa:cams:cam1:active:h264'), b'1')
+        viewers_keys = self.rdb.keys('wilsa:cams:cam1:viewers:*')
+        self.assertEqual(len(viewers_keys), 1)
+        self.assertEqual(self.rdb.get(viewers_keys[0]), b'2')
+        self.assertEqual(stats.GAUGES['viewers:cam1'], 2)
+
+        self.tracker.remove_viewer('wilsa:cams:cam1:active')
+        self.tracker.remove_viewer('wilsa:cams:cam1:active:h264')
+        self.tracker.flush()
+        self.assertEqual(self.rdb.keys('wilsa:cams:cam1:viewers:*'), [])
+        self.assertEqual(self.tracker.get_viewers('cam1'), 0)
+
+
+class TestDemand(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+        patcher = patch('app.main.activity.rdb', self.rdb)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tracker = ActivityTracker('wilsa', 5)
+
+    def _published(self, cam):
+        values = list(self.rdb.hgetall('wilsa:cams:{}:demand'.format(cam)).values())
+        self.assertEqual(len(values), 1)
+        fps, width, ts = values[0].split(b',')
+        return int(fps), int(width)
+
+    def test_merge_demand(self):
+        self.assertEqual(merge_demand(None, (5, 0)), (5, 0))
+        self.assertEqual(merge_demand((5, 320), (10, 640)), (10, 640))
+        self.assertEqual(merge_demand((5, 320), (0, 160)), (0, 320))
+
+    def test_highest_demand_is_published(self):
+        self.tracker.mark('wilsa:cams:cam1:active', 5, 160)
+        self.assertEqual(self._published('cam1'), (5, 160))
+
+        # Increases are written immediately, while lower demands are not written at all.
+        self.tracker.mark('wilsa:cams:cam1:active', 10, 320)
+        self.tracker.mark('wilsa:cams:cam1:active', 2, 160)
+        self.assertEqual(self._published('cam1'), (10, 320))
+        self.assertEqual(stats.COUNTERS['demand_writes'], 2)
+
+    def test_demand_decreases_on_flush(self):
+        self.tracker.mark('wilsa:cams:cam1:active', 30)
+        self.tracker.flush()
+        self.tracker.mark('wilsa:cams:cam1:active', 5)
+        self.tracker.flush()
+        self.assertEqual(self._published('cam1'), (5, 0))
+
+        # Once nobody demands the camera, the process withdraws its demand.
+        self.tracker.flush()
+        self.assertEqual(self.rdb.hgetall('wilsa:cams:cam1:demand'), {})
+
+    def test_fractional_fps(self):
+        # The feeder parses the published demand as integers, so fractional rates are rounded up.
+        self.tracker.mark('wilsa:cams:cam1:active', 7.5, 320)
+        self.assertEqual(self._published('cam1'), (8, 320))
+
+    def test_no_limit(self):
+        self.tracker.mark('wilsa:cams:cam1:active', 5)
+        self.tracker.mark('wilsa:cams:cam1:active', 0, 0)
+        self.assertEqual(self._published('cam1'), (0, 0))
+
+    def test_unknown_demand_is_not_published(self):
+        # New viewers and H.264 streams mark the camera without knowing the demand, which must not lift the limit.
+        self.tracker.add_viewer('wilsa:cams:cam1:active')
+        self.tracker.mark('wilsa:cams:cam1:active:h264')
+        self.assertEqual(self.rdb.hgetall('wilsa:cams:cam1:demand'), {})
+
+        self.tracker.mark('wilsa:cams:cam1:active', 5, 320)
+        self.tracker.add_viewer('wilsa:cams:cam1:active')
+        self.assertEqual(self._published('cam1'), (5, 320))
+        self.tracker.flush()
+        self.assertEqual(self._published('cam1'), (5, 320))
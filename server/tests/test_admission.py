@@ -0,0 +1,126 @@
+from __future__ import unicode_literals
+
+import json
+from unittest.mock import patch, Mock
+
+from werkzeug.test import EnvironBuilder
+
+from app.main import admission, stats
+from app.main.admission import AdmissionController
+from tests.base import BaseTestCase
+
+
+def controller(max_streams=10, max_cam_streams=0, max_egress=0, max_hub_lag=0):
+    return AdmissionController(max_streams, max_cam_streams, max_egress, max_hub_lag, degrade_ratio=0.5,
+                               degraded_fps=2, degraded_width=320, retry_after=10)
+
+
+class TestAdmissionController(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_admit_degrade_reject(self):
+        c = controller(max_streams=4)
+        tickets = [c.admit('archimedes', 10) for _ in range(4)]
+
+        # Below half of the limit, as requested. Then degraded.
+        self.assertEqual([(t.admitted, t.degraded, t.fps) for t in tickets],
+                         [(True, False, 10), (True, False, 10), (True, True, 2), (True, True, 2)])
+        self.assertEqual(tickets[2].width, 320)
+
+        refused = c.admit('archimedes', 10)
+        self.assertFalse(refused.admitted)
+        self.assertEqual(refused.reason, 'streams')
+        self.assertTrue(10 <= refused.retry_after <= 20)
+        self.assertEqual(stats.COUNTERS['admission_rejected:streams'], 1)
+
+        # Releasing is idempotent, and makes room again.
+        tickets[0].release()
+        tickets[0].release()
+        refused.release()
+        self.assertTrue(c.admit('archimedes', 10).admitted)
+        self.assertFalse(c.admit('archimedes', 10).admitted)
+
+    def test_cannot_degrade(self):
+        c = controller(max_streams=2)
+        c.admit('archimedes', 10)
+        ticket = c.admit('archimedes', None, can_degrade=False)
+        self.assertTrue(ticket.admitted)
+        self.assertFalse(ticket.degraded)
+
+    def test_cam_limit(self):
+        c = controller(max_streams=0, max_cam_streams=2)
+        c.admit('archimedes', 5)
+        c.admit('archimedes', 5)
+        self.assertFalse(c.admit('archimedes', 5).admitted)
+        self.assertTrue(c.admit('euclid', 5).admitted)
+
+        # Streams that are not of a single camera only count against the worker limits.
+        self.assertTrue(c.admit(None, 5).admitted)
+
+    def test_egress_limit(self):
+        c = controller(max_streams=0, max_egress=1000)
+        c._egress_time -= 1
+        stats.incr('egress_bytes', 2000)
+        ticket = c.admit('archimedes', 5)
+        self.assertFalse(ticket.admitted)
+        self.assertEqual(ticket.reason, 'egress')
+
+    def test_hub_lag_limit(self):
+        c = controller(max_streams=0, max_hub_lag=0.1)
+        ticker = Mock()
+        ticker.get_jitter.return_value = 0.06
+        with patch.dict('app.main.admission.TICKERS', {5: ticker}):
+            ticket = c.admit('archimedes', 5)
+        self.assertTrue(ticket.degraded)
+        self.assertEqual(ticket.reason, 'hub_lag')
+
+
+class TestAdmissionViews(BaseTestCase):
+
+    CLIENT_PER_TEST = True
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+        admission.reset()
+        self.addCleanup(admission.reset)
+        self.addCleanup(self.app.config.__setitem__, 'ADMISSION_MAX_STREAMS', self.app.config['ADMISSION_MAX_STREAMS'])
+        self.app.config['ADMISSION_MAX_STREAMS'] = 1
+
+    def test_refused_with_retry_after(self):
+        admission.get_controller().admit('archimedes', 5)
+
+        response = self.client.get('/cams/archimedes/mjpeg')
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), self.app.config['ADMISSION_RETRY_AFTER'])
+
+        self.assertEqual(self.client.get('/mosaic/mjpeg?cams=archimedes').status_code, 503)
+
+        health = json.loads(self.client.get('/healthcheck').data.decode())
+        self.assertEqual(health['result'], 'success')
+        self.assertTrue(health['admission']['overloaded'])
+        self.assertEqual(health['admission']['streams'], 1)
+        self.assertEqual(health['admission']['rejected_by_limit'], {'streams': 2})
+
+    def test_released_without_iterating(self):
+        # HEAD responses have an empty body, so the stream never starts. The server still closes the response.
+        for url in ('/cams/archimedes/mjpeg', '/mosaic/mjpeg?cams=archimedes'):
+            response = self.client.head(url)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+            self.assertEqual(admission.get_controller()._streams, 0)
+
+    def test_released_when_closed_before_the_first_part(self):
+        # Driven through the WSGI interface of the Flask views (behind the fast path, if any), so that nothing iterates
+        # the body before it is closed.
+        wsgi_app = getattr(self.app.wsgi_app, 'wsgi_app', self.app.wsgi_app)
+        for url in ('/cams/archimedes/mjpeg', '/mosaic/mjpeg?cams=archimedes'):
+            path, _, query = url.partition('?')
+            environ = EnvironBuilder(path=path, query_string=query).get_environ()
+            app_iter = wsgi_app(environ, lambda status, headers: None)
+            self.assertEqual(admission.get_controller()._streams, 1)
+            app_iter.close()
+            self.assertEqual(admission.get_controller()._streams, 0)
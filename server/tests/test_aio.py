@@ -0,0 +1,161 @@
+from __future__ import unicode_literals
+
+import asyncio
+import os
+import unittest
+
+import redis
+
+try:
+    import redis.asyncio
+    HAS_ASYNCIO_REDIS = True
+except ImportError:
+    HAS_ASYNCIO_REDIS = False
+
+CAM = 'aiotest'
+PREFIX = 'wilsa'
+
+FRAME = open(os.path.join(os.path.dirname(__file__), '..', '..', 'feeder', 'tests', 'data', 'img.jpg'), 'rb').read()
+
+
+class TestSubscription(unittest.TestCase):
+
+    def setUp(self):
+        if not HAS_ASYNCIO_REDIS:
+            self.skipTest('The asyncio engine needs requirements_asgi.txt')
+
+    def test_lagging_viewer_gets_gap(self):
+        from aio.hub import Subscription, GAP
+
+        async def run():
+            subscription = Subscription(None, 'cam/h264', 3)
+            for n in range(5):
+                subscription.put(n)
+            return [await subscription.get() for _ in range(2)], subscription.dropped
+
+        messages, dropped = asyncio.run(run())
+        # The queued messages are dropped, and the viewer resumes after a gap.
+        self.assertEqual(messages, [GAP, 3])
+        self.assertEqual(dropped, 3)
+
+
+class TestTicker(unittest.TestCase):
+
+    def setUp(self):
+        if not HAS_ASYNCIO_REDIS:
+            self.skipTest('The asyncio engine needs requirements_asgi.txt')
+
+    def test_lookup_survives_its_first_client(self):
+        from aio.store import FetchedFrame
+        from aio.ticker import Ticker
+
+        class SlowStore(object):
+            calls = 0
+
+            async def fetch_frame(self, cam_name, since_seq=None, fps=None):
+                SlowStore.calls += 1
+                await asyncio.sleep(0.05)
+                return FetchedFrame(b'1', True, False, b'frame1', False)
+
+        async def run():
+            ticker = Ticker(10, SlowStore(), {})
+            first = asyncio.ensure_future(ticker.get_frame(CAM))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(ticker.get_frame(CAM))
+            await asyncio.sleep(0.01)
+
+            # The client that started the lookup disconnects while the fetch is going on.
+            first.cancel()
+            return await asyncio.wait_for(second, 1)
+
+        fetched = asyncio.run(run())
+        self.assertEqual(fetched.frame, b'frame1')
+        self.assertEqual(SlowStore.calls, 1)
+
+
+class TestAioApp(unittest.TestCase):
+    """
+    Drives the ASGI app directly. Needs a real redis server (for the frame lookup script), so these tests are skipped
+    when none is reachable.
+    """
+
+    def setUp(self):
+        if not HAS_ASYNCIO_REDIS:
+            self.skipTest('The asyncio engine needs requirements_asgi.txt')
+        self.rdb = redis.StrictRedis()
+        try:
+            self.rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+
+        self.rdb.set(PREFIX + ':cams:' + CAM + ':lastframe', FRAME, ex=60)
+        self.rdb.incr(PREFIX + ':cams:' + CAM + ':frameseq')
+        self.rdb.set(PREFIX + ':feeder:alive', 1, ex=60)
+
+    def _request(self, path, query=b'', parts=None):
+        """
+        :param parts: For streams, number of body messages after which the client disconnects.
+        :return: List of the messages sent by the app.
+        """
+        from aio.app import App
+        from config import config
+
+        async def run():
+            app = App(config['testing'])
+            sent = []
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if parts is not None and len(sent) > parts:
+                    disconnected.set()
+
+            await app({'type': 'http', 'path': path, 'query_string': query}, receive, send)
+            await app.stop()
+            return sent
+
+        return asyncio.run(run())
+
+    def test_snapshot(self):
+        start, body = self._request('/cams/' + CAM)
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'image/jpeg'), start['headers'])
+        self.assertEqual(body['body'], FRAME)
+        self.assertTrue(self.rdb.exists(PREFIX + ':cams:' + CAM + ':active'))
+
+    def test_snapshot_not_available(self):
+        start, body = self._request('/cams/aiotest_missing')
+        self.assertEqual(start['status'], 503)
+        self.assertIn((b'content-type', b'image/png'), start['headers'])
+
+    def test_transformations_not_supported(self):
+        start, _ = self._request('/cams/' + CAM, b'crop_top')
+        self.assertEqual(start['status'], 501)
+        start, _ = self._request('/cams/' + CAM, b'tfps=wrong')
+        self.assertEqual(start['status'], 400)
+
+    def test_mjpeg(self):
+        sent = self._request('/cams/' + CAM + '/mjpeg', b'tfps=20&keepalive=0.01', parts=2)
+        start, first, second = sent[:3]
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'multipart/x-mixed-replace; boundary=frame'), start['headers'])
+        self.assertTrue(first['body'].startswith(b'--frame\r\nContent-Type: image/jpeg\r\n'))
+        self.assertTrue(first['body'].endswith(FRAME + b'\r\n'))
+        # The part is built once per frame.
+        self.assertIs(first['body'], second['body'])
+
+    def test_mjpeg_wrong_arguments(self):
+        start, body = self._request('/cams/' + CAM + '/mjpeg', b'tfps=abc')
+        self.assertEqual(start['status'], 400)
+        self.assertIn(b'tfps', body['body'])
+
+        start, _ = self._request('/cams/' + CAM + '/mjpeg', b'keepalive=abc')
+        self.assertEqual(start['status'], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+from __future__ import unicode_literals
+
+import io
+
+import redis
+from PIL import Image
+
+from app import rdb
+from app.main import activity, batch, frame_cache, stats
+from app.main.batch import BUNDLE_ENTRY, BUNDLE_HEADER, BUNDLE_MAGIC, FLAG_AVAILABLE, FLAG_ERROR
+from app.main.redis_funcs import fetch_frames
+from tests.base import BaseTestCase
+
+
+def jpeg(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (0, 128, 255)).save(out, 'jpeg')
+    return out.getvalue()
+
+
+def parse_bundle(data):
+    magic, count = BUNDLE_HEADER.unpack_from(data)
+    pos = BUNDLE_HEADER.size
+    entries = []
+    for _ in range(count):
+        name_length, seq, flags, frame_length = BUNDLE_ENTRY.unpack_from(data, pos)
+        pos += BUNDLE_ENTRY.size
+        name = data[pos:pos + name_length].decode()
+        pos += name_length
+        entries.append((name, seq, flags, data[pos:pos + frame_length]))
+        pos += frame_length
+    return magic, entries
+
+
+class TestBatch(BaseTestCase):
+    """
+    Needs a real redis server (for MGET and SCAN), so these tests are skipped when none is reachable at REDIS_URL.
+    """
+
+    CLIENT_PER_TEST = True
+
+    def setUp(self):
+        super().setUp()
+        try:
+            rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+
+        stats.reset()
+        self.addCleanup(self.app.config.__setitem__, 'FRAME_CACHE_MAX_BYTES', self.app.config['FRAME_CACHE_MAX_BYTES'])
+        self.app.config['FRAME_CACHE_MAX_BYTES'] = 0
+        for module in (frame_cache, activity, batch):
+            module.reset()
+            self.addCleanup(module.reset)
+
+        self.prefix = self.app.config['REDIS_PREFIX']
+        self.frame = jpeg(640, 480)
+        keys = []
+        for cam in ('batchtest1', 'batchtest2', 'batchtest3'):
+            cam_key = self.prefix + ':cams:' + cam
+            keys += [cam_key + suffix for suffix in (':lastframe', ':frameseq', ':error', ':active', ':demand')]
+        rdb.delete(*keys)
+        self.addCleanup(rdb.delete, *keys)
+
+        rdb.set(self.prefix + ':cams:batchtest1:lastframe', self.frame)
+        rdb.set(self.prefix + ':cams:batchtest1:frameseq', 7)
+        rdb.set(self.prefix + ':cams:batchtest2:lastframe', self.frame)
+        rdb.set(self.prefix + ':cams:batchtest3:error', 'Timeout')
+
+    def test_single_round_trip(self):
+        fetched = fetch_frames(['batchtest1', 'batchtest2', 'batchtest3'])
+        self.assertEqual(stats.COUNTERS['redis_round_trips'], 1)
+        self.assertEqual([f.frame is not None for f in fetched], [True, True, False])
+        self.assertEqual(fetched[0].seq, b'7')
+        self.assertTrue(fetched[2].error)
+
+    def test_bundle(self):
+        response = self.client.get('/cams/batch?cams=batchtest1,batchtest3&format=bundle')
+        self.assertEqual(response.status_code, 200)
+        magic, entries = parse_bundle(response.data)
+        self.assertEqual(magic, BUNDLE_MAGIC)
+        self.assertEqual([(e[0], e[1]) for e in entries], [('batchtest1', 7), ('batchtest3', 0)])
+        self.assertEqual(entries[0][2] & FLAG_AVAILABLE, FLAG_AVAILABLE)
+        self.assertEqual(entries[0][3], self.frame)
+        self.assertEqual(entries[1][2] & (FLAG_AVAILABLE | FLAG_ERROR), FLAG_ERROR)
+
+    def test_multipart_glob(self):
+        response = self.client.get('/cams/batch?glob=batchtest*')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith('multipart/mixed'))
+        self.assertEqual(response.data.count(b'X-Camera-Id: batchtest'), 2)
+        self.assertIn(b'X-Frame-Id: 7', response.data)
+        self.assertTrue(response.data.endswith(b'--frame--\r\n'))
+
+    def test_thumbnails(self):
+        response = self.client.get('/cams/batch?cams=batchtest1&format=bundle&width=160')
+        magic, entries = parse_bundle(response.data)
+        self.assertEqual(Image.open(io.BytesIO(entries[0][3])).size, (160, 120))
+
+        self.client.get('/cams/batch?cams=batchtest1&format=bundle&width=160')
+        self.assertEqual(stats.COUNTERS['thumbnails_built'], 1)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/cams/batch').status_code, 400)
+        self.assertEqual(self.client.get('/cams/batch?cams=a&format=zip').status_code, 400)
+        self.assertEqual(self.client.get('/cams/batch?cams=a&width=5').status_code, 400)
@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from app.main import stats
+from app.main.delivery import FrameDelivery, NOT_AVAILABLE
+from tests.base import BaseTestCase
+
+
+class TestFrameDelivery(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_only_new_frames(self):
+        delivery = FrameDelivery(None)
+        self.assertTrue(delivery.should_send(b'1'))
+        delivery.sent(b'1')
+        self.assertFalse(delivery.should_send(b'1'))
+        self.assertTrue(delivery.should_send(b'2'))
+        self.assertEqual(stats.COUNTERS['unchanged_frames_skipped'], 1)
+
+    def test_not_available_sent_once(self):
+        delivery = FrameDelivery(0)
+        delivery.sent(NOT_AVAILABLE)
+        self.assertFalse(delivery.should_send(NOT_AVAILABLE))
+        self.assertTrue(delivery.should_send(b'1'))
+
+    def test_unidentified_frames_always_sent(self):
+        delivery = FrameDelivery(None)
+        delivery.sent(None)
+        self.assertTrue(delivery.should_send(None))
+
+    def test_keepalive(self):
+        delivery = FrameDelivery(5)
+        with patch('app.main.delivery.time.time', return_value=100):
+            delivery.sent(b'1')
+        with patch('app.main.delivery.time.time', return_value=104):
+            self.assertFalse(delivery.should_send(b'1'))
+        with patch('app.main.delivery.time.time', return_value=105):
+            self.assertTrue(delivery.should_send(b'1'))
+        self.assertEqual(stats.COUNTERS['keepalive_resends'], 1)
@@ -0,0 +1,92 @@
+from __future__ import unicode_literals
+
+import time
+
+import gevent
+
+from app.main import stats
+from app.main.egress import EgressScheduler
+from tests.base import BaseTestCase
+
+
+class TestEgressScheduler(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def _scheduler(self, rate, max_wait=1.0, cam_weights=None, class_weights=None):
+        return EgressScheduler(rate, burst=2000, quantum=1000, max_wait=max_wait, cam_weights=cam_weights or {},
+                               class_weights=class_weights or {'default': 1})
+
+    def _run_flows(self, scheduler, flows, seconds, size=1000, droppable=False):
+        """
+        Runs greedy senders for the specified (cam, class) flows.
+        :return: Bytes sent by each flow.
+        """
+        sent = [0] * len(flows)
+        deadline = time.time() + seconds
+
+        def sender(n, cam, client_class):
+            with scheduler.open_flow(cam, client_class) as flow:
+                while time.time() < deadline:
+                    # The requests still queued at the deadline are not counted.
+                    if flow.send(size, droppable) and time.time() < deadline:
+                        sent[n] += size
+                    gevent.sleep(0)
+
+        gevent.joinall([gevent.spawn(sender, n, cam, cls) for n, (cam, cls) in enumerate(flows)],
+                       timeout=seconds + 2)
+        return sent
+
+    def test_disabled_sends_everything(self):
+        scheduler = self._scheduler(0, class_weights={'default': 1, 'lab': 4})
+        with scheduler.open_flow('archimedes', 'lab') as flow:
+            self.assertTrue(flow.send(10 ** 9))
+        with scheduler.open_flow('archimedes', 'unknown') as flow:
+            self.assertEqual(flow.client_class, 'default')
+            self.assertTrue(flow.send(100))
+
+        self.assertEqual(stats.COUNTERS['egress_bytes'], 10 ** 9 + 100)
+        self.assertEqual(stats.COUNTERS['egress_bytes:lab'], 10 ** 9)
+        self.assertEqual(stats.COUNTERS['egress_bytes:default'], 100)
+        self.assertEqual(stats.GAUGES['egress_flows'], 0)
+
+    def test_rate_is_enforced(self):
+        scheduler = self._scheduler(100000)
+        sent = self._run_flows(scheduler, [('archimedes', None), ('dalton', None)], 0.5)
+        # 0.5s at 100 KB/s, plus the initial burst.
+        self.assertLess(sum(sent), 100000 * 0.5 + 2000 + 2000)
+        self.assertGreater(sum(sent), 100000 * 0.5 * 0.7)
+
+    def test_many_viewers_do_not_starve_other_cameras(self):
+        scheduler = self._scheduler(100000)
+        flows = [('popular', None)] * 10 + [('quiet', None)]
+        sent = self._run_flows(scheduler, flows, 0.5)
+
+        popular, quiet = sum(sent[:10]), sent[10]
+        self.assertGreater(quiet, popular * 0.7)
+        self.assertLess(quiet, popular * 1.3)
+
+    def test_weights(self):
+        scheduler = self._scheduler(100000, cam_weights={'hd': 3})
+        sent = self._run_flows(scheduler, [('hd', None), ('hd', None), ('sd', None), ('sd', None)], 0.5)
+
+        ratio = (sent[0] + sent[1]) / (sent[2] + sent[3])
+        self.assertGreater(ratio, 2)
+        self.assertLess(ratio, 4)
+
+    def test_lowest_priority_dropped_first(self):
+        scheduler = self._scheduler(50000, max_wait=0.05, class_weights={'default': 1, 'lab': 10})
+        flows = [('archimedes', 'lab')] * 3 + [('archimedes', None)] * 3
+        self._run_flows(scheduler, flows, 0.5, droppable=True)
+
+        lab_dropped = stats.COUNTERS.get('egress_dropped:lab', 0)
+        default_dropped = stats.COUNTERS.get('egress_dropped:default', 0)
+        self.assertGreater(default_dropped, lab_dropped)
+        self.assertGreater(stats.COUNTERS['egress_bytes:lab'], stats.COUNTERS['egress_bytes:default'])
+
+        health = scheduler.get_health()
+        self.assertEqual(health['rate'], 50000)
+        self.assertEqual(health['waiting'], 0)
+        self.assertEqual(health['dropped']['default'], default_dropped)
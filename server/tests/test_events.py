@@ -0,0 +1,153 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from app import socketio
+from app.main import admission, events, registry
+from app.main.SocketIOH264RedisBroadcaster import SocketIOH264RedisBroadcaster
+from app.main.SocketIOMJPEGBroadcaster import SocketIOMJPEGBroadcaster
+from tests.base import BaseTestCase
+
+
+class TestCamsNamespace(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+        # The broadcasters are not run: only their bookkeeping is tested.
+        self.spawn_patcher = patch('app.main.registry.gevent')
+        self.spawn_patcher.start()
+        self.addCleanup(self.spawn_patcher.stop)
+
+        self.mark_patcher = patch('app.main.events.mark_active')
+        self.mark_patcher.start()
+        self.addCleanup(self.mark_patcher.stop)
+
+        self.sio = socketio.test_client(self.app, namespace=events.CAMS_NAMESPACE)
+
+    def _subscribe(self, data):
+        return self.sio.emit('subscribe', data, namespace=events.CAMS_NAMESPACE, callback=True)
+
+    def _keys(self):
+        return sorted((key[1], key[2]) for key in registry.get_registry().keys())
+
+    def _broadcasters(self):
+        return [registry.get_registry().get(key) for key in registry.get_registry().keys()]
+
+    def test_several_cams_on_one_connection(self):
+        self.assertTrue(self._subscribe({'cam': 'archimedes', 'format': 'mjpeg', 'tfps': 10}))
+        self.assertTrue(self._subscribe({'cam': 'euclid', 'format': 'mjpeg'}))
+        self.assertTrue(self._subscribe({'cam': 'archimedes', 'format': 'h264'}))
+        self.assertEqual(self._keys(), [('archimedes', 'h264'), ('archimedes', 'mjpeg'), ('euclid', 'mjpeg')])
+
+        # All of them on the same connection, and emitting tagged data to the /cams namespace.
+        self.assertEqual(len(set(key[0] for key in registry.get_registry().keys())), 1)
+        for broadcaster in self._broadcasters():
+            self.assertEqual(broadcaster._namespace, events.CAMS_NAMESPACE)
+
+        self.assertTrue(self.sio.emit('unsubscribe', {'cam': 'euclid', 'format': 'mjpeg'},
+                                      namespace=events.CAMS_NAMESPACE, callback=True))
+        self.assertEqual(self._keys(), [('archimedes', 'h264'), ('archimedes', 'mjpeg')])
+
+        self.sio.disconnect(namespace=events.CAMS_NAMESPACE)
+        self.assertEqual(self._keys(), [])
+
+    def test_resubscribe_replaces(self):
+        self._subscribe({'cam': 'archimedes', 'tfps': 5})
+        first, = self._broadcasters()
+        self._subscribe({'cam': 'archimedes', 'tfps': 10})
+        second, = self._broadcasters()
+
+        self.assertEqual(len(self._keys()), 1)
+        self.assertTrue(first._should_stop)
+        self.assertEqual(second._fps, 10)
+
+    def test_rejected_when_overloaded(self):
+        admission.reset()
+        self.addCleanup(admission.reset)
+        self.addCleanup(self.app.config.__setitem__, 'ADMISSION_MAX_STREAMS', self.app.config['ADMISSION_MAX_STREAMS'])
+        self.app.config['ADMISSION_MAX_STREAMS'] = 1
+
+        self.assertTrue(self._subscribe({'cam': 'archimedes'}))
+        self.assertFalse(self._subscribe({'cam': 'euclid'}))
+        rejected = [msg for msg in self.sio.get_received(events.CAMS_NAMESPACE) if msg['name'] == 'rejected']
+        self.assertEqual(rejected[0]['args'][0]['cam'], 'euclid')
+        self.assertEqual(rejected[0]['args'][0]['reason'], 'streams')
+
+        # Resubscribing replaces the subscription rather than counting twice, and unsubscribing makes room.
+        self.assertTrue(self._subscribe({'cam': 'archimedes', 'tfps': 10}))
+        self.sio.emit('unsubscribe', {'cam': 'archimedes'}, namespace=events.CAMS_NAMESPACE)
+        self.assertTrue(self._subscribe({'cam': 'euclid'}))
+
+    def test_adaptive_quality_is_opt_in(self):
+        self.assertFalse(events._is_adaptive_quality({}))
+        self.assertTrue(events._is_adaptive_quality({'quality': 'auto'}))
+
+        self.addCleanup(self.app.config.__setitem__, 'MJPEG_ADAPTIVE_QUALITY', self.app.config['MJPEG_ADAPTIVE_QUALITY'])
+        self.app.config['MJPEG_ADAPTIVE_QUALITY'] = True
+        self.assertTrue(events._is_adaptive_quality({}))
+        self.assertFalse(events._is_adaptive_quality({'quality': 'full'}))
+
+    def test_wrong_subscription(self):
+        self.assertFalse(self._subscribe({'cam': 'archimedes', 'format': 'gif'}))
+        self.assertFalse(self._subscribe({'format': 'mjpeg'}))
+        self.assertEqual(self._keys(), [])
+
+
+class TestMPEGNamespace(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        registry.reset()
+        self.addCleanup(registry.reset)
+        admission.reset()
+        self.addCleanup(admission.reset)
+
+        spawn_patcher = patch('app.main.registry.gevent')
+        spawn_patcher.start()
+        self.addCleanup(spawn_patcher.stop)
+
+        mark_patcher = patch('app.main.events.mark_active')
+        mark_patcher.start()
+        self.addCleanup(mark_patcher.stop)
+
+        self.sio = socketio.test_client(self.app, namespace='/mpeg')
+
+    def test_start_again_replaces(self):
+        self.addCleanup(self.app.config.__setitem__, 'ADMISSION_MAX_STREAMS', self.app.config['ADMISSION_MAX_STREAMS'])
+        self.app.config['ADMISSION_MAX_STREAMS'] = 1
+
+        self.sio.emit('start', {'cam': 'archimedes'}, namespace='/mpeg')
+        first = registry.get_registry().get(next(iter(registry.get_registry().keys())))
+        self.sio.emit('start', {'cam': 'archimedes'}, namespace='/mpeg')
+
+        # The previous stream is stopped (and its ticket released) before the new one is admitted.
+        self.assertEqual([msg for msg in self.sio.get_received('/mpeg') if msg['name'] == 'rejected'], [])
+        self.assertEqual(len(list(registry.get_registry().keys())), 1)
+        self.assertTrue(first._should_stop)
+
+
+class TestTaggedEmits(BaseTestCase):
+
+    def test_mjpeg(self):
+        with patch('app.main.SocketIOMJPEGBroadcaster.socketio') as socketio_mock:
+            SocketIOMJPEGBroadcaster('archimedes', 'sid1', namespace='/cams')._emit(b'jpeg')
+            SocketIOMJPEGBroadcaster('archimedes', 'sid1')._emit(b'jpeg')
+
+        tagged, untagged = socketio_mock.emit.call_args_list
+        self.assertEqual(tagged[0], ('frame', {'cam': 'archimedes', 'frame': b'jpeg'}))
+        self.assertEqual(tagged[1]['namespace'], '/cams')
+        self.assertEqual(untagged[0], ('frame', b'jpeg'))
+        self.assertEqual(untagged[1]['namespace'], '/mjpeg')
+
+    def test_h264(self):
+        with patch('app.main.SocketIOH264RedisBroadcaster.socketio') as socketio_mock:
+            SocketIOH264RedisBroadcaster('archimedes', 'sid1', namespace='/cams')._emit(b'nal')
+
+        args, kwargs = socketio_mock.emit.call_args
+        self.assertEqual(args, ('stream', {'cam': 'archimedes', 'nal': b'nal'}))
+        self.assertEqual(kwargs['namespace'], '/cams')
@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+
+import os
+
+import redis
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import Response
+
+from app import rdb
+from app.main import admission, stats
+from app.main.fastpath import FastPath
+from tests.base import BaseTestCase
+
+CAM = 'fastpathtest'
+
+FRAME = open(os.path.join(os.path.dirname(__file__), '..', '..', 'feeder', 'tests', 'data', 'img.jpg'), 'rb').read()
+
+
+class TestFastPath(BaseTestCase):
+    """
+    Compares the fast path with the Flask views. Needs a real redis server (for the frame lookup scripts), so these
+    tests are skipped when none is reachable at REDIS_URL.
+    """
+
+    def setUp(self):
+        super().setUp()
+        try:
+            rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+        stats.reset()
+        admission.reset()
+
+        prefix = self.app.config['REDIS_PREFIX']
+        rdb.set(prefix + ':cams:' + CAM + ':lastframe', FRAME, ex=60)
+        rdb.incr(prefix + ':cams:' + CAM + ':frameseq')
+        rdb.set(prefix + ':feeder:alive', 1, ex=60)
+
+        self.assertIsInstance(self.app.wsgi_app, FastPath)
+        self.fast = Client(self.app.wsgi_app, Response)
+        self.flask = Client(self.app.wsgi_app.wsgi_app, Response)
+
+    def _compare(self, url):
+        fast = self.fast.get(url)
+        flask = self.flask.get(url)
+        self.assertEqual(fast.status_code, flask.status_code)
+        self.assertEqual(fast.headers.get('Content-Type'), flask.headers.get('Content-Type'))
+        self.assertEqual(fast.data, flask.data)
+        return fast
+
+    def test_snapshot(self):
+        response = self._compare('/cams/' + CAM)
+        self.assertEqual(response.data, FRAME)
+        self._compare('/cams/' + CAM + '?rotate=90&crop_top&tfps=5')
+        self.assertEqual(stats.COUNTERS['fastpath_requests'], 2)
+
+    def test_uncommon_cases_go_through_flask(self):
+        response = self._compare('/cams/' + CAM + '?rotate=wrong')
+        self.assertEqual(response.status_code, 400)
+        # Not a camera.
+        self.assertEqual(self.fast.get('/cams/batch').status_code, 400)
+        self.assertEqual(self.fast.post('/cams/' + CAM).status_code, 405)
+        self.assertNotIn('fastpath_requests', stats.COUNTERS)
+
+    def test_mjpeg(self):
+        response = self.fast.get('/cams/' + CAM + '/mjpeg?tfps=10&quality=full', buffered=False)
+        self.assertEqual(response.headers['Content-Type'], 'multipart/x-mixed-replace; boundary=frame')
+        part = next(response.iter_encoded())
+        self.assertTrue(part.startswith(b'--frame\r\nContent-Type: image/jpeg\r\n'))
+        self.assertTrue(part.endswith(FRAME + b'\r\n'))
+        self.assertEqual(admission.get_controller().get_health()['streams'], 1)
+
+        # Closing the stream releases its admission ticket.
+        response.close()
+        self.assertEqual(admission.get_controller().get_health()['streams'], 0)
+
+    def test_mjpeg_closed_before_the_first_part(self):
+        # Driven through the WSGI interface, so that nothing iterates the body before it is closed.
+        environ = EnvironBuilder(path='/cams/' + CAM + '/mjpeg', query_string='tfps=10').get_environ()
+        app_iter = self.app.wsgi_app(environ, lambda status, headers: None)
+        self.assertEqual(stats.COUNTERS['fastpath_requests'], 1)
+        self.assertEqual(admission.get_controller().get_health()['streams'], 1)
+
+        app_iter.close()
+        self.assertEqual(admission.get_controller().get_health()['streams'], 0)
@@ -0,0 +1,194 @@
+from __future__ import unicode_literals
+
+import gevent
+import redis
+
+from app import rdb
+from app.main import frame_cache, stats
+from app.main.frame_cache import FrameCache
+from app.main.redis_funcs import fetch_frame
+from tests.base import BaseTestCase
+
+
+class TestFrameCache(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+        self.cache = FrameCache(100, 0.05, 'wilsa:feeder:alive', 'wilsa:cams:')
+        self.cache.tracking = True
+        self.cache._tracked.update('wilsa:cams:cam{}'.format(n) for n in range(1, 5))
+
+    def _put(self, cam_key, frame, alive=True, error=False):
+        self.cache.put(cam_key, b'1', frame, alive, error, self.cache.get_generation(cam_key))
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('wilsa:cams:cam1'))
+        self._put('wilsa:cams:cam1', b'f' * 10)
+        self.assertEqual(self.cache.get('wilsa:cams:cam1'), (b'1', b'f' * 10, True, False))
+
+        self.assertEqual(self.cache.get_hit_ratio(), 0.5)
+        self.assertEqual(stats.GAUGES['frame_cache_bytes'], 10)
+
+    def test_lru_eviction_by_bytes(self):
+        self._put('wilsa:cams:cam1', b'a' * 40)
+        self._put('wilsa:cams:cam2', b'b' * 40)
+        self.cache.get('wilsa:cams:cam1')
+        self._put('wilsa:cams:cam3', b'c' * 40)
+
+        # cam2 was the least recently used.
+        self.assertIsNone(self.cache.get('wilsa:cams:cam2'))
+        self.assertIsNotNone(self.cache.get('wilsa:cams:cam1'))
+        self.assertEqual(self.cache.get_bytes(), 80)
+
+        # Frames that do not fit are not cached at all.
+        self._put('wilsa:cams:cam4', b'd' * 101)
+        self.assertIsNone(self.cache.get('wilsa:cams:cam4'))
+
+    def test_invalidation(self):
+        self._put('wilsa:cams:cam1', b'f')
+        self.cache.invalidate([b'wilsa:cams:cam1:active', b'wilsa:cams:cam2:lastframe'])
+        self.assertIsNotNone(self.cache.get('wilsa:cams:cam1'))
+
+        self.cache.invalidate([b'wilsa:cams:cam1:lastframe'])
+        self.assertIsNone(self.cache.get('wilsa:cams:cam1'))
+
+    def test_flags_invalidation(self):
+        self._put('wilsa:cams:cam1', b'f', True, True)
+        self.assertEqual(self.cache.get('wilsa:cams:cam1'), (b'1', b'f', True, True))
+
+        self.cache.invalidate([b'wilsa:cams:cam1:error'])
+        self.assertIsNone(self.cache.get('wilsa:cams:cam1'))
+
+        # The alive flag is shared by every camera. Without it, no cached frame is served.
+        self._put('wilsa:cams:cam1', b'f')
+        self.cache.invalidate([b'wilsa:feeder:alive'])
+        self.assertIsNone(self.cache.get('wilsa:cams:cam1'))
+
+        self._put('wilsa:cams:cam2', b'g', False, False)
+        self.assertEqual(self.cache.get('wilsa:cams:cam1'), (b'1', b'f', False, False))
+
+    def test_frame_invalidated_while_fetching(self):
+        generation = self.cache.get_generation('wilsa:cams:cam1')
+        self.cache.invalidate([b'wilsa:cams:cam1:frameseq'])
+        self.cache.put('wilsa:cams:cam1', b'1', b'f', True, False, generation)
+        self.assertIsNone(self.cache.get('wilsa:cams:cam1'))
+
+    def test_other_keys_do_not_discard_fetches(self):
+        generation = self.cache.get_generation('wilsa:cams:cam1')
+        # Writes of other cameras, and of the other keys of the camera, while its frame is being fetched.
+        self.cache.invalidate([b'wilsa:cams:cam1:active', b'wilsa:cams:cam1:demand', b'wilsa:cams:cam2:lastframe'])
+        self.cache.put('wilsa:cams:cam1', b'1', b'f', True, False, generation)
+        self.assertIsNotNone(self.cache.get('wilsa:cams:cam1'))
+
+    def test_untracked_camera_not_stored(self):
+        # Nothing would invalidate the frame until the keys of the camera are tracked.
+        self._put('wilsa:cams:cam5', b'f')
+        self.assertIsNone(self.cache.get('wilsa:cams:cam5'))
+        self.assertEqual(self.cache._track_queue.get_nowait(), 'wilsa:cams:cam5')
+
+        # Requested once only.
+        self._put('wilsa:cams:cam5', b'f')
+        self.assertTrue(self.cache._track_queue.empty())
+
+    def test_ttl_without_tracking(self):
+        self.cache.tracking = False
+        self._put('wilsa:cams:cam1', b'f')
+        self.assertIsNotNone(self.cache.get('wilsa:cams:cam1'))
+        gevent.sleep(0.06)
+        self.assertIsNone(self.cache.get('wilsa:cams:cam1'))
+
+
+class TestFrameCacheTracking(BaseTestCase):
+    """
+    Client-side caching needs a real redis (6 or newer) server, so these tests are skipped when none is reachable.
+    """
+
+    def setUp(self):
+        super().setUp()
+        try:
+            if int(rdb.info()['redis_version'].split('.')[0]) < 6:
+                self.skipTest('Redis 6 server not available')
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+
+        stats.reset()
+        frame_cache.reset()
+        self.addCleanup(frame_cache.reset)
+
+        self.cam_key = self.app.config['REDIS_PREFIX'] + ':cams:cachetest'
+        self.alive_key = self.app.config['REDIS_PREFIX'] + ':feeder:alive'
+        keys = [self.cam_key + ':lastframe', self.cam_key + ':frameseq', self.cam_key + ':active', self.alive_key]
+        rdb.delete(*keys)
+        self.addCleanup(rdb.delete, *keys)
+
+        self.cache = frame_cache.get_cache()
+        for i in range(50):
+            if self.cache.tracking:
+                break
+            gevent.sleep(0.01)
+        self.assertTrue(self.cache.tracking)
+
+    def _track_cam(self):
+        # The first fetch of the camera has its frame keys tracked, and is not stored.
+        fetch_frame('cachetest')
+        for i in range(50):
+            if self.cam_key in self.cache._tracked:
+                return
+            gevent.sleep(0.01)
+        self.fail("The camera keys were not tracked")
+
+    def _wait_for_invalidation(self):
+        for i in range(50):
+            if self.cache.get_bytes() == 0:
+                return
+            gevent.sleep(0.01)
+
+    def test_frame_read_once(self):
+        rdb.set(self.cam_key + ':lastframe', b'frame1')
+        rdb.set(self.cam_key + ':frameseq', 1)
+        self._track_cam()
+
+        stats.reset()
+        for i in range(10):
+            self.assertEqual(fetch_frame('cachetest').frame, b'frame1')
+        self.assertEqual(stats.COUNTERS['frame_cache_hits'], 9)
+
+        rdb.set(self.cam_key + ':lastframe', b'frame2')
+        rdb.set(self.cam_key + ':frameseq', 2)
+        self._wait_for_invalidation()
+        self.assertEqual(fetch_frame('cachetest').frame, b'frame2')
+
+    def test_dead_feeder_not_reported_alive(self):
+        rdb.set(self.cam_key + ':lastframe', b'frame1')
+        rdb.set(self.cam_key + ':frameseq', 1)
+        rdb.set(self.alive_key, 1)
+        self._track_cam()
+
+        stats.reset()
+        self.assertTrue(fetch_frame('cachetest').alive)
+        self.assertTrue(fetch_frame('cachetest').alive)
+        self.assertEqual(stats.COUNTERS['frame_cache_hits'], 1)
+
+        # Once the feeder alive key is gone, cached frames no longer claim that it is alive.
+        rdb.delete(self.alive_key)
+        for i in range(50):
+            fetched = fetch_frame('cachetest')
+            if not fetched.alive:
+                break
+            gevent.sleep(0.01)
+        self.assertFalse(fetched.alive)
+        self.assertEqual(fetched.frame, b'frame1')
+
+    def test_activity_writes_do_not_discard_fetches(self):
+        rdb.set(self.cam_key + ':lastframe', b'frame1')
+        rdb.set(self.cam_key + ':frameseq', 1)
+        self._track_cam()
+        self.cache.clear()
+
+        # The server marks the camera active while its frame is being fetched.
+        generation = self.cache.get_generation(self.cam_key)
+        rdb.set(self.cam_key + ':active', 1)
+        gevent.sleep(0.05)
+        self.cache.put(self.cam_key, b'1', b'frame1', True, False, generation)
+        self.assertIsNotNone(self.cache.get(self.cam_key))
@@ -0,0 +1,140 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from app.main import hls, stats
+from app.main.hls import SegmentStore
+from tests.base import BaseTestCase
+
+INIT = b'ftyp+moov'
+
+
+def fragment(n, keyframe):
+    return ('K' if keyframe else 'D').encode() + str(n).encode()
+
+
+class TestSegmentStore(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+        # 1-second segments of 0.25-second parts, at 10 FPS with a keyframe every 10 frames.
+        self.store = SegmentStore('archimedes', 1.0, 0.25, 3)
+        self.store.init_segment = INIT
+
+    def _feed(self, frames, start=0):
+        for n in range(start, start + frames):
+            self.store.add_fragment(fragment(n, n % 10 == 0), 0.1, n % 10 == 0)
+
+    def test_starts_at_keyframe(self):
+        self.store.add_fragment(fragment(0, False), 0.1, False)
+        self.assertIsNone(self.store.get_segment(0))
+
+        self._feed(3, start=10)
+        self.assertIsNotNone(self.store.get_segment(0))
+
+    def test_segments_and_parts(self):
+        self._feed(25)
+
+        # Two complete segments, and a third one in progress.
+        first = self.store.get_segment(0)
+        self.assertTrue(first.complete)
+        self.assertTrue(first.data.startswith(b'K0'))
+        self.assertEqual(len(first.parts), 4)
+        self.assertTrue(first.parts[0].independent)
+        self.assertFalse(first.parts[1].independent)
+        self.assertEqual(b''.join(p.data for p in first.parts), first.data)
+
+        self.assertFalse(self.store.get_segment(2).complete)
+        self.assertTrue(self.store.has_part(2, 0))
+        self.assertFalse(self.store.has_part(2, 1))
+        self.assertFalse(self.store.has_part(3, 0))
+
+    def test_store_is_bounded(self):
+        self._feed(100)
+        self.assertIsNone(self.store.get_segment(0))
+        self.assertIsNotNone(self.store.get_segment(9))
+
+        # Segments that fell off the window are no longer waited for.
+        self.assertTrue(self.store.has_part(0, 0))
+
+    def test_playlist(self):
+        self._feed(25)
+        playlist = self.store.playlist()
+
+        self.assertIn('#EXT-X-MAP:URI="init.mp4"', playlist)
+        self.assertIn('#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES', playlist)
+        self.assertIn('#EXT-X-PART:DURATION=0.300,URI="part0.0.m4s",INDEPENDENT=YES', playlist)
+        self.assertIn('seg1.m4s', playlist)
+        self.assertNotIn('seg2.m4s', playlist)
+        self.assertTrue(playlist.endswith('#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part2.1.m4s"\n'))
+
+    def test_wait_times_out(self):
+        self._feed(5)
+        self.assertFalse(self.store.wait(lambda: self.store.has_part(5, 0), 0.05))
+        self.assertTrue(self.store.wait(lambda: self.store.has_part(0, 0), 0.05))
+
+
+class TestHLSViews(BaseTestCase):
+
+    CLIENT_PER_TEST = True
+
+    def setUp(self):
+        super().setUp()
+        self.store = SegmentStore('archimedes', 1.0, 0.25, 3)
+        self.store.init_segment = INIT
+        for n in range(25):
+            self.store.add_fragment(fragment(n, n % 10 == 0), 0.1, n % 10 == 0)
+
+        # Already running stores are served as they are, without touching redis.
+        hls.STORES['archimedes'] = self.store
+        self.addCleanup(hls.STORES.pop, 'archimedes', None)
+
+        patcher = patch('app.main.hls.mark_active')
+        self.mark_active_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_playlist(self):
+        response = self.client.get('/hls/archimedes/playlist.m3u8')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/vnd.apple.mpegurl')
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertIn('seg0.m4s', response.data.decode('utf-8'))
+
+        # Every request keeps the camera active.
+        self.mark_active_mock.assert_called_with('archimedes', 'h264')
+
+    def test_blocking_reload_of_available_part(self):
+        response = self.client.get('/hls/archimedes/playlist.m3u8?_HLS_msn=1&_HLS_part=2')
+        self.assertEqual(response.status_code, 200)
+
+    def test_blocking_reload_too_far_ahead(self):
+        self.assertEqual(self.store.last_msn, 2)
+
+        # Beyond two segments past the last one, the request fails at once instead of waiting for the timeout.
+        with patch('app.main.hls._blocking_timeout', return_value=10):
+            response = self.client.get('/hls/archimedes/playlist.m3u8?_HLS_msn=5&_HLS_part=0')
+        self.assertEqual(response.status_code, 400)
+
+        with patch('app.main.hls._blocking_timeout', return_value=0.05):
+            response = self.client.get('/hls/archimedes/playlist.m3u8?_HLS_msn=4&_HLS_part=0')
+        self.assertEqual(response.status_code, 503)
+
+    def test_segments_and_parts_are_cacheable(self):
+        response = self.client.get('/hls/archimedes/seg0.m4s')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.store.get_segment(0).data)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+        response = self.client.get('/hls/archimedes/part1.2.m4s')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.store.get_part(1, 2).data)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+        response = self.client.get('/hls/archimedes/init.mp4')
+        self.assertEqual(response.data, INIT)
+
+    def test_incomplete_segment_not_found(self):
+        response = self.client.get('/hls/archimedes/seg2.m4s')
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+
+import gevent
+import redis
+
+from app import rdb
+from app.main import stats
+from app.main.hub import ChannelHub
+from tests.base import BaseTestCase
+
+CHANNEL = 'hubtest/h264'
+
+
+class TestChannelHub(BaseTestCase):
+    """
+    Needs a real redis server (for pubsub), so these tests are skipped when none is reachable at REDIS_URL.
+    """
+
+    def setUp(self):
+        super().setUp()
+        try:
+            rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+        stats.reset()
+
+    def _redis_subscribers(self):
+        return dict(rdb.pubsub_numsub(CHANNEL))[CHANNEL.encode()]
+
+    def _listen(self, hub, received, stop):
+        with hub.subscribe(CHANNEL) as subscription:
+            for data in subscription.messages(lambda: stop[0], poll_interval=0.05):
+                received.append(data)
+
+    def test_fan_out_with_a_single_redis_subscription(self):
+        hub = ChannelHub(queue_size=16)
+        first, second, stop = [], [], [False]
+        greenlets = [gevent.spawn(self._listen, hub, first, stop), gevent.spawn(self._listen, hub, second, stop)]
+        gevent.sleep(0.1)
+        self.assertEqual(self._redis_subscribers(), 1)
+        self.assertEqual(hub.get_subscriber_count(CHANNEL), 2)
+
+        rdb.publish(CHANNEL, b'nal1')
+        rdb.publish(CHANNEL, b'nal2')
+        gevent.sleep(0.1)
+        self.assertEqual(first, [b'nal1', b'nal2'])
+        self.assertEqual(second, [b'nal1', b'nal2'])
+        self.assertEqual(stats.COUNTERS['hub_messages'], 2)
+        self.assertEqual(stats.COUNTERS['hub_deliveries'], 4)
+
+        stop[0] = True
+        gevent.joinall(greenlets, timeout=0.5)
+        self.assertEqual(hub.get_subscriber_count(), 0)
+
+    def test_channel_closed_after_last_subscriber(self):
+        hub = ChannelHub(queue_size=16)
+        received, stop = [], [False]
+        greenlet = gevent.spawn(self._listen, hub, received, stop)
+        gevent.sleep(0.1)
+        self.assertEqual(hub.get_channel_count(), 1)
+
+        stop[0] = True
+        greenlet.join(timeout=0.5)
+        # The channel notices within the poll interval of its listener, and unsubscribes.
+        gevent.sleep(1.5)
+        self.assertEqual(hub.get_channel_count(), 0)
+        self.assertEqual(self._redis_subscribers(), 0)
+        self.assertEqual(stats.GAUGES['hub_channels'], 0)
+
+    def test_lagging_subscriber_gets_a_gap(self):
+        hub = ChannelHub(queue_size=4)
+        with hub.subscribe(CHANNEL) as subscription:
+            gevent.sleep(0.1)
+            for n in range(5):
+                rdb.publish(CHANNEL, 'nal{}'.format(n).encode())
+            gevent.sleep(0.1)
+
+            received = []
+            for data in subscription.messages(lambda: len(received) >= 2, poll_interval=0.05):
+                received.append(data)
+
+        # The stale messages are dropped, and replaced by a gap, after which it resumes with the newest one.
+        self.assertEqual(received[0], None)
+        self.assertEqual(received[1:], [b'nal4'])
+        self.assertEqual(stats.COUNTERS['hub_messages_dropped'], 4)
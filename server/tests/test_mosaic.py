@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+
+import io
+from unittest.mock import patch
+
+from PIL import Image
+
+from app.main import mosaic, stats
+from app.main.mosaic import MosaicCache, MosaicLayout
+from app.main.redis_funcs import FetchedFrame
+from tests.base import BaseTestCase
+
+
+def jpeg(width, height, color):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(out, 'jpeg')
+    return out.getvalue()
+
+
+class TestMosaicLayout(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def assertEmptyTile(self, pixel):
+        # JPEG is lossy.
+        for value in pixel:
+            self.assertAlmostEqual(value, 40, delta=3)
+
+    def test_grid(self):
+        layout = MosaicLayout(['a', 'b', 'c'], 2, 160, 70)
+        self.assertEqual((layout.cols, layout.rows, layout.tile_height), (2, 2, 120))
+
+        img = Image.open(io.BytesIO(layout.render([jpeg(640, 480, (255, 0, 0)), None, jpeg(640, 480, (0, 0, 255))])))
+        self.assertEqual(img.size, (320, 240))
+
+        # Tiles in their cells, and the missing camera left empty.
+        r, g, b = img.getpixel((80, 60))
+        self.assertGreater(r, 200)
+        self.assertEmptyTile(img.getpixel((240, 60)))
+        r, g, b = img.getpixel((80, 180))
+        self.assertGreater(b, 200)
+
+    def test_invalid_frame_left_empty(self):
+        layout = MosaicLayout(['a'], 1, 160, 70)
+        img = Image.open(io.BytesIO(layout.render([b'not a jpeg'])))
+        self.assertEmptyTile(img.getpixel((80, 60)))
+
+
+class TestMosaicCache(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_rendered_once_per_frame_set(self):
+        cache = MosaicCache(4)
+        layout = MosaicLayout(['a', 'b'], 2, 64, 70)
+        frames = [jpeg(64, 48, (255, 0, 0)), jpeg(64, 48, (0, 255, 0))]
+
+        first = cache.get(layout, ('1', '1'), frames)
+        self.assertIs(cache.get(layout, ('1', '1'), frames)[1], first[1])
+        self.assertEqual(stats.COUNTERS['mosaic_renders'], 1)
+
+        cache.get(layout, ('1', '2'), frames)
+        self.assertEqual(stats.COUNTERS['mosaic_renders'], 2)
+
+        # Frames that cannot be identified are always rendered.
+        cache.get(layout, ('1', None), frames)
+        cache.get(layout, ('1', None), frames)
+        self.assertEqual(stats.COUNTERS['mosaic_renders'], 4)
+
+
+class TestMosaicViews(BaseTestCase):
+
+    CLIENT_PER_TEST = True
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+        mosaic.reset()
+
+        self.fetch_patcher = patch('app.main.mosaic.fetch_frames')
+        self.fetch_mock = self.fetch_patcher.start()
+        self.addCleanup(self.fetch_patcher.stop)
+        frame = FetchedFrame(b'1', True, False, jpeg(64, 48, (255, 0, 0)), False)
+        self.fetch_mock.side_effect = lambda cams, width: [frame] * len(cams)
+
+    def test_mosaic(self):
+        response = self.client.get('/mosaic?cams=a,b,c,d&width=100')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size, (200, 150))
+        self.assertEqual(self.fetch_mock.call_count, 1)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/mosaic').status_code, 400)
+        self.assertEqual(self.client.get('/mosaic?cams=a&width=100000').status_code, 400)
+        cams = ','.join('cam{}'.format(i) for i in range(self.app.config['MOSAIC_MAX_CAMS'] + 1))
+        self.assertEqual(self.client.get('/mosaic?cams=' + cams).status_code, 400)
@@ -0,0 +1,59 @@
+from __future__ import unicode_literals
+
+from unittest.mock import Mock
+
+from app.main import stats
+from app.main.multipart import PartCache, build_part
+from tests.base import BaseTestCase
+
+
+class TestMultipart(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_build_part(self):
+        part = build_part(b'jpeg', b'7')
+        self.assertEqual(part, b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: 4\r\nX-Frame-Id: 7\r\n\r\n'
+                               b'jpeg\r\n')
+
+    def test_part_shared_per_frame(self):
+        cache = PartCache(10)
+        part = cache.get_part('cam1', None, b'1', b'jpeg')
+        self.assertIs(cache.get_part('cam1', None, b'1', b'jpeg'), part)
+        self.assertEqual(stats.COUNTERS['mjpeg_parts_built'], 1)
+
+        # A new frame replaces the part.
+        self.assertIn(b'X-Frame-Id: 2', cache.get_part('cam1', None, b'2', b'jpeg2'))
+        self.assertEqual(stats.COUNTERS['mjpeg_parts_built'], 2)
+
+    def test_transform_once_per_variant(self):
+        cache = PartCache(10)
+        transform = Mock(return_value=b'rotated')
+        for _ in range(3):
+            part = cache.get_part('cam1', (90.0,), b'1', b'jpeg', transform)
+        self.assertEqual(transform.call_count, 1)
+        self.assertTrue(part.endswith(b'\r\n\r\nrotated\r\n'))
+
+        # The original frame is a different variant.
+        self.assertTrue(cache.get_part('cam1', None, b'1', b'jpeg').endswith(b'\r\n\r\njpeg\r\n'))
+
+    def test_frame_shared_with_part(self):
+        cache = PartCache(10)
+        transform = Mock(return_value=b'smaller')
+        self.assertEqual(cache.get_frame('cam1', (0, 320, 50), b'1', b'jpeg', transform), b'smaller')
+        self.assertTrue(cache.get_part('cam1', (0, 320, 50), b'1', b'jpeg', transform).endswith(b'\r\n\r\nsmaller\r\n'))
+        self.assertEqual(transform.call_count, 1)
+
+    def test_bounded(self):
+        cache = PartCache(2)
+        for cam in ('cam1', 'cam2', 'cam3'):
+            cache.get_part(cam, None, b'1', b'jpeg')
+        self.assertEqual(stats.GAUGES['mjpeg_part_cache_entries'], 2)
+
+    def test_unidentified_frames_not_cached(self):
+        cache = PartCache(10)
+        cache.get_part('cam1', None, None, b'jpeg')
+        cache.get_part('cam1', None, None, b'jpeg')
+        self.assertEqual(stats.COUNTERS['mjpeg_parts_built'], 2)
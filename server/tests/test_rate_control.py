@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+
+import io
+
+from PIL import Image
+
+from app.main import stats
+from app.main.rate_control import AdaptiveRate, AdaptiveQuality, reencode
+from tests.base import BaseTestCase
+
+
+class TestAdaptiveRate(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_serves_every_tick_when_fast(self):
+        rate = AdaptiveRate(10, 1)
+        for _ in range(20):
+            self.assertFalse(rate.record(0.001))
+        self.assertEqual(rate.get_fps(), 10)
+        self.assertTrue(all(rate.should_serve(tick) for tick in range(10)))
+
+    def test_halves_on_congestion(self):
+        rate = AdaptiveRate(10, 1)
+        self.assertTrue(rate.record(0.08))
+        self.assertEqual(rate.get_fps(), 5)
+        self.assertEqual([tick for tick in range(6) if rate.should_serve(tick)], [0, 2, 4])
+
+        rate.record(0.5)
+        self.assertEqual(rate.interval, 4)
+        self.assertEqual(stats.COUNTERS['mjpeg_rate_decreases'], 2)
+
+    def test_min_fps(self):
+        rate = AdaptiveRate(10, 2)
+        for _ in range(10):
+            rate.record(5)
+        self.assertEqual(rate.interval, 5)
+        self.assertEqual(rate.get_fps(), 2)
+
+    def test_increases_additively_with_headroom(self):
+        rate = AdaptiveRate(10, 1)
+        rate.record(0.5)
+        rate.record(0.5)
+        self.assertEqual(rate.interval, 4)
+
+        # Once the average flush time leaves headroom, and after about a second (3 frames at 2.5 FPS) of fast
+        # flushes, one tick less per frame.
+        changed = [rate.record(0.001) for _ in range(6)]
+        self.assertEqual(changed, [False] * 5 + [True])
+        self.assertEqual(rate.interval, 3)
+        self.assertEqual(stats.COUNTERS['mjpeg_rate_increases'], 1)
+
+
+class TestAdaptiveQuality(BaseTestCase):
+
+    LADDER = [(0, 0), (0, 60), (320, 50)]
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+    def test_keeps_original_when_fast(self):
+        quality = AdaptiveQuality(self.LADDER, 10)
+        for _ in range(20):
+            self.assertFalse(quality.record(10000, 0.001))
+        self.assertEqual(quality.get_rung(), (None, None))
+
+    def test_steps_down_on_congestion(self):
+        quality = AdaptiveQuality(self.LADDER, 10)
+        # 10 KB in 200 ms: sending a frame takes more than half of the 100 ms period.
+        self.assertTrue(quality.record(10000, 0.2))
+        self.assertEqual(quality.get_rung(), (None, 60))
+        self.assertTrue(quality.record(5000, 0.1))
+        self.assertEqual(quality.get_rung(), (320, 50))
+        self.assertTrue(quality.is_lowest())
+
+        # There is no lower rung.
+        self.assertFalse(quality.record(2000, 1))
+        self.assertEqual(stats.COUNTERS['mjpeg_quality_decreases'], 2)
+        self.assertGreater(quality.get_throughput(), 0)
+
+    def test_steps_up_with_headroom(self):
+        quality = AdaptiveQuality(self.LADDER, 10)
+        quality.record(10000, 0.2)
+        quality.record(5000, 0.1)
+        self.assertEqual(quality.level, 2)
+
+        # Once the previous size of the higher rung could be sent well within the period, and after about a second
+        # (10 frames at 10 FPS) of such frames, one rung up.
+        changed = [quality.record(2000, 0.0001) for _ in range(20)]
+        self.assertEqual(changed.count(True), 1)
+        self.assertLess(changed.index(True), 15)
+        self.assertGreaterEqual(changed.index(True), 9)
+        self.assertEqual(quality.level, 1)
+        self.assertEqual(stats.COUNTERS['mjpeg_quality_increases'], 1)
+
+    def test_reencode(self):
+        img = Image.effect_noise((640, 480), 64).convert('RGB')
+        out = io.BytesIO()
+        img.save(out, 'jpeg', quality=95)
+        frame = out.getvalue()
+
+        lower = reencode(frame, quality=40)
+        self.assertLess(len(lower), len(frame))
+        self.assertEqual(Image.open(io.BytesIO(lower)).size, (640, 480))
+
+        smaller = reencode(frame, 320, 40)
+        self.assertLess(len(smaller), len(lower))
+        self.assertEqual(Image.open(io.BytesIO(smaller)).size, (320, 240))
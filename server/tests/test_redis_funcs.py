@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+
+import redis
+
+from app import rdb
+from app.main import activity, frame_cache, stats
+from app.main.redis_funcs import fetch_frame
+from tests.base import BaseTestCase
+
+
+class TestFetchFrame(BaseTestCase):
+    """
+    The fetch_frame Lua script needs a real redis server (mockredis does not run Lua), so these tests are skipped
+    when none is reachable at REDIS_URL.
+    """
+
+    def setUp(self):
+        super().setUp()
+        try:
+            rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+
+        stats.reset()
+
+        # The frame cache is tested on its own.
+        self.addCleanup(self.app.config.__setitem__, 'FRAME_CACHE_MAX_BYTES', self.app.config['FRAME_CACHE_MAX_BYTES'])
+        self.app.config['FRAME_CACHE_MAX_BYTES'] = 0
+        frame_cache.reset()
+        self.addCleanup(frame_cache.reset)
+        activity.reset()
+        self.addCleanup(activity.reset)
+
+        self.prefix = self.app.config['REDIS_PREFIX']
+        self.cam_key = self.prefix + ':cams:fetchtest'
+        self.keys = [self.cam_key + suffix for suffix in (':lastframe', ':frameseq', ':error', ':active',
+                                                          ':active:mjpeg')]
+        self.keys.append(self.prefix + ':feeder:alive')
+        rdb.delete(*self.keys)
+        self.addCleanup(rdb.delete, *self.keys)
+
+    def test_marks_active(self):
+        fetch_frame('fetchtest')
+        self.assertGreater(rdb.ttl(self.cam_key + ':active'), 0)
+
+        fetch_frame('fetchtest', 'mjpeg')
+        self.assertGreater(rdb.ttl(self.cam_key + ':active:mjpeg'), 0)
+
+    def test_no_frame(self):
+        fetched = fetch_frame('fetchtest')
+        self.assertIsNone(fetched.frame)
+        self.assertFalse(fetched.alive)
+        self.assertFalse(fetched.error)
+
+        rdb.set(self.prefix + ':feeder:alive', 1)
+        rdb.set(self.cam_key + ':error', 'Timeout')
+        fetched = fetch_frame('fetchtest')
+        self.assertTrue(fetched.alive)
+        self.assertTrue(fetched.error)
+
+    def test_since_seq(self):
+        rdb.set(self.cam_key + ':lastframe', b'frame1')
+        rdb.set(self.cam_key + ':frameseq', 1)
+
+        fetched = fetch_frame('fetchtest')
+        self.assertEqual(fetched.frame, b'frame1')
+        self.assertEqual(fetched.seq, b'1')
+        self.assertFalse(fetched.unchanged)
+
+        # The same frame is not transferred again.
+        fetched = fetch_frame('fetchtest', since_seq=fetched.seq)
+        self.assertIsNone(fetched.frame)
+        self.assertTrue(fetched.unchanged)
+
+        rdb.set(self.cam_key + ':lastframe', b'frame2')
+        rdb.set(self.cam_key + ':frameseq', 2)
+        fetched = fetch_frame('fetchtest', since_seq=b'1')
+        self.assertEqual(fetched.frame, b'frame2')
+
+        # A single round trip per fetch.
+        self.assertEqual(stats.COUNTERS['redis_round_trips'], 3)
+
+    def test_frames_without_seq(self):
+        # Frames stored by feeders that do not number them are always returned.
+        rdb.set(self.cam_key + ':lastframe', b'frame1')
+        fetched = fetch_frame('fetchtest', since_seq=b'1')
+        self.assertEqual(fetched.frame, b'frame1')
+        self.assertIsNone(fetched.seq)
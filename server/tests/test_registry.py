@@ -0,0 +1,158 @@
+from __future__ import unicode_literals
+
+import time
+from unittest.mock import patch
+
+import gevent
+import redis
+
+from app import rdb
+from app.main import stats
+from app.main.redis_funcs import ChannelListener
+from app.main.registry import BroadcasterRegistry
+from tests.base import BaseTestCase
+
+
+class FakeBroadcaster(object):
+
+    def __init__(self, stubborn=False):
+        self.stubborn = stubborn  # Ignores stop(), like the broadcasters that leaked.
+        self.should_stop = False
+        self.last_activity = time.time()
+        self.exited = False
+
+    def stop(self):
+        self.should_stop = True
+
+    def get_last_activity(self):
+        return self.last_activity
+
+    def run(self):
+        try:
+            while self.stubborn or not self.should_stop:
+                gevent.sleep(0.01)
+        finally:
+            self.exited = True
+
+
+class TestBroadcasterRegistry(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+        self.registry = BroadcasterRegistry(idle_timeout=60, reap_interval=1000, stop_grace=0.05)
+        self.addCleanup(self.registry.stop_all)
+
+        # Every client is connected unless the test says otherwise.
+        self.connected_patcher = patch('app.main.registry.socketio')
+        self.socketio_mock = self.connected_patcher.start()
+        self.addCleanup(self.connected_patcher.stop)
+        self.socketio_mock.server.manager.is_connected.return_value = True
+
+    def test_stop_client(self):
+        a, b, other = FakeBroadcaster(), FakeBroadcaster(), FakeBroadcaster()
+        self.registry.start(('sid1', 'archimedes', 'mjpeg'), '/cams', a)
+        self.registry.start(('sid1', 'euclid', 'h264'), '/cams', b)
+        self.registry.start(('sid2', 'archimedes', 'mjpeg'), '/cams', other)
+        gevent.sleep(0.02)
+        self.assertEqual(stats.GAUGES['broadcasters_live'], 3)
+
+        self.assertEqual(self.registry.stop_client('sid1'), 2)
+        gevent.sleep(0.05)
+        self.assertTrue(a.exited and b.exited)
+        self.assertFalse(other.exited)
+        self.assertEqual(stats.GAUGES['broadcasters_live'], 1)
+        self.assertEqual(stats.GAUGES['broadcasters_stopping'], 0)
+
+    def test_start_replaces(self):
+        first, second = FakeBroadcaster(), FakeBroadcaster()
+        self.registry.start(('sid1', 'archimedes', 'mjpeg'), '/cams', first)
+        self.registry.start(('sid1', 'archimedes', 'mjpeg'), '/cams', second)
+        gevent.sleep(0.05)
+        self.assertTrue(first.exited)
+        self.assertIs(self.registry.get(('sid1', 'archimedes', 'mjpeg')), second)
+
+    def test_leaked_greenlet_killed(self):
+        stubborn = FakeBroadcaster(stubborn=True)
+        self.registry.start(('sid1', 'archimedes', 'mjpeg'), '/cams', stubborn)
+        gevent.sleep(0.02)
+        self.registry.stop(('sid1', 'archimedes', 'mjpeg'))
+        self.assertEqual(self.registry.get_stopping_count(), 1)
+
+        # Still within the grace period.
+        self.registry.reap()
+        gevent.sleep(0.02)
+        self.assertFalse(stubborn.exited)
+
+        gevent.sleep(0.05)
+        self.registry.reap()
+        gevent.sleep(0.02)
+        self.assertTrue(stubborn.exited)
+        self.assertEqual(self.registry.get_stopping_count(), 0)
+        self.assertEqual(stats.COUNTERS['broadcasters_leaked'], 1)
+
+    def test_reap_disconnected_and_idle(self):
+        gone, idle, fine = FakeBroadcaster(), FakeBroadcaster(), FakeBroadcaster()
+        self.registry.start(('gone', 'archimedes', 'mjpeg'), '/cams', gone)
+        self.registry.start(('sid1', 'archimedes', 'h264'), '/h264', idle)
+        self.registry.start(('sid1', 'archimedes', 'mjpeg'), '/cams', fine)
+        self.socketio_mock.server.manager.is_connected.side_effect = lambda sid, namespace: sid != 'gone'
+        idle.last_activity -= 120
+
+        self.registry.reap()
+        gevent.sleep(0.05)
+        self.assertTrue(gone.exited and idle.exited)
+        self.assertFalse(fine.exited)
+        self.assertEqual(self.registry.keys(), [('sid1', 'archimedes', 'mjpeg')])
+        self.assertEqual(stats.COUNTERS['broadcasters_reaped_disconnected'], 1)
+        self.assertEqual(stats.COUNTERS['broadcasters_reaped_idle'], 1)
+
+    def test_exited_on_its_own(self):
+        broadcaster = FakeBroadcaster()
+        self.registry.start(('sid1', 'archimedes', 'mjpeg'), '/cams', broadcaster)
+        broadcaster.should_stop = True  # As if it had failed.
+        gevent.sleep(0.05)
+        self.assertEqual(self.registry.get_live_count(), 0)
+        self.assertEqual(stats.COUNTERS['broadcasters_exited'], 1)
+
+
+class TestChannelListener(BaseTestCase):
+    """
+    Needs a real redis server (for pubsub), so these tests are skipped when none is reachable at REDIS_URL.
+    """
+
+    def setUp(self):
+        super().setUp()
+        try:
+            rdb.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis server not available')
+        stats.reset()
+
+    def _subscribers(self):
+        return dict(rdb.pubsub_numsub('listenertest/h264'))[b'listenertest/h264']
+
+    def test_messages_and_release(self):
+        received = []
+        stop = [False]
+
+        def listen():
+            with ChannelListener(['listenertest/h264'], poll_interval=0.05) as listener:
+                for data in listener.messages(lambda: stop[0]):
+                    received.append(data)
+
+        greenlet = gevent.spawn(listen)
+        gevent.sleep(0.1)
+        self.assertEqual(self._subscribers(), 1)
+        self.assertEqual(stats.GAUGES['redis_pubsubs'], 1)
+
+        rdb.publish('listenertest/h264', b'nal')
+        gevent.sleep(0.1)
+        self.assertEqual(received, [b'nal'])
+
+        # Stops within the poll interval even though nothing else is published, and unsubscribes.
+        stop[0] = True
+        greenlet.join(timeout=0.5)
+        self.assertTrue(greenlet.dead)
+        self.assertEqual(self._subscribers(), 0)
+        self.assertEqual(stats.GAUGES['redis_pubsubs'], 0)
@@ -0,0 +1,158 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from app.main import stats
+from app.main.SocketIOH264RedisBroadcaster import SocketIOH264RedisBroadcaster
+from app.main.h264_nal import NALSplitter, nal_type, starts_access_unit, NAL_IDR, NAL_SPS, NAL_PPS
+from tests.base import BaseTestCase
+
+SPS = b'\x00\x00\x00\x01\x67' + b'S' * 10
+PPS = b'\x00\x00\x00\x01\x68' + b'P' * 4
+IDR = b'\x00\x00\x00\x01\x65' + b'I' * 1000
+SLICE = b'\x00\x00\x00\x01\x41' + b'p' * 100
+
+# Slices whose first_mb_in_slice is 0 (first slice of a picture) or not.
+IDR_FIRST = b'\x00\x00\x00\x01\x65\x88' + b'I' * 1000
+P_FIRST = b'\x00\x00\x00\x01\x41\x9a' + b'p' * 100
+P_SECOND = b'\x00\x00\x00\x01\x41\x40' + b'q' * 100
+
+
+class TestNALSplitter(BaseTestCase):
+
+    def test_split_across_chunks(self):
+        splitter = NALSplitter()
+        stream = SPS + PPS + IDR + SLICE
+        nals = splitter.feed(stream[:7])
+        nals += splitter.feed(stream[7:500])
+        nals += splitter.feed(stream[500:])
+
+        # The last NAL is only complete once the next start code arrives.
+        self.assertEqual(nals, [SPS, PPS, IDR])
+        self.assertEqual(splitter.feed(b'\x00\x00\x00\x01'), [SLICE])
+
+    def test_joined_mid_nal(self):
+        splitter = NALSplitter()
+        # The tail of an IDR slice, without its start code, would look like a whole IDR NAL unit.
+        self.assertEqual(splitter.feed(IDR[4:] + SPS + PPS), [SPS])
+        self.assertEqual(splitter.feed(IDR), [PPS])
+
+    def test_peek(self):
+        splitter = NALSplitter()
+        self.assertEqual(splitter.feed(SPS[:-2]), [])
+        # The data before the first start code is not the beginning of a NAL unit.
+        self.assertEqual(splitter.feed(SPS[-2:] + P_FIRST[:5]), [SPS])
+        self.assertIsNone(splitter.peek())
+        splitter.feed(P_FIRST[5:7])
+        self.assertEqual(splitter.peek(), P_FIRST[:6])
+
+    def test_starts_access_unit(self):
+        for nal in (SPS, PPS, IDR_FIRST, P_FIRST, b'\x00\x00\x00\x01\x06\x05', b'\x00\x00\x00\x01\x09\xf0'):
+            self.assertTrue(starts_access_unit(nal))
+        self.assertFalse(starts_access_unit(P_SECOND))
+        self.assertFalse(starts_access_unit(b'\x00\x00\x00\x01\x41'))
+
+    def test_nal_type(self):
+        self.assertEqual(nal_type(SPS), NAL_SPS)
+        self.assertEqual(nal_type(PPS), NAL_PPS)
+        self.assertEqual(nal_type(IDR), NAL_IDR)
+        self.assertIsNone(nal_type(b'\x00\x00\x00\x01'))
+
+
+class TestSocketIOH264RedisBroadcasterCatchUp(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+        self.emit_patcher = patch('app.main.SocketIOH264RedisBroadcaster.socketio')
+        self.socketio_mock = self.emit_patcher.start()
+        self.addCleanup(self.emit_patcher.stop)
+
+        self.app.config['H264_CLIENT_QUEUE_BUDGET'] = 1500
+        self.addCleanup(self.app.config.pop, 'H264_CLIENT_QUEUE_BUDGET')
+
+        self.broadcaster = SocketIOH264RedisBroadcaster('archimedes', 'sid1', ack=True)
+
+    def _emitted(self):
+        return [c[0][1] for c in self.socketio_mock.emit.call_args_list]
+
+    def _ack_all(self):
+        for c in self.socketio_mock.emit.call_args_list:
+            c[1]['callback']()
+        self.socketio_mock.emit.reset_mock()
+
+    def test_starts_at_keyframe(self):
+        self.broadcaster._forward(SLICE)
+        self.broadcaster._forward(SPS)
+        self.broadcaster._forward(PPS)
+        self.broadcaster._forward(IDR)
+        self.assertEqual(self._emitted(), [SPS, PPS, IDR])
+        self.assertEqual(self.broadcaster.get_resyncs(), 0)
+
+    def test_lagging_client_resumes_at_idr(self):
+        for nal in (SPS, PPS, IDR, SLICE, SLICE, SLICE, SLICE, SLICE, SLICE):
+            self.broadcaster._forward(nal)
+
+        # The budget was exceeded, so the remaining slices were not sent.
+        self.assertEqual(self.broadcaster.get_resyncs(), 1)
+        self.assertEqual(stats.COUNTERS['h264_resyncs'], 1)
+        self.assertGreater(stats.COUNTERS['h264_nals_dropped'], 0)
+
+        # Once the client catches up, it gets the parameter sets along with the next IDR.
+        self._ack_all()
+        self.broadcaster._forward(SLICE)
+        self.broadcaster._forward(IDR)
+        self.assertEqual(self._emitted(), [SPS, PPS, IDR])
+
+    def test_no_ack_mode_never_resyncs(self):
+        broadcaster = SocketIOH264RedisBroadcaster('archimedes', 'sid1')
+        for nal in (SPS, PPS, IDR) + (SLICE,) * 50:
+            broadcaster._forward(nal)
+        self.assertEqual(self.socketio_mock.emit.call_count, 53)
+        self.assertEqual(broadcaster.get_resyncs(), 0)
+
+
+class TestSocketIOH264RedisBroadcasterBatching(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+        self.emit_patcher = patch('app.main.SocketIOH264RedisBroadcaster.socketio')
+        self.socketio_mock = self.emit_patcher.start()
+        self.addCleanup(self.emit_patcher.stop)
+
+    def _emitted(self):
+        return [c[0][1] for c in self.socketio_mock.emit.call_args_list]
+
+    def test_access_unit_per_emit(self):
+        broadcaster = SocketIOH264RedisBroadcaster('archimedes', 'sid1', batch=True)
+        for nal in (SPS, PPS, IDR_FIRST, P_FIRST, P_SECOND, P_FIRST):
+            broadcaster._forward(nal)
+
+        # The last access unit is not complete yet.
+        self.assertEqual(self._emitted(), [SPS + PPS + IDR_FIRST, P_FIRST + P_SECOND])
+        self.assertEqual(stats.COUNTERS['h264_sio_emits'], 2)
+
+    def test_flushed_when_next_access_unit_starts(self):
+        broadcaster = SocketIOH264RedisBroadcaster('archimedes', 'sid1', ack=True, batch=True)
+        splitter = NALSplitter()
+        broadcaster._feed(splitter, SPS + PPS + IDR_FIRST + P_FIRST[:4])
+        self.assertEqual(self._emitted(), [])
+
+        # The beginning of the next picture completes the access unit, before the rest of it arrives.
+        broadcaster._feed(splitter, P_FIRST[4:6])
+        self.assertEqual(self._emitted(), [SPS + PPS + IDR_FIRST])
+
+        # The whole access unit is acked at once.
+        self.assertEqual(broadcaster._unacked_bytes, len(SPS + PPS + IDR_FIRST))
+        self.socketio_mock.emit.call_args[1]['callback']()
+        self.assertEqual(broadcaster._unacked_bytes, 0)
+
+    def test_starts_at_keyframe(self):
+        broadcaster = SocketIOH264RedisBroadcaster('archimedes', 'sid1', batch=True)
+        for nal in (P_FIRST, P_SECOND, IDR_FIRST, P_FIRST):
+            broadcaster._forward(nal)
+        self.assertEqual(self._emitted(), [IDR_FIRST])
+        self.assertEqual(stats.COUNTERS['h264_nals_dropped'], 2)
@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+from app.main import stats
+from app.main.SocketIOMJPEGBroadcaster import SocketIOMJPEGBroadcaster
+from tests.base import BaseTestCase
+
+
+class TestSocketIOMJPEGBroadcasterFlowControl(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+
+        self.emit_patcher = patch('app.main.SocketIOMJPEGBroadcaster.socketio')
+        self.socketio_mock = self.emit_patcher.start()
+        self.addCleanup(self.emit_patcher.stop)
+
+        self.broadcaster = SocketIOMJPEGBroadcaster('archimedes', 'sid1', 5, ack=True)
+
+    def _last_callback(self):
+        return self.socketio_mock.emit.call_args[1]['callback']
+
+    def test_no_ack_mode_always_emits(self):
+        broadcaster = SocketIOMJPEGBroadcaster('archimedes', 'sid1', 5)
+        broadcaster._offer(b'1')
+        broadcaster._offer(b'2')
+        self.assertEqual(self.socketio_mock.emit.call_count, 2)
+        self.assertNotIn('callback', self.socketio_mock.emit.call_args[1])
+        self.assertEqual(broadcaster.get_queue_depth(), 0)
+
+    def test_single_frame_in_flight(self):
+        self.broadcaster._offer(b'1')
+        self.broadcaster._offer(b'2')
+        self.assertEqual(self.socketio_mock.emit.call_count, 1)
+        self.assertEqual(self.broadcaster.get_queue_depth(), 2)
+        self.assertEqual(stats.GAUGES['mjpeg_sio_queue_depth'], 2)
+
+    def test_latest_frame_wins(self):
+        self.broadcaster._offer(b'1')
+        self.broadcaster._offer(b'2')
+        self.broadcaster._offer(b'3')
+        self.assertEqual(self.broadcaster.get_frames_dropped(), 1)
+        self.assertEqual(stats.COUNTERS['mjpeg_sio_frames_dropped'], 1)
+
+        # Once the client acks, the newest frame is sent immediately.
+        self._last_callback()()
+        self.assertEqual(self.socketio_mock.emit.call_count, 2)
+        self.assertEqual(self.socketio_mock.emit.call_args[0][1], b'3')
+        self.assertEqual(self.broadcaster.get_queue_depth(), 1)
+
+        self._last_callback()()
+        self.assertEqual(self.broadcaster.get_queue_depth(), 0)
+        self.assertEqual(stats.GAUGES['mjpeg_sio_queue_depth'], 0)
+
+    def test_fps_adapts_to_ack_rtt(self):
+        with patch('app.main.SocketIOMJPEGBroadcaster.time.time', return_value=100):
+            self.broadcaster._offer(b'1')
+        with patch('app.main.SocketIOMJPEGBroadcaster.time.time', return_value=101):
+            self._last_callback()()
+        self.assertAlmostEqual(self.broadcaster.get_effective_fps(), 1.0)
+
+    def test_lost_ack_does_not_stall(self):
+        with patch('app.main.SocketIOMJPEGBroadcaster.time.time', return_value=100):
+            self.broadcaster._offer(b'1')
+        with patch('app.main.SocketIOMJPEGBroadcaster.time.time', return_value=100 + SocketIOMJPEGBroadcaster.ACK_TIMEOUT + 1):
+            self.broadcaster._offer(b'2')
+        self.assertEqual(self.socketio_mock.emit.call_count, 2)
+        self.assertEqual(stats.COUNTERS['mjpeg_sio_ack_timeouts'], 1)
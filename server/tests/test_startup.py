@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+import app as app_package
+from app.main import assets
+from tests.base import BaseTestCase
+
+
+class TestStartup(BaseTestCase):
+
+    def test_page_extensions_disabled(self):
+        self.assertFalse(self.app.config['PAGE_EXTENSIONS'])
+        self.assertNotIn('bootstrap', self.app.blueprints)
+        self.assertNotIn('mail', self.app.extensions)
+
+    def test_page_extensions_enabled(self):
+        app = app_package.create_app('testing')
+        app_package._init_page_extensions(app)
+        self.assertIn('bootstrap', app.blueprints)
+        self.assertIn('mail', app.extensions)
+        self.assertIsNotNone(app_package.moment)
+
+    def test_warm_up(self):
+        assets.reset()
+        app_package.warm_up(self.app)
+        self.assertIn(assets.NOT_AVAILABLE_FILE, assets._assets)
@@ -0,0 +1,119 @@
+from __future__ import unicode_literals
+
+from unittest.mock import patch
+
+import gevent
+
+from app.main import stats, ticker
+from app.main.redis_funcs import FetchedFrame
+from app.main.ticker import Ticker, get_ticker
+from tests.base import BaseTestCase
+
+
+class TestTicker(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        stats.reset()
+        ticker.TICKERS.clear()
+
+        self.fetch_patcher = patch('app.main.ticker.fetch_frame')
+        self.fetch_mock = self.fetch_patcher.start()
+        self.addCleanup(self.fetch_patcher.stop)
+        self.fetch_mock.return_value = FetchedFrame(b'1', True, False, b'frame1', False)
+
+    def test_shared_per_tier(self):
+        self.assertIs(get_ticker(10), get_ticker(10))
+        self.assertIsNot(get_ticker(10), get_ticker(5))
+
+    def test_wakes_all_clients_together(self):
+        t = get_ticker(50)
+        ticks = []
+
+        def client():
+            t.subscribe()
+            try:
+                for _ in range(3):
+                    ticks.append(t.wait())
+            finally:
+                t.unsubscribe()
+
+        gevent.joinall([gevent.spawn(client) for _ in range(4)], timeout=2)
+
+        # Every client saw the same three consecutive ticks.
+        self.assertEqual(len(ticks), 12)
+        self.assertEqual(len(set(ticks)), 3)
+        self.assertEqual(max(ticks) - min(ticks), 2)
+        self.assertEqual(stats.GAUGES['ticker_clients'], 0)
+        self.assertIn('ticker_jitter_ms:50', stats.GAUGES)
+
+    def test_stops_without_clients(self):
+        t = get_ticker(50)
+        t.subscribe()
+        t.wait()
+        t.unsubscribe()
+        gevent.sleep(0.1)
+        self.assertNotIn(50, ticker.TICKERS)
+        self.assertEqual(stats.GAUGES['ticker_timers'], 0)
+
+    def test_one_lookup_per_tick(self):
+        t = Ticker(10)
+        frames = [t.get_frame('cam1') for _ in range(5)]
+        self.assertEqual(self.fetch_mock.call_count, 1)
+        self.assertTrue(all(f.frame == b'frame1' for f in frames))
+        self.assertEqual(stats.COUNTERS['ticker_shared_lookups'], 4)
+
+        t.get_frame('cam2')
+        self.assertEqual(self.fetch_mock.call_count, 2)
+
+    def _get_frame(self, t, cam_name):
+        # Clients run in their own greenlets, within the app context as the streams do.
+        with self.app.app_context():
+            return t.get_frame(cam_name)
+
+    def test_concurrent_lookups_share_the_fetch(self):
+        t = Ticker(10)
+
+        def slow_fetch(*args, **kwargs):
+            gevent.sleep(0.05)
+            return FetchedFrame(b'1', True, False, b'frame1', False)
+        self.fetch_mock.side_effect = slow_fetch
+
+        jobs = [gevent.spawn(self._get_frame, t, 'cam1') for _ in range(3)]
+        gevent.joinall(jobs, timeout=1)
+        self.assertEqual(self.fetch_mock.call_count, 1)
+        self.assertTrue(all(job.value.frame == b'frame1' for job in jobs))
+
+    def test_lookup_survives_its_first_client(self):
+        t = Ticker(10)
+
+        def slow_fetch(*args, **kwargs):
+            gevent.sleep(0.05)
+            return FetchedFrame(b'1', True, False, b'frame1', False)
+        self.fetch_mock.side_effect = slow_fetch
+
+        # The client that started the lookup is killed (as the registry reaps them) while the fetch is going on, and
+        # another one times out. The rest still get the frame.
+        first = gevent.spawn(self._get_frame, t, 'cam1')
+        gevent.sleep(0)
+        timed_out = gevent.spawn(gevent.with_timeout, 0.01, self._get_frame, t, 'cam1', timeout_value='timeout')
+        others = [gevent.spawn(self._get_frame, t, 'cam1') for _ in range(2)]
+        gevent.sleep(0.02)
+        first.kill()
+
+        gevent.joinall(others, timeout=1)
+        self.assertEqual(self.fetch_mock.call_count, 1)
+        self.assertEqual(timed_out.value, 'timeout')
+        self.assertTrue(all(job.value is not None and job.value.frame == b'frame1' for job in others))
+
+    def test_unchanged_frame_is_resolved(self):
+        t = Ticker(10)
+        t.get_frame('cam1')
+
+        # Next tick: the frame did not change, so it is not transferred again but is still returned.
+        t._lookups = {}
+        self.fetch_mock.return_value = FetchedFrame(b'1', True, False, None, True)
+        fetched = t.get_frame('cam1')
+        self.assertEqual(self.fetch_mock.call_args[1]['since_seq'], b'1')
+        self.assertEqual(fetched.frame, b'frame1')
+        self.assertFalse(fetched.unchanged)
@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+from unittest.mock import patch, Mock
+
 from flask import Response
 
 from tests.base import BaseTestCase
@@ -50,3 +52,48 @@ class TestViewsExps(BaseTestCase):
 
         # Same for other important ones
         self.assertIn('socket.io', response.data.decode('utf-8'))
+
+    def test_ws_endpoints_require_websocket(self):
+        """
+        Ensure the plain WebSocket endpoints refuse normal HTTP requests.
+        :return:
+        """
+        response = self.client.get('/ws/cams/not_existing/mjpeg')  # type: Response
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/ws/cams/not_existing/h264')  # type: Response
+        self.assertEqual(response.status_code, 400)
+
+    def test_mjpeg_wrong_parameters(self):
+        for url in ('/ws/cams/not_existing/mjpeg?tfps=abc', '/cams/not_existing/mjpeg?tfps=abc'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('tfps', response.data.decode('utf-8'))
+
+        # Upgraded connections are closed instead, before they are admitted.
+        ws = Mock()
+        with patch('app.main.websockets.get_controller') as get_controller:
+            self.client.get('/ws/cams/not_existing/mjpeg?keepalive=abc', environ_base={'wsgi.websocket': ws})
+        ws.close.assert_called_once_with(1008, b'Wrong value: keepalive must be a float')
+        get_controller.assert_not_called()
+
+    def test_h264_js_ws_transport(self):
+        """
+        Ensure the exp can be switched to the plain WebSocket endpoint.
+        :return:
+        """
+        response = self.client.get('/exps/h264js/not_existing?transport=ws')  # type: Response
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/ws/cams/not_existing/h264', response.data.decode('utf-8'))
+
+    def test_fmp4_mse_links_script(self):
+        """
+        Ensure the exp links the right JavaScript even if the cam does not exist.
+        :return:
+        """
+        response = self.client.get('/exps/fmp4mse/not_existing')  # type: Response
+        self.assertEqual(response.status_code, 200)
+
+        # The MSE widget is included, and it connects to the plain WebSocket endpoint.
+        self.assertIn('fmp4_mse_camera.widget.js', response.data.decode('utf-8'))
+        self.assertIn('/ws/cams/not_existing/fmp4', response.data.decode('utf-8'))
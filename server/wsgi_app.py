@@ -12,8 +12,10 @@ if WILSASERVER_DIR == '':
 sys.path.insert(0, WILSASERVER_DIR)
 os.chdir(WILSASERVER_DIR)
 
-sys.stdout = open('stdout.txt', 'w', 100)
-sys.stderr = open('stderr.txt', 'w', 100)
+# Appended to, line buffered: the workers (or, if the app is preloaded, the master that forks them) and the restarts
+# share the files.
+sys.stdout = open('stdout.txt', 'a', 1)
+sys.stderr = open('stderr.txt', 'a', 1)
 
 
 application = create_app(os.environ.get("FLASK_CONFIG", 'production'))